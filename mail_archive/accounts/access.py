@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from datetime import datetime
 from django.core.exceptions import PermissionDenied
+from django.db.models import Q
 from .models import MailboxAccess, User
 
 
@@ -27,6 +28,27 @@ class AccessService:
             if email.mailbox_id not in allowed_mailboxes:
                 raise PermissionDenied("mailbox_forbidden")
 
+    @staticmethod
+    def mailbox_filter(user: User, field: str = "mailbox") -> Q:
+        """Filter for rows whose mailbox `field` the user may read: their department's or granted mailboxes."""
+        if user.has_permission("GLOBAL_MAILBOX_READ"):
+            return Q()
+        allowed = [access.mailbox_id for access in user.allowed_mailboxes()]
+        return Q(**{f"{field}__department_id": user.department_id}) | Q(**{f"{field}_id__in": allowed})
+
+    @staticmethod
+    def time_filter(user: User, field: str) -> Q:
+        """Filter for rows whose datetime `field` passes `ensure_time_scope`."""
+        if user.has_permission("TIME_UNBOUND"):
+            return Q()
+        scope = Q(pk__in=[])
+        for acc in user.allowed_mailboxes():
+            window = Q(**{f"{field}__gte": acc.time_start})
+            if acc.time_end is not None:
+                window &= Q(**{f"{field}__lte": acc.time_end})
+            scope |= window
+        return scope
+
     @staticmethod
     def ensure_time_scope(user: User, sent_at: datetime) -> None:
         if user.has_permission("TIME_UNBOUND"):
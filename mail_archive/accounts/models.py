@@ -89,11 +89,17 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     @property
     def role_codes(self):
+        principal = getattr(self, "_principal", None)
+        if principal is not None:
+            return principal.role_codes()
         return list(self.roles.values_list("name", flat=True))
 
     def has_permission(self, code: str) -> bool:
         if self.is_superuser:
             return True
+        principal = getattr(self, "_principal", None)
+        if principal is not None:
+            return principal.has_permission(code)
         return self.roles.filter(permissions__code=code).exists()
 
     def allowed_mailboxes(self):
@@ -0,0 +1,220 @@
+"""Cache of authenticated principals, so API requests skip the user and role lookups.
+
+An entry is keyed by the token's (sub, iat) and holds the user's columns, role
+names and permission codes. It lives in a per-process LRU and in Redis for the
+token's lifetime, and is stamped with two generation counters: one per user
+and one for role definitions. Every lookup reads both counters from Redis in a
+single round trip; signals bump them on commit whenever a user, their roles or
+a role's permissions change, so deactivation and revoked rights apply to the
+next request. Without Redis the principal is loaded from MySQL and not cached;
+bumps that fail then are replayed by the next lookup that reaches Redis.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from redis.exceptions import RedisError
+from core.lru import SizedLRU
+from core.redis import get_redis
+from .models import Permission, Role, User
+
+logger = logging.getLogger(__name__)
+
+USER_FIELDS = ("id", "username", "email", "department_id", "is_active", "is_staff", "is_superuser")
+GLOBAL_GENERATION_KEY = "principal:gen"
+STATS_KEY = "principal_cache:stats"
+
+_local = SizedLRU(settings.PRINCIPAL_CACHE["LOCAL_MAX_ENTRIES"], lambda entry: 1)
+
+
+def _user_generation_key(user_id) -> str:
+    return f"principal:gen:{user_id}"
+
+
+def _entry_key(user_id, issued_at) -> str:
+    return f"principal:{user_id}:{issued_at}"
+
+
+class _Stats:
+    """Counters kept in process and flushed to Redis alongside the next generation lookup."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict[str, int] = {}
+        self._flushed = time.monotonic()
+
+    def add(self, **counts: int) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                self._pending[name] = self._pending.get(name, 0) + value
+
+    def flush_into(self, pipe) -> None:
+        if time.monotonic() - self._flushed < settings.PRINCIPAL_CACHE["STATS_FLUSH_SECONDS"]:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.monotonic()
+        for name, value in pending.items():
+            pipe.hincrby(STATS_KEY, name, value)
+
+
+_stats = _Stats()
+
+
+class _Invalidations:
+    """Generation bumps that failed while Redis was unavailable, replayed with the next generation lookup."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: set[str] = set()
+
+    def bump(self, key: str) -> None:
+        try:
+            get_redis().incr(key)
+        except RedisError:
+            logger.error("principal cache invalidation %s deferred: Redis unavailable", key, exc_info=True)
+            self.restore([key])
+
+    def take(self) -> list[str]:
+        with self._lock:
+            pending, self._pending = sorted(self._pending), set()
+        return pending
+
+    def restore(self, keys) -> None:
+        with self._lock:
+            self._pending.update(keys)
+
+
+_invalidations = _Invalidations()
+
+
+class Principal:
+    """Role names and permission codes of a cached user; each answer replaces one query."""
+
+    __slots__ = ("roles", "permissions")
+
+    def __init__(self, roles, permissions):
+        self.roles = tuple(roles)
+        self.permissions = frozenset(permissions)
+
+    def role_codes(self) -> list[str]:
+        _stats.add(queries_saved=1)
+        return list(self.roles)
+
+    def has_permission(self, code: str) -> bool:
+        _stats.add(queries_saved=1)
+        return code in self.permissions
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _load_entry(user_id: int, stamp: list[int]) -> dict:
+    counter = _QueryCounter()
+    with connection.execute_wrapper(counter):
+        fields = User.objects.filter(id=user_id).values(*USER_FIELDS).first()
+        roles, permissions = [], []
+        if fields is not None and fields["is_active"]:
+            roles = list(Role.objects.filter(users__id=user_id).order_by("name").values_list("name", flat=True))
+            permissions = list(
+                Permission.objects.filter(roles__users__id=user_id).values_list("code", flat=True).distinct()
+            )
+    return {"stamp": stamp, "fields": fields, "roles": roles, "permissions": permissions, "queries": counter.count}
+
+
+def _materialize(entry: dict) -> User | None:
+    fields = entry["fields"]
+    if fields is None or not fields["is_active"]:
+        return None
+    # Columns outside USER_FIELDS stay deferred: they load on access and are skipped by save().
+    names = [f.attname for f in User._meta.concrete_fields if f.attname in fields]
+    user = User.from_db(connection.alias, names, [fields[name] for name in names])
+    user._principal = Principal(entry["roles"], entry["permissions"])
+    return user
+
+
+def _uncached_user(user_id) -> User | None:
+    return User.objects.filter(id=user_id, is_active=True).first()
+
+
+def authenticated_user(user_id, issued_at) -> User | None:
+    """Returns the active user for a verified token's `sub`/`iat`, or None."""
+    if not settings.PRINCIPAL_CACHE["ENABLED"]:
+        return _uncached_user(user_id)
+    redis = get_redis()
+    replayed = _invalidations.take()
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for generation_key in replayed:
+            pipe.incr(generation_key)
+        pipe.mget(GLOBAL_GENERATION_KEY, _user_generation_key(user_id))
+        _stats.flush_into(pipe)
+        generations = pipe.execute()[len(replayed)]
+    except RedisError:
+        _invalidations.restore(replayed)
+        logger.warning("principal cache unavailable; loading user %s from the database", user_id, exc_info=True)
+        _stats.add(requests=1, bypassed=1)
+        return _uncached_user(user_id)
+    stamp = [int(value or 0) for value in generations]
+    key = (str(user_id), int(issued_at))
+    entry = _local.get(key)
+    if entry is not None and entry["stamp"] == stamp:
+        _stats.add(requests=1, local_hits=1, queries_saved=entry["queries"])
+        return _materialize(entry)
+    try:
+        raw = redis.get(_entry_key(*key))
+    except RedisError:
+        logger.warning("principal cache entry of user %s unreadable", user_id, exc_info=True)
+        raw = None
+    entry = json.loads(raw) if raw else None
+    if entry is not None and entry["stamp"] == stamp:
+        _stats.add(requests=1, redis_hits=1, queries_saved=entry["queries"])
+    else:
+        entry = _load_entry(int(user_id), stamp)
+        ttl = settings.JWT_SETTINGS["EXP_MINUTES"] * 60
+        try:
+            redis.set(_entry_key(*key), json.dumps(entry, separators=(",", ":")), ex=ttl)
+        except RedisError:
+            logger.warning("principal cache entry of user %s not stored", user_id, exc_info=True)
+        _stats.add(requests=1, misses=1, queries_spent=entry["queries"])
+    _local.set(key, entry)
+    return _materialize(entry)
+
+
+def invalidate_user(user_id) -> None:
+    """Drops every cached principal of one user once the current transaction commits.
+
+    Signals call this for model saves; code that changes users with
+    `QuerySet.update()` must call it itself.
+    """
+    transaction.on_commit(lambda: _invalidations.bump(_user_generation_key(user_id)))
+
+
+def invalidate_all() -> None:
+    """Drops every cached principal; used when role definitions or role permissions change."""
+    transaction.on_commit(lambda: _invalidations.bump(GLOBAL_GENERATION_KEY))
+
+
+def stats() -> dict:
+    raw = get_redis().hgetall(STATS_KEY)
+    counters = {k.decode(): int(v) for k, v in raw.items()}
+    requests = counters.get("requests", 0)
+    hits = counters.get("local_hits", 0) + counters.get("redis_hits", 0)
+    return {
+        "enabled": settings.PRINCIPAL_CACHE["ENABLED"],
+        "hit_ratio": round(hits / requests, 4) if requests else None,
+        "queries_saved_per_request": round(counters.get("queries_saved", 0) / requests, 2) if requests else None,
+        "local": _local.stats(),
+        **counters,
+    }
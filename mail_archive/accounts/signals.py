@@ -0,0 +1,41 @@
+"""Invalidates cached principals when users, their roles or role permissions change."""
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from .models import Permission, Role, RolePermission, User, UserRole
+from .principal import invalidate_all, invalidate_user
+
+
+@receiver([post_save, post_delete], sender=User)
+def _user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.id)
+
+
+@receiver([post_save, post_delete], sender=UserRole)
+def _user_role_changed(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver(m2m_changed, sender=UserRole)
+def _user_roles_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        invalidate_user(instance.id)
+    elif pk_set:
+        for user_id in pk_set:
+            invalidate_user(user_id)
+    else:
+        invalidate_all()
+
+
+@receiver([post_save, post_delete], sender=Role)
+@receiver([post_save, post_delete], sender=Permission)
+@receiver([post_save, post_delete], sender=RolePermission)
+def _role_definition_changed(sender, **kwargs):
+    invalidate_all()
+
+
+@receiver(m2m_changed, sender=RolePermission)
+def _role_permissions_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        invalidate_all()
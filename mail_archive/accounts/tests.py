@@ -1,3 +1,104 @@
-from django.test import TestCase
+import datetime as dt
+import os
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from redis.exceptions import ConnectionError as RedisConnectionError
+from core import revocation
+from core.authentication import generate_jwt
+from core.testing import BackendsMixin
+from . import principal
+from .models import Department, Permission, Role, RolePermission, User, UserRole
+
+
+@override_settings(PRINCIPAL_CACHE={**settings.PRINCIPAL_CACHE, "ENABLED": True})
+class PrincipalCacheTests(BackendsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        principal._local.clear()
+        principal._invalidations.take()
+        department = Department.objects.create(name="Legal", path="/legal")
+        self.user = User.objects.create(username="reviewer", email="reviewer@example.com", department=department)
+        self.role = Role.objects.create(name="reviewer", description="")
+        self.permission = Permission.objects.create(code="EMAIL_VIEW", description="")
+        UserRole.objects.create(user=self.user, role=self.role)
+
+    def grant(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            RolePermission.objects.create(role=self.role, permission=self.permission)
+
+    def test_cached_principal_follows_permission_changes(self):
+        self.assertFalse(principal.authenticated_user(self.user.id, 1).has_permission("EMAIL_VIEW"))
+        with self.assertNumQueries(0):
+            principal.authenticated_user(self.user.id, 1)
+        self.grant()
+        self.assertTrue(principal.authenticated_user(self.user.id, 1).has_permission("EMAIL_VIEW"))
+
+    def test_unreadable_entry_loads_from_database(self):
+        with mock.patch.object(self.redis, "get", side_effect=RedisConnectionError("down")):
+            user = principal.authenticated_user(self.user.id, 1)
+        self.assertEqual(user.id, self.user.id)
+
+    def test_unstored_entry_still_authenticates(self):
+        with mock.patch.object(self.redis, "set", side_effect=RedisConnectionError("down")):
+            user = principal.authenticated_user(self.user.id, 1)
+        self.assertEqual(user.id, self.user.id)
+        self.assertIsNone(self.redis.get(principal._entry_key(self.user.id, 1)))
+
+    def test_generation_lookup_failure_bypasses_cache(self):
+        with mock.patch.object(self.redis, "pipeline", side_effect=RedisConnectionError("down")):
+            self.assertEqual(principal.authenticated_user(self.user.id, 1).id, self.user.id)
+
+    def test_failed_invalidation_is_replayed(self):
+        principal.authenticated_user(self.user.id, 1)
+        with mock.patch.object(self.redis, "incr", side_effect=RedisConnectionError("down")):
+            self.grant()
+        self.assertEqual(principal._invalidations.take(), ["principal:gen"])
+        principal._invalidations.restore(["principal:gen"])
+
+        self.assertTrue(principal.authenticated_user(self.user.id, 1).has_permission("EMAIL_VIEW"))
+        self.assertEqual(principal._invalidations.take(), [])
+
+
+class TokenRevocationTests(BackendsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # A mirror without its subscriber thread: unloaded, it checks every token against this test's Redis.
+        for name, value in (("_mirror", revocation.RevocationMirror()), ("_mirror_pid", os.getpid())):
+            patcher = mock.patch.object(revocation, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        department = Department.objects.create(name="Legal", path="/legal")
+        self.user = User.objects.create(username="reviewer", email="reviewer@example.com", department=department)
+        self.admin = User.objects.create(
+            username="admin", email="admin@example.com", department=department, is_superuser=True
+        )
+
+    def post(self, path: str, token: str):
+        return self.client.post(path, HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_logout_revokes_only_that_token(self):
+        token, other = generate_jwt(self.user), generate_jwt(self.user)
+        self.assertEqual(self.post("/api/v1/auth/logout/", token).status_code, 204)
+
+        response = self.post("/api/v1/auth/logout/", token)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()["detail"], "token_revoked")
+        self.assertEqual(self.post("/api/v1/auth/logout/", other).status_code, 204)
+
+    def test_admin_revokes_every_token_of_a_user(self):
+        token = generate_jwt(self.user)
+        admin_token = generate_jwt(self.admin, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+        response = self.post(f"/api/v1/auth/users/{self.user.id}/revoke-tokens/", admin_token)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.post("/api/v1/auth/logout/", token).json()["detail"], "token_revoked")
+        self.assertEqual(self.post("/api/v1/auth/logout/", admin_token).status_code, 204)
+
+    def test_revocation_check_fails_closed_without_redis(self):
+        token = generate_jwt(self.user)
+        with mock.patch.object(self.redis, "pipeline", side_effect=RedisConnectionError("down")):
+            response = self.post("/api/v1/auth/logout/", token)
+        self.assertEqual(response.json()["detail"], "revocation_unavailable")
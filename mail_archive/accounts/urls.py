@@ -1,9 +1,20 @@
 from django.urls import path
-from .views import CurrentUserView, LoginView, MfaEnrollView, MfaVerifyView
+from .views import (
+    CurrentUserView,
+    LoginView,
+    LogoutView,
+    MfaEnrollView,
+    MfaVerifyView,
+    PrincipalCacheStatsView,
+    UserTokenRevokeView,
+)
 
 urlpatterns = [
     path("login/", LoginView.as_view(), name="login"),
+    path("logout/", LogoutView.as_view(), name="logout"),
     path("me/", CurrentUserView.as_view(), name="me"),
     path("mfa/enroll/", MfaEnrollView.as_view(), name="mfa-enroll"),
     path("mfa/verify/", MfaVerifyView.as_view(), name="mfa-verify"),
+    path("users/<int:user_id>/revoke-tokens/", UserTokenRevokeView.as_view(), name="user-revoke-tokens"),
+    path("principal-cache/stats/", PrincipalCacheStatsView.as_view(), name="principal-cache-stats"),
 ]
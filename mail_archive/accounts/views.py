@@ -2,14 +2,19 @@ from rest_framework import status
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from django.shortcuts import get_object_or_404
 from core.authentication import generate_jwt
+from core.permissions import RBACPermission
+from core.revocation import revoke_token, revoke_user_tokens
 from audit.services import AuditService
 from .serializers import LoginSerializer, MfaEnrollSerializer, MfaVerifySerializer
 from .models import User
+from .principal import stats as principal_cache_stats
 
 
 class LoginView(APIView):
     permission_classes = [AllowAny]
+    rate_limit_scope = "LOGIN"
 
     def post(self, request):
         serializer = LoginSerializer(data=request.data)
@@ -21,6 +26,32 @@ class LoginView(APIView):
         return Response(data, status=http_status)
 
 
+class LogoutView(APIView):
+    def post(self, request):
+        payload = request.auth or {}
+        if payload.get("jti"):
+            revoke_token(payload["jti"], payload["exp"])
+        else:
+            # Tokens issued before token IDs existed can only be revoked all at once.
+            revoke_user_tokens(request.user.id)
+        AuditService.append(request.user, "LOGOUT", {})
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UserTokenRevokeView(APIView):
+    """Revokes every token issued to a user so far, e.g. for a compromised account."""
+
+    permission_classes = [RBACPermission]
+    required_permission = "USER_ADMIN"
+    require_mfa = True
+
+    def post(self, request, user_id: int):
+        user = get_object_or_404(User, id=user_id)
+        cutoff = revoke_user_tokens(user.id)
+        AuditService.append(request.user, "TOKENS_REVOKE", {"user_id": user.id}, target_id=str(user.id))
+        return Response({"user_id": user.id, "revoked_before": cutoff})
+
+
 class MfaEnrollView(APIView):
     def post(self, request):
         serializer = MfaEnrollSerializer(context={"request": request})
@@ -49,3 +80,11 @@ class CurrentUserView(APIView):
                 "mfa_enrolled": hasattr(request.user, "mfa_secret"),
             }
         )
+
+
+class PrincipalCacheStatsView(APIView):
+    permission_classes = [RBACPermission]
+    required_permission = "OPS_METRICS"
+
+    def get(self, request):
+        return Response(principal_cache_stats())
@@ -1,7 +1,16 @@
 from django.contrib import admin
-from .models import ArchivedEmail, EmailAttachment, EmailParticipant, ExportJob
+from .models import ArchivedEmail, EmailAttachment, EmailParticipant, ExportJob, IntegrityCheck, IntegritySweep
 
 admin.site.register(ArchivedEmail)
 admin.site.register(EmailAttachment)
 admin.site.register(EmailParticipant)
 admin.site.register(ExportJob)
+
+
+@admin.register(IntegrityCheck)
+class IntegrityCheckAdmin(admin.ModelAdmin):
+    list_display = ("kind", "object_id", "ok", "last_verified_at", "error")
+    list_filter = ("kind", "ok")
+
+
+admin.site.register(IntegritySweep)
@@ -0,0 +1,77 @@
+"""Per-department zstd compression of stored EML objects.
+
+`ArchivedEmail.sha256` and `size_bytes` always describe the original message;
+`codec`, `compression_dictionary` and `stored_size_bytes` describe the object
+in S3. Dictionaries are immutable once created, so decoded dictionaries are
+cached per process for good.
+"""
+from __future__ import annotations
+
+import threading
+import time
+
+from django.conf import settings
+from core import compression
+from .models import ArchivedEmail, CompressionDictionary
+
+_dictionaries: dict[int, object] = {}
+_active: dict[int, tuple[float, CompressionDictionary | None]] = {}
+_lock = threading.Lock()
+
+
+def _dictionary(dictionary_id: int):
+    loaded = _dictionaries.get(dictionary_id)
+    if loaded is None:
+        data = CompressionDictionary.objects.values_list("data", flat=True).get(id=dictionary_id)
+        loaded = compression.load_dictionary(bytes(data))
+        with _lock:
+            _dictionaries[dictionary_id] = loaded
+    return loaded
+
+
+def active_dictionary(department_id: int) -> CompressionDictionary | None:
+    now = time.monotonic()
+    cached = _active.get(department_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    dictionary = (
+        CompressionDictionary.objects.filter(department_id=department_id, active=True)
+        .defer("data")
+        .order_by("-created_at")
+        .first()
+    )
+    with _lock:
+        _active[department_id] = (now + settings.COMPRESSION["DICTIONARY_REFRESH_SECONDS"], dictionary)
+    return dictionary
+
+
+def encode(raw_bytes: bytes, department_id: int) -> tuple[bytes, dict]:
+    """Returns (bytes to store, ArchivedEmail storage fields)."""
+    cfg = settings.COMPRESSION
+    fields = {"codec": compression.CODEC_IDENTITY, "compression_dictionary_id": None, "stored_size_bytes": len(raw_bytes)}
+    if not cfg["ENABLED"] or len(raw_bytes) < cfg["MIN_BYTES"]:
+        return raw_bytes, fields
+    dictionary = active_dictionary(department_id)
+    stored = compression.compress(
+        raw_bytes, level=cfg["LEVEL"], dictionary=_dictionary(dictionary.id) if dictionary else None
+    )
+    if len(stored) >= len(raw_bytes):
+        return raw_bytes, fields
+    fields.update(
+        codec=compression.CODEC_ZSTD,
+        compression_dictionary_id=dictionary.id if dictionary else None,
+        stored_size_bytes=len(stored),
+    )
+    return stored, fields
+
+
+def decoder(codec: str, dictionary_id: int | None):
+    """Returns a chunk-stream transform that yields the original bytes, or None for identity."""
+    if codec == compression.CODEC_IDENTITY:
+        return None
+    dictionary = _dictionary(dictionary_id) if dictionary_id else None
+    return lambda chunks: compression.decompress_stream(chunks, dictionary)
+
+
+def email_decoder(email: ArchivedEmail):
+    return decoder(email.codec, email.compression_dictionary_id)
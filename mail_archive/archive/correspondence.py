@@ -0,0 +1,159 @@
+"""Normalized participant addresses and monthly correspondence counts.
+
+Every address is stored once in `Address` and referenced by
+`EmailParticipant.address_ref`, so the mail of an address, or between two
+addresses, is found through the (address_ref, email) index.
+
+`CorrespondenceCount` holds, per mailbox and month, how many messages each
+address sent to and received from each counterpart: every FROM address is
+paired with every TO/CC/BCC address of a message. `store_participants` adds
+the counts in the transaction that stores the emails, so they are exact and
+never need a batch recomputation; they also keep covering months whose
+metadata has moved to the cold tier, where participant rows no longer exist.
+`rebuild` recomputes one mailbox from scratch, for data archived before the
+counts existed.
+"""
+from __future__ import annotations
+
+import datetime as dt
+from collections import defaultdict
+
+from django.db import connection, transaction
+from core.partitioning import month_start
+from .models import Address, ArchivedEmail, ColdPartition, CorrespondenceCount, EmailParticipant
+from .tiering import ColdStore
+
+RECIPIENT_TYPES = ("TO", "CC", "BCC")
+UPSERT_BATCH = 500
+
+
+def normalize(address: str) -> str:
+    return address.strip().lower()
+
+
+def address_ids(addresses) -> dict[str, int]:
+    """Ids of the normalized `addresses`, creating the ones not seen before."""
+    wanted = {normalize(address) for address in addresses}
+    if not wanted:
+        return {}
+    found = dict(Address.objects.filter(address__in=wanted).values_list("address", "id"))
+    if missing := wanted - found.keys():
+        # A concurrent ingest may create the same address; either insert wins.
+        Address.objects.bulk_create([Address(address=address) for address in sorted(missing)], ignore_conflicts=True)
+        found.update(Address.objects.filter(address__in=missing).values_list("address", "id"))
+    return found
+
+
+def pairs(participants) -> set[tuple[str, str]]:
+    """(sender, recipient) pairs of a message's participants, as normalized addresses."""
+    senders = {normalize(p["address"]) for p in participants if p["type"] == "FROM"}
+    recipients = {normalize(p["address"]) for p in participants if p["type"] in RECIPIENT_TYPES}
+    return {(sender, recipient) for sender in senders for recipient in recipients if sender != recipient}
+
+
+def _month(received_at: dt.datetime) -> dt.date:
+    return month_start(received_at.astimezone(dt.timezone.utc).date())
+
+
+def _tally(messages) -> dict[tuple, list[int]]:
+    """(mailbox id, month, address, counterpart) -> [sent, received] for (mailbox id, received_at, participants)."""
+    counts: dict[tuple, list[int]] = defaultdict(lambda: [0, 0])
+    for mailbox_id, received_at, participants in messages:
+        month = _month(received_at)
+        for sender, recipient in pairs(participants):
+            counts[(mailbox_id, month, sender, recipient)][0] += 1
+            counts[(mailbox_id, month, recipient, sender)][1] += 1
+    return counts
+
+
+def _add_counts(counts: dict[tuple, list[int]]) -> None:
+    if not counts:
+        return
+    ids = address_ids({key[2] for key in counts} | {key[3] for key in counts})
+    # Rows in unique key order, so concurrent ingests lock them in the same order.
+    rows = sorted(
+        (ids[address], ids[counterpart], month, mailbox_id, sent, received)
+        for (mailbox_id, month, address, counterpart), (sent, received) in counts.items()
+    )
+    table = CorrespondenceCount._meta.db_table
+    if connection.vendor == "mysql":
+        conflict = "ON DUPLICATE KEY UPDATE sent = sent + VALUES(sent), received = received + VALUES(received)"
+    else:
+        conflict = (
+            "ON CONFLICT (address_id, counterpart_id, month, mailbox_id) DO UPDATE SET "
+            f"sent = {table}.sent + excluded.sent, received = {table}.received + excluded.received"
+        )
+    with connection.cursor() as cursor:
+        for i in range(0, len(rows), UPSERT_BATCH):
+            batch = rows[i : i + UPSERT_BATCH]
+            cursor.execute(
+                f"INSERT INTO {table} (address_id, counterpart_id, month, mailbox_id, sent, received) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(batch))} {conflict}",
+                [value for row in batch for value in row],
+            )
+
+
+def store_participants(items, *, batch_size: int | None = None) -> None:
+    """Inserts the participant rows of newly stored emails and adds them to the correspondence counts.
+
+    `items` are (email, participants) with participants as in the ingest payload.
+    Call it in the transaction that inserts the emails.
+    """
+    items = list(items)
+    ids = address_ids(p["address"] for _, participants in items for p in participants)
+    EmailParticipant.objects.bulk_create(
+        [
+            EmailParticipant(
+                email=email, type=p["type"], address=p["address"], address_ref_id=ids[normalize(p["address"])]
+            )
+            for email, participants in items
+            for p in participants
+        ],
+        ignore_conflicts=True,
+        batch_size=batch_size,
+    )
+    _add_counts(_tally((email.mailbox_id, email.received_at, participants) for email, participants in items))
+
+
+def _hot_messages(mailbox_id: int, batch_size: int):
+    last_id = 0
+    while True:
+        emails = list(
+            ArchivedEmail.objects.filter(mailbox_id=mailbox_id, id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "received_at")[:batch_size]
+        )
+        if not emails:
+            return
+        participants = defaultdict(list)
+        for email_id, kind, address in EmailParticipant.objects.filter(
+            email_id__in=[email_id for email_id, _ in emails]
+        ).values_list("email_id", "type", "address"):
+            participants[email_id].append({"type": kind, "address": address})
+        for email_id, received_at in emails:
+            yield mailbox_id, received_at, participants[email_id]
+        last_id = emails[-1][0]
+
+
+def _cold_messages(mailbox_id: int):
+    cold = ColdStore()
+    for partition in ColdPartition.objects.filter(mailbox_id=mailbox_id).order_by("month"):
+        for row in cold.rows(partition, ["received_at", "participants"]):
+            yield mailbox_id, row["received_at"], row["participants"] or []
+
+
+def rebuild(mailbox_id: int, batch_size: int = 1000) -> int:
+    """Recomputes the counts of one mailbox from both tiers; returns the number of count rows.
+
+    Messages stored while it runs may be counted twice or not at all, so run it
+    while the mailbox receives no mail (e.g. right after the migration).
+    """
+    hot = _tally(_hot_messages(mailbox_id, batch_size))
+    cold = _tally(_cold_messages(mailbox_id))
+    for key, (sent, received) in cold.items():
+        hot[key][0] += sent
+        hot[key][1] += received
+    with transaction.atomic():
+        CorrespondenceCount.objects.filter(mailbox_id=mailbox_id).delete()
+        _add_counts(hot)
+    return len(hot)
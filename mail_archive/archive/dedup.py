@@ -0,0 +1,161 @@
+"""Duplicate detection for retried deliveries, run before any payload byte is decoded.
+
+A Redis Bloom filter of stored `mailbox_id:message_id` keys answers "new" for
+most messages without touching MySQL; possible hits are confirmed against the
+(mailbox, message_id) unique key in MessageKey. Until the filter has been rebuilt
+(`manage.py rebuild_dedup_filter`, also run by beat) every message is confirmed
+against MySQL. A key that could not be added drops the "warm" flag (replayed by the
+next lookup if Redis is down), and the flag expires after `WARM_TTL_SECONDS`, so a
+missed key never lets its duplicate skip the confirmation for long.
+
+Redis is an accelerator here, never a dependency: when it fails, lookups go to
+MySQL and claims are skipped, leaving concurrent deliveries to the unique key.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+
+from django.conf import settings
+from redis.exceptions import RedisError
+from core.bloom import RedisBloomFilter, bloom_positions
+from core.redis import get_redis
+from .models import ArchivedEmail, MessageKey
+from .tiering import get_email_by_message_id
+
+logger = logging.getLogger(__name__)
+
+# Set when this process failed to add a key and could not drop the warm flag either.
+_missed_keys = threading.Event()
+
+
+def dedup_key(mailbox_id: int, message_id: str) -> str:
+    return f"{mailbox_id}:{message_id}"
+
+
+class DuplicateGuard:
+    def __init__(self):
+        self.cfg = settings.DEDUP_SETTINGS
+        self.redis = get_redis()
+        self.prefix = self.cfg["KEY_PREFIX"]
+        self.bloom = RedisBloomFilter(
+            self.redis,
+            f"{self.prefix}:bloom",
+            capacity=self.cfg["BLOOM_CAPACITY"],
+            error_rate=self.cfg["BLOOM_ERROR_RATE"],
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.cfg["ENABLED"]
+
+    def is_warm(self) -> bool:
+        return bool(self.redis.exists(f"{self.prefix}:warm"))
+
+    def existing(self, mailbox_id: int, message_id: str) -> ArchivedEmail | None:
+        if self.enabled:
+            cool = _missed_keys.is_set()
+            pipe = self.redis.pipeline(transaction=False)
+            if cool:
+                pipe.delete(f"{self.prefix}:warm")
+            pipe.exists(f"{self.prefix}:warm")
+            for position in bloom_positions(dedup_key(mailbox_id, message_id), self.bloom.size, self.bloom.hashes):
+                pipe.getbit(self.bloom.key, position)
+            try:
+                warm, *bits = pipe.execute()[int(cool) :]
+            except RedisError:
+                logger.warning("dedup filter unavailable; confirming %s in the database", message_id, exc_info=True)
+            else:
+                if cool:
+                    _missed_keys.clear()
+                if warm and not all(bits):
+                    return None
+        email = get_email_by_message_id(mailbox_id, message_id)
+        if email is not None:
+            self._count("duplicates")
+        return email
+
+    def claim(self, mailbox_id: int, message_id: str) -> bool:
+        """Serializes concurrent deliveries of the same message; False if another one is in flight."""
+        if not self.enabled:
+            return True
+        try:
+            return bool(
+                self.redis.set(
+                    f"{self.prefix}:claim:{dedup_key(mailbox_id, message_id)}",
+                    1,
+                    nx=True,
+                    ex=self.cfg["CLAIM_TTL_SECONDS"],
+                )
+            )
+        except RedisError:
+            # The (mailbox, message_id) unique key still keeps one row; the loser's
+            # upload is recorded as an orphan.
+            logger.warning("dedup claim of %s skipped: Redis unavailable", message_id, exc_info=True)
+            return True
+
+    def release(self, mailbox_id: int, message_id: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            self.redis.delete(f"{self.prefix}:claim:{dedup_key(mailbox_id, message_id)}")
+        except RedisError:
+            logger.warning("dedup claim of %s left to expire: Redis unavailable", message_id, exc_info=True)
+
+    def remember(self, mailbox_id: int, message_id: str) -> None:
+        self.remember_many(mailbox_id, [message_id])
+
+    def remember_many(self, mailbox_id: int, message_ids) -> None:
+        if not self.enabled:
+            return
+        try:
+            self.bloom.add_many(dedup_key(mailbox_id, message_id) for message_id in message_ids)
+        except RedisError:
+            logger.error("dedup filter missed keys of mailbox %s: Redis unavailable", mailbox_id, exc_info=True)
+            self._cool()
+
+    def _cool(self) -> None:
+        """Stops trusting the filter once it has missed a key; the next rebuild warms it again."""
+        try:
+            self.redis.delete(f"{self.prefix}:warm")
+        except RedisError:
+            logger.error("dedup filter stays warm until the next lookup reaches Redis", exc_info=True)
+            _missed_keys.set()
+
+    def _count(self, name: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            self.redis.incr(f"{self.prefix}:{name}")
+        except RedisError:
+            logger.warning("dedup counter %s not incremented: Redis unavailable", name, exc_info=True)
+
+    def record_orphan(self, key: str, reason: str = "metadata insert lost a duplicate race") -> None:
+        logger.error("orphaned locked object %s: %s", key, reason)
+        self._count("orphaned_blobs")
+
+    def rebuild(self, batch_size: int = 10000) -> int:
+        self.redis.delete(f"{self.prefix}:warm", self.bloom.key)
+        count = 0
+        batch = []
+        for mailbox_id, message_id in MessageKey.objects.values_list("mailbox_id", "message_id").iterator(
+            chunk_size=batch_size
+        ):
+            batch.append(dedup_key(mailbox_id, message_id))
+            if len(batch) >= batch_size:
+                self.bloom.add_many(batch)
+                count += len(batch)
+                batch = []
+        self.bloom.add_many(batch)
+        count += len(batch)
+        self.redis.set(f"{self.prefix}:warm", 1, ex=self.cfg["WARM_TTL_SECONDS"])
+        return count
+
+    def stats(self) -> dict:
+        duplicates, orphaned = self.redis.mget(f"{self.prefix}:duplicates", f"{self.prefix}:orphaned_blobs")
+        return {
+            "enabled": self.enabled,
+            "filter_warm": self.is_warm(),
+            "duplicates_rejected": int(duplicates or 0),
+            "orphaned_blobs": int(orphaned or 0),
+        }
@@ -0,0 +1,311 @@
+"""Bulk backfill of mbox files and Maildir trees (`manage.py import_mailstore`).
+
+Sources are cut into fixed chunks. Worker processes parse, hash and upload a
+chunk's blobs (packing small messages into one segment per chunk when segment
+storage is enabled); the parent bulk-inserts the metadata, marks the chunk DONE
+in the `ImportChunk` ledger in the same transaction and bulk-indexes ES.
+"""
+from __future__ import annotations
+
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from elasticsearch import helpers
+from accounts.models import Mailbox
+from core.hash_utils import sha256_bytes
+from core.search import get_client
+from core.storage import S3Storage
+from audit.services import AuditService
+from .compression import encode
+from .correspondence import store_participants
+from .dedup import DuplicateGuard
+from .mime import build_payload
+from .models import ArchivedEmail, EmailAttachment, ImportChunk, MessageKey
+from .segments import SegmentWriter, packable, record_header, seal
+from .services import ATTACHMENT_PREFIX, attachment_object_key, email_object_key, search_document
+from .threads import link as link_threads, retry_on_deadlock
+
+_MBOXRD_FROM = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+
+@dataclass
+class Chunk:
+    source: str
+    index: int
+    kind: str  # "mbox" (byte spans) or "maildir" (file paths)
+    size: int  # the planned chunk size; the last chunk may hold fewer items
+    items: list = field(default_factory=list)
+    resumed: bool = False
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the chunk's items; a ledger row only stands for the chunk it was written for."""
+        digest = hashlib.sha256()
+        for item in self.items:
+            digest.update(f"{item}\n".encode())
+        return digest.hexdigest()
+
+
+def detect_kind(path: Path) -> str:
+    if path.is_dir():
+        return "maildir"
+    return "mbox"
+
+
+def _mbox_spans(path: Path) -> list[tuple[int, int]]:
+    spans = []
+    start = None
+    offset = 0
+    with path.open("rb") as f:
+        for line in f:
+            if line.startswith(b"From "):
+                if start is not None:
+                    spans.append((start, offset))
+                start = offset
+            offset += len(line)
+    if start is not None:
+        spans.append((start, offset))
+    return spans
+
+
+def _maildir_files(path: Path) -> list[str]:
+    files = []
+    for sub in ("cur", "new"):
+        for folder in sorted([path, *[p for p in path.iterdir() if p.is_dir() and p.name.startswith(".")]]):
+            target = folder / sub
+            if target.is_dir():
+                files.extend(str(p) for p in target.iterdir() if p.is_file())
+    return sorted(files)
+
+
+def plan_chunks(path: Path, chunk_size: int) -> list[Chunk]:
+    kind = detect_kind(path)
+    items = _maildir_files(path) if kind == "maildir" else _mbox_spans(path)
+    source = str(path.resolve())
+    return [
+        Chunk(source=source, index=i // chunk_size, kind=kind, size=chunk_size, items=items[i : i + chunk_size])
+        for i in range(0, len(items), chunk_size)
+    ]
+
+
+def _iter_raw(chunk: Chunk):
+    if chunk.kind == "maildir":
+        for name in chunk.items:
+            yield Path(name).read_bytes()
+        return
+    with open(chunk.source, "rb") as f:
+        for start, end in chunk.items:
+            f.seek(start)
+            data = f.read(end - start)
+            _, _, body = data.partition(b"\n")  # drop the From_ separator line
+            yield _MBOXRD_FROM.sub(rb"\1", body.rstrip(b"\r\n") + b"\n")
+
+
+def iter_messages(path: Path):
+    """Yields every raw message of an mbox file or Maildir tree."""
+    for chunk in plan_chunks(path, 1000):
+        yield from _iter_raw(chunk)
+
+
+_storage = None
+
+
+def _get_storage() -> S3Storage:
+    global _storage
+    if _storage is None:
+        _storage = S3Storage()
+    return _storage
+
+
+def prepare_chunk(chunk: Chunk, mailbox_id: int, upload_concurrency: int, retain_days: int | None) -> list[dict]:
+    """Runs in a worker process: parses, hashes and uploads one chunk; returns metadata records."""
+    mailbox = Mailbox.objects.select_related("department").get(id=mailbox_id)
+    records = {}
+    for raw in _iter_raw(chunk):
+        payload = build_payload(raw, mailbox=mailbox)
+        if payload["message_id"] in records:
+            continue
+        attachments = []
+        uploads = []
+        for attachment in payload["attachments"]:
+            content = attachment["content_bytes"]
+            att_sha = sha256_bytes(content)
+            att_key = attachment_object_key(att_sha)
+            uploads.append((att_key, content))
+            attachments.append(
+                {
+                    "filename": attachment["filename"][:255],
+                    "mime_type": attachment["mime_type"][:128],
+                    "size_bytes": len(content),
+                    "sha256": att_sha,
+                    "s3_object_key": att_key,
+                }
+            )
+        key = email_object_key(payload["received_at"], payload["message_id"])
+        stored, storage_fields = encode(raw, mailbox.department_id)
+        records[payload["message_id"]] = {
+            "message_id": payload["message_id"],
+            "subject": payload["subject"],
+            "sent_at": payload["sent_at"],
+            "received_at": payload["received_at"],
+            "sha256": sha256_bytes(raw),
+            "s3_object_key": key,
+            "size_bytes": len(raw),
+            **storage_fields,
+            "has_html": bool(payload["body_html"]),
+            "has_text": bool(payload["body_text"]),
+            "body_text": payload["body_text"],
+            "body_html": payload["body_html"],
+            "participants": payload["participants"],
+            "references": payload["references"],
+            "attachments": attachments,
+            "uploads": uploads,
+            "stored": stored,
+        }
+    existing = set(
+        MessageKey.objects.filter(mailbox_id=mailbox_id, message_id__in=list(records)).values_list(
+            "message_id", flat=True
+        )
+    )
+    pending = [r for mid, r in records.items() if mid not in existing]
+    storage = _get_storage()
+
+    def upload(item):
+        key, data = item
+        # Object Lock keeps every version forever, so never write a second one: attachments
+        # are shared by content across messages and imports, and a resumed chunk may
+        # already have uploaded its EML objects.
+        if (chunk.resumed or key.startswith(ATTACHMENT_PREFIX)) and storage.exists(key):
+            return
+        storage.put_object(key, data, retain_days=retain_days)
+
+    uploads = {}
+    segment_members = []
+    for record in pending:
+        uploads.update(record.pop("uploads"))
+        stored = record.pop("stored")
+        if packable(stored):
+            header = record_header(
+                message_id=record["message_id"], mailbox_id=mailbox_id, sha256=record["sha256"], storage_fields=record
+            )
+            segment_members.append((record["message_id"], header, stored, retain_days))
+        else:
+            uploads[record["s3_object_key"]] = stored
+    for record in records.values():
+        record.pop("uploads", None)
+        record.pop("stored", None)
+    with ThreadPoolExecutor(max_workers=upload_concurrency) as pool:
+        list(pool.map(upload, uploads.items()))
+    if segment_members:
+        # A resumed chunk writes a new segment; the earlier one is settled as abandoned.
+        placements = SegmentWriter(storage).write(segment_members)
+        for record in pending:
+            placement = placements.get(record["message_id"])
+            if isinstance(placement, Exception):
+                raise placement
+            if placement is not None:
+                record.update(placement)
+    return pending
+
+
+def _store_chunk(chunk: Chunk, records: list[dict], mailbox: Mailbox) -> tuple[list[dict], dict, dict]:
+    """Inserts the chunk's new messages and marks it DONE; returns those records, their emails and thread ids."""
+    with transaction.atomic():
+        message_ids = [r["message_id"] for r in records]
+        existing = set(
+            MessageKey.objects.filter(mailbox=mailbox, message_id__in=message_ids).values_list("message_id", flat=True)
+        )
+        records = [r for r in records if r["message_id"] not in existing]
+        ArchivedEmail.objects.bulk_create(
+            [
+                ArchivedEmail(
+                    message_id=r["message_id"],
+                    mailbox=mailbox,
+                    department=mailbox.department,
+                    subject=r["subject"],
+                    sent_at=r["sent_at"],
+                    received_at=r["received_at"],
+                    sha256=r["sha256"],
+                    s3_object_key=r["s3_object_key"],
+                    size_bytes=r["size_bytes"],
+                    has_html=r["has_html"],
+                    has_text=r["has_text"],
+                    codec=r["codec"],
+                    compression_dictionary_id=r["compression_dictionary_id"],
+                    stored_size_bytes=r["stored_size_bytes"],
+                    segment_id=r.get("segment_id"),
+                    segment_offset=r.get("segment_offset"),
+                    segment_length=r.get("segment_length"),
+                )
+                for r in records
+            ],
+            batch_size=500,
+        )
+        emails = {}
+        if records:
+            received = [r["received_at"] for r in records]
+            emails = {
+                e.message_id: e
+                for e in ArchivedEmail.objects.select_related("mailbox", "department").filter(
+                    mailbox=mailbox,
+                    message_id__in=[r["message_id"] for r in records],
+                    # Confines the lookup to the partitions the chunk was written to.
+                    received_at__range=(min(received), max(received)),
+                )
+            }
+        threads = link_threads((r["message_id"], r["references"]) for r in records)
+        # A concurrent import of the same messages fails here and rolls the chunk back.
+        MessageKey.objects.bulk_create(
+            [MessageKey.for_email(e, threads[e.message_id]) for e in emails.values()], batch_size=1000
+        )
+        store_participants(((emails[r["message_id"]], r["participants"]) for r in records), batch_size=1000)
+        attachments = []
+        for r in records:
+            attachments.extend(EmailAttachment(email=emails[r["message_id"]], **a) for a in r["attachments"])
+        EmailAttachment.objects.bulk_create(attachments, batch_size=1000)
+        seal(r.get("segment_id") for r in records)
+        ImportChunk.objects.update_or_create(
+            source=chunk.source,
+            mailbox=mailbox,
+            chunk_index=chunk.index,
+            defaults={
+                "status": "DONE",
+                "chunk_size": chunk.size,
+                "fingerprint": chunk.fingerprint,
+                "message_count": len(chunk.items),
+                "imported_count": len(records),
+            },
+        )
+    return records, emails, threads
+
+
+def commit_chunk(chunk: Chunk, records: list[dict], *, mailbox: Mailbox, actor) -> int:
+    """Inserts a prepared chunk and marks it DONE atomically; then bulk-indexes ES."""
+    records, emails, threads = retry_on_deadlock(lambda: _store_chunk(chunk, records, mailbox))
+    DuplicateGuard().remember_many(mailbox.id, [r["message_id"] for r in records])
+    if records:
+        index = settings.ELASTICSEARCH["INDEX"]
+        helpers.bulk(
+            get_client(),
+            (
+                {
+                    "_index": index,
+                    "_id": emails[r["message_id"]].id,
+                    "_source": search_document(emails[r["message_id"]], r, threads[r["message_id"]]),
+                }
+                for r in records
+            ),
+            chunk_size=500,
+        )
+    AuditService.append(
+        actor,
+        "ARCHIVE_IMPORT",
+        {"source": chunk.source, "chunk": chunk.index, "mailbox": mailbox.address},
+        result_count=len(records),
+    )
+    return len(records)
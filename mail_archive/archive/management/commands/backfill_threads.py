@@ -0,0 +1,70 @@
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from elasticsearch import helpers
+from core.search import get_client
+from archive.mime import HEADER_END, header_references
+from archive.models import MessageKey
+from archive.services import EmailAccessService
+from archive.threads import link
+from archive.tiering import resolve_keys
+
+logger = logging.getLogger(__name__)
+
+# A header block larger than this is cut off; the references are near the top anyway.
+MAX_HEADER_BYTES = 1024 * 1024
+
+
+def _header_block(access: EmailAccessService, email) -> bytes:
+    data = b""
+    for chunk in access.iter_content(email, chunk_size=64 * 1024):
+        data += chunk
+        if HEADER_END.search(data) or len(data) >= MAX_HEADER_BYTES:
+            break
+    return data
+
+
+class Command(BaseCommand):
+    help = "Threads mail archived before threading by reading the In-Reply-To/References headers of stored messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        access = EmailAccessService()
+        index = settings.ELASTICSEARCH["INDEX"]
+        total = 0
+        while True:
+            keys = list(MessageKey.objects.filter(thread__isnull=True).order_by("id")[: options["batch_size"]])
+            if not keys:
+                break
+            emails = resolve_keys([(key.email_id, key.mailbox_id, key.received_at) for key in keys])
+            messages = []
+            for key in keys:
+                references = []
+                if email := emails.get(key.email_id):
+                    try:
+                        references = header_references(_header_block(access, email))
+                    except Exception as exc:
+                        # Unreadable objects surface through the integrity checks; the message is threaded alone.
+                        logger.error("cannot read headers of email %s: %r", key.email_id, exc)
+                messages.append((key.message_id, references))
+            with transaction.atomic():
+                threads = link(messages)
+                for key in keys:
+                    key.thread_id = threads[key.message_id]
+                MessageKey.objects.bulk_update(keys, ["thread"])
+            helpers.bulk(
+                get_client(),
+                (
+                    {"_op_type": "update", "_index": index, "_id": key.email_id, "doc": {"thread_id": key.thread_id}}
+                    for key in keys
+                ),
+                chunk_size=500,
+                raise_on_error=False,
+            )
+            total += len(keys)
+            self.stdout.write(f"threaded {total} messages")
+        self.stdout.write(self.style.SUCCESS(f"threaded {total} messages"))
@@ -0,0 +1,72 @@
+import random
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import Department
+from archive.compression import active_dictionary
+from archive.importer import iter_messages
+from archive.models import ArchivedEmail, CompressionDictionary
+from archive.services import EmailAccessService
+from core import compression
+
+
+class Command(BaseCommand):
+    help = "Reports zstd compression ratio and throughput, with and without dictionaries, on a sample corpus."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="*", help="mbox files or Maildir directories to sample")
+        parser.add_argument("--department", help="sample archived messages of this department path instead")
+        parser.add_argument("--samples", type=int, default=2000)
+        parser.add_argument("--levels", default="3,6,19", help="comma-separated zstd levels")
+        parser.add_argument("--train-fraction", type=float, default=0.5, help="share of samples used for training")
+
+    def _corpus(self, options) -> list[bytes]:
+        if options["department"]:
+            emails = ArchivedEmail.objects.filter(department__path=options["department"]).order_by("-received_at")
+            access = EmailAccessService()
+            return [access.read(email) for email in emails[: options["samples"]]]
+        corpus = []
+        for raw_path in options["paths"]:
+            for raw in iter_messages(Path(raw_path)):
+                corpus.append(raw)
+                if len(corpus) >= options["samples"]:
+                    return corpus
+        return corpus
+
+    def handle(self, *args, **options):
+        if not options["paths"] and not options["department"]:
+            raise CommandError("give mbox/Maildir paths or --department")
+        corpus = self._corpus(options)
+        if len(corpus) < 20:
+            raise CommandError(f"need at least 20 messages, found {len(corpus)}")
+        random.Random(0).shuffle(corpus)
+        split = int(len(corpus) * options["train_fraction"])
+        train, test = corpus[:split], corpus[split:]
+        dictionaries = {"none": None}
+        dictionaries["trained"] = compression.train_dictionary(train, settings.COMPRESSION["DICTIONARY_SIZE"])
+        if options["department"]:
+            department = Department.objects.filter(path=options["department"]).first()
+            current = active_dictionary(department.id) if department else None
+            if current is not None:
+                data = CompressionDictionary.objects.values_list("data", flat=True).get(id=current.id)
+                dictionaries[f"active#{current.id}"] = compression.load_dictionary(bytes(data))
+        original = sum(len(m) for m in test)
+        self.stdout.write(f"{len(test)} test messages, {original / 1024 / 1024:.1f} MiB, {len(train)} used for training")
+        self.stdout.write(f"{'dictionary':<14}{'level':>6}{'ratio':>9}{'comp MB/s':>12}{'decomp MB/s':>13}")
+        for level in (int(v) for v in options["levels"].split(",")):
+            for name, dictionary in dictionaries.items():
+                start = time.perf_counter()
+                frames = [compression.compress(m, level=level, dictionary=dictionary) for m in test]
+                compress_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                for frame in frames:
+                    for _ in compression.decompress_stream([frame], dictionary):
+                        pass
+                decompress_seconds = time.perf_counter() - start
+                stored = sum(len(f) for f in frames)
+                self.stdout.write(
+                    f"{name:<14}{level:>6}{original / stored:>9.2f}"
+                    f"{original / compress_seconds / 1e6:>12.1f}{original / decompress_seconds / 1e6:>13.1f}"
+                )
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core import partitioning
+
+
+def _mb(size: int) -> str:
+    return f"{size / 1024**2:.1f}"
+
+
+class Command(BaseCommand):
+    help = "Pre-creates monthly partitions of the email and audit tables and reports partition sizes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=settings.PARTITIONING["MONTHS_AHEAD"],
+            help="create partitions up to this many months after the current one",
+        )
+        parser.add_argument("--report-only", action="store_true", help="only print the partition report")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "mysql":
+            raise CommandError("partitioning is only supported on MySQL")
+        if not options["report_only"]:
+            for table in partitioning.PARTITIONED_TABLES:
+                created = partitioning.ensure_future_partitions(connection, table, options["months_ahead"])
+                if created:
+                    self.stdout.write(self.style.SUCCESS(f"{table}: created {', '.join(created)}"))
+        rows = [("table", "partition", "less than", "rows", "data MB", "index MB")]
+        for p in partitioning.partitions(connection):
+            less_than = p.less_than.isoformat() if p.less_than else "MAXVALUE"
+            rows.append((p.table, p.name, less_than, str(p.rows), _mb(p.data_bytes), _mb(p.index_bytes)))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            self.stdout.write("  ".join(value.ljust(width) for value, width in zip(row, widths)))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import Mailbox
+from archive.correspondence import rebuild
+
+
+class Command(BaseCommand):
+    help = "Recomputes the monthly correspondence counts of every (or one) mailbox from both storage tiers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mailbox", help="address of the only mailbox to rebuild")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        mailboxes = Mailbox.objects.order_by("id")
+        if options["mailbox"]:
+            mailboxes = mailboxes.filter(address=options["mailbox"])
+            if not mailboxes.exists():
+                raise CommandError(f"unknown mailbox {options['mailbox']}")
+        for mailbox in mailboxes:
+            rows = rebuild(mailbox.id, batch_size=options["batch_size"])
+            self.stdout.write(self.style.SUCCESS(f"{mailbox.address}: {rows} count rows"))
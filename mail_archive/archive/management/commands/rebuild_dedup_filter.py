@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from archive.dedup import DuplicateGuard
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the ingest duplicate Bloom filter from ArchivedEmail and marks it warm."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        count = DuplicateGuard().rebuild(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"loaded {count} keys"))
@@ -0,0 +1,16 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from archive.smtp import serve
+
+
+class Command(BaseCommand):
+    help = "Runs the asyncio SMTP journaling receiver that archives messages directly."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default=settings.SMTP_JOURNAL["HOST"])
+        parser.add_argument("--port", type=int, default=settings.SMTP_JOURNAL["PORT"])
+
+    def handle(self, *args, **options):
+        asyncio.run(serve(options["host"], options["port"]))
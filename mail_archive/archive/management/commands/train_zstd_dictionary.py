@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from accounts.models import Department
+from archive.models import ArchivedEmail, CompressionDictionary
+from archive.services import EmailAccessService
+from core import compression
+
+
+class Command(BaseCommand):
+    help = "Trains a zstd dictionary from a department's recent messages and makes it the active one."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--department", required=True, help="department path, e.g. /acme/legal")
+        parser.add_argument("--samples", type=int, default=2000)
+        parser.add_argument("--size", type=int, default=None, help="dictionary size in bytes")
+        parser.add_argument(
+            "--sample-bytes", type=int, default=64 * 1024, help="leading bytes of each message used for training"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            department = Department.objects.get(path=options["department"])
+        except Department.DoesNotExist as exc:
+            raise CommandError("department_not_found") from exc
+        access = EmailAccessService()
+        emails = ArchivedEmail.objects.filter(department=department).order_by("-received_at")[: options["samples"]]
+        # Headers and the start of the body carry the shared structure; whole messages
+        # with large attachments would only add download time and trainer memory.
+        limit = options["sample_bytes"]
+        samples = [b"".join(access.iter_range(email, 0, min(email.size_bytes, limit))) for email in emails]
+        if len(samples) < 10:
+            raise CommandError(f"need at least 10 messages to train, found {len(samples)}")
+        trained = compression.train_dictionary(samples, options["size"] or settings.COMPRESSION["DICTIONARY_SIZE"])
+        with transaction.atomic():
+            # Older dictionaries stay readable for the objects compressed with them.
+            CompressionDictionary.objects.filter(department=department, active=True).update(active=False)
+            dictionary = CompressionDictionary.objects.create(
+                department=department,
+                dict_id=trained.dict_id(),
+                data=trained.as_bytes(),
+                sample_count=len(samples),
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"dictionary {dictionary.id} (zstd id {dictionary.dict_id}, {len(dictionary.data)} bytes) "
+                f"trained on {len(samples)} messages"
+            )
+        )
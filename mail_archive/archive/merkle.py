@@ -0,0 +1,168 @@
+"""Daily Merkle commitments over archived messages and inclusion proofs.
+
+Each received day (UTC) gets one tree per mailbox, whose leaves are (email id,
+sha256) pairs, and one day tree over the mailbox roots. Bucketing by
+`received_at`, the partitioning key, lets each build read a single partition.
+Emails of a day archived after its trees were built (delayed journal traffic,
+bulk imports of old mail) are committed in the day's next generation of trees;
+committed trees are never rebuilt. Proofs read only the stored trees, never S3.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import BinaryField, Q
+from django.db.models.functions import Substr
+from django.utils import timezone
+from audit.services import AuditService
+from core import merkle
+from .models import ArchivedEmail, MerkleTree
+
+logger = logging.getLogger(__name__)
+
+
+def _day_bounds(day: dt.date) -> tuple[dt.datetime, dt.datetime]:
+    start = dt.datetime.combine(day, dt.time.min, tzinfo=dt.timezone.utc)
+    return start, start + dt.timedelta(days=1)
+
+
+def archive_day(email: ArchivedEmail) -> dt.date:
+    return email.received_at.astimezone(dt.timezone.utc).date()
+
+
+@transaction.atomic
+def build_day(day: dt.date) -> MerkleTree | None:
+    """Commits the day's emails not in any of its trees yet as a new generation; None if there are none."""
+    committed = set()
+    generation = 0
+    for tree_generation, leaf_ids in MerkleTree.objects.filter(day=day, mailbox__isnull=False).values_list(
+        "generation", "leaf_ids"
+    ):
+        committed.update(merkle.unpack_ids(bytes(leaf_ids)))
+        generation = max(generation, tree_generation)
+    generation += 1
+    start, end = _day_bounds(day)
+    rows = (
+        ArchivedEmail.objects.filter(received_at__gte=start, received_at__lt=end)
+        .order_by("mailbox_id", "id")
+        .values_list("mailbox_id", "id", "sha256")
+    )
+    per_mailbox: dict[int, tuple[list[int], list[bytes]]] = {}
+    for mailbox_id, email_id, sha in rows.iterator(chunk_size=10000):
+        if email_id in committed:
+            continue
+        ids, leaves = per_mailbox.setdefault(mailbox_id, ([], []))
+        ids.append(email_id)
+        leaves.append(merkle.leaf_hash(email_id, sha))
+    if not per_mailbox:
+        return None
+    mailbox_trees = []
+    for position, (mailbox_id, (ids, leaves)) in enumerate(sorted(per_mailbox.items())):
+        root, nodes = merkle.build(leaves)
+        mailbox_trees.append(
+            MerkleTree(
+                day=day,
+                mailbox_id=mailbox_id,
+                generation=generation,
+                leaf_count=len(leaves),
+                root=root.hex(),
+                nodes=nodes,
+                leaf_ids=merkle.pack_ids(ids),
+                position=position,
+            )
+        )
+    MerkleTree.objects.bulk_create(mailbox_trees, batch_size=500)
+    day_ids = [tree.mailbox_id for tree in mailbox_trees]
+    day_root, day_nodes = merkle.build([merkle.leaf_hash(t.mailbox_id, t.root) for t in mailbox_trees])
+    day_tree = MerkleTree(
+        day=day,
+        mailbox=None,
+        generation=generation,
+        leaf_count=len(mailbox_trees),
+        root=day_root.hex(),
+        nodes=day_nodes,
+        leaf_ids=merkle.pack_ids(day_ids),
+    )
+    actor_name = settings.MERKLE_SETTINGS["AUDIT_ACTOR"]
+    if actor_name:
+        actor = get_user_model().objects.get(username=actor_name)
+        day_tree.audit_entry = AuditService.append(
+            actor,
+            "MERKLE_ROOT",
+            {
+                "day": day,
+                "generation": generation,
+                "root": day_tree.root,
+                "mailboxes": len(mailbox_trees),
+                "emails": sum(t.leaf_count for t in mailbox_trees),
+            },
+            target_id=str(day),
+        )
+    day_tree.save()
+    logger.info(
+        "merkle root for %s generation %s: %s over %s mailboxes", day, generation, day_tree.root, len(mailbox_trees)
+    )
+    return day_tree
+
+
+def build_days(days) -> list[dt.date]:
+    """Commits new emails of the given closed days; returns the days that got a new generation."""
+    today = timezone.now().astimezone(dt.timezone.utc).date()
+    return [day for day in sorted(set(days)) if day < today and build_day(day) is not None]
+
+
+def build_pending(days_back: int) -> list[dt.date]:
+    """Commits new emails of the closed days in the look-back window."""
+    today = timezone.now().astimezone(dt.timezone.utc).date()
+    return build_days(today - dt.timedelta(days=offset) for offset in range(days_back, 0, -1))
+
+
+def _sparse_proof(tree: MerkleTree, index: int) -> list[dict]:
+    """Reads only the O(log n) sibling digests from the stored blob instead of the whole tree."""
+    offsets = merkle.proof_offsets(tree.leaf_count, index)
+    if not offsets:
+        return []
+    annotations = {
+        f"n{i}": Substr("nodes", offset * merkle.DIGEST_SIZE + 1, merkle.DIGEST_SIZE, output_field=BinaryField())
+        for i, (offset, _) in enumerate(offsets)
+    }
+    values = MerkleTree.objects.filter(id=tree.id).annotate(**annotations).values(*annotations).get()
+    return [{"position": side, "hash": bytes(values[f"n{i}"]).hex()} for i, (_, side) in enumerate(offsets)]
+
+
+def inclusion_proof(email: ArchivedEmail) -> dict | None:
+    day = archive_day(email)
+    trees = {
+        (tree.generation, tree.mailbox_id): tree
+        for tree in MerkleTree.objects.filter(Q(mailbox_id=email.mailbox_id) | Q(mailbox__isnull=True), day=day)
+        .select_related("audit_entry")
+        .defer("nodes")
+    }
+    for (generation, mailbox_id), mailbox_tree in sorted(trees.items(), key=lambda item: item[0][0]):
+        if mailbox_id is None:
+            continue
+        index = merkle.find_id(bytes(mailbox_tree.leaf_ids), email.id)
+        day_tree = trees.get((generation, None))
+        if index is not None and day_tree is not None:
+            break
+    else:
+        return None
+    return {
+        "email_id": email.id,
+        "sha256": email.sha256,
+        "day": day,
+        "generation": generation,
+        "leaf": merkle.leaf_hash(email.id, email.sha256).hex(),
+        "mailbox_proof": _sparse_proof(mailbox_tree, index),
+        "mailbox_root": mailbox_tree.root,
+        "mailbox_leaf": merkle.leaf_hash(email.mailbox_id, mailbox_tree.root).hex(),
+        "day_proof": _sparse_proof(day_tree, mailbox_tree.position),
+        "day_root": day_tree.root,
+        "audit_log_id": day_tree.audit_entry_id,
+        "audit_sha256": day_tree.audit_entry.sha256 if day_tree.audit_entry else None,
+        "scheme": "sha256; leaf=0x00||id(u64be)||digest; node=0x01||left||right; odd node promoted",
+    }
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_alter_mailboxaccess_mailbox_alter_mailboxaccess_user'),
+        ('archive', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=512)),
+                ('chunk_index', models.PositiveIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('status', models.CharField(default='STARTED', max_length=16)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('imported_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('mailbox', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.mailbox')),
+            ],
+            options={
+                'unique_together': {('source', 'mailbox', 'chunk_index')},
+            },
+        ),
+    ]
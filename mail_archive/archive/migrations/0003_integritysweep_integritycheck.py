@@ -0,0 +1,40 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0002_importchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IntegritySweep',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16, unique=True)),
+                ('cursor', models.BigIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('last_completed_at', models.DateTimeField(blank=True, null=True)),
+                ('checked', models.BigIntegerField(default=0)),
+                ('failures', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IntegrityCheck',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('email', 'email'), ('attachment', 'attachment')], max_length=16)),
+                ('object_id', models.BigIntegerField()),
+                ('last_verified_at', models.DateTimeField()),
+                ('ok', models.BooleanField()),
+                ('error', models.CharField(blank=True, max_length=512, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ok', 'last_verified_at'], name='archive_int_ok_8c077a_idx')],
+                'unique_together': {('kind', 'object_id')},
+            },
+        ),
+    ]
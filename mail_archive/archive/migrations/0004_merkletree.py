@@ -0,0 +1,35 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0001_initial'),
+        ('accounts', '0002_alter_mailboxaccess_mailbox_alter_mailboxaccess_user'),
+        ('archive', '0003_integritysweep_integritycheck'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MerkleTree',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('generation', models.PositiveIntegerField(default=1)),
+                ('leaf_count', models.PositiveIntegerField()),
+                ('root', models.CharField(max_length=64)),
+                ('nodes', models.BinaryField()),
+                ('leaf_ids', models.BinaryField()),
+                ('position', models.PositiveIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('audit_entry', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='audit.auditlog')),
+                ('mailbox', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='accounts.mailbox')),
+            ],
+            options={
+                'unique_together': {('day', 'mailbox', 'generation')},
+            },
+        ),
+    ]
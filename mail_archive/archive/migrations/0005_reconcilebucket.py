@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0004_merkletree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconcileBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('db_count', models.BigIntegerField(default=0)),
+                ('db_digest', models.BigIntegerField(default=0)),
+                ('es_count', models.BigIntegerField(default=0)),
+                ('es_digest', models.BigIntegerField(default=0)),
+                ('s3_count', models.BigIntegerField(blank=True, null=True)),
+                ('orphan_keys', models.JSONField(blank=True, default=list)),
+                ('status', models.CharField(default='REPAIRING', max_length=16)),
+                ('checked_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedemail',
+            index=models.Index(fields=['created_at'], name='archive_arc_created_175ae4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reconcilebucket',
+            index=models.Index(fields=['status'], name='archive_rec_status_71dc2a_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_alter_mailboxaccess_mailbox_alter_mailboxaccess_user'),
+        ('archive', '0005_reconcilebucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedemail',
+            name='codec',
+            field=models.CharField(default='identity', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='archivedemail',
+            name='stored_size_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CompressionDictionary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dict_id', models.BigIntegerField()),
+                ('data', models.BinaryField()),
+                ('sample_count', models.PositiveIntegerField()),
+                ('active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('department', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.department')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedemail',
+            name='compression_dictionary',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='archive.compressiondictionary'),
+        ),
+        migrations.AddIndex(
+            model_name='compressiondictionary',
+            index=models.Index(fields=['department', 'active'], name='archive_com_departm_201d78_idx'),
+        ),
+    ]
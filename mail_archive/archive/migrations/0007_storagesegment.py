@@ -0,0 +1,44 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0006_compressiondictionary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedemail',
+            name='segment_length',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedemail',
+            name='segment_offset',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='StorageSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=512, unique=True)),
+                ('status', models.CharField(default='OPEN', max_length=16)),
+                ('size_bytes', models.BigIntegerField()),
+                ('record_count', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sealed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='archive_sto_status_adf0f1_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='archivedemail',
+            name='segment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='archive.storagesegment'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:38
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def stamp_running_jobs(apps, schema_editor):
+    # Jobs running during the upgrade count as alive from now; once their worker is gone they go stale and are requeued.
+    ExportJob = apps.get_model("archive", "ExportJob")
+    ExportJob.objects.filter(status="RUNNING").update(heartbeat_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0007_storagesegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='cursor_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='cursor_received_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='exported_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='result_parts',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddIndex(
+            model_name='exportjob',
+            index=models.Index(fields=['status', 'created_at'], name='archive_exp_status_1db3a7_idx'),
+        ),
+        migrations.RunPython(stamp_running_jobs, migrations.RunPython.noop),
+    ]
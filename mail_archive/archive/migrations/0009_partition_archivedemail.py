@@ -0,0 +1,96 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from core.partitioning import partition_table, unpartition_table
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        partition_table(schema_editor.connection, "archive_archivedemail", settings.PARTITIONING["MONTHS_AHEAD"])
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        unpartition_table(schema_editor.connection, "archive_archivedemail")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_alter_mailboxaccess_mailbox_alter_mailboxaccess_user'),
+        ('audit', '0001_initial'),
+        ('archive', '0008_exportjob_parts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(max_length=255)),
+                ('received_at', models.DateTimeField()),
+                ('email', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='key', to='archive.archivedemail')),
+                ('mailbox', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.mailbox')),
+            ],
+            options={
+                'unique_together': {('mailbox', 'message_id')},
+            },
+        ),
+        migrations.RunSQL(
+            "INSERT INTO archive_messagekey (mailbox_id, message_id, email_id, received_at) "
+            "SELECT mailbox_id, message_id, id, received_at FROM archive_archivedemail",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='archivedemail',
+            name='compression_dictionary',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='archive.compressiondictionary'),
+        ),
+        migrations.AlterField(
+            model_name='archivedemail',
+            name='department',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='accounts.department'),
+        ),
+        migrations.AlterField(
+            model_name='archivedemail',
+            name='mailbox',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='accounts.mailbox'),
+        ),
+        migrations.AlterField(
+            model_name='archivedemail',
+            name='segment',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='archive.storagesegment'),
+        ),
+        migrations.AlterField(
+            model_name='emailattachment',
+            name='email',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='archive.archivedemail'),
+        ),
+        migrations.AlterField(
+            model_name='emailparticipant',
+            name='email',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='participants', to='archive.archivedemail'),
+        ),
+        migrations.AlterField(
+            model_name='merkletree',
+            name='audit_entry',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='audit.auditlog'),
+        ),
+        migrations.AlterField(
+            model_name='searchqueue',
+            name='email',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to='archive.archivedemail'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedemail',
+            index=models.Index(fields=['mailbox', 'message_id'], name='archive_arc_mailbox_d0eafe_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='archivedemail',
+            unique_together=set(),
+        ),
+        migrations.RunPython(partition, unpartition),
+    ]
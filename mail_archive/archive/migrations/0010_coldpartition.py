@@ -0,0 +1,46 @@
+# Generated by Django 4.2.11 on 2026-10-19 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_alter_mailboxaccess_mailbox_alter_mailboxaccess_user'),
+        ('archive', '0009_partition_archivedemail'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messagekey',
+            name='email',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='key', to='archive.archivedemail'),
+        ),
+        migrations.AlterField(
+            model_name='emailattachment',
+            name='email',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='attachments', to='archive.archivedemail'),
+        ),
+        migrations.CreateModel(
+            name='ColdPartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('generation', models.PositiveIntegerField(default=1)),
+                ('s3_object_key', models.CharField(max_length=512)),
+                ('size_bytes', models.BigIntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('row_count', models.PositiveIntegerField()),
+                ('min_received_at', models.DateTimeField()),
+                ('max_received_at', models.DateTimeField()),
+                ('day_digests', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('mailbox', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.mailbox')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['month'], name='archive_col_month_7ff86f_idx')],
+                'unique_together': {('mailbox', 'month')},
+            },
+        ),
+    ]
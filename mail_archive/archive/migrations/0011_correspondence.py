@@ -0,0 +1,78 @@
+# Generated by Django 4.2.11 on 2026-10-19 13:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_alter_mailboxaccess_mailbox_alter_mailboxaccess_user'),
+        ('archive', '0010_coldpartition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Address',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.EmailField(max_length=254, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='emailparticipant',
+            name='address_ref',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='participations', to='archive.address'),
+        ),
+        migrations.RunSQL(
+            "INSERT INTO archive_address (address) "
+            "SELECT DISTINCT LOWER(TRIM(address)) FROM archive_emailparticipant",
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            "UPDATE archive_emailparticipant SET address_ref_id = ("
+            "SELECT id FROM archive_address WHERE archive_address.address = LOWER(TRIM(archive_emailparticipant.address)))",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='emailparticipant',
+            name='address_ref',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='participations', to='archive.address'),
+        ),
+        migrations.AddIndex(
+            model_name='emailparticipant',
+            index=models.Index(fields=['address_ref', 'email'], name='archive_ema_address_95c3b4_idx'),
+        ),
+        migrations.CreateModel(
+            name='CorrespondenceCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('received', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='correspondencecount',
+            name='address',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='archive.address'),
+        ),
+        migrations.AddField(
+            model_name='correspondencecount',
+            name='counterpart',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='archive.address'),
+        ),
+        migrations.AddField(
+            model_name='correspondencecount',
+            name='mailbox',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='accounts.mailbox'),
+        ),
+        migrations.AddIndex(
+            model_name='correspondencecount',
+            index=models.Index(fields=['address', 'month'], name='archive_cor_address_1dbe47_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='correspondencecount',
+            unique_together={('address', 'counterpart', 'month', 'mailbox')},
+        ),
+    ]
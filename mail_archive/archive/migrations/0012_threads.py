@@ -0,0 +1,52 @@
+# Generated by Django 4.2.11 on 2026-10-19 13:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def binary_collation(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        schema_editor.execute(
+            "ALTER TABLE archive_threadnode MODIFY message_id varchar(255) "
+            "CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('archive', '0011_correspondence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thread',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ThreadNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.RunPython(binary_collation, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='threadnode',
+            name='thread',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='nodes', to='archive.thread'),
+        ),
+        migrations.AddField(
+            model_name='messagekey',
+            name='thread',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='keys', to='archive.thread'),
+        ),
+        migrations.AddIndex(
+            model_name='messagekey',
+            index=models.Index(fields=['thread', 'received_at'], name='archive_mes_thread__cd42a4_idx'),
+        ),
+    ]
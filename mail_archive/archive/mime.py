@@ -0,0 +1,156 @@
+"""RFC822 parsing into the ingest payload shape used by `ArchiveIngestService`."""
+from __future__ import annotations
+
+import re
+from email import policy
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import getaddresses, parsedate_to_datetime
+
+from django.conf import settings
+from django.utils import timezone
+from core.hash_utils import sha256_bytes
+
+PARTICIPANT_HEADERS = (("FROM", "From"), ("TO", "To"), ("CC", "Cc"), ("BCC", "Bcc"))
+MESSAGE_ID_PATTERN = re.compile(r"<[^<>\s]+>")
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+
+def parse_message(raw_bytes: bytes):
+    return BytesParser(policy=policy.default).parsebytes(raw_bytes)
+
+
+def _header_date(message, received_at):
+    value = message.get("Date")
+    if value:
+        try:
+            parsed = parsedate_to_datetime(str(value))
+        except (TypeError, ValueError):
+            parsed = None
+        if parsed is not None:
+            if timezone.is_naive(parsed):
+                parsed = timezone.make_aware(parsed, timezone.utc)
+            return parsed
+    return received_at
+
+
+def _received_header_date(message):
+    """Date of the most recent `Received:` hop, i.e. when the mailbox got the message."""
+    for value in message.get_all("Received", []):
+        _, _, stamp = str(value).rpartition(";")
+        try:
+            parsed = parsedate_to_datetime(stamp.strip())
+        except (TypeError, ValueError):
+            continue
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed, timezone.utc)
+        return parsed
+    return None
+
+
+def message_participants(message) -> list[dict]:
+    participants = []
+    seen = set()
+    for kind, header in PARTICIPANT_HEADERS:
+        for _, address in getaddresses([str(v) for v in message.get_all(header, [])]):
+            address = address.strip().lower()
+            if "@" not in address or (kind, address) in seen:
+                continue
+            seen.add((kind, address))
+            participants.append({"type": kind, "address": address})
+    return participants
+
+
+def message_references(message) -> list[str]:
+    """Message ids of In-Reply-To and References, In-Reply-To first and without repeats.
+
+    A long References header keeps its first id (the thread root) and the
+    closest ancestors, `THREADING["MAX_REFERENCES"]` ids in total.
+    """
+    limit = settings.THREADING["MAX_REFERENCES"]
+    replied = MESSAGE_ID_PATTERN.findall(" ".join(str(v) for v in message.get_all("In-Reply-To", [])))
+    chain = MESSAGE_ID_PATTERN.findall(" ".join(str(v) for v in message.get_all("References", [])))
+    if len(chain) > limit:
+        chain = chain[:1] + chain[len(chain) - limit + 1 :]
+    return list(dict.fromkeys(replied + chain))[:limit]
+
+
+def header_references(raw_bytes: bytes) -> list[str]:
+    """`message_references` of a raw message, parsing only its header block."""
+    end = HEADER_END.search(raw_bytes)
+    headers = raw_bytes[: end.end()] if end else raw_bytes
+    return message_references(BytesHeaderParser(policy=policy.default).parsebytes(headers))
+
+
+def _envelope_participants(participants: list[dict], envelope_recipients) -> list[dict]:
+    known = {p["address"] for p in participants}
+    for address in envelope_recipients:
+        address = address.strip().lower()
+        if address not in known:
+            participants.append({"type": "BCC", "address": address})
+            known.add(address)
+    return participants
+
+
+def build_payload(raw_bytes: bytes, *, mailbox, received_at=None, envelope_recipients=()) -> dict:
+    """Returns a payload equivalent to a validated `ArchiveRequestSerializer` result.
+
+    The raw message travels as bytes (`raw_bytes`) and attachments carry decoded
+    `content_bytes`, so nothing is base64 encoded on this path.
+    """
+    message = parse_message(raw_bytes)
+    received_at = received_at or _received_header_date(message) or _header_date(message, None) or timezone.now()
+    message_id = str(message.get("Message-ID", "")).strip()
+    if not message_id:
+        message_id = f"<{sha256_bytes(raw_bytes)}@archive.local>"
+    participants = _envelope_participants(message_participants(message), envelope_recipients)
+    body_text = body_html = ""
+    text_part = message.get_body(preferencelist=("plain",))
+    if text_part is not None:
+        body_text = text_part.get_content()
+    html_part = message.get_body(preferencelist=("html",))
+    if html_part is not None:
+        body_html = html_part.get_content()
+    attachments = []
+    for part in message.iter_attachments():
+        content = part.get_payload(decode=True) or b""
+        attachments.append(
+            {
+                "filename": part.get_filename() or "attachment.bin",
+                "mime_type": part.get_content_type(),
+                "content_bytes": content,
+            }
+        )
+    return {
+        "mailbox": mailbox,
+        "message_id": message_id[:255],
+        "subject": str(message.get("Subject", ""))[:512],
+        "sent_at": _header_date(message, received_at),
+        "received_at": received_at,
+        "raw_bytes": raw_bytes,
+        "body_text": body_text,
+        "body_html": body_html,
+        "participants": participants,
+        "references": message_references(message),
+        "attachments": attachments,
+    }
+
+
+def raw_payload(raw_bytes: bytes, *, mailbox, received_at, envelope_recipients=()) -> dict:
+    """Minimal payload for a message `build_payload` cannot parse, so the raw bytes are still archived.
+
+    The message id is derived from the content hash, as for messages without a
+    Message-ID, and the envelope recipients are the only participants.
+    """
+    return {
+        "mailbox": mailbox,
+        "message_id": f"<{sha256_bytes(raw_bytes)}@archive.local>",
+        "subject": "",
+        "sent_at": received_at,
+        "received_at": received_at,
+        "raw_bytes": raw_bytes,
+        "body_text": "",
+        "body_html": "",
+        "participants": _envelope_participants([], envelope_recipients),
+        "references": [],
+        "attachments": [],
+    }
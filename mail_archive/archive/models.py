@@ -1,14 +1,14 @@
 from __future__ import annotations
 
 from django.db import models
-from django.utils import timezone
 from accounts.models import Department, Mailbox
 
 
 class ArchivedEmail(models.Model):
     message_id = models.CharField(max_length=255)
-    mailbox = models.ForeignKey(Mailbox, on_delete=models.PROTECT)
-    department = models.ForeignKey(Department, on_delete=models.PROTECT)
+    # Partitioned by month of received_at (core.partitioning), so no foreign keys to or from this table.
+    mailbox = models.ForeignKey(Mailbox, on_delete=models.PROTECT, db_constraint=False)
+    department = models.ForeignKey(Department, on_delete=models.PROTECT, db_constraint=False)
     subject = models.CharField(max_length=512)
     sent_at = models.DateTimeField()
     received_at = models.DateTimeField()
@@ -18,21 +18,98 @@ class ArchivedEmail(models.Model):
     has_html = models.BooleanField(default=False)
     has_text = models.BooleanField(default=True)
     immutable_flag = models.BooleanField(default=True)
+    # How the object is stored in S3; sha256 and size_bytes always describe the original message.
+    codec = models.CharField(max_length=16, default="identity")
+    compression_dictionary = models.ForeignKey(
+        "CompressionDictionary", null=True, blank=True, on_delete=models.PROTECT, db_constraint=False
+    )
+    stored_size_bytes = models.BigIntegerField(null=True, blank=True)
+    # Set when the message is packed into a segment; s3_object_key is then the segment key.
+    segment = models.ForeignKey(
+        "StorageSegment", null=True, blank=True, on_delete=models.PROTECT, db_constraint=False
+    )
+    segment_offset = models.BigIntegerField(null=True, blank=True)
+    segment_length = models.BigIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
-        unique_together = ("message_id", "mailbox")
+        # (mailbox, message_id) uniqueness is enforced by MessageKey.
         indexes = [
+            models.Index(fields=["mailbox", "message_id"]),
             models.Index(fields=["mailbox", "received_at"]),
             models.Index(fields=["department", "received_at"]),
+            models.Index(fields=["created_at"]),
         ]
 
     def __str__(self):
         return f"{self.mailbox.address}:{self.message_id}"
 
 
+class MessageKey(models.Model):
+    """The (mailbox, message_id) unique key of an ArchivedEmail, kept outside the partitioned table.
+
+    A unique key of a partitioned table must include received_at, which would
+    make it useless for deduplication. The row is inserted in the same
+    transaction as its email and outlives it when the email's metadata moves
+    to the cold tier, so it is also how an email id is resolved to the
+    mailbox-month file holding it (`archive.tiering`).
+    """
+
+    mailbox = models.ForeignKey(Mailbox, on_delete=models.PROTECT)
+    message_id = models.CharField(max_length=255)
+    email = models.OneToOneField(ArchivedEmail, on_delete=models.DO_NOTHING, related_name="key", db_constraint=False)
+    received_at = models.DateTimeField()
+    # Null only for mail archived before threading until `manage.py backfill_threads` has run.
+    thread = models.ForeignKey(
+        "Thread", null=True, blank=True, on_delete=models.PROTECT, related_name="keys", db_index=False
+    )
+
+    class Meta:
+        unique_together = ("mailbox", "message_id")
+        indexes = [models.Index(fields=["thread", "received_at"])]
+
+    @classmethod
+    def for_email(cls, email: ArchivedEmail, thread_id: int | None = None) -> MessageKey:
+        return cls(
+            mailbox_id=email.mailbox_id,
+            message_id=email.message_id,
+            email_id=email.id,
+            received_at=email.received_at,
+            thread_id=thread_id,
+        )
+
+
+class Thread(models.Model):
+    """A conversation: message ids connected through In-Reply-To and References (archive.threads)."""
+
+    # Number of ThreadNode rows; the smaller thread is relabelled when two merge.
+    size = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class ThreadNode(models.Model):
+    """A message id seen in a Message-ID, In-Reply-To or References header, archived or not."""
+
+    # Message ids are case-sensitive: on MySQL the column uses the binary collation
+    # (migration 0012), or ids differing only in case would collide.
+    message_id = models.CharField(max_length=255, unique=True)
+    # Null only inside the transaction that creates the node.
+    thread = models.ForeignKey(Thread, null=True, on_delete=models.PROTECT, related_name="nodes")
+
+
+class Address(models.Model):
+    """A participant address, stored once in normalized (lower case) form; see `archive.correspondence`."""
+
+    address = models.EmailField(unique=True)
+
+    def __str__(self):
+        return self.address
+
+
 class EmailParticipant(models.Model):
-    email = models.ForeignKey(ArchivedEmail, on_delete=models.CASCADE, related_name="participants")
+    email = models.ForeignKey(
+        ArchivedEmail, on_delete=models.CASCADE, related_name="participants", db_constraint=False
+    )
     type = models.CharField(max_length=4, choices=(
         ("FROM", "FROM"),
         ("TO", "TO"),
@@ -40,13 +117,19 @@ class EmailParticipant(models.Model):
         ("BCC", "BCC"),
     ))
     address = models.EmailField()
+    address_ref = models.ForeignKey(Address, on_delete=models.PROTECT, related_name="participations")
 
     class Meta:
         unique_together = ("email", "type", "address")
+        # Mail of an address, and mail between two addresses, without scanning participants.
+        indexes = [models.Index(fields=["address_ref", "email"])]
 
 
 class EmailAttachment(models.Model):
-    email = models.ForeignKey(ArchivedEmail, on_delete=models.CASCADE, related_name="attachments")
+    # Rows outlive their email when it moves to the cold tier (archive.tiering), so deletes do not cascade.
+    email = models.ForeignKey(
+        ArchivedEmail, on_delete=models.DO_NOTHING, related_name="attachments", db_constraint=False
+    )
     filename = models.CharField(max_length=255)
     mime_type = models.CharField(max_length=128)
     size_bytes = models.BigIntegerField()
@@ -55,7 +138,7 @@ class EmailAttachment(models.Model):
 
 
 class SearchQueue(models.Model):
-    email = models.ForeignKey(ArchivedEmail, on_delete=models.CASCADE)
+    email = models.ForeignKey(ArchivedEmail, on_delete=models.CASCADE, db_constraint=False)
     payload = models.JSONField()
     status = models.CharField(max_length=16, default="PENDING")
     retry_count = models.PositiveIntegerField(default=0)
@@ -65,17 +148,197 @@ class SearchQueue(models.Model):
 
 
 class ExportJob(models.Model):
+    """An export, produced in parts of at most `EXPORT_SCHEDULER["PART_MESSAGES"]` messages.
+
+    Between parts the job is QUEUED again, so the fair-share scheduler can run
+    other owners' work before the next part of a large export.
+    """
+
+    STATUS_QUEUED = "QUEUED"
+    STATUS_RUNNING = "RUNNING"
+    STATUS_COMPLETED = "COMPLETED"
+    STATUS_FAILED = "FAILED"
+
     owner = models.ForeignKey("accounts.User", on_delete=models.CASCADE)
     mailbox = models.ForeignKey(Mailbox, on_delete=models.PROTECT)
     time_start = models.DateTimeField()
     time_end = models.DateTimeField()
-    status = models.CharField(max_length=16, default="QUEUED")
+    status = models.CharField(max_length=16, default=STATUS_QUEUED)
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     result_s3_key = models.CharField(max_length=512, null=True, blank=True)
+    # Stamped when a part is dispatched; it identifies that run of the part.
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    # Refreshed by the worker while a part runs; a part whose heartbeat stops is requeued.
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # Keyset cursor: the last (received_at, id) exported so far.
+    cursor_received_at = models.DateTimeField(null=True, blank=True)
+    cursor_id = models.BigIntegerField(null=True, blank=True)
+    exported_count = models.PositiveBigIntegerField(default=0)
+    result_parts = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+
+class ImportChunk(models.Model):
+    """Progress ledger for `manage.py import_mailstore`; a DONE chunk is never re-imported."""
+
+    source = models.CharField(max_length=512)
+    # Importing one source into another mailbox is a separate import.
+    mailbox = models.ForeignKey(Mailbox, on_delete=models.PROTECT)
+    chunk_index = models.PositiveIntegerField()
+    # A row only stands for the items it was planned with; see `Chunk.fingerprint`.
+    chunk_size = models.PositiveIntegerField()
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, default="STARTED")
+    message_count = models.PositiveIntegerField(default=0)
+    imported_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("source", "mailbox", "chunk_index")
+
+
+class IntegrityCheck(models.Model):
+    """Latest scheduled hash audit result for one stored object."""
+
+    KIND_EMAIL = "email"
+    KIND_ATTACHMENT = "attachment"
+
+    kind = models.CharField(max_length=16, choices=((KIND_EMAIL, KIND_EMAIL), (KIND_ATTACHMENT, KIND_ATTACHMENT)))
+    object_id = models.BigIntegerField()
+    last_verified_at = models.DateTimeField()
+    ok = models.BooleanField()
+    error = models.CharField(max_length=512, null=True, blank=True)
+
+    class Meta:
+        unique_together = ("kind", "object_id")
+        indexes = [models.Index(fields=["ok", "last_verified_at"])]
+
+
+class IntegritySweep(models.Model):
+    """Keyset cursor of the running sweep per object kind, so the next run resumes where this one stopped."""
 
-    def mark_complete(self, key: str):
-        self.status = "COMPLETED"
-        self.result_s3_key = key
-        self.completed_at = timezone.now()
-        self.save(update_fields=["status", "result_s3_key", "completed_at"])
+    kind = models.CharField(max_length=16, unique=True)
+    cursor = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    last_completed_at = models.DateTimeField(null=True, blank=True)
+    checked = models.BigIntegerField(default=0)
+    failures = models.BigIntegerField(default=0)
+
+
+class MerkleTree(models.Model):
+    """Merkle tree over one received day: per mailbox (leaves are emails) or per day (leaves are mailbox roots)."""
+
+    day = models.DateField()
+    mailbox = models.ForeignKey(Mailbox, null=True, blank=True, on_delete=models.PROTECT)
+    # Emails of the day archived after its first trees were built are committed in the next generation.
+    generation = models.PositiveIntegerField(default=1)
+    leaf_count = models.PositiveIntegerField()
+    root = models.CharField(max_length=64)
+    nodes = models.BinaryField()
+    leaf_ids = models.BinaryField()
+    position = models.PositiveIntegerField(null=True, blank=True)
+    audit_entry = models.ForeignKey(
+        "audit.AuditLog", null=True, blank=True, on_delete=models.PROTECT, db_constraint=False
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("day", "mailbox", "generation")
+
+
+class ReconcileBucket(models.Model):
+    """Per-day (count, digest) summary of each store from the last reconciliation run."""
+
+    STATUS_OK = "OK"
+    STATUS_REPAIRING = "REPAIRING"
+
+    day = models.DateField(unique=True)
+    db_count = models.BigIntegerField(default=0)
+    db_digest = models.BigIntegerField(default=0)
+    es_count = models.BigIntegerField(default=0)
+    es_digest = models.BigIntegerField(default=0)
+    s3_count = models.BigIntegerField(null=True, blank=True)
+    orphan_keys = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=16, default=STATUS_REPAIRING)
+    checked_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status"])]
+
+
+class CompressionDictionary(models.Model):
+    """Trained zstd dictionary; kept forever because stored objects reference it."""
+
+    department = models.ForeignKey(Department, on_delete=models.PROTECT)
+    dict_id = models.BigIntegerField()
+    data = models.BinaryField()
+    sample_count = models.PositiveIntegerField()
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["department", "active"])]
+
+
+class StorageSegment(models.Model):
+    """Immutable S3 object packing many small EML records; see `archive.segments`."""
+
+    STATUS_OPEN = "OPEN"
+    STATUS_SEALED = "SEALED"
+    STATUS_ABANDONED = "ABANDONED"
+
+    key = models.CharField(max_length=512, unique=True)
+    status = models.CharField(max_length=16, default=STATUS_OPEN)
+    size_bytes = models.BigIntegerField()
+    record_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    sealed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+
+class ColdPartition(models.Model):
+    """One mailbox-month of email metadata moved out of MySQL into a Parquet file (archive.tiering)."""
+
+    mailbox = models.ForeignKey(Mailbox, on_delete=models.PROTECT)
+    month = models.DateField()
+    # Every rewrite (late rows merged in) is a new object; locked objects cannot be replaced.
+    generation = models.PositiveIntegerField(default=1)
+    s3_object_key = models.CharField(max_length=512)
+    size_bytes = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    row_count = models.PositiveIntegerField()
+    min_received_at = models.DateTimeField()
+    max_received_at = models.DateTimeField()
+    # {"YYYY-MM-DD": [count, digest]} in the form archive.reconcile compares with Elasticsearch.
+    day_digests = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("mailbox", "month")
+        indexes = [models.Index(fields=["month"])]
+
+
+class CorrespondenceCount(models.Model):
+    """Messages `address` sent to and received from `counterpart` in one mailbox and month.
+
+    Each sender/recipient pair of a message is counted twice, once from either
+    side, so the counterparts of an address are read from its own rows.
+    """
+
+    mailbox = models.ForeignKey(Mailbox, on_delete=models.PROTECT)
+    month = models.DateField()
+    address = models.ForeignKey(Address, on_delete=models.PROTECT, related_name="+")
+    counterpart = models.ForeignKey(Address, on_delete=models.PROTECT, related_name="+")
+    sent = models.PositiveIntegerField(default=0)
+    received = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # Column order matches the upsert in archive.correspondence and serves pair timelines.
+        unique_together = ("address", "counterpart", "month", "mailbox")
+        indexes = [models.Index(fields=["address", "month"])]
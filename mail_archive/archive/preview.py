@@ -0,0 +1,141 @@
+"""Parsed message previews: headers, a plain-text body and the attachment list.
+
+Stored messages never change, so a parsed preview is cached per process by
+`sha256` and shared by every email row with that content. The cached body is
+capped at `MAX_BODY_CHARS`; callers page through it with `body_page`.
+"""
+from __future__ import annotations
+
+import json
+import re
+from html.parser import HTMLParser
+
+from django.conf import settings
+from core.lru import SizedLRU
+from .mime import parse_message
+from .models import ArchivedEmail
+from .services import EmailAccessService
+
+PREVIEW_HEADERS = ("From", "Reply-To", "To", "Cc", "Bcc", "Date", "Subject", "Message-ID", "In-Reply-To", "References")
+_CONTROL = re.compile("[\x00-\x08\x0b-\x1f\x7f\u200b-\u200f\u202a-\u202e\u2066-\u2069]")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+_cache = SizedLRU(settings.PREVIEW["CACHE_MAX_BYTES"], lambda preview: len(json.dumps(preview)))
+
+
+class _TextExtractor(HTMLParser):
+    """Keeps the text of an HTML body; scripts, styles and markup are dropped."""
+
+    SKIP = {"script", "style", "head", "title", "template"}
+    BREAKS = {"br", "p", "div", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "pre", "table"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: list[str] = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        elif tag in self.BREAKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BREAKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def sanitize_text(text: str) -> str:
+    """Normalizes newlines and strips control and bidi-override characters."""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return _BLANK_LINES.sub("\n\n", _CONTROL.sub("", text)).strip()
+
+
+def html_to_text(html: str) -> str:
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return "\n".join(line.strip() for line in "".join(extractor.parts).splitlines())
+
+
+def _header_values(message) -> list[dict]:
+    headers = []
+    for name in PREVIEW_HEADERS:
+        for value in message.get_all(name, []):
+            headers.append({"name": name, "value": sanitize_text(str(value))})
+    return headers
+
+
+def _body_text(message) -> str:
+    part = message.get_body(preferencelist=("plain", "html"))
+    if part is None:
+        return ""
+    try:
+        content = part.get_content()
+    except (LookupError, ValueError):
+        content = (part.get_payload(decode=True) or b"").decode("utf-8", "replace")
+    if part.get_content_subtype() == "html":
+        content = html_to_text(content)
+    return sanitize_text(content)
+
+
+def _attachment_size(part) -> int:
+    # Decoding every attachment only to report its size would dominate the parse; estimate it instead.
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return 0
+    if part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+        return len("".join(payload.split())) * 3 // 4
+    return len(payload)
+
+
+def build_preview(raw_bytes: bytes) -> dict:
+    message = parse_message(raw_bytes)
+    body = _body_text(message)
+    max_chars = settings.PREVIEW["MAX_BODY_CHARS"]
+    attachments = [
+        {
+            "index": index,
+            "filename": part.get_filename() or "attachment.bin",
+            "mime_type": part.get_content_type(),
+            "content_id": str(part.get("Content-ID", "")).strip() or None,
+            "approx_size_bytes": _attachment_size(part),
+        }
+        for index, part in enumerate(message.iter_attachments())
+    ]
+    return {
+        "headers": _header_values(message),
+        "body": body[:max_chars],
+        "body_chars": len(body),
+        "attachments": attachments,
+    }
+
+
+def email_preview(email: ArchivedEmail) -> dict:
+    preview = _cache.get(email.sha256)
+    if preview is None:
+        preview = build_preview(EmailAccessService().read(email))
+        _cache.set(email.sha256, preview)
+    return preview
+
+
+def body_page(preview: dict, offset: int, limit: int) -> dict:
+    text = preview["body"][offset : offset + limit]
+    end = offset + len(text)
+    return {
+        "text": text,
+        "offset": offset,
+        "total_chars": preview["body_chars"],
+        "truncated": end < preview["body_chars"],
+        "next_offset": end if end < len(preview["body"]) else None,
+    }
+
+
+def cache_stats() -> dict:
+    return _cache.stats()
@@ -0,0 +1,372 @@
+"""Anti-entropy reconciliation between MySQL, Elasticsearch and S3.
+
+Every store is summarised per archive bucket as (count, digest), where the
+digest XORs `sha256[:15] ^ id` over the bucket's messages. Day buckets are
+compared first; only differing days are split per mailbox, and only differing
+mailbox-days are listed message by message. MySQL day digests are cached in
+`ReconcileBucket` and recomputed only for days that received rows since the
+last run, and S3 prefixes are only listed for those days, so a run costs the
+number of changed or differing buckets rather than the archive size. Months
+moved to the cold tier contribute the per-day digests stored with their
+files, and their rows are read back only when a bucket has to be listed.
+
+A run compares the last `LOOKBACK_DAYS` days and the days that received rows.
+Older days are compared `HISTORY_DAYS_PER_RUN` at a time, least recently
+checked first (`ReconcileBucket.checked_at` is the checkpoint), so the whole
+archive is covered over successive runs without aggregating all of it daily.
+Days are UTC days in every store.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Aggregate, BigIntegerField, Count, F, Func
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from elasticsearch import helpers
+from core.partitioning import month_start
+from core.search import get_client
+from core.storage import S3Storage
+from .dedup import DuplicateGuard
+from .integrity import _upsert_checks
+from .mime import build_payload
+from .models import ArchivedEmail, ColdPartition, IntegrityCheck, MessageKey, ReconcileBucket
+from .segments import settle_open_segments
+from .services import EmailAccessService, search_document
+from .tiering import ColdStore
+
+logger = logging.getLogger(__name__)
+
+_ES_DIGEST = {
+    "scripted_metric": {
+        "init_script": "state.x = 0L",
+        "map_script": (
+            "state.x ^= Long.parseLong(doc['sha256'].value.substring(0, 15), 16)"
+            " ^ Long.parseLong(doc['email_id'].value)"
+        ),
+        "combine_script": "return state.x",
+        "reduce_script": "long x = 0L; for (s in states) { if (s != null) { x ^= s } } return x",
+    }
+}
+
+
+def item_digest(email_id: int, sha: str) -> int:
+    return int(sha[:15], 16) ^ int(email_id)
+
+
+class _ShaPrefix(Func):
+    template = "CAST(CONV(SUBSTRING(%(expressions)s, 1, 15), 16, 10) AS UNSIGNED)"
+    output_field = BigIntegerField()
+
+
+class _BitXor(Aggregate):
+    function = "BIT_XOR"
+    output_field = BigIntegerField()
+
+
+def _day_bounds(day: dt.date) -> tuple[dt.datetime, dt.datetime]:
+    start = dt.datetime.combine(day, dt.time.min, tzinfo=dt.timezone.utc)
+    return start, start + dt.timedelta(days=1)
+
+
+def _utc_day(field: str) -> TruncDate:
+    return TruncDate(field, tzinfo=dt.timezone.utc)
+
+
+def _merge_digest(digests: dict, key, count: int, digest: int) -> None:
+    before_count, before_digest = digests.get(key, (0, 0))
+    digests[key] = (before_count + count, before_digest ^ digest)
+
+
+def _db_digests(queryset, group: str) -> dict:
+    """{group value: (count, digest)}; pushed down to MySQL, folded in Python elsewhere."""
+    if connection.vendor == "mysql":
+        rows = queryset.values(group).annotate(
+            count=Count("id"), digest=_BitXor(_ShaPrefix("sha256").bitxor(F("id")))
+        )
+        return {row[group]: (row["count"], int(row["digest"] or 0)) for row in rows}
+    digests: dict = defaultdict(lambda: (0, 0))
+    for key, email_id, sha in queryset.values_list(group, "id", "sha256").iterator(chunk_size=10000):
+        count, digest = digests[key]
+        digests[key] = (count + 1, digest ^ item_digest(email_id, sha))
+    return dict(digests)
+
+
+class StoreReconciler:
+    def __init__(self):
+        self.cfg = settings.RECONCILE_SETTINGS
+        self.es = get_client()
+        self.index = settings.ELASTICSEARCH["INDEX"]
+        self.storage = S3Storage()
+        self.cold = ColdStore(self.storage)
+        self.report = defaultdict(int)
+
+    def _dirty_days(self, full: bool) -> set[dt.date]:
+        days = ArchivedEmail.objects.annotate(day=_utc_day("received_at"))
+        watermark = ReconcileBucket.objects.order_by("-checked_at").values_list("checked_at", flat=True).first()
+        if not full and watermark is not None:
+            # Rows commit a little after `created_at` is stamped; look back past the skew.
+            days = days.filter(created_at__gte=watermark - dt.timedelta(seconds=self.cfg["WATERMARK_SKEW_SECONDS"]))
+        dirty = set(days.values_list("day", flat=True).distinct())
+        dirty.update(ReconcileBucket.objects.exclude(status=ReconcileBucket.STATUS_OK).values_list("day", flat=True))
+        return dirty
+
+    def _refresh_db_digests(self, days: set[dt.date]) -> None:
+        digests = {}
+        # One grouped query per run of consecutive days, so a sparse backfill never scans the gaps.
+        runs: list[list[dt.date]] = []
+        for day in sorted(days):
+            if runs and day - runs[-1][-1] == dt.timedelta(days=1):
+                runs[-1].append(day)
+            else:
+                runs.append([day])
+        for run in runs:
+            start, _ = _day_bounds(run[0])
+            _, end = _day_bounds(run[-1])
+            queryset = ArchivedEmail.objects.filter(received_at__gte=start, received_at__lt=end).annotate(
+                day=_utc_day("received_at")
+            )
+            digests.update(_db_digests(queryset, "day"))
+        for partition in ColdPartition.objects.filter(month__in={month_start(day) for day in days}):
+            for day_text, (count, digest) in partition.day_digests.items():
+                if (day := dt.date.fromisoformat(day_text)) in days:
+                    _merge_digest(digests, day, count, digest)
+        buckets = {b.day: b for b in ReconcileBucket.objects.filter(day__in=days)}
+        for day in days:
+            bucket = buckets.get(day) or ReconcileBucket(day=day)
+            bucket.db_count, bucket.db_digest = digests.get(day, (0, 0))
+            bucket.save()
+
+    def _es_aggregate(self, query: dict, bucket_agg: dict) -> list[dict]:
+        response = self.es.search(
+            index=self.index,
+            size=0,
+            query=query,
+            aggs={"buckets": {**bucket_agg, "aggs": {"digest": _ES_DIGEST}}},
+        )
+        return response["aggregations"]["buckets"]["buckets"]
+
+    def _history_days(self, horizon: dt.date, dirty: set[dt.date]) -> set[dt.date]:
+        """The least recently checked days before `horizon`, for this run's share of the history."""
+        days = (
+            ReconcileBucket.objects.filter(day__lt=horizon)
+            .exclude(day__in=dirty)
+            .order_by(F("checked_at").asc(nulls_first=True), "day")
+            .values_list("day", flat=True)
+        )
+        return set(days[: self.cfg["HISTORY_DAYS_PER_RUN"]])
+
+    def _es_day_digests(self, horizon: dt.date | None, extra_days=()) -> dict[dt.date, tuple[int, int]]:
+        """ES day digests from `horizon` on (every day when None) and of `extra_days`."""
+        query = {"match_all": {}}
+        if horizon is not None:
+            ranges = [{"range": {"received_at": {"gte": _day_bounds(horizon)[0].isoformat()}}}]
+            for day in sorted(extra_days):
+                start, end = _day_bounds(day)
+                ranges.append({"range": {"received_at": {"gte": start.isoformat(), "lt": end.isoformat()}}})
+            query = {"bool": {"should": ranges, "minimum_should_match": 1}}
+        buckets = self._es_aggregate(
+            query,
+            {
+                "date_histogram": {
+                    "field": "received_at",
+                    "calendar_interval": "day",
+                    "time_zone": "UTC",
+                    "format": "yyyy-MM-dd",
+                    "min_doc_count": 1,
+                }
+            },
+        )
+        return {
+            dt.date.fromisoformat(b["key_as_string"]): (b["doc_count"], int(b["digest"]["value"] or 0))
+            for b in buckets
+        }
+
+    def _day_query(self, day: dt.date, mailbox: str | None = None) -> dict:
+        start, end = _day_bounds(day)
+        clauses = [{"range": {"received_at": {"gte": start.isoformat(), "lt": end.isoformat()}}}]
+        if mailbox is not None:
+            clauses.append({"term": {"mailbox": mailbox}})
+        return {"bool": {"filter": clauses}}
+
+    def _diff_mailboxes(self, day: dt.date) -> list[str]:
+        start, end = _day_bounds(day)
+        db = _db_digests(
+            ArchivedEmail.objects.filter(received_at__gte=start, received_at__lt=end).annotate(
+                address=F("mailbox__address")
+            ),
+            "address",
+        )
+        for partition in ColdPartition.objects.filter(month=month_start(day)).select_related("mailbox"):
+            if day_digest := partition.day_digests.get(day.isoformat()):
+                _merge_digest(db, partition.mailbox.address, *day_digest)
+        es = {
+            b["key"]: (b["doc_count"], int(b["digest"]["value"] or 0))
+            for b in self._es_aggregate(
+                self._day_query(day), {"terms": {"field": "mailbox", "size": self.cfg["MAX_MAILBOXES_PER_DAY"]}}
+            )
+        }
+        return sorted(address for address in db.keys() | es.keys() if db.get(address) != es.get(address))
+
+    def _diff_messages(self, day: dt.date, address: str) -> tuple[set[int], set[int]]:
+        """Returns (ids to re-index, ids to delete from the index)."""
+        start, end = _day_bounds(day)
+        db = dict(
+            ArchivedEmail.objects.filter(
+                mailbox__address=address, received_at__gte=start, received_at__lt=end
+            ).values_list("id", "sha256")
+        )
+        db.update((email.id, email.sha256) for email in self.cold.day_emails(day, address))
+        es = {
+            int(hit["_id"]): hit["_source"].get("sha256")
+            for hit in helpers.scan(
+                self.es,
+                index=self.index,
+                query={"query": self._day_query(day, address), "_source": ["sha256"]},
+                size=self.cfg["SCAN_PAGE_SIZE"],
+            )
+        }
+        reindex = {email_id for email_id, sha in db.items() if es.get(email_id) != sha}
+        stray = set(es) - set(db)
+        # A document filed under the wrong day or mailbox is fixed by re-indexing its row, not deleting it.
+        known = set(MessageKey.objects.filter(email_id__in=stray).values_list("email_id", flat=True))
+        return reindex | known, stray - known
+
+    def _check_objects(self, day: dt.date, bucket: ReconcileBucket) -> None:
+        prefix = f"eml/{day}/"
+        listed = set()
+        paginator = self.storage.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.storage.bucket, Prefix=prefix):
+            listed.update(obj["Key"] for obj in page.get("Contents", []))
+        # The key carries the received day; bounding received_at as well lets MySQL prune
+        # the monthly partitions instead of matching the prefix in every one of them.
+        start, end = _day_bounds(day)
+        skew = dt.timedelta(seconds=self.cfg["WATERMARK_SKEW_SECONDS"])
+        rows = dict(
+            ArchivedEmail.objects.filter(
+                received_at__gte=start - skew, received_at__lt=end + skew, s3_object_key__startswith=prefix
+            ).values_list("s3_object_key", "id")
+        )
+        cold = self.cold.day_emails(day)
+        rows.update((email.s3_object_key, email.id) for email in cold if email.s3_object_key.startswith(prefix))
+        known_orphans = set(bucket.orphan_keys)
+        guard = DuplicateGuard()
+        for key in sorted(listed - rows.keys() - known_orphans):
+            guard.record_orphan(key, reason="no metadata row found by reconciliation")
+            self.report["orphaned_objects"] += 1
+        missing = [rows[key] for key in rows.keys() - listed] + self._missing_segment_members(day, cold)
+        if missing:
+            now = timezone.now()
+            _upsert_checks(
+                [
+                    IntegrityCheck(
+                        kind=IntegrityCheck.KIND_EMAIL, object_id=i, last_verified_at=now, ok=False, error="missing_object"
+                    )
+                    for i in missing
+                ]
+            )
+            self.report["missing_objects"] += len(missing)
+        bucket.orphan_keys = sorted(listed - rows.keys())
+        bucket.s3_count = len(listed)
+
+    def _missing_segment_members(self, day: dt.date, cold: list[ArchivedEmail]) -> list[int]:
+        """Ids of the day's packed emails whose segment object is gone.
+
+        Segments are named after the day they were written, not the received
+        day, so their keys are checked one by one instead of listed.
+        """
+        start, end = _day_bounds(day)
+        members = defaultdict(list)
+        hot = ArchivedEmail.objects.filter(
+            received_at__gte=start, received_at__lt=end, segment__isnull=False
+        ).values_list("s3_object_key", "id")
+        for key, email_id in hot:
+            members[key].append(email_id)
+        for email in cold:
+            if email.segment_id is not None:
+                members[email.s3_object_key].append(email.id)
+        return [email_id for key, ids in members.items() if not self.storage.exists(key) for email_id in ids]
+
+    def _queue_repairs(self, reindex: set[int], delete: set[int]) -> None:
+        from .tasks import repair_search_index
+
+        batch = self.cfg["REPAIR_BATCH_SIZE"]
+        reindex, delete = sorted(reindex), sorted(delete)
+        for i in range(0, max(len(reindex), len(delete)), batch):
+            repair_search_index.delay(reindex[i : i + batch], delete[i : i + batch])
+        self.report["reindex_queued"] += len(reindex)
+        self.report["delete_queued"] += len(delete)
+
+    def run(self, *, full: bool = False) -> dict:
+        started = timezone.now()
+        settled = settle_open_segments()
+        self.report["segments_sealed"] = settled["sealed"]
+        self.report["segments_abandoned"] = settled["abandoned"]
+        dirty = self._dirty_days(full)
+        self._refresh_db_digests(dirty)
+        horizon, older = None, set()
+        if self.cfg["LOOKBACK_DAYS"] and not full:
+            horizon = started.astimezone(dt.timezone.utc).date() - dt.timedelta(days=self.cfg["LOOKBACK_DAYS"])
+            older = self._history_days(horizon, dirty) | {day for day in dirty if day < horizon}
+        es_days = self._es_day_digests(horizon, older)
+        buckets = {b.day: b for b in ReconcileBucket.objects.all()}
+        for day in es_days.keys() - buckets.keys():
+            buckets[day] = ReconcileBucket(day=day)
+        if horizon is not None:
+            buckets = {day: b for day, b in buckets.items() if day >= horizon or day in older}
+        self.report["days_compared"] = len(buckets)
+        for day, bucket in sorted(buckets.items()):
+            bucket.es_count, bucket.es_digest = es_days.get(day, (0, 0))
+            differs = (bucket.db_count, bucket.db_digest) != (bucket.es_count, bucket.es_digest)
+            if differs:
+                self.report["days_differing"] += 1
+                reindex, delete = set(), set()
+                for address in self._diff_mailboxes(day):
+                    self.report["mailboxes_differing"] += 1
+                    day_reindex, day_delete = self._diff_messages(day, address)
+                    reindex |= day_reindex
+                    delete |= day_delete
+                self._queue_repairs(reindex, delete)
+            if day in dirty:
+                self._check_objects(day, bucket)
+            # Repaired days stay non-OK so the next run confirms the fix.
+            bucket.status = ReconcileBucket.STATUS_REPAIRING if differs else ReconcileBucket.STATUS_OK
+            bucket.checked_at = started
+            bucket.save()
+        logger.info("reconciliation finished: %s", dict(self.report))
+        return dict(self.report)
+
+
+def reindex_documents(email_ids: list[int]) -> list[dict]:
+    """Rebuilds search documents from the rows (hot or cold) and the stored EML bodies."""
+    access = EmailAccessService()
+    index = settings.ELASTICSEARCH["INDEX"]
+    actions = []
+    emails = list(
+        ArchivedEmail.objects.filter(id__in=email_ids)
+        .select_related("mailbox", "department")
+        .prefetch_related("participants")
+    )
+    if missing := set(email_ids) - {email.id for email in emails}:
+        keys = MessageKey.objects.filter(email_id__in=missing).values_list("email_id", "mailbox_id", "received_at")
+        emails.extend(ColdStore().get_many(keys, participants=True).values())
+    threads = dict(MessageKey.objects.filter(email_id__in=email_ids).values_list("email_id", "thread_id"))
+    for email in emails:
+        try:
+            raw_bytes = access.read(email)
+        except Exception as exc:
+            # Unreadable objects surface through the integrity checks; keep repairing the rest.
+            logger.error("cannot re-index email %s: %r", email.id, exc)
+            continue
+        payload = build_payload(raw_bytes, mailbox=email.mailbox, received_at=email.received_at)
+        payload["sent_at"] = email.sent_at
+        payload["participants"] = getattr(email, "tiered_participants", None) or [
+            {"type": p.type, "address": p.address} for p in email.participants.all()
+        ]
+        document = search_document(email, payload, threads.get(email.id))
+        actions.append({"_index": index, "_id": email.id, "_source": document})
+    return actions
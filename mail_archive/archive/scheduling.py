@@ -0,0 +1,171 @@
+"""Weighted fair-share dispatch of export work.
+
+Exports run one part (at most `PART_MESSAGES` messages) at a time and return
+to the queue between parts, so a huge export is preempted at part boundaries.
+Whenever a slot is free the dispatcher picks the department with the lowest
+recent usage per unit of weight, then the owner with the lowest usage in it,
+then that owner's oldest job. Usage is the number of messages exported,
+decayed with a half-life of `USAGE_HALF_LIFE_SECONDS`, so heavy exporters
+yield to everyone else without being starved.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+from core.redis import get_redis
+from .models import ExportJob
+
+logger = logging.getLogger(__name__)
+
+USAGE_KEY = "export_share:usage"
+DECAYED_AT_KEY = "export_share:decayed_at"
+LOCK_KEY = "export_share:dispatch"
+
+# KEYS[1] usage hash; ARGV factor. Scales every counter, dropping the ones that decayed away.
+DECAY_LUA = """
+local factor = tonumber(ARGV[1])
+local fields = redis.call('HGETALL', KEYS[1])
+for i = 1, #fields, 2 do
+  local value = tonumber(fields[i + 1]) * factor
+  if value < 1 then
+    redis.call('HDEL', KEYS[1], fields[i])
+  else
+    redis.call('HSET', KEYS[1], fields[i], tostring(value))
+  end
+end
+return #fields / 2
+"""
+
+
+class FairShareLedger:
+    def __init__(self):
+        self.cfg = settings.EXPORT_SCHEDULER
+        self.redis = get_redis()
+
+    def charge(self, owner_id: int, department_id: int, messages: int) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrbyfloat(USAGE_KEY, f"o:{owner_id}", messages)
+        pipe.hincrbyfloat(USAGE_KEY, f"d:{department_id}", messages)
+        pipe.execute()
+
+    def decay(self) -> None:
+        now = time.time()
+        last = self.redis.getset(DECAYED_AT_KEY, now)
+        if last is None:
+            return
+        factor = 0.5 ** (max(0.0, now - float(last)) / self.cfg["USAGE_HALF_LIFE_SECONDS"])
+        self.redis.eval(DECAY_LUA, 1, USAGE_KEY, factor)
+
+    def usage(self) -> dict[str, float]:
+        return {k.decode(): float(v) for k, v in self.redis.hgetall(USAGE_KEY).items()}
+
+
+def pick_jobs(jobs: list[ExportJob], usage: dict[str, float], slots: int) -> list[ExportJob]:
+    """Chooses up to `slots` jobs; `jobs` must be ordered oldest first and have owner departments loaded."""
+    cfg = settings.EXPORT_SCHEDULER
+    usage = dict(usage)
+    pending: dict[int, dict[int, list[ExportJob]]] = defaultdict(lambda: defaultdict(list))
+    weights = {}
+    for job in jobs:
+        department = job.owner.department
+        pending[department.id][job.owner_id].append(job)
+        weights[department.id] = float(cfg["DEPARTMENT_WEIGHTS"].get(department.path, 1))
+    chosen = []
+    while pending and len(chosen) < slots:
+        department_id = min(pending, key=lambda d: usage.get(f"d:{d}", 0.0) / weights[d])
+        owners = pending[department_id]
+        owner_id = min(owners, key=lambda o: usage.get(f"o:{o}", 0.0))
+        chosen.append(owners[owner_id].pop(0))
+        # Provisionally charge one part so the remaining slots spread across principals.
+        usage[f"d:{department_id}"] = usage.get(f"d:{department_id}", 0.0) + cfg["PART_MESSAGES"]
+        usage[f"o:{owner_id}"] = usage.get(f"o:{owner_id}", 0.0) + cfg["PART_MESSAGES"]
+        if not owners[owner_id]:
+            del owners[owner_id]
+        if not owners:
+            del pending[department_id]
+    return chosen
+
+
+class PartSuperseded(Exception):
+    """The running part was requeued (its heartbeat lapsed) and belongs to another run now."""
+
+
+def heartbeat(job: ExportJob) -> None:
+    """Marks the running part of `job` alive; raises PartSuperseded if this run no longer owns it."""
+    alive = ExportJob.objects.filter(
+        id=job.id, status=ExportJob.STATUS_RUNNING, dispatched_at=job.dispatched_at
+    ).update(heartbeat_at=timezone.now())
+    if not alive:
+        raise PartSuperseded(job.id)
+
+
+class ExportScheduler:
+    def __init__(self):
+        self.cfg = settings.EXPORT_SCHEDULER
+        self.redis = get_redis()
+        self.ledger = FairShareLedger()
+
+    def _requeue_stalled(self) -> int:
+        cutoff = timezone.now() - dt.timedelta(seconds=self.cfg["PART_TIMEOUT_SECONDS"])
+        # A slow part keeps its heartbeat fresh; only a part whose worker went away stops beating.
+        stalled = ExportJob.objects.filter(status=ExportJob.STATUS_RUNNING, heartbeat_at__lt=cutoff).update(
+            status=ExportJob.STATUS_QUEUED, dispatched_at=None, heartbeat_at=None
+        )
+        if stalled:
+            logger.warning("requeued %s export parts whose worker stopped responding", stalled)
+        return stalled
+
+    def dispatch(self, enqueue) -> list[int]:
+        """Marks the chosen jobs RUNNING and passes their ids to `enqueue`; one dispatcher runs at a time."""
+        lock = self.redis.lock(LOCK_KEY, timeout=60)
+        if not lock.acquire(blocking=False):
+            return []
+        try:
+            self._requeue_stalled()
+            self.ledger.decay()
+            slots = self.cfg["MAX_RUNNING"] - ExportJob.objects.filter(status=ExportJob.STATUS_RUNNING).count()
+            if slots <= 0:
+                return []
+            queued = list(
+                ExportJob.objects.filter(status=ExportJob.STATUS_QUEUED)
+                .select_related("owner__department")
+                .order_by("created_at")[: self.cfg["MAX_CANDIDATES"]]
+            )
+            dispatched = []
+            for job in pick_jobs(queued, self.ledger.usage(), slots):
+                now = timezone.now()
+                claimed = ExportJob.objects.filter(id=job.id, status=ExportJob.STATUS_QUEUED).update(
+                    status=ExportJob.STATUS_RUNNING, dispatched_at=now, heartbeat_at=now
+                )
+                if claimed:
+                    enqueue(job.id)
+                    dispatched.append(job.id)
+            return dispatched
+        finally:
+            lock.release()
+
+    def stats(self) -> dict:
+        counts = dict(
+            ExportJob.objects.filter(status__in=[ExportJob.STATUS_QUEUED, ExportJob.STATUS_RUNNING])
+            .values_list("status")
+            .annotate(jobs=Count("id"))
+        )
+        oldest = (
+            ExportJob.objects.filter(status=ExportJob.STATUS_QUEUED)
+            .order_by("created_at")
+            .values_list("created_at", flat=True)
+            .first()
+        )
+        return {
+            "queued": counts.get(ExportJob.STATUS_QUEUED, 0),
+            "running": counts.get(ExportJob.STATUS_RUNNING, 0),
+            "max_running": self.cfg["MAX_RUNNING"],
+            "oldest_queued_job_age_seconds": round((timezone.now() - oldest).total_seconds(), 1) if oldest else None,
+            "usage": self.ledger.usage(),
+        }
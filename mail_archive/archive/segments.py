@@ -0,0 +1,154 @@
+"""Append-only segment objects that pack many small EML records (WARC-like).
+
+A segment is a run of records, each `ARCSEG/1 <json header>\\r\\n<stored bytes>\\r\\n`,
+so it can be read back without the database. Rows address their record by
+(segment, offset, length) and read it with an HTTP Range request.
+
+The whole segment is written with a single PUT, after its `StorageSegment`
+row has been committed as OPEN, and the row is sealed once the member rows
+are committed. A segment therefore stays OPEN only if its writer died in
+between; `settle_open_segments` then seals it if rows reference it and marks
+it ABANDONED otherwise (Object Lock keeps the bytes, nothing points at them).
+"""
+from __future__ import annotations
+
+import datetime as dt
+import json
+import logging
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+from core.storage import S3Storage
+from .dedup import DuplicateGuard
+from .models import ArchivedEmail, StorageSegment
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ARCSEG/1 "
+MAX_RUN_GAP = 4096
+
+
+def segment_key(day: dt.date) -> str:
+    return f"segments/{day}/{uuid.uuid4().hex}.seg"
+
+
+def segment_range(email: ArchivedEmail) -> tuple[int, int] | None:
+    if email.segment_id is None:
+        return None
+    return email.segment_offset, email.segment_length
+
+
+def packable(stored: bytes) -> bool:
+    cfg = settings.SEGMENT_STORAGE
+    return cfg["ENABLED"] and len(stored) <= cfg["MAX_OBJECT_BYTES"]
+
+
+class SegmentWriter:
+    def __init__(self, storage: S3Storage | None = None):
+        self.cfg = settings.SEGMENT_STORAGE
+        self.storage = storage or S3Storage()
+
+    def _groups(self, members: list) -> list[list]:
+        groups, current, size = [], [], 0
+        for member in members:
+            if current and size + len(member[2]) > self.cfg["TARGET_SEGMENT_BYTES"]:
+                groups.append(current)
+                current, size = [], 0
+            current.append(member)
+            size += len(member[2])
+        if current:
+            groups.append(current)
+        return groups
+
+    def write(self, members: list[tuple[object, dict, bytes, int | None]]) -> dict:
+        """Packs (token, header, stored bytes, retain days) members into as many segments as needed.
+
+        Returns {token: ArchivedEmail storage fields, or the exception that lost its segment}.
+        """
+        placed = {}
+        for group in self._groups(members):
+            buffer = bytearray()
+            offsets = {}
+            for token, header, data, _ in group:
+                buffer += MAGIC + json.dumps(header, separators=(",", ":")).encode() + b"\r\n"
+                offsets[token] = (len(buffer), len(data))
+                buffer += data + b"\r\n"
+            # Retention is per object; the segment keeps the longest retention any member asked for.
+            retain_days = max(days or settings.S3_STORAGE["LOCK_RETENTION_DAYS"] for *_, days in group)
+            segment = StorageSegment.objects.create(
+                key=segment_key(timezone.now().date()), size_bytes=len(buffer), record_count=len(group)
+            )
+            try:
+                self.storage.put_object(segment.key, bytes(buffer), retain_days=retain_days)
+            except Exception as exc:
+                logger.exception("segment %s write failed", segment.key)
+                segment.status = StorageSegment.STATUS_ABANDONED
+                segment.save(update_fields=["status"])
+                placed.update({token: exc for token, *_ in group})
+                continue
+            for token, (offset, length) in offsets.items():
+                placed[token] = {
+                    "s3_object_key": segment.key,
+                    "segment_id": segment.id,
+                    "segment_offset": offset,
+                    "segment_length": length,
+                }
+        return placed
+
+
+def record_header(*, message_id: str, mailbox_id: int, sha256: str, storage_fields: dict) -> dict:
+    return {
+        "message_id": message_id,
+        "mailbox_id": mailbox_id,
+        "sha256": sha256,
+        "codec": storage_fields["codec"],
+        "dictionary_id": storage_fields["compression_dictionary_id"],
+    }
+
+
+def seal(segment_ids) -> None:
+    segment_ids = {i for i in segment_ids if i is not None}
+    if segment_ids:
+        StorageSegment.objects.filter(id__in=segment_ids, status=StorageSegment.STATUS_OPEN).update(
+            status=StorageSegment.STATUS_SEALED, sealed_at=timezone.now()
+        )
+
+
+def settle_open_segments() -> dict:
+    cutoff = timezone.now() - dt.timedelta(seconds=settings.SEGMENT_STORAGE["OPEN_GRACE_SECONDS"])
+    settled = {"sealed": 0, "abandoned": 0}
+    guard = DuplicateGuard()
+    for segment in StorageSegment.objects.filter(status=StorageSegment.STATUS_OPEN, created_at__lt=cutoff):
+        if ArchivedEmail.objects.filter(segment=segment).exists():
+            seal([segment.id])
+            settled["sealed"] += 1
+            continue
+        segment.status = StorageSegment.STATUS_ABANDONED
+        segment.save(update_fields=["status"])
+        guard.record_orphan(segment.key, reason="segment writer stopped before its rows were committed")
+        settled["abandoned"] += 1
+    return settled
+
+
+def coalesced_runs(emails: list[ArchivedEmail], max_bytes: int) -> list[list[ArchivedEmail]]:
+    """Groups packed emails that can be fetched with one Range request per group.
+
+    Neighbouring records are separated by their framing (a short header line);
+    gaps up to MAX_RUN_GAP are read and discarded rather than split into a new request.
+    """
+    runs: list[list[ArchivedEmail]] = []
+    for email in sorted(emails, key=lambda e: (e.segment_id, e.segment_offset)):
+        if runs:
+            last = runs[-1][-1]
+            gap = email.segment_offset - (last.segment_offset + last.segment_length)
+            end = email.segment_offset + email.segment_length
+            if (
+                email.segment_id == last.segment_id
+                and 0 <= gap <= MAX_RUN_GAP
+                and end - runs[-1][0].segment_offset <= max_bytes
+            ):
+                runs[-1].append(email)
+                continue
+        runs.append([email])
+    return runs
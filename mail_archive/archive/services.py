@@ -1,13 +1,79 @@
 from __future__ import annotations
 
 import base64
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from django.conf import settings
-from django.db import transaction
-from core.hash_utils import sha256_bytes
-from core.storage import S3Storage
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import APIException
+from core.compression import CODEC_IDENTITY
+from core.hash_utils import sha256_bytes, sha256_stream
+from core.storage import BlobCache, S3Storage
 from core.search import get_client
+from core import metrics
+from core.timing import StageTimer
 from audit.services import AuditService
-from .models import ArchivedEmail, EmailAttachment, EmailParticipant
+from .compression import email_decoder, encode
+from .correspondence import store_participants
+from .dedup import DuplicateGuard
+from .mime import header_references
+from .models import ArchivedEmail, EmailAttachment, MessageKey, SearchQueue
+from .segments import SegmentWriter, coalesced_runs, packable, record_header, seal, segment_range
+from .threads import link as link_threads, retry_on_deadlock
+from .tiering import get_email_by_message_id
+
+logger = logging.getLogger(__name__)
+
+
+class IngestInProgress(APIException):
+    status_code = 409
+    default_detail = "ingest_in_progress"
+    default_code = "ingest_in_progress"
+
+
+@dataclass
+class PreparedEmail:
+    """A decoded and hashed message whose attachments (and usually EML) are already in S3."""
+
+    key: str
+    sha256: str
+    size_bytes: int
+    storage_fields: dict
+    attachment_rows: list[dict]
+    stored: bytes | None = None  # encoded EML still to be written into a segment
+    references: list[str] = field(default_factory=list)  # In-Reply-To / References ids
+
+
+def email_object_key(received_at, message_id: str) -> str:
+    return f"eml/{received_at.date()}/{message_id}.eml"
+
+
+ATTACHMENT_PREFIX = "attachments/sha256/"
+
+
+def attachment_object_key(sha: str) -> str:
+    return f"{ATTACHMENT_PREFIX}{sha[:2]}/{sha}"
+
+
+def search_document(email: ArchivedEmail, payload: dict, thread_id: int | None = None) -> dict:
+    return {
+        "email_id": email.id,
+        "message_id": email.message_id,
+        "department_path": email.department.path,
+        "mailbox": email.mailbox.address,
+        "subject": email.subject,
+        "body_text": payload.get("body_text", ""),
+        "body_html": payload.get("body_html", ""),
+        "participants": [p["address"] for p in payload["participants"]],
+        "sent_at": payload["sent_at"].isoformat(),
+        "received_at": payload["received_at"].isoformat(),
+        "sha256": email.sha256,
+        "immutable_flag": True,
+        "access_tags": [email.department.path, email.mailbox.address],
+        "thread_id": thread_id,
+    }
 
 
 class ArchiveIngestService:
@@ -15,95 +81,334 @@ class ArchiveIngestService:
         self.storage = S3Storage()
         self.es = get_client()
         self.index = settings.ELASTICSEARCH["INDEX"]
+        self.guard = DuplicateGuard()
 
-    @transaction.atomic
     def ingest(self, *, user, payload: dict) -> ArchivedEmail:
+        """Stores a message; a retried delivery returns the existing row with `is_duplicate` set."""
         mailbox = payload["mailbox"]
-        raw_bytes = base64.b64decode(payload["raw_eml"])
-        sha = sha256_bytes(raw_bytes)
-        key = f"eml/{payload['received_at'].date()}/{payload['message_id']}.eml"
-        self.storage.put_object(key, raw_bytes, retain_days=payload.get("retain_days"))
-        email = ArchivedEmail.objects.create(
-            message_id=payload["message_id"],
-            mailbox=mailbox,
-            department=mailbox.department,
-            subject=payload["subject"],
-            sent_at=payload["sent_at"],
-            received_at=payload["received_at"],
+        message_id = payload["message_id"]
+        timer = self.timer = StageTimer()
+        with timer.stage("dedup"):
+            existing = self.guard.existing(mailbox.id, message_id)
+        if existing is not None:
+            existing.is_duplicate = True
+            return existing
+        if not self.guard.claim(mailbox.id, message_id):
+            raise IngestInProgress()
+        try:
+            prepared = self._prepare(payload, timer)
+            email = self._persist(user=user, payload=payload, prepared=prepared, timer=timer)
+        finally:
+            self.guard.release(mailbox.id, message_id)
+        return email
+
+    def ingest_batch(self, items: list[tuple[object, dict]]) -> list[ArchivedEmail | Exception]:
+        """Stores (user, payload) items; each result is the email or the exception for that item.
+
+        With segment storage enabled, small messages of the batch are packed into
+        shared segment objects instead of one S3 object each.
+        """
+        results: list = [None] * len(items)
+        prepared: dict[int, tuple[PreparedEmail, StageTimer]] = {}
+        claimed = []
+        try:
+            for i, (user, payload) in enumerate(items):
+                mailbox, message_id = payload["mailbox"], payload["message_id"]
+                timer = StageTimer()
+                try:
+                    with timer.stage("dedup"):
+                        existing = self.guard.existing(mailbox.id, message_id)
+                    if existing is not None:
+                        existing.is_duplicate = True
+                        results[i] = existing
+                        continue
+                    if not self.guard.claim(mailbox.id, message_id):
+                        raise IngestInProgress()
+                    claimed.append((mailbox.id, message_id))
+                    prepared[i] = (self._prepare(payload, timer, pack=True), timer)
+                except Exception as exc:
+                    results[i] = exc
+            self._pack(items, prepared, results)
+            for i, (item, timer) in prepared.items():
+                if results[i] is not None:
+                    continue
+                user, payload = items[i]
+                try:
+                    results[i] = self._persist(user=user, payload=payload, prepared=item, timer=timer)
+                except Exception as exc:
+                    results[i] = exc
+            seal(item.storage_fields.get("segment_id") for item, _ in prepared.values())
+        finally:
+            for mailbox_id, message_id in claimed:
+                self.guard.release(mailbox_id, message_id)
+        return results
+
+    def _pack(self, items, prepared: dict, results: list) -> None:
+        members = [
+            (
+                i,
+                record_header(
+                    message_id=items[i][1]["message_id"],
+                    mailbox_id=items[i][1]["mailbox"].id,
+                    sha256=item.sha256,
+                    storage_fields=item.storage_fields,
+                ),
+                item.stored,
+                items[i][1].get("retain_days"),
+            )
+            for i, (item, _) in prepared.items()
+            if item.stored is not None
+        ]
+        if not members:
+            return
+        for i, placement in SegmentWriter(self.storage).write(members).items():
+            if isinstance(placement, Exception):
+                results[i] = placement
+                continue
+            item = prepared[i][0]
+            item.key = placement.pop("s3_object_key")
+            item.storage_fields.update(placement)
+            item.stored = None
+
+    def _prepare(self, payload: dict, timer: StageTimer, *, pack: bool = False) -> PreparedEmail:
+        """Decodes and hashes the message and uploads its blobs, except a packable EML when `pack`."""
+        with timer.stage("decode"):
+            raw_bytes = payload.get("raw_bytes") or base64.b64decode(payload["raw_eml"])
+        with timer.stage("hash"):
+            sha = sha256_bytes(raw_bytes)
+        # Parsed payloads carry the references; API payloads are read from the header block.
+        references = payload["references"] if "references" in payload else header_references(raw_bytes)
+        key = email_object_key(payload["received_at"], payload["message_id"])
+        # Blobs are written before the transaction opens so row locks are only held for the inserts.
+        with timer.stage("blobs"):
+            attachment_rows, storage_fields, stored = self._upload_blobs(key, raw_bytes, payload, timer, pack=pack)
+        return PreparedEmail(
+            key=key,
             sha256=sha,
-            s3_object_key=key,
             size_bytes=len(raw_bytes),
-            has_html=bool(payload.get("body_html")),
-            has_text=bool(payload.get("body_text")),
+            storage_fields=storage_fields,
+            attachment_rows=attachment_rows,
+            stored=stored,
+            references=references,
         )
-        participants = [
-            EmailParticipant(email=email, type=p["type"], address=p["address"])
-            for p in payload["participants"]
-        ]
-        EmailParticipant.objects.bulk_create(participants, ignore_conflicts=True)
-        attachments = []
-        for attachment in payload.get("attachments", []):
-            content = attachment.get("content")
-            if content:
-                content_bytes = base64.b64decode(content)
-                att_sha = sha256_bytes(content_bytes)
-                att_key = f"attachments/{email.id}/{attachment['filename']}"
-                self.storage.put_object(att_key, content_bytes)
-                attachments.append(
-                    EmailAttachment(
-                        email=email,
-                        filename=attachment["filename"],
-                        mime_type=attachment["mime_type"],
-                        size_bytes=len(content_bytes),
-                        sha256=att_sha,
-                        s3_object_key=att_key,
-                    )
+
+    def _persist(self, *, user, payload: dict, prepared: PreparedEmail, timer: StageTimer) -> ArchivedEmail:
+        mailbox = payload["mailbox"]
+        message_id = payload["message_id"]
+        try:
+            email = self._insert(user=user, payload=payload, prepared=prepared, timer=timer)
+        except IntegrityError:
+            existing = get_email_by_message_id(mailbox.id, message_id)
+            if existing is None:
+                raise
+            self.guard.record_orphan(prepared.key)
+            existing.is_duplicate = True
+            return existing
+        self.guard.remember(mailbox.id, message_id)
+        email.is_duplicate = False
+        logger.info("archived %s timings_ms=%s", message_id, timer.as_dict())
+        metrics.observe_stages("ingest", timer)
+        return email
+
+    def _insert(self, *, user, payload: dict, prepared: PreparedEmail, timer: StageTimer) -> ArchivedEmail:
+        email, thread_id = retry_on_deadlock(
+            lambda: self._store(user=user, payload=payload, prepared=prepared, timer=timer)
+        )
+        with timer.stage("es"):
+            self._index(email, payload, thread_id)
+        return email
+
+    def _store(self, *, user, payload: dict, prepared: PreparedEmail, timer: StageTimer) -> tuple[ArchivedEmail, int]:
+        mailbox = payload["mailbox"]
+        with transaction.atomic():
+            with timer.stage("db"):
+                email = ArchivedEmail.objects.create(
+                    message_id=payload["message_id"],
+                    mailbox=mailbox,
+                    department=mailbox.department,
+                    subject=payload["subject"],
+                    sent_at=payload["sent_at"],
+                    received_at=payload["received_at"],
+                    sha256=prepared.sha256,
+                    s3_object_key=prepared.key,
+                    size_bytes=prepared.size_bytes,
+                    has_html=bool(payload.get("body_html")),
+                    has_text=bool(payload.get("body_text")),
+                    **prepared.storage_fields,
                 )
-            else:
-                attachments.append(
-                    EmailAttachment(
-                        email=email,
-                        filename=attachment["filename"],
-                        mime_type=attachment["mime_type"],
-                        size_bytes=attachment["size_bytes"],
-                        sha256=attachment["sha256"],
-                        s3_object_key=f"external/{attachment['filename']}",
+                thread_id = link_threads([(email.message_id, prepared.references)])[email.message_id]
+                # Raises IntegrityError, rolling the email back, when the message is already stored.
+                MessageKey.for_email(email, thread_id).save()
+                store_participants([(email, payload["participants"])])
+                if prepared.attachment_rows:
+                    EmailAttachment.objects.bulk_create(
+                        [EmailAttachment(email=email, **row) for row in prepared.attachment_rows], ignore_conflicts=True
                     )
-                )
-        if attachments:
-            EmailAttachment.objects.bulk_create(attachments, ignore_conflicts=True)
-        self._index(email, payload, sha)
-        AuditService.append(user, "ARCHIVE_STORE", {"message_id": email.message_id})
-        return email
+            with timer.stage("audit"):
+                AuditService.append(user, "ARCHIVE_STORE", {"message_id": email.message_id})
+        return email, thread_id
+
+    def _upload_blobs(
+        self, key: str, raw_bytes: bytes, payload: dict, timer: StageTimer, *, pack: bool = False
+    ) -> tuple[list[dict], dict, bytes | None]:
+        """Uploads the EML and decodes, hashes and uploads attachments concurrently.
+
+        Returns the attachment rows, the storage fields (codec) of the EML and, if
+        `pack` and it is small enough for a segment, the encoded EML left to write.
+        """
+        retain_days = payload.get("retain_days")
+        department_id = payload["mailbox"].department_id
+
+        def put_eml() -> tuple[dict, bytes | None]:
+            start = time.perf_counter()
+            stored, fields = encode(raw_bytes, department_id)
+            timer.add("compress", time.perf_counter() - start)
+            if pack and packable(stored):
+                return fields, stored
+            put(key, stored, retain_days)
+            return fields, None
+
+        def put(object_key: str, data: bytes, days: int | None = None):
+            start = time.perf_counter()
+            self.storage.put_object(object_key, data, retain_days=days)
+            timer.add("s3", time.perf_counter() - start)
 
-    def _index(self, email: ArchivedEmail, payload: dict, sha: str):
-        doc = {
-            "email_id": email.id,
-            "message_id": email.message_id,
-            "department_path": email.department.path,
-            "mailbox": email.mailbox.address,
-            "subject": email.subject,
-            "body_text": payload.get("body_text", ""),
-            "body_html": payload.get("body_html", ""),
-            "participants": [p["address"] for p in payload["participants"]],
-            "sent_at": payload["sent_at"].isoformat(),
-            "received_at": payload["received_at"].isoformat(),
-            "sha256": sha,
-            "immutable_flag": True,
-            "access_tags": [email.department.path, email.mailbox.address],
-        }
-        self.es.index(index=self.index, id=email.id, document=doc, refresh=False)
+        def process(attachment: dict) -> dict:
+            content_bytes = attachment.get("content_bytes")
+            if content_bytes is None and attachment.get("content"):
+                start = time.perf_counter()
+                content_bytes = base64.b64decode(attachment["content"])
+                timer.add("attachment_decode", time.perf_counter() - start)
+            if content_bytes is None:
+                return {
+                    "filename": attachment["filename"],
+                    "mime_type": attachment["mime_type"],
+                    "size_bytes": attachment["size_bytes"],
+                    "sha256": attachment["sha256"],
+                    "s3_object_key": f"external/{attachment['filename']}",
+                }
+            start = time.perf_counter()
+            att_sha = sha256_bytes(content_bytes)
+            timer.add("attachment_hash", time.perf_counter() - start)
+            att_key = attachment_object_key(att_sha)
+            # Attachments are content-addressed: a HEAD is far cheaper than a second locked version of the object.
+            start = time.perf_counter()
+            stored = self.storage.exists(att_key)
+            timer.add("s3", time.perf_counter() - start)
+            if not stored:
+                put(att_key, content_bytes)
+            return {
+                "filename": attachment["filename"],
+                "mime_type": attachment["mime_type"],
+                "size_bytes": len(content_bytes),
+                "sha256": att_sha,
+                "s3_object_key": att_key,
+            }
+
+        attachments = payload.get("attachments") or []
+        workers = max(1, min(settings.INGEST_SETTINGS["ATTACHMENT_CONCURRENCY"], len(attachments) + 1))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-blob") as pool:
+            eml_upload = pool.submit(put_eml)
+            rows = list(pool.map(process, attachments))
+            storage_fields, stored = eml_upload.result()
+        return rows, storage_fields, stored
+
+    def _index(self, email: ArchivedEmail, payload: dict, thread_id: int):
+        doc = search_document(email, payload, thread_id)
+        try:
+            self.es.index(index=self.index, id=email.id, document=doc, refresh=False)
+        except Exception as exc:
+            # The row is committed; park the document for `retry_search_queue`.
+            logger.warning("indexing email %s deferred: %s", email.id, exc)
+            SearchQueue.objects.create(email=email, payload=doc, last_error=repr(exc))
 
 
 class EmailAccessService:
     def __init__(self):
         self.storage = S3Storage()
+        self.cache = BlobCache(self.storage)
 
     def presign(self, email: ArchivedEmail) -> str:
         return self.storage.presign(email.s3_object_key)
 
+    def iter_content(self, email: ArchivedEmail, chunk_size: int = 1024 * 1024):
+        """Yields the original message bytes, decompressed if needed."""
+        return self.cache.iter_object(
+            email.s3_object_key,
+            email.sha256,
+            chunk_size=chunk_size,
+            decoder=email_decoder(email),
+            byte_range=segment_range(email),
+        )
+
+    def iter_range(self, email: ArchivedEmail, start: int, length: int, chunk_size: int = 1024 * 1024):
+        """Yields `length` bytes of the original message from `start`.
+
+        Served from a cached copy when there is one. Otherwise uncompressed objects
+        are read with a Range request for just the slice; compressed ones have to be
+        decoded from the beginning, and the prefix is discarded.
+        """
+        cached = self.cache.iter_cached_slice(
+            email.s3_object_key, email.sha256, start, length, chunk_size=chunk_size, byte_range=segment_range(email)
+        )
+        if cached is not None:
+            yield from cached
+            return
+        if email.codec == CODEC_IDENTITY:
+            base = email.segment_offset if email.segment_id is not None else 0
+            yield from self.storage.iter_object(
+                email.s3_object_key, chunk_size=chunk_size, byte_range=(base + start, length)
+            )
+            return
+        position = 0
+        for chunk in self.iter_content(email, chunk_size=chunk_size):
+            end = position + len(chunk)
+            if end > start:
+                yield chunk[max(0, start - position) : start + length - position]
+            position = end
+            if position >= start + length:
+                break
+
+    def read(self, email: ArchivedEmail) -> bytes:
+        return b"".join(self.iter_content(email))
+
+    def read_many(self, emails, window: int = 1000):
+        """Yields (email, original bytes); packed neighbours in a segment share one Range request.
+
+        Packed emails are collected `window` at a time, so their order within a window changes.
+        """
+        packed = []
+        for email in emails:
+            if email.segment_id is None:
+                yield email, self.read(email)
+                continue
+            packed.append(email)
+            if len(packed) >= window:
+                yield from self._read_packed(packed)
+                packed = []
+        yield from self._read_packed(packed)
+
+    def _read_packed(self, packed: list[ArchivedEmail]):
+        for run in coalesced_runs(packed, settings.SEGMENT_STORAGE["EXPORT_MAX_RANGE_BYTES"]):
+            if len(run) == 1:
+                yield run[0], self.read(run[0])
+                continue
+            start = run[0].segment_offset
+            end = run[-1].segment_offset + run[-1].segment_length
+            data = b"".join(self.storage.iter_object(run[0].s3_object_key, byte_range=(start, end - start)))
+            for email in run:
+                stored = data[email.segment_offset - start : email.segment_offset - start + email.segment_length]
+                decode = email_decoder(email)
+                yield email, b"".join(decode([stored])) if decode else stored
+
     def verify(self, email: ArchivedEmail) -> bool:
-        client = self.storage.client
-        obj = client.get_object(Bucket=self.storage.bucket, Key=email.s3_object_key)
-        contents = obj["Body"].read()
-        return email.sha256 == sha256_bytes(contents)
+        # Always hashes the S3 object itself; a matching read refreshes the cached copy on the way.
+        return email.sha256 == sha256_stream(
+            self.cache.iter_object(
+                email.s3_object_key,
+                email.sha256,
+                refresh=True,
+                decoder=email_decoder(email),
+                byte_range=segment_range(email),
+            )
+        )
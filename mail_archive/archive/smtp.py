@@ -0,0 +1,225 @@
+"""Asyncio SMTP journaling receiver that feeds raw messages into the archive pipeline.
+
+Each accepted message is fsynced to the local spool before the 250 reply, so a
+crash never loses an acknowledged message. A persister coroutine hands spooled
+messages to a thread pool in batches while the listener keeps accepting; it is
+fed in memory by the handler, and the spool directory is only scanned at startup
+to replay what a previous run left behind.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+
+from aiosmtpd.smtp import SMTP
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from accounts.models import Mailbox
+from core.spool import Spool
+from .mime import build_payload, raw_payload
+from .services import ArchiveIngestService
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_mailboxes(payload: dict, envelope_recipients: list[str]) -> list[Mailbox]:
+    """Archived mailboxes among the envelope recipients, falling back to header participants."""
+    envelope = {address.lower() for address in envelope_recipients}
+    headers = {p["address"] for p in payload["participants"]}
+    mailboxes = list(Mailbox.objects.select_related("department").filter(address__in=envelope | headers))
+    by_envelope = [m for m in mailboxes if m.address.lower() in envelope]
+    return by_envelope or mailboxes
+
+
+def persist_batch(spool: Spool, paths: list[Path], user) -> tuple[int, list[Path]]:
+    """Archives spooled messages; returns the number stored and the paths left in the spool for a retry.
+
+    A message that cannot be parsed is archived as raw bytes with minimal
+    metadata (`raw_payload`); only messages matching no archived mailbox are
+    rejected here.
+    """
+    close_old_connections()
+    service = ArchiveIngestService()
+    items = []
+    owners = []
+    failed = []
+    try:
+        for path in paths:
+            meta, raw = spool.read(path)
+            received = {"received_at": parse_datetime(meta["received_at"]), "envelope_recipients": meta["rcpt_tos"]}
+            try:
+                payload = build_payload(raw, mailbox=None, **received)
+            except Exception:
+                logger.exception("unparseable journal message %s archived with minimal metadata", path.name)
+                payload = raw_payload(raw, mailbox=None, **received)
+            try:
+                mailboxes = resolve_mailboxes(payload, meta["rcpt_tos"])
+            except Exception:
+                logger.exception("journal message %s left in spool for retry", path.name)
+                failed.append(path)
+                continue
+            if not mailboxes:
+                logger.warning("journal message %s matches no archived mailbox", path.name)
+                spool.reject(path)
+                continue
+            for mailbox in mailboxes:
+                items.append((user, {**payload, "mailbox": mailbox}))
+                owners.append(path)
+        # One call per batch, so segment storage can pack the small messages together.
+        # A message replayed from the spool after a crash comes back as a duplicate.
+        results = service.ingest_batch(items)
+        for path, result in zip(owners, results):
+            if isinstance(result, Exception) and path not in failed:
+                logger.error("journal message %s left in spool for retry", path.name, exc_info=result)
+                failed.append(path)
+        stored = 0
+        for path in dict.fromkeys(owners):
+            if path not in failed:
+                spool.remove(path)
+                stored += 1
+    finally:
+        close_old_connections()
+    return stored, failed
+
+
+class JournalHandler:
+    def __init__(self, spool: Spool, executor: Executor, persister: JournalPersister):
+        self.spool = spool
+        self.executor = executor
+        self.persister = persister
+
+    async def handle_DATA(self, server, session, envelope):
+        meta = {
+            "mail_from": envelope.mail_from,
+            "rcpt_tos": list(envelope.rcpt_tos),
+            "peer": str(session.peer[0]) if session.peer else None,
+            "received_at": timezone.now().isoformat(),
+        }
+        data = envelope.original_content or envelope.content
+        loop = asyncio.get_running_loop()
+        try:
+            path = await loop.run_in_executor(self.executor, self.spool.write, data, meta)
+        except OSError:
+            logger.exception("spool write failed")
+            return "451 Requested action aborted: local spool error"
+        self.persister.enqueue(path)
+        return f"250 OK queued as {path.stem}"
+
+
+class JournalPersister:
+    def __init__(self, spool: Spool, executor: Executor, user):
+        cfg = settings.SMTP_JOURNAL
+        self.spool = spool
+        self.executor = executor
+        self.user = user
+        self.batch_size = cfg["BATCH_SIZE"]
+        self.flush_interval = cfg["FLUSH_INTERVAL_SECONDS"]
+        self.slots = asyncio.Semaphore(cfg["PERSIST_WORKERS"])
+        self.retry_base = cfg["RETRY_BASE_SECONDS"]
+        self.retry_max = cfg["RETRY_MAX_SECONDS"]
+        self.max_attempts = cfg["MAX_ATTEMPTS"]
+        self.wakeup = asyncio.Event()
+        # Spooled paths awaiting their first attempt, in arrival order.
+        self.queue: deque[Path] = deque()
+        self.in_flight: set[Path] = set()
+        # Failed path -> (attempts, monotonic time of the next attempt); a restart retries at once.
+        self.retries: dict[Path, tuple[int, float]] = {}
+
+    def enqueue(self, path: Path) -> None:
+        self.queue.append(path)
+        self.wakeup.set()
+
+    async def recover(self) -> int:
+        """Queues what a previous run left in the spool; the only directory scan."""
+        paths = await asyncio.get_running_loop().run_in_executor(self.executor, self.spool.pending)
+        self.queue.extendleft(reversed(paths))
+        self.wakeup.set()
+        return len(paths)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.dispatch()
+
+    async def dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = self._next_batch(time.monotonic())
+            if not batch:
+                self.slots.release()
+                return
+            self.in_flight.update(batch)
+            future = loop.run_in_executor(self.executor, persist_batch, self.spool, batch, self.user)
+            future.add_done_callback(lambda fut, batch=batch: self._finished(fut, batch))
+
+    def _next_batch(self, now: float) -> list[Path]:
+        due = sorted(p for p, (_, retry_at) in self.retries.items() if retry_at <= now and p not in self.in_flight)
+        batch = due[: self.batch_size]
+        while self.queue and len(batch) < self.batch_size:
+            batch.append(self.queue.popleft())
+        return batch
+
+    def _finished(self, future, batch: list[Path]) -> None:
+        self.in_flight.difference_update(batch)
+        self.slots.release()
+        if future.exception():
+            logger.error("journal batch failed", exc_info=future.exception())
+            failed = batch
+        else:
+            _, failed = future.result()
+        for path in set(batch) - set(failed):
+            self.retries.pop(path, None)
+        for path in failed:
+            self._retry_later(path)
+
+    def _retry_later(self, path: Path) -> None:
+        """Backs the path off exponentially; after MAX_ATTEMPTS storage failures it is rejected."""
+        attempts = self.retries.get(path, (0, 0.0))[0] + 1
+        if attempts >= self.max_attempts:
+            logger.error("journal message %s rejected after %s failed attempts", path.name, attempts)
+            self.retries.pop(path, None)
+            try:
+                self.spool.reject(path)
+            except OSError:
+                logger.exception("rejecting journal message %s failed", path.name)
+            return
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        self.retries[path] = (attempts, time.monotonic() + delay)
+
+
+async def serve(host: str, port: int) -> None:
+    cfg = settings.SMTP_JOURNAL
+    user = await asyncio.to_thread(get_user_model().objects.get, username=cfg["SERVICE_USERNAME"])
+    spool = Spool(cfg["SPOOL_DIR"])
+    executor = ThreadPoolExecutor(max_workers=cfg["PERSIST_WORKERS"] + 4, thread_name_prefix="journal")
+    persister = JournalPersister(spool, executor, user)
+    # Replays anything left in the spool by a previous run, ahead of new messages.
+    recovered = await persister.recover()
+    handler = JournalHandler(spool, executor, persister)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        lambda: SMTP(
+            handler,
+            data_size_limit=cfg["MAX_MESSAGE_BYTES"],
+            enable_SMTPUTF8=True,
+            decode_data=False,
+            hostname=cfg["HOSTNAME"],
+        ),
+        host=host,
+        port=port,
+    )
+    logger.info("smtp journal receiver listening on %s:%s (%s spooled)", host, port, recovered)
+    async with server:
+        await persister.run()
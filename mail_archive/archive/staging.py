@@ -0,0 +1,168 @@
+"""Durable staging of ingest payloads for the queued ingest mode.
+
+Payloads are appended to a Redis stream (persisted by Redis AOF) and drained
+by Celery workers through a consumer group, so the API only pays for the
+validation and a single XADD per message.
+"""
+from __future__ import annotations
+
+import json
+import time
+import uuid
+from dataclasses import dataclass
+
+from django.conf import settings
+from rest_framework.exceptions import APIException
+from core.redis import get_redis
+
+
+class IngestBackpressure(APIException):
+    status_code = 503
+    default_detail = "ingest_backpressure"
+    default_code = "ingest_backpressure"
+
+
+@dataclass
+class StagedEntry:
+    entry_id: str
+    tracking_id: str
+    user_id: int
+    payload: dict
+    staged_at_ms: int
+
+
+class IngestStage:
+    def __init__(self):
+        self.cfg = settings.INGEST_SETTINGS
+        self.redis = get_redis()
+        self.stream = self.cfg["STREAM"]
+        self.group = self.cfg["CONSUMER_GROUP"]
+
+    def _status_key(self, tracking_id: str) -> str:
+        return f"{self.stream}:status:{tracking_id}"
+
+    def ensure_group(self) -> None:
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except Exception as exc:  # group already exists
+            if "BUSYGROUP" not in str(exc):
+                raise
+
+    def enqueue(self, *, user, data: dict) -> str:
+        if self.redis.xlen(self.stream) >= self.cfg["MAX_PENDING"]:
+            raise IngestBackpressure()
+        tracking_id = uuid.uuid4().hex
+        now_ms = int(time.time() * 1000)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(
+            self._status_key(tracking_id), mapping={"status": "QUEUED", "staged_at_ms": now_ms, "user_id": user.id}
+        )
+        pipe.expire(self._status_key(tracking_id), self.cfg["STATUS_TTL_SECONDS"])
+        pipe.xadd(
+            self.stream,
+            {
+                "tracking_id": tracking_id,
+                "user_id": user.id,
+                "staged_at_ms": now_ms,
+                "payload": json.dumps(data, separators=(",", ":")),
+            },
+        )
+        pipe.execute()
+        return tracking_id
+
+    def claim_batch(self, consumer: str) -> list[StagedEntry]:
+        """Returns up to BATCH_SIZE entries, reclaiming ones abandoned by crashed workers first."""
+        count = self.cfg["BATCH_SIZE"]
+        _, messages, *_ = self.redis.xautoclaim(
+            self.stream,
+            self.group,
+            consumer,
+            min_idle_time=self.cfg["CLAIM_IDLE_SECONDS"] * 1000,
+            start_id="0-0",
+            count=count,
+        )
+        if len(messages) < count:
+            fresh = self.redis.xreadgroup(self.group, consumer, {self.stream: ">"}, count=count - len(messages))
+            for _, stream_messages in fresh:
+                messages.extend(stream_messages)
+        return [self._decode(entry_id, fields) for entry_id, fields in messages if fields]
+
+    @staticmethod
+    def _decode(entry_id, fields) -> StagedEntry:
+        decoded = {k.decode(): v.decode() for k, v in fields.items()}
+        return StagedEntry(
+            entry_id=entry_id.decode() if isinstance(entry_id, bytes) else entry_id,
+            tracking_id=decoded["tracking_id"],
+            user_id=int(decoded["user_id"]),
+            payload=json.loads(decoded["payload"]),
+            staged_at_ms=int(decoded["staged_at_ms"]),
+        )
+
+    def start_attempt(self, entry: StagedEntry) -> int:
+        key = self._status_key(entry.tracking_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hincrby(key, "attempts", 1)
+        pipe.hset(key, "status", "PROCESSING")
+        attempts, _ = pipe.execute()
+        return attempts
+
+    def complete(self, entry: StagedEntry, *, email_id: int, sha256: str, duplicate: bool = False) -> None:
+        lag_ms = int(time.time() * 1000) - entry.staged_at_ms
+        self._finish(
+            entry,
+            {
+                "status": "DUPLICATE" if duplicate else "STORED",
+                "email_id": email_id,
+                "sha256": sha256,
+                "lag_ms": lag_ms,
+            },
+        )
+        self.redis.set(f"{self.stream}:last_lag_ms", lag_ms)
+
+    def fail(self, entry: StagedEntry, error: str) -> None:
+        self._finish(entry, {"status": "FAILED", "error": error[:1024]})
+        self.redis.xadd(
+            f"{self.stream}:dead",
+            {"tracking_id": entry.tracking_id, "user_id": entry.user_id, "error": error[:1024]},
+            maxlen=self.cfg["MAX_PENDING"],
+            approximate=True,
+        )
+
+    def _finish(self, entry: StagedEntry, status: dict) -> None:
+        key = self._status_key(entry.tracking_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(key, mapping=status)
+        pipe.expire(key, self.cfg["STATUS_TTL_SECONDS"])
+        pipe.xack(self.stream, self.group, entry.entry_id)
+        pipe.xdel(self.stream, entry.entry_id)
+        pipe.execute()
+
+    def status(self, tracking_id: str, *, user) -> dict | None:
+        """The entry's status, or None if it is unknown or was submitted by another user."""
+        raw = self.redis.hgetall(self._status_key(tracking_id))
+        record = {k.decode(): v.decode() for k, v in raw.items()}
+        if record.pop("user_id", None) != str(user.id):
+            return None
+        return record
+
+    def stats(self) -> dict:
+        depth = self.redis.xlen(self.stream)
+        oldest_age = 0.0
+        head = self.redis.xrange(self.stream, count=1)
+        if head:
+            entry_id = head[0][0].decode()
+            oldest_age = max(0.0, time.time() - int(entry_id.split("-")[0]) / 1000)
+        in_flight = 0
+        try:
+            in_flight = self.redis.xpending(self.stream, self.group)["pending"]
+        except Exception:  # group not created yet
+            pass
+        last_lag = self.redis.get(f"{self.stream}:last_lag_ms")
+        return {
+            "depth": depth,
+            "in_flight": in_flight,
+            "oldest_age_seconds": round(oldest_age, 3),
+            "last_lag_ms": int(last_lag) if last_lag else None,
+            "dead_letters": self.redis.xlen(f"{self.stream}:dead"),
+            "max_pending": self.cfg["MAX_PENDING"],
+        }
@@ -1,37 +1,346 @@
 from __future__ import annotations
 
+import heapq
 import io
+import itertools
+import logging
+import os
+import socket
 import tarfile
+import time
 from celery import shared_task
+from elasticsearch import helpers
+from redis.exceptions import LockError, RedisError
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Q
 from django.utils import timezone
-from core.storage import S3Storage
+from core.redis import get_redis
+from core.search import get_client
+from core.timing import StageTimer
+from core import metrics, partitioning
 from core.hash_utils import sha256_bytes
-from .models import ArchivedEmail, ExportJob
+from core.ratelimit import export_slots
+from core.replicas import export_database
+from .dedup import DuplicateGuard
+from .integrity import IntegritySweeper
+from .merkle import build_pending
+from .reconcile import StoreReconciler, reindex_documents
+from .scheduling import ExportScheduler, FairShareLedger, PartSuperseded, heartbeat
+from .tiering import ColdStore
+from .models import ArchivedEmail, ExportJob, IntegrityCheck, MessageKey, SearchQueue
+from .serializers import ArchiveRequestSerializer
+from .services import ArchiveIngestService, EmailAccessService
+from .staging import IngestStage
 
+logger = logging.getLogger(__name__)
 
-@shared_task(bind=True, max_retries=3)
-def build_export_archive(self, job_id: int):
-    storage = S3Storage()
-    job = ExportJob.objects.get(id=job_id)
-    queryset = ArchivedEmail.objects.filter(
-        mailbox=job.mailbox,
+INTEGRITY_LOCK_KEY = "integrity:sweep"
+
+
+def _export_part(job: ExportJob) -> bool:
+    """Writes the next part of `job` to S3 and records it; returns True when the export is complete."""
+    access = EmailAccessService()
+    storage = access.storage
+    part_messages = settings.EXPORT_SCHEDULER["PART_MESSAGES"]
+    # Scans read from the export replica so they do not compete with ingest on the primary.
+    queryset = ArchivedEmail.objects.using(export_database()).filter(
+        mailbox_id=job.mailbox_id,
         received_at__range=(job.time_start, job.time_end),
-    ).order_by("received_at")
+    ).order_by("received_at", "id")
+    if job.cursor_id is not None:
+        queryset = queryset.filter(
+            Q(received_at__gt=job.cursor_received_at) | Q(received_at=job.cursor_received_at, id__gt=job.cursor_id)
+        )
+    cold = ColdStore(storage)
+    cursor = (job.cursor_received_at, job.cursor_id) if job.cursor_id is not None else None
+    timer = StageTimer()
+    with timer.stage("cold"):
+        cold_rows = cold.emails(job.mailbox_id, job.time_start, job.time_end, after=cursor, limit=part_messages)
+    # Rows of tiered months interleave with hot ones in (received_at, id) order.
+    rows = heapq.merge(
+        queryset[:part_messages].iterator(), cold_rows, key=lambda email: (email.received_at, email.id)
+    )
     buffer = io.BytesIO()
+    count, last = 0, None
+    beat_every = settings.EXPORT_SCHEDULER["HEARTBEAT_SECONDS"]
+    beaten = time.monotonic()
     with tarfile.open(mode="w:gz", fileobj=buffer) as tar:
-        for email in queryset.iterator():
-            obj = storage.client.get_object(Bucket=storage.bucket, Key=email.s3_object_key)
-            body = obj["Body"].read()
+        # "read" covers the row query and object reads; tar/gzip time is split out as "archive".
+        started = time.perf_counter()
+        for email, body in access.read_many(itertools.islice(rows, part_messages)):
+            compressing = time.perf_counter()
+            timer.add("read", compressing - started)
             info = tarfile.TarInfo(name=f"{email.id}.eml")
             info.size = len(body)
             tar.addfile(info, io.BytesIO(body))
-    buffer.seek(0)
-    export_key = f"exports/{job.id}.tar.gz"
-    storage.client.put_object(
-        Bucket=storage.bucket,
-        Key=export_key,
-        Body=buffer.getvalue(),
-        ServerSideEncryption="AES256",
+            count, last = count + 1, email
+            if time.monotonic() - beaten >= beat_every:
+                heartbeat(job)
+                beaten = time.monotonic()
+            started = time.perf_counter()
+            timer.add("archive", started - compressing)
+    with timer.stage("db"):
+        has_more = last is not None and (
+            queryset.filter(
+                Q(received_at__gt=last.received_at) | Q(received_at=last.received_at, id__gt=last.id)
+            ).exists()
+            or bool(cold.emails(job.mailbox_id, job.time_start, job.time_end, after=(last.received_at, last.id), limit=1))
+        )
+    # A rerun of a part (after its heartbeat lapsed) writes the same key.
+    if not job.result_parts and not has_more:
+        export_key = f"exports/{job.id}.tar.gz"
+    else:
+        export_key = f"exports/{job.id}/part-{len(job.result_parts) + 1:04d}.tar.gz"
+    with timer.stage("s3"):
+        storage.client.put_object(
+            Bucket=storage.bucket,
+            Key=export_key,
+            Body=buffer.getvalue(),
+            ServerSideEncryption="AES256",
+        )
+    metrics.STORAGE_BYTES.labels(direction="out").inc(len(buffer.getbuffer()))
+    metrics.observe_stages("export", timer)
+    parts = [*job.result_parts, {"key": export_key, "count": count, "sha256": sha256_bytes(buffer.getvalue())}]
+    fields = {"result_parts": parts, "exported_count": job.exported_count + count, "heartbeat_at": None}
+    if last is not None:
+        fields.update(cursor_received_at=last.received_at, cursor_id=last.id)
+    if has_more:
+        fields.update(status=ExportJob.STATUS_QUEUED, dispatched_at=None)
+    else:
+        fields.update(
+            status=ExportJob.STATUS_COMPLETED,
+            result_s3_key=export_key if len(parts) == 1 else f"exports/{job.id}/",
+            completed_at=timezone.now(),
+        )
+    # Only the run that still owns the part records it, so a part is never appended twice.
+    recorded = ExportJob.objects.filter(
+        id=job.id, status=ExportJob.STATUS_RUNNING, dispatched_at=job.dispatched_at
+    ).update(**fields)
+    if not recorded:
+        raise PartSuperseded(job.id)
+    for name, value in fields.items():
+        setattr(job, name, value)
+    FairShareLedger().charge(job.owner_id, job.owner.department_id, max(count, 1))
+    return not has_more
+
+
+@shared_task(bind=True)
+def build_export_archive(self, job_id: int):
+    """Exports the next part of a job, then hands it back to the fair-share scheduler."""
+    job = ExportJob.objects.select_related("owner").get(id=job_id)
+    if job.status != ExportJob.STATUS_RUNNING:
+        return {"skipped": job.status}
+    complete = False
+    try:
+        complete = _export_part(job)
+    except PartSuperseded:
+        # The part was requeued while this worker looked dead; the run that owns it now records it.
+        logger.warning("export %s part was requeued while it ran; discarding this run", job_id)
+        return {"job_id": job.id, "superseded": True}
+    except Exception as exc:
+        logger.exception("export %s failed", job_id)
+        complete = bool(
+            ExportJob.objects.filter(id=job_id, dispatched_at=job.dispatched_at).update(
+                status=ExportJob.STATUS_FAILED, error=repr(exc)
+            )
+        )
+        raise
+    finally:
+        if complete:
+            try:
+                export_slots().release(job.owner_id, job.id)
+            except RedisError:
+                # The slot lapses after EXPORT_SLOT_SECONDS.
+                logger.warning("export slot of job %s not released", job.id, exc_info=True)
+        dispatch_exports.delay()
+    return {"job_id": job.id, "parts": len(job.result_parts), "count": job.exported_count, "complete": complete}
+
+
+@shared_task(bind=True)
+def dispatch_exports(self):
+    return {"dispatched": ExportScheduler().dispatch(build_export_archive.delay)}
+
+
+def _retry_or_fail(stage: IngestStage, entry, attempts: int, exc: Exception) -> None:
+    logger.error("staged ingest %s failed (attempt %s)", entry.tracking_id, attempts, exc_info=exc)
+    if attempts >= settings.INGEST_SETTINGS["MAX_DELIVERIES"]:
+        stage.fail(entry, repr(exc))
+    # otherwise left pending; reclaimed after CLAIM_IDLE_SECONDS
+
+
+@shared_task(bind=True)
+def drain_ingest_stage(self):
+    stage = IngestStage()
+    stage.ensure_group()
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    deadline = time.monotonic() + settings.INGEST_SETTINGS["DRAIN_SECONDS"]
+    service = ArchiveIngestService()
+    users = {}
+    processed = 0
+    while time.monotonic() < deadline:
+        batch = stage.claim_batch(consumer)
+        if not batch:
+            break
+        accepted = []
+        for entry in batch:
+            attempts = stage.start_attempt(entry)
+            try:
+                if entry.user_id not in users:
+                    # The submitter may have been deactivated or lost the right since staging.
+                    user = get_user_model().objects.filter(id=entry.user_id, is_active=True).first()
+                    users[entry.user_id] = user if user is not None and user.has_permission("ARCHIVE_STORE") else None
+            except Exception as exc:
+                _retry_or_fail(stage, entry, attempts, exc)
+                continue
+            if users[entry.user_id] is None:
+                stage.fail(entry, "submitter_not_authorized")
+                continue
+            serializer = ArchiveRequestSerializer(data=entry.payload)
+            if not serializer.is_valid():
+                stage.fail(entry, f"invalid_payload: {serializer.errors}")
+                continue
+            accepted.append((entry, attempts, users[entry.user_id], serializer.validated_data))
+        # One call per batch, so segment storage can pack the small messages together.
+        results = service.ingest_batch([(user, payload) for _, _, user, payload in accepted])
+        for (entry, attempts, _, _), result in zip(accepted, results):
+            if isinstance(result, Exception):
+                _retry_or_fail(stage, entry, attempts, result)
+                continue
+            stage.complete(entry, email_id=result.id, sha256=result.sha256, duplicate=result.is_duplicate)
+            processed += 1
+    return {"processed": processed, **stage.stats()}
+
+
+@shared_task(bind=True)
+def retry_search_queue(self, batch_size: int = 500):
+    es = get_client()
+    index = settings.ELASTICSEARCH["INDEX"]
+    indexed = 0
+    items = list(SearchQueue.objects.filter(status="PENDING").order_by("id")[:batch_size])
+    # The thread may have been merged into another since the document was parked.
+    threads = dict(
+        MessageKey.objects.filter(email_id__in=[item.email_id for item in items]).values_list("email_id", "thread_id")
     )
-    job.mark_complete(export_key)
-    return {"sha256": sha256_bytes(buffer.getvalue()), "count": queryset.count()}
+    for item in items:
+        if "thread_id" in item.payload:
+            item.payload["thread_id"] = threads.get(item.email_id, item.payload["thread_id"])
+        try:
+            es.index(index=index, id=item.email_id, document=item.payload, refresh=False)
+        except Exception as exc:
+            item.retry_count += 1
+            item.last_error = repr(exc)
+            if item.retry_count >= settings.INGEST_SETTINGS["MAX_DELIVERIES"]:
+                item.status = "FAILED"
+            item.save(update_fields=["retry_count", "last_error", "status", "updated_at"])
+            continue
+        item.status = "DONE"
+        item.save(update_fields=["status", "updated_at"])
+        indexed += 1
+    return {"indexed": indexed}
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=30)
+def merge_thread_documents(self, thread_id: int, merged_ids: list[int]):
+    """Moves the search documents of the threads in `merged_ids` to `thread_id` (see archive.threads).
+
+    Runs again until no document carries a merged id: documents skipped on a
+    version conflict, or indexed with a merged id while this ran, are caught by
+    the next run.
+    """
+    index = settings.ELASTICSEARCH["INDEX"]
+    query = {"terms": {"thread_id": merged_ids}}
+    try:
+        client = get_client()
+        resp = client.update_by_query(
+            index=index,
+            query=query,
+            script={"source": "ctx._source.thread_id = params.thread_id", "params": {"thread_id": thread_id}},
+            conflicts="proceed",
+            refresh=True,
+        )
+        left = client.count(index=index, query=query)["count"]
+    except Exception as exc:
+        raise self.retry(exc=exc)
+    if left:
+        logger.info("%s documents of threads %s not yet moved to thread %s", left, merged_ids, thread_id)
+        raise self.retry()
+    return {"updated": resp.get("updated", 0)}
+
+
+@shared_task(bind=True)
+def sweep_integrity(self):
+    budget = settings.INTEGRITY_SETTINGS["TIME_BUDGET_SECONDS"]
+    # A run that outlives the beat interval must not be joined by the next one; the timeout covers a last batch.
+    lock = get_redis().lock(INTEGRITY_LOCK_KEY, timeout=budget + 600)
+    if not lock.acquire(blocking=False):
+        logger.info("integrity sweep already running, skipping this run")
+        return []
+    try:
+        end = time.monotonic() + budget
+        sweeper = IntegritySweeper()
+        kinds = (IntegrityCheck.KIND_EMAIL, IntegrityCheck.KIND_ATTACHMENT)
+        reports = []
+        for position, kind in enumerate(kinds):
+            # Each kind gets an equal share of the time left, so a long email sweep cannot starve attachments.
+            now = time.monotonic()
+            reports.append(sweeper.run(kind, deadline=now + (end - now) / (len(kinds) - position)))
+        return reports
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning("integrity sweep lock expired before the run finished")
+
+
+@shared_task(bind=True)
+def build_merkle_trees(self):
+    built = build_pending(settings.MERKLE_SETTINGS["LOOKBACK_DAYS"])
+    return {"built": [day.isoformat() for day in built]}
+
+
+@shared_task(bind=True)
+def reconcile_stores(self, full: bool = False):
+    return StoreReconciler().run(full=full)
+
+
+@shared_task(bind=True)
+def maintain_partitions(self):
+    if connection.vendor != "mysql":
+        return {}
+    months_ahead = settings.PARTITIONING["MONTHS_AHEAD"]
+    return {
+        table: partitioning.ensure_future_partitions(connection, table, months_ahead)
+        for table in partitioning.PARTITIONED_TABLES
+    }
+
+
+@shared_task(bind=True)
+def tier_cold_metadata(self):
+    if not settings.COLD_TIER["ENABLED"]:
+        return {}
+    return ColdStore().run()
+
+
+@shared_task(bind=True)
+def rebuild_dedup_filter(self):
+    if not settings.DEDUP_SETTINGS["ENABLED"]:
+        return {}
+    return {"loaded": DuplicateGuard().rebuild()}
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def repair_search_index(self, reindex_ids: list[int], delete_ids: list[int]):
+    index = settings.ELASTICSEARCH["INDEX"]
+    actions = reindex_documents(reindex_ids)
+    actions.extend({"_op_type": "delete", "_index": index, "_id": email_id} for email_id in delete_ids)
+    try:
+        indexed, errors = helpers.bulk(get_client(), actions, chunk_size=500, raise_on_error=False)
+    except Exception as exc:
+        raise self.retry(exc=exc)
+    # A delete of an already missing document is not a failure.
+    errors = [e for e in errors if e.get("delete", {}).get("status") != 404]
+    if errors:
+        logger.error("search repair left %s errors, first: %s", len(errors), errors[0])
+    return {"indexed": len(reindex_ids), "deleted": len(delete_ids), "errors": len(errors)}
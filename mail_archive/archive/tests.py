@@ -1,3 +1,1063 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import datetime as dt
+import tempfile
+import time
+from concurrent.futures import Executor, Future
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from redis.exceptions import ConnectionError as RedisConnectionError
+from accounts.models import Department, Mailbox, MailboxAccess, Permission, Role, RolePermission, User, UserRole
+from core import compression as core_compression, merkle as core_merkle
+from core.compression import CODEC_IDENTITY, CODEC_ZSTD
+from core.authentication import generate_jwt
+from core.lru import SizedLRU
+from core.spool import Spool
+from core.testing import BackendsMixin
+from . import (
+    compression as compression_module,
+    correspondence,
+    importer,
+    merkle,
+    preview,
+    smtp,
+    tasks,
+    threads,
+    tiering,
+)
+from .dedup import DuplicateGuard, dedup_key
+from .importer import commit_chunk, plan_chunks, prepare_chunk
+from .integrity import IntegritySweeper
+from .reconcile import StoreReconciler
+from .scheduling import ExportScheduler, PartSuperseded
+from .models import (
+    ArchivedEmail,
+    ColdPartition,
+    CompressionDictionary,
+    CorrespondenceCount,
+    EmailAttachment,
+    ExportJob,
+    ImportChunk,
+    IntegrityCheck,
+    MerkleTree,
+    MessageKey,
+    ReconcileBucket,
+    SearchQueue,
+    Thread,
+    ThreadNode,
+)
+from .services import ArchiveIngestService, EmailAccessService, IngestInProgress
+from .staging import IngestStage
+
+JANUARY = dt.datetime(2024, 1, 3, tzinfo=dt.timezone.utc)
+
+
+class InlineExecutor(Executor):
+    """Runs submitted work at once, in the caller's thread and test transaction."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+@override_settings(
+    DEDUP_SETTINGS={**settings.DEDUP_SETTINGS, "ENABLED": False},
+    COLD_TIER={**settings.COLD_TIER, "ENABLED": True, "ROW_GROUP_ROWS": 4},
+)
+class ArchiveTestCase(BackendsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Object keys repeat across tests, each of which starts with an empty bucket.
+        tiering._footers._entries.clear()
+        self.department = Department.objects.create(name="Legal", path="/legal")
+        self.mailbox = Mailbox.objects.create(address="legal@example.com", department=self.department)
+        self.user = User.objects.create(
+            username="archivist", email="archivist@example.com", department=self.department, is_superuser=True
+        )
+        self.service = ArchiveIngestService()
+
+    def ingest(
+        self,
+        message_id: str,
+        received_at: dt.datetime,
+        *,
+        mailbox=None,
+        references=(),
+        attachment=None,
+        raw=None,
+        participants=None,
+    ):
+        payload = {
+            "mailbox": mailbox or self.mailbox,
+            "message_id": message_id,
+            "subject": f"subject {message_id}",
+            "sent_at": received_at,
+            "received_at": received_at,
+            "raw_bytes": raw or f"Message-ID: {message_id}\r\n\r\nbody of {message_id}".encode(),
+            "participants": participants
+            or [
+                {"type": "FROM", "address": "alice@example.com"},
+                {"type": "TO", "address": "bob@example.com"},
+            ],
+            "attachments": [],
+            "references": list(references),
+        }
+        if attachment is not None:
+            payload["attachments"] = [
+                {"filename": "a.txt", "mime_type": "text/plain", "content": base64.b64encode(attachment).decode()}
+            ]
+        return self.service.ingest(user=self.user, payload=payload)
+
+
+class IntegritySweepTests(ArchiveTestCase):
+    def test_sweep_covers_tiered_month(self):
+        emails = [
+            self.ingest(f"<m{i}@example.com>", JANUARY + dt.timedelta(days=i), attachment=f"file {i}".encode())
+            for i in range(6)
+        ]
+        self.assertEqual(tiering.ColdStore().tier(self.mailbox.id, JANUARY.date().replace(day=1)), 6)
+        self.assertFalse(ArchivedEmail.objects.exists())
+        self.assertEqual(ColdPartition.objects.count(), 1)
+        self.assertEqual(MessageKey.objects.count(), 6)
+        self.assertEqual(EmailAttachment.objects.count(), 6)
+
+        sweeper = IntegritySweeper()
+        for kind in (IntegrityCheck.KIND_EMAIL, IntegrityCheck.KIND_ATTACHMENT):
+            report = sweeper.run(kind, deadline=time.monotonic() + 60)
+            self.assertEqual((report["checked"], report["failures"], report["cursor"]), (6, 0, 0))
+
+        checked = IntegrityCheck.objects.filter(kind=IntegrityCheck.KIND_EMAIL, ok=True)
+        self.assertEqual(set(checked.values_list("object_id", flat=True)), {email.id for email in emails})
+        self.assertEqual(IntegrityCheck.objects.filter(kind=IntegrityCheck.KIND_ATTACHMENT, ok=True).count(), 6)
+
+    def test_sweep_reports_damaged_cold_email(self):
+        email = self.ingest("<damaged@example.com>", JANUARY)
+        tiering.ColdStore().tier(self.mailbox.id, JANUARY.date().replace(day=1))
+        storage = tiering.ColdStore().storage
+        storage.client.put_object(Bucket=storage.bucket, Key=email.s3_object_key, Body=b"tampered")
+
+        report = IntegritySweeper().run(IntegrityCheck.KIND_EMAIL, deadline=time.monotonic() + 60)
+
+        self.assertEqual(report["failures"], 1)
+        check = IntegrityCheck.objects.get(kind=IntegrityCheck.KIND_EMAIL, object_id=email.id)
+        self.assertFalse(check.ok)
+
+
+    def test_sweep_splits_the_budget_between_kinds(self):
+        deadlines = {}
+
+        def run(kind, *, deadline):
+            deadlines[kind] = deadline - time.monotonic()
+            return {"kind": kind}
+
+        integrity = {**settings.INTEGRITY_SETTINGS, "TIME_BUDGET_SECONDS": 100}
+        with override_settings(INTEGRITY_SETTINGS=integrity):
+            with mock.patch.object(IntegritySweeper, "run", side_effect=run):
+                tasks.sweep_integrity.apply()
+        self.assertAlmostEqual(deadlines[IntegrityCheck.KIND_EMAIL], 50, delta=1)
+        self.assertAlmostEqual(deadlines[IntegrityCheck.KIND_ATTACHMENT], 100, delta=1)
+
+    def test_overlapping_sweep_is_skipped(self):
+        self.redis.set(tasks.INTEGRITY_LOCK_KEY, "other worker")
+        with mock.patch.object(IntegritySweeper, "run") as run:
+            self.assertEqual(tasks.sweep_integrity.apply().result, [])
+        run.assert_not_called()
+        self.redis.delete(tasks.INTEGRITY_LOCK_KEY)
+        with mock.patch.object(IntegritySweeper, "run", return_value={}) as run:
+            tasks.sweep_integrity.apply()
+        self.assertEqual(run.call_count, 2)
+        self.assertIsNone(self.redis.get(tasks.INTEGRITY_LOCK_KEY))
+
+
+class TieringTests(ArchiveTestCase):
+    def tier(self) -> int:
+        return tiering.ColdStore().tier(self.mailbox.id, JANUARY.date().replace(day=1))
+
+    def get(self, path: str):
+        token = generate_jwt(self.user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+        return self.client.get(path, HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_cold_email_reads_through_the_index(self):
+        email = self.ingest("<cold@example.com>", JANUARY)
+        self.tier()
+        self.assertFalse(ArchivedEmail.objects.exists())
+
+        response = self.get(f"/api/v1/archive/emails/{email.id}/")
+        self.assertEqual(response.status_code, 200)
+        detail = response.json()["email"]
+        self.assertEqual((detail["subject"], detail["mailbox"]), ("subject <cold@example.com>", self.mailbox.address))
+        self.assertEqual(tiering.get_email_by_message_id(self.mailbox.id, "<cold@example.com>").id, email.id)
+        self.assertTrue(self.ingest("<cold@example.com>", JANUARY).is_duplicate)
+
+    def test_late_rows_merge_into_a_new_generation(self):
+        first = self.ingest("<first@example.com>", JANUARY)
+        self.assertEqual(self.tier(), 1)
+        late = self.ingest("<late@example.com>", JANUARY + dt.timedelta(days=1))
+        self.assertEqual(self.tier(), 1)
+
+        partition = ColdPartition.objects.get()
+        self.assertEqual(partition.generation, 2)
+        self.assertEqual(set(tiering.get_emails([first.id, late.id])), {first.id, late.id})
+        self.assertFalse(ArchivedEmail.objects.exists())
+
+    @mock.patch("archive.tasks.dispatch_exports")
+    def test_export_includes_cold_months(self, dispatch):
+        for i in range(3):
+            self.ingest(f"<m{i}@example.com>", JANUARY + dt.timedelta(hours=i))
+        self.tier()
+        self.ingest("<hot@example.com>", JANUARY + dt.timedelta(days=40))
+        job = ExportJob.objects.create(
+            owner=self.user,
+            mailbox=self.mailbox,
+            time_start=JANUARY,
+            time_end=JANUARY + dt.timedelta(days=60),
+            status=ExportJob.STATUS_RUNNING,
+            dispatched_at=timezone.now(),
+        )
+        self.assertTrue(tasks.build_export_archive.apply(args=(job.id,)).result["complete"])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.exported_count), (ExportJob.STATUS_COMPLETED, 4))
+
+    def test_month_waiting_for_the_search_queue_does_not_take_a_run_slot(self):
+        waiting = self.ingest("<waiting@example.com>", JANUARY)
+        SearchQueue.objects.create(email=waiting, payload={})
+        february = self.ingest("<february@example.com>", JANUARY + dt.timedelta(days=31))
+
+        with override_settings(COLD_TIER={**settings.COLD_TIER, "MAX_FILES_PER_RUN": 1}):
+            self.assertEqual(tiering.ColdStore().run(), {"files": 1, "emails": 1, "failed": 0})
+        self.assertEqual(list(ArchivedEmail.objects.values_list("id", flat=True)), [waiting.id])
+        self.assertEqual(tiering.get_email(february.id).id, february.id)
+
+
+class CorrespondenceTests(ArchiveTestCase):
+    def message(self, message_id: str, received_at: dt.datetime, sender: str, *recipients: tuple[str, str]):
+        participants = [{"type": "FROM", "address": sender}]
+        participants += [{"type": kind, "address": address} for kind, address in recipients]
+        return self.ingest(message_id, received_at, participants=participants)
+
+    def counts(self) -> dict[tuple, tuple[int, int]]:
+        return {
+            (row.address.address, row.counterpart.address, f"{row.month:%Y-%m}"): (row.sent, row.received)
+            for row in CorrespondenceCount.objects.select_related("address", "counterpart")
+        }
+
+    def correspondents(self, **params):
+        token = generate_jwt(self.user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+        params = {"time_start": "2024-01-01T00:00:00Z", "time_end": "2024-02-29T00:00:00Z", **params}
+        return self.client.get("/api/v1/search/correspondents/", params, HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def ingest_conversation(self):
+        self.message(
+            "<m1@example.com>", JANUARY, "Alice@Example.com", ("TO", "bob@example.com"), ("CC", "carol@example.com")
+        )
+        self.message("<m2@example.com>", JANUARY + dt.timedelta(days=1), "bob@example.com", ("TO", "alice@example.com"))
+        self.message(
+            "<m3@example.com>", JANUARY + dt.timedelta(days=31), "alice@example.com", ("BCC", "bob@example.com")
+        )
+        # Writing to oneself pairs no addresses.
+        self.message("<m4@example.com>", JANUARY, "alice@example.com", ("TO", "ALICE@example.com"))
+
+    def test_ingest_counts_each_pair_from_both_sides_per_month(self):
+        self.ingest_conversation()
+        self.assertEqual(
+            self.counts(),
+            {
+                ("alice@example.com", "bob@example.com", "2024-01"): (1, 1),
+                ("bob@example.com", "alice@example.com", "2024-01"): (1, 1),
+                ("alice@example.com", "carol@example.com", "2024-01"): (1, 0),
+                ("carol@example.com", "alice@example.com", "2024-01"): (0, 1),
+                ("alice@example.com", "bob@example.com", "2024-02"): (1, 0),
+                ("bob@example.com", "alice@example.com", "2024-02"): (0, 1),
+            },
+        )
+        # A duplicate stores nothing and so counts nothing.
+        duplicate = self.message("<m2@example.com>", JANUARY, "bob@example.com", ("TO", "alice@example.com"))
+        self.assertTrue(duplicate.is_duplicate)
+        self.assertEqual(self.counts()[("bob@example.com", "alice@example.com", "2024-01")], (1, 1))
+
+    def test_rebuild_recomputes_both_tiers(self):
+        self.ingest_conversation()
+        expected = self.counts()
+        tiering.ColdStore().tier(self.mailbox.id, JANUARY.date().replace(day=1))
+        self.assertFalse(ArchivedEmail.objects.filter(received_at__lt=JANUARY + dt.timedelta(days=28)).exists())
+        self.assertEqual(self.counts(), expected)
+        CorrespondenceCount.objects.all().delete()
+
+        out = io.StringIO()
+        call_command("rebuild_correspondence", "--mailbox", self.mailbox.address, stdout=out)
+
+        self.assertEqual(self.counts(), expected)
+        self.assertIn(f"{self.mailbox.address}: 6 count rows", out.getvalue())
+        self.assertEqual(correspondence.rebuild(self.mailbox.id, batch_size=1), 6)
+        self.assertEqual(self.counts(), expected)
+
+    def test_correspondents_ranks_counterparts_with_timelines(self):
+        self.ingest_conversation()
+        response = self.correspondents(address="ALICE@example.com")
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["address"], "alice@example.com")
+        self.assertEqual(
+            body["counterparts"],
+            [
+                {
+                    "address": "bob@example.com",
+                    "sent": 2,
+                    "received": 1,
+                    "total": 3,
+                    "timeline": [
+                        {"month": "2024-01", "sent": 1, "received": 1},
+                        {"month": "2024-02", "sent": 1, "received": 0},
+                    ],
+                },
+                {
+                    "address": "carol@example.com",
+                    "sent": 1,
+                    "received": 0,
+                    "total": 1,
+                    "timeline": [{"month": "2024-01", "sent": 1, "received": 0}],
+                },
+            ],
+        )
+
+        pair = self.correspondents(
+            address="alice@example.com", counterpart="carol@example.com", time_end="2024-01-31T00:00:00Z"
+        )
+        self.assertEqual([row["address"] for row in pair.json()["counterparts"]], ["carol@example.com"])
+        self.assertEqual(self.correspondents(address="nobody@example.com").json()["counterparts"], [])
+        top = self.correspondents(address="alice@example.com", limit=1).json()["counterparts"]
+        self.assertEqual([row["address"] for row in top], ["bob@example.com"])
+
+
+class MerkleTests(ArchiveTestCase):
+    def test_root_commits_the_day_and_is_stable(self):
+        emails = [self.ingest(f"<m{i}@example.com>", JANUARY + dt.timedelta(hours=i)) for i in range(3)]
+        self.ingest("<next-day@example.com>", JANUARY + dt.timedelta(days=1))
+
+        with CaptureQueriesContext(connection) as queries:
+            day_tree = merkle.build_day(JANUARY.date())
+        # Bucketed by the partitioning key, so MySQL reads only the day's partition.
+        (rows,) = [q["sql"] for q in queries.captured_queries if "sha256" in q["sql"]]
+        self.assertIn("received_at", rows)
+        mailbox_tree = MerkleTree.objects.get(day=JANUARY.date(), mailbox=self.mailbox)
+        leaves = [core_merkle.leaf_hash(email.id, email.sha256) for email in sorted(emails, key=lambda e: e.id)]
+        self.assertEqual(mailbox_tree.root, core_merkle.build(leaves)[0].hex())
+        self.assertEqual(mailbox_tree.leaf_count, 3)
+
+        self.assertIsNone(merkle.build_day(JANUARY.date()))
+        self.assertEqual(MerkleTree.objects.get(day=JANUARY.date(), mailbox=None).root, day_tree.root)
+
+    def test_proof_verifies_and_a_changed_leaf_does_not(self):
+        emails = [self.ingest(f"<m{i}@example.com>", JANUARY + dt.timedelta(hours=i)) for i in range(5)]
+        merkle.build_day(JANUARY.date())
+
+        def verifies(leaf: bytes, proof: dict) -> bool:
+            mailbox_root, day_root = bytes.fromhex(proof["mailbox_root"]), bytes.fromhex(proof["day_root"])
+            return core_merkle.verify_proof(leaf, proof["mailbox_proof"], mailbox_root) and core_merkle.verify_proof(
+                bytes.fromhex(proof["mailbox_leaf"]), proof["day_proof"], day_root
+            )
+
+        for email in emails:
+            proof = merkle.inclusion_proof(email)
+            self.assertTrue(verifies(bytes.fromhex(proof["leaf"]), proof))
+        proof = merkle.inclusion_proof(emails[2])
+        self.assertFalse(verifies(core_merkle.leaf_hash(emails[2].id, "0" * 64), proof))
+
+    def test_late_email_is_committed_in_the_next_generation(self):
+        first = self.ingest("<first@example.com>", JANUARY)
+        merkle.build_day(JANUARY.date())
+        late = self.ingest("<late@example.com>", JANUARY + dt.timedelta(hours=5))
+
+        self.assertEqual(merkle.build_days([JANUARY.date()]), [JANUARY.date()])
+        self.assertEqual(merkle.inclusion_proof(first)["generation"], 1)
+        proof = merkle.inclusion_proof(late)
+        self.assertEqual(proof["generation"], 2)
+        self.assertEqual(proof["day_root"], MerkleTree.objects.get(generation=2, mailbox=None).root)
+        self.assertEqual(MerkleTree.objects.get(generation=2, mailbox=self.mailbox).leaf_count, 1)
+
+
+class CompressionTests(ArchiveTestCase):
+    def message(self, i: int, body_bytes: int = 2000) -> bytes:
+        headers = (
+            f"Message-ID: <c{i}@example.com>\r\nFrom: alice@example.com\r\nTo: bob@example.com\r\n"
+            f"Subject: quarterly filing {i}\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n"
+        )
+        line = f"Privileged and confidential legal advice regarding matter {i % 7}, paragraph {{}}.\r\n"
+        body = "".join(line.format(n) for n in range(body_bytes // len(line) + 1))
+        return (headers + body).encode()
+
+    def train(self) -> CompressionDictionary:
+        out = io.StringIO()
+        call_command("train_zstd_dictionary", "--department", self.department.path, "--size", "4096", stdout=out)
+        return CompressionDictionary.objects.get(department=self.department, active=True)
+
+    def test_dictionary_round_trip_and_legacy_objects(self):
+        legacy_raw = self.message(0)
+        legacy = self.ingest("<c0@example.com>", JANUARY, raw=legacy_raw)
+        self.assertEqual(legacy.codec, CODEC_IDENTITY)
+        compressing = override_settings(COMPRESSION={**settings.COMPRESSION, "ENABLED": True, "MIN_BYTES": 64})
+        compressing.enable()
+        self.addCleanup(compressing.disable)
+        for i in range(1, 40):
+            self.ingest(f"<c{i}@example.com>", JANUARY + dt.timedelta(minutes=i), raw=self.message(i))
+        dictionary = self.train()
+
+        raw = self.message(99)
+        with mock.patch.dict(compression_module._active, clear=True), mock.patch.dict(
+            compression_module._dictionaries, clear=True
+        ):
+            # Encoding runs on an upload thread, which cannot see this test's transaction.
+            compression_module._dictionary(compression_module.active_dictionary(self.department.id).id)
+            email = self.ingest("<c99@example.com>", JANUARY + dt.timedelta(hours=2), raw=raw)
+        self.assertEqual((email.codec, email.compression_dictionary_id), (CODEC_ZSTD, dictionary.id))
+        self.assertLess(email.stored_size_bytes, len(raw))
+        access = EmailAccessService()
+        self.assertEqual(access.read(ArchivedEmail.objects.get(id=email.id)), raw)
+        # Stored before any dictionary existed, and still read as it was written.
+        legacy = ArchivedEmail.objects.get(id=legacy.id)
+        self.assertEqual((legacy.codec, legacy.compression_dictionary_id), (CODEC_IDENTITY, None))
+        self.assertEqual(access.read(legacy), legacy_raw)
+        self.assertTrue(access.verify(legacy))
+
+    def test_training_reads_only_the_start_of_each_message(self):
+        for i in range(12):
+            self.ingest(f"<c{i}@example.com>", JANUARY + dt.timedelta(minutes=i), raw=self.message(i, 100 * 1024))
+        with mock.patch("core.compression.train_dictionary", wraps=core_compression.train_dictionary) as train:
+            self.train()
+        samples = train.call_args.args[0]
+        self.assertEqual({len(sample) for sample in samples}, {64 * 1024})
+        self.assertTrue(all(sample.startswith(b"Message-ID: <c") for sample in samples))
+
+
+class PreviewTests(ArchiveTestCase):
+    RAW = (
+        b"Message-ID: <preview@example.com>\r\nFrom: Alice <alice@example.com>\r\nTo: bob@example.com\r\n"
+        b"Subject: quarterly \xe2\x80\xaefiling\r\nMIME-Version: 1.0\r\n"
+        b'Content-Type: multipart/mixed; boundary="b"\r\n\r\n'
+        b"--b\r\nContent-Type: text/html; charset=utf-8\r\n\r\n"
+        b"<html><head><title>t</title><style>p {}</style></head><body><p>Hello&amp;welcome</p>"
+        b"<script>alert(1)</script><div>second\x07 line</div></body></html>\r\n"
+        b"--b\r\nContent-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n"
+        b'Content-Disposition: attachment; filename="report.pdf"\r\n\r\nJVBERi0xLjQK\r\n'
+        b"--b--\r\n"
+    )
+
+    def setUp(self):
+        super().setUp()
+        cache = mock.patch.object(preview, "_cache", SizedLRU(1024 * 1024, lambda entry: 1))
+        cache.start()
+        self.addCleanup(cache.stop)
+        self.email = self.ingest("<preview@example.com>", JANUARY, raw=self.RAW)
+
+    def get(self, **params):
+        token = generate_jwt(self.user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+        return self.client.get(
+            f"/api/v1/archive/emails/{self.email.id}/preview/", params, HTTP_AUTHORIZATION=f"Bearer {token}"
+        )
+
+    def test_preview_renders_sanitized_text_headers_and_attachments(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["body"]["text"], "Hello&welcome\n\nsecond line")
+        headers = {header["name"]: header["value"] for header in data["headers"]}
+        self.assertEqual(headers["Subject"], "quarterly filing")
+        self.assertEqual(
+            data["attachments"],
+            [
+                {
+                    "index": 0,
+                    "filename": "report.pdf",
+                    "mime_type": "application/pdf",
+                    "content_id": None,
+                    "approx_size_bytes": 9,
+                }
+            ],
+        )
+
+    def test_body_is_paged_and_parsed_once_per_content(self):
+        with mock.patch.object(EmailAccessService, "read", autospec=True, side_effect=EmailAccessService.read) as read:
+            first = self.get(offset=0, limit=5).json()["body"]
+            second = self.get(offset=5, limit=100).json()["body"]
+        self.assertEqual(read.call_count, 1)
+        self.assertEqual(
+            (first["text"], first["next_offset"], first["truncated"], first["total_chars"]), ("Hello", 5, True, 26)
+        )
+        self.assertEqual(
+            (second["text"], second["next_offset"], second["truncated"]), ("&welcome\n\nsecond line", None, False)
+        )
+        self.assertEqual(self.get(offset=-1).status_code, 400)
+        self.assertEqual(self.get(limit="many").status_code, 400)
+
+
+@override_settings(DEDUP_SETTINGS={**settings.DEDUP_SETTINGS, "ENABLED": True})
+class DedupTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.guard = DuplicateGuard()
+        self.guard.rebuild()
+
+    def test_filter_hit_is_confirmed_against_the_database(self):
+        stored = self.ingest("<stored@example.com>", JANUARY)
+        self.guard.bloom.add(dedup_key(self.mailbox.id, "<false-positive@example.com>"))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNone(self.guard.existing(self.mailbox.id, "<unknown@example.com>"))
+        self.assertEqual(len(queries), 0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNone(self.guard.existing(self.mailbox.id, "<false-positive@example.com>"))
+        self.assertGreater(len(queries), 0)
+        self.assertEqual(self.guard.existing(self.mailbox.id, "<stored@example.com>").id, stored.id)
+
+    def test_concurrent_delivery_is_refused_while_claimed(self):
+        other = DuplicateGuard()
+        self.assertTrue(self.guard.claim(self.mailbox.id, "<racing@example.com>"))
+        self.assertFalse(other.claim(self.mailbox.id, "<racing@example.com>"))
+        with self.assertRaises(IngestInProgress):
+            self.ingest("<racing@example.com>", JANUARY)
+
+        self.guard.release(self.mailbox.id, "<racing@example.com>")
+        self.assertFalse(self.ingest("<racing@example.com>", JANUARY).is_duplicate)
+        self.assertTrue(other.claim(self.mailbox.id, "<racing@example.com>"))
+
+    def test_redis_outage_falls_back_to_the_database(self):
+        with mock.patch.object(self.redis.connection_pool, "get_connection", side_effect=RedisConnectionError("down")):
+            first = self.ingest("<outage@example.com>", JANUARY)
+            self.assertFalse(first.is_duplicate)
+            again = self.ingest("<outage@example.com>", JANUARY)
+        self.assertEqual((again.id, again.is_duplicate), (first.id, True))
+        # The filter missed the stored key, so the first lookup after the outage stops
+        # trusting it until the next rebuild.
+        self.assertTrue(self.guard.is_warm())
+        self.assertEqual(self.guard.existing(self.mailbox.id, "<outage@example.com>").id, first.id)
+        self.assertFalse(self.guard.is_warm())
+        self.guard.rebuild()
+        self.assertEqual(self.guard.existing(self.mailbox.id, "<outage@example.com>").id, first.id)
+
+    def test_warm_flag_expires(self):
+        self.assertGreater(self.redis.ttl(f"{self.guard.prefix}:warm"), 0)
+
+
+class DownloadTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.email = self.ingest("<download@example.com>", JANUARY)
+        self.raw = b"Message-ID: <download@example.com>\r\n\r\nbody of <download@example.com>"
+        self.token = generate_jwt(self.user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+
+    def download(self, **headers):
+        return self.client.get(
+            f"/api/v1/archive/emails/{self.email.id}/download/",
+            HTTP_AUTHORIZATION=f"Bearer {self.token}",
+            HTTP_ACCEPT_ENCODING="gzip",
+            **headers,
+        )
+
+    def test_full_download_is_not_compressed(self):
+        response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.raw)
+        self.assertEqual(response["Content-Length"], str(len(self.raw)))
+        self.assertEqual(response["ETag"], f'"{self.email.sha256}"')
+        self.assertNotEqual(response["Content-Encoding"], "gzip")
+
+    def test_range_resumes_with_the_returned_etag(self):
+        etag = self.download()["ETag"]
+        response = self.download(HTTP_RANGE="bytes=10-", HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), self.raw[10:])
+        self.assertEqual(response["Content-Range"], f"bytes 10-{len(self.raw) - 1}/{len(self.raw)}")
+
+    def test_if_range_mismatch_sends_the_whole_body(self):
+        for validator in ('"other"', f'W/"{self.email.sha256}"'):
+            response = self.download(HTTP_RANGE="bytes=10-", HTTP_IF_RANGE=validator)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response.streaming_content), self.raw)
+
+    def test_if_none_match_uses_weak_comparison(self):
+        for validator in (f'"{self.email.sha256}"', f'W/"{self.email.sha256}"', f'"x", "{self.email.sha256}"'):
+            self.assertEqual(self.download(HTTP_IF_NONE_MATCH=validator).status_code, 304)
+        self.assertEqual(self.download(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_unsatisfiable_range(self):
+        response = self.download(HTTP_RANGE=f"bytes={len(self.raw)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.raw)}")
+
+
+class PartitionRoutingTests(ArchiveTestCase):
+    def test_lookups_by_message_id_carry_the_received_at_bounds(self):
+        email = self.ingest("<routed@example.com>", JANUARY)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(tiering.get_email_by_message_id(self.mailbox.id, "<routed@example.com>").id, email.id)
+        (lookup,) = [q["sql"] for q in queries.captured_queries if 'FROM "archive_archivedemail"' in q["sql"]]
+        self.assertIn('"archive_archivedemail"."received_at" BETWEEN', lookup)
+
+    def test_message_key_keeps_messages_unique_per_mailbox(self):
+        email = self.ingest("<once@example.com>", JANUARY)
+        # A redelivery stamped in another month falls into another partition; only MessageKey sees both.
+        duplicate = self.ingest("<once@example.com>", JANUARY + dt.timedelta(days=45))
+        self.assertTrue(duplicate.is_duplicate)
+        self.assertEqual(duplicate.id, email.id)
+        self.assertEqual(ArchivedEmail.objects.count(), 1)
+
+        other = Mailbox.objects.create(address="other@example.com", department=self.department)
+        self.assertFalse(self.ingest("<once@example.com>", JANUARY, mailbox=other).is_duplicate)
+        self.assertEqual(MessageKey.objects.filter(message_id="<once@example.com>").count(), 2)
+
+
+class JournalTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spool = Spool(directory.name)
+
+    def spooled(self, raw: bytes):
+        meta = {"mail_from": "relay@example.com", "rcpt_tos": [self.mailbox.address]}
+        return self.spool.write(raw, {**meta, "received_at": JANUARY.isoformat()})
+
+    def test_unparseable_message_is_archived_raw(self):
+        raw = b"not quite a message"
+        path = self.spooled(raw)
+        with mock.patch.object(smtp, "build_payload", side_effect=ValueError("bad MIME")):
+            self.assertEqual(smtp.persist_batch(self.spool, [path], self.user), (1, []))
+
+        email = ArchivedEmail.objects.get()
+        self.assertEqual(email.mailbox, self.mailbox)
+        self.assertTrue(email.message_id.endswith("@archive.local>"))
+        self.assertEqual(list(email.participants.values_list("address", flat=True)), [self.mailbox.address])
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual(list(self.spool.rejected.iterdir()), [])
+
+    def test_storage_failure_backs_off_then_rejects(self):
+        path = self.spooled(b"Message-ID: <retry@example.com>\r\n\r\nbody")
+        with mock.patch.object(smtp.ArchiveIngestService, "_prepare", side_effect=RuntimeError("S3 down")):
+            self.assertEqual(smtp.persist_batch(self.spool, [path], self.user), (0, [path]))
+        self.assertEqual(self.spool.pending(), [path])
+
+        journal = {**settings.SMTP_JOURNAL, "RETRY_BASE_SECONDS": 10, "RETRY_MAX_SECONDS": 15, "MAX_ATTEMPTS": 3}
+        with override_settings(SMTP_JOURNAL=journal):
+            persister = smtp.JournalPersister(self.spool, executor=None, user=self.user)
+        start = time.monotonic()
+        persister._retry_later(path)
+        persister._retry_later(path)
+        attempts, retry_at = persister.retries[path]
+        self.assertEqual(attempts, 2)
+        self.assertGreaterEqual(retry_at - start, 15)
+        persister._retry_later(path)
+        self.assertNotIn(path, persister.retries)
+        self.assertEqual(self.spool.pending(), [])
+        self.assertEqual([p.name for p in self.spool.rejected.iterdir()], [path.name])
+
+    def test_batch_is_stored_with_one_ingest_call(self):
+        paths = [self.spooled(f"Message-ID: <batch-{i}@example.com>\r\n\r\nbody".encode()) for i in range(3)]
+        with mock.patch.object(
+            smtp.ArchiveIngestService, "ingest_batch", autospec=True, side_effect=ArchiveIngestService.ingest_batch
+        ) as ingest_batch:
+            self.assertEqual(smtp.persist_batch(self.spool, paths, self.user), (3, []))
+        self.assertEqual(ingest_batch.call_count, 1)
+        self.assertEqual(ArchivedEmail.objects.filter(mailbox=self.mailbox).count(), 3)
+        self.assertEqual(self.spool.pending(), [])
+
+    def test_persister_is_fed_by_the_handler_not_by_scanning(self):
+        leftover = self.spooled(b"Message-ID: <leftover@example.com>\r\n\r\nbody")
+        persister = smtp.JournalPersister(self.spool, InlineExecutor(), self.user)
+        handler = smtp.JournalHandler(self.spool, persister.executor, persister)
+        envelope = SimpleNamespace(
+            mail_from="relay@example.com",
+            rcpt_tos=[self.mailbox.address],
+            original_content=b"Message-ID: <accepted@example.com>\r\n\r\nbody",
+            content=None,
+        )
+
+        async def scenario():
+            self.assertEqual(await persister.recover(), 1)
+            reply = await handler.handle_DATA(None, SimpleNamespace(peer=("192.0.2.1", 25)), envelope)
+            with mock.patch.object(self.spool, "pending", side_effect=AssertionError("spool scanned")):
+                await persister.dispatch()
+            return reply
+
+        with mock.patch.object(smtp, "persist_batch", return_value=(2, [])) as persist:
+            reply = asyncio.run(scenario())
+        self.assertTrue(reply.startswith("250 OK queued as "))
+        (accepted,) = set(self.spool.pending()) - {leftover}
+        self.assertEqual(persist.call_args.args[1], [leftover, accepted])
+        self.assertEqual((list(persister.queue), persister.in_flight), ([], set()))
+
+
+@override_settings(INGEST_SETTINGS={**settings.INGEST_SETTINGS, "MODE": "queued"})
+class QueuedIngestTests(ArchiveTestCase):
+    def submit(self, message_id: str, *, user=None, mailbox=None):
+        raw = f"Message-ID: {message_id}\r\n\r\nbody".encode()
+        return self.client.post(
+            "/api/v1/archive/ingest/",
+            {
+                "mailbox": (mailbox or self.mailbox).address,
+                "message_id": message_id,
+                "subject": "queued",
+                "sent_at": JANUARY.isoformat(),
+                "received_at": JANUARY.isoformat(),
+                "raw_eml": base64.b64encode(raw).decode(),
+                "participants": [{"type": "FROM", "address": "alice@example.com"}],
+            },
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {self.token(user or self.user)}",
+        )
+
+    @staticmethod
+    def token(user) -> str:
+        return generate_jwt(user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+
+    def status(self, tracking_id: str, *, user=None):
+        return self.client.get(
+            f"/api/v1/archive/ingest/{tracking_id}/", HTTP_AUTHORIZATION=f"Bearer {self.token(user or self.user)}"
+        )
+
+    def test_enqueued_message_is_drained_and_reported_to_its_submitter(self):
+        response = self.submit("<queued@example.com>")
+        self.assertEqual(response.status_code, 202)
+        tracking_id = response.json()["tracking_id"]
+        self.assertEqual(self.status(tracking_id).json()["status"], "QUEUED")
+
+        self.assertEqual(tasks.drain_ingest_stage.apply().result["processed"], 1)
+        record = self.status(tracking_id).json()
+        email = ArchivedEmail.objects.get(message_id="<queued@example.com>")
+        self.assertEqual((record["status"], int(record["email_id"])), ("STORED", email.id))
+        self.assertNotIn("user_id", record)
+
+        other = User.objects.create(
+            username="other-ingester", email="other@example.com", department=self.department, is_superuser=True
+        )
+        self.assertEqual(self.status(tracking_id, user=other).status_code, 404)
+
+    def test_payload_rejected_by_the_worker_fails(self):
+        doomed = Mailbox.objects.create(address="doomed@example.com", department=self.department)
+        tracking_id = self.submit("<doomed@example.com>", mailbox=doomed).json()["tracking_id"]
+        doomed.delete()
+
+        self.assertEqual(tasks.drain_ingest_stage.apply().result["processed"], 0)
+        record = self.status(tracking_id).json()
+        self.assertEqual(record["status"], "FAILED")
+        self.assertIn("mailbox_not_found", record["error"])
+        self.assertFalse(ArchivedEmail.objects.exists())
+
+    def test_entry_of_a_deactivated_submitter_is_not_stored(self):
+        ingester = User.objects.create(
+            username="ingester", email="ingester@example.com", department=self.department, is_superuser=True
+        )
+        tracking_id = self.submit("<late@example.com>", user=ingester).json()["tracking_id"]
+        User.objects.filter(id=ingester.id).update(is_active=False)
+
+        self.assertEqual(tasks.drain_ingest_stage.apply().result["processed"], 0)
+        self.assertFalse(ArchivedEmail.objects.exists())
+        record = IngestStage().status(tracking_id, user=ingester)
+        self.assertEqual((record["status"], record["error"]), ("FAILED", "submitter_not_authorized"))
+
+
+class ExportRequestTests(ArchiveTestCase):
+    def request_export(self):
+        token = generate_jwt(self.user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+        return self.client.post(
+            "/api/v1/archive/exports/",
+            {"mailbox": self.mailbox.id, "time_start": "2024-01-01T00:00:00Z", "time_end": "2024-02-01T00:00:00Z"},
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+
+    @mock.patch("archive.views.dispatch_exports")
+    def test_concurrency_limit(self, dispatch):
+        with override_settings(RATE_LIMITS={**settings.RATE_LIMITS, "ENABLED": False, "EXPORT_MAX_CONCURRENT": 1}):
+            self.assertEqual(self.request_export().status_code, 202)
+            self.assertEqual(self.request_export().status_code, 429)
+
+    @mock.patch("archive.views.dispatch_exports")
+    def test_slots_fail_open_without_redis(self, dispatch):
+        with mock.patch("core.ratelimit.ConcurrencySlots.acquire", side_effect=RedisConnectionError("down")):
+            response = self.request_export()
+        self.assertEqual(response.status_code, 202)
+        dispatch.delay.assert_called_once()
+
+
+class ExportPartTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingest("<exported@example.com>", JANUARY)
+        self.job = ExportJob.objects.create(
+            owner=self.user, mailbox=self.mailbox, time_start=JANUARY, time_end=JANUARY + dt.timedelta(days=1)
+        )
+
+    def dispatch(self):
+        self.assertEqual(ExportScheduler().dispatch(lambda job_id: None), [self.job.id])
+
+    def test_slow_part_with_a_heartbeat_is_not_requeued(self):
+        self.dispatch()
+        stale = timezone.now() - dt.timedelta(seconds=settings.EXPORT_SCHEDULER["PART_TIMEOUT_SECONDS"] + 1)
+        ExportJob.objects.filter(id=self.job.id).update(dispatched_at=stale)
+        self.assertEqual(ExportScheduler()._requeue_stalled(), 0)
+        ExportJob.objects.filter(id=self.job.id).update(heartbeat_at=stale)
+        self.assertEqual(ExportScheduler()._requeue_stalled(), 1)
+
+    @mock.patch("archive.tasks.dispatch_exports")
+    def test_requeued_part_is_recorded_once(self, dispatch):
+        self.dispatch()
+        superseded = ExportJob.objects.select_related("owner").get(id=self.job.id)
+        # The part is requeued and dispatched again while the first worker still runs it.
+        ExportJob.objects.filter(id=self.job.id).update(status=ExportJob.STATUS_QUEUED, dispatched_at=None)
+        self.dispatch()
+        self.assertTrue(tasks.build_export_archive.apply(args=(self.job.id,)).result["complete"])
+
+        with self.assertRaises(PartSuperseded):
+            tasks._export_part(superseded)
+        job = ExportJob.objects.get(id=self.job.id)
+        self.assertEqual((job.status, job.exported_count, len(job.result_parts)), (ExportJob.STATUS_COMPLETED, 1, 1))
+
+
+class ThreadSearchTests(ArchiveTestCase):
+    def search(self):
+        token = generate_jwt(self.user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+        response = self.client.post(
+            "/api/v1/search/emails/",
+            {"time_start": "2024-01-01T00:00:00Z", "time_end": "2024-02-01T00:00:00Z"},
+            content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        )
+        self.assertEqual(response.status_code, 200)
+        return {result["id"]: result["thread_id"] for result in response.json()["results"]}
+
+    def test_results_carry_the_merged_thread(self):
+        parent = self.ingest("<parent@example.com>", JANUARY)
+        other = self.ingest("<other@example.com>", JANUARY + dt.timedelta(hours=1))
+        with mock.patch("archive.threads._dispatch_merge"):
+            # Replies to both, so the two threads merge; the search documents keep their old thread ids.
+            reply = self.ingest(
+                "<reply@example.com>",
+                JANUARY + dt.timedelta(hours=2),
+                references=["<parent@example.com>", "<other@example.com>"],
+            )
+        thread_id = MessageKey.objects.get(email_id=reply.id).thread_id
+        self.assertEqual(Thread.objects.count(), 1)
+        self.assertEqual(self.search(), {parent.id: thread_id, other.id: thread_id, reply.id: thread_id})
+
+    def test_merge_runs_until_no_document_carries_a_merged_id(self):
+        client = mock.Mock()
+        client.update_by_query.return_value = {"updated": 2, "version_conflicts": 1}
+        client.count.side_effect = [{"count": 1}, {"count": 0}]
+        with mock.patch.object(tasks, "get_client", return_value=client):
+            tasks.merge_thread_documents.apply(args=(1, [2, 3]))
+        self.assertEqual(client.update_by_query.call_count, 2)
+        self.assertEqual(client.update_by_query.call_args.kwargs["query"], {"terms": {"thread_id": [2, 3]}})
+
+
+@mock.patch("archive.threads._dispatch_merge")
+class ThreadTests(ArchiveTestCase):
+    def thread_of(self, email):
+        return MessageKey.objects.get(email_id=email.id).thread_id
+
+    def test_link_groups_replies_and_references(self, dispatch):
+        linked = threads.link(
+            [("<a@x>", []), ("<b@x>", ["<a@x>"]), ("<c@x>", ["<b@x>"]), ("<d@x>", []), ("<E@x>", ["<e@x>"])]
+        )
+        self.assertEqual(len({linked["<a@x>"], linked["<b@x>"], linked["<c@x>"]}), 1)
+        self.assertEqual(len(set(linked.values())), 3)
+        # Message ids compare exactly; only the angle brackets and whitespace are normalized.
+        self.assertEqual(Thread.objects.get(id=linked["<E@x>"]).size, 2)
+        self.assertEqual(ThreadNode.objects.count(), 6)
+
+    def test_late_parent_merges_threads(self, dispatch):
+        first = self.ingest("<first@example.com>", JANUARY, references=["<parent@example.com>"])
+        second = self.ingest("<second@example.com>", JANUARY + dt.timedelta(hours=1))
+        self.assertNotEqual(self.thread_of(first), self.thread_of(second))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            parent = self.ingest(
+                "<parent@example.com>", JANUARY + dt.timedelta(hours=2), references=["<second@example.com>"]
+            )
+
+        thread_id = self.thread_of(parent)
+        self.assertEqual({self.thread_of(first), self.thread_of(second)}, {thread_id})
+        self.assertEqual(list(Thread.objects.values_list("id", "size")), [(thread_id, 3)])
+        self.assertEqual(set(ThreadNode.objects.values_list("thread_id", flat=True)), {thread_id})
+        (merged,) = dispatch.call_args.args[1]
+        self.assertEqual(dispatch.call_args.args[0], thread_id)
+        self.assertNotEqual(merged, thread_id)
+
+    def test_link_follows_a_thread_merged_later_in_the_batch(self, dispatch):
+        linked = threads.link([("<a@x>", []), ("<b@x>", [])])
+        linked = threads.link([("<c@x>", ["<a@x>"]), ("<d@x>", ["<a@x>", "<b@x>"])])
+        self.assertEqual(linked["<c@x>"], linked["<d@x>"])
+        self.assertEqual(list(Thread.objects.values_list("id", flat=True)), [linked["<c@x>"]])
+
+    def test_deadlocked_transaction_is_retried(self, dispatch):
+        function = mock.Mock(side_effect=[OperationalError(1213, "Deadlock found"), "stored"])
+        with mock.patch("archive.threads.time.sleep"):
+            self.assertEqual(threads.retry_on_deadlock(function), "stored")
+        self.assertEqual(function.call_count, 2)
+        with self.assertRaises(OperationalError):
+            threads.retry_on_deadlock(mock.Mock(side_effect=OperationalError(1062, "Duplicate entry")))
+
+    def test_thread_view_hides_unreadable_mailboxes(self, dispatch):
+        finance = Department.objects.create(name="Finance", path="/finance")
+        hidden = Mailbox.objects.create(address="finance@example.com", department=finance)
+        ops = Department.objects.create(name="Ops", path="/ops")
+        reviewer = User.objects.create(username="reviewer", email="reviewer@example.com", department=ops)
+        role = Role.objects.create(name="reviewer", description="")
+        permission = Permission.objects.create(code="EMAIL_VIEW", description="")
+        RolePermission.objects.create(role=role, permission=permission)
+        UserRole.objects.create(user=reviewer, role=role)
+        MailboxAccess.objects.create(
+            user=reviewer, mailbox=self.mailbox, time_start=JANUARY - dt.timedelta(days=1), scope="READ"
+        )
+
+        root = self.ingest("<root@example.com>", JANUARY)
+        self.ingest(
+            "<aside@example.com>", JANUARY + dt.timedelta(hours=1), mailbox=hidden, references=["<root@example.com>"]
+        )
+        reply = self.ingest("<reply@example.com>", JANUARY + dt.timedelta(hours=2), references=["<root@example.com>"])
+
+        token = generate_jwt(reviewer, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+        response = self.client.get(
+            f"/api/v1/archive/threads/{self.thread_of(root)}/", HTTP_AUTHORIZATION=f"Bearer {token}"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([email["id"] for email in response.json()["emails"]], [root.id, reply.id])
+
+
+class IngestTests(ArchiveTestCase):
+    def test_stored_attachment_is_not_uploaded_again(self):
+        first = self.ingest("<first@example.com>", JANUARY, attachment=b"same file")
+        second = self.ingest("<second@example.com>", JANUARY, attachment=b"same file")
+
+        (key,) = set(EmailAttachment.objects.values_list("s3_object_key", flat=True))
+        self.assertTrue(key.startswith("attachments/sha256/"))
+        storage = self.service.storage
+        versions = storage.client.list_object_versions(Bucket=storage.bucket, Prefix=key)["Versions"]
+        self.assertEqual(len(versions), 1)
+        self.assertEqual(EmailAttachment.objects.filter(email_id__in=[first.id, second.id]).count(), 2)
+
+
+@mock.patch("archive.importer.helpers.bulk")
+class ImportTests(ArchiveTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "legal.mbox"
+        self.path.write_bytes(
+            b"From alice@example.com Wed Jan  3 00:00:00 2024\n"
+            b"Message-ID: <imported@example.com>\nFrom: alice@example.com\nTo: bob@example.com\n"
+            b"Date: Wed, 03 Jan 2024 00:00:00 +0000\nSubject: imported\n\nbody\n"
+        )
+
+    def import_into(self, mailbox) -> int:
+        (chunk,) = plan_chunks(self.path, 10)
+        records = prepare_chunk(chunk, mailbox.id, 1, None)
+        return commit_chunk(chunk, records, mailbox=mailbox, actor=self.user)
+
+    def test_one_source_imports_into_each_mailbox(self, bulk):
+        path = self.path
+        other = Mailbox.objects.create(address="archive@example.com", department=self.department)
+        for mailbox in (self.mailbox, other):
+            self.assertEqual(self.import_into(mailbox), 1)
+
+        ledger = ImportChunk.objects.filter(source=str(path.resolve()), chunk_index=0, status="DONE")
+        self.assertEqual(set(ledger.values_list("mailbox_id", flat=True)), {self.mailbox.id, other.id})
+        self.assertEqual(MessageKey.objects.filter(message_id="<imported@example.com>").count(), 2)
+
+    def test_import_does_not_upload_stored_attachment_again(self, bulk):
+        self.path.write_bytes(
+            b"From alice@example.com Wed Jan  3 00:00:00 2024\n"
+            b"Message-ID: <attached@example.com>\nFrom: alice@example.com\nTo: bob@example.com\n"
+            b"Date: Wed, 03 Jan 2024 00:00:00 +0000\nSubject: attached\nMIME-Version: 1.0\n"
+            b'Content-Type: multipart/mixed; boundary="b"\n\n'
+            b"--b\nContent-Type: text/plain\n\nbody\n"
+            b'--b\nContent-Type: text/plain\nContent-Disposition: attachment; filename="a.txt"\n\nsame file\n'
+            b"--b--\n"
+        )
+        other = Mailbox.objects.create(address="archive@example.com", department=self.department)
+        for mailbox in (self.mailbox, other):
+            self.assertEqual(self.import_into(mailbox), 1)
+
+        (key,) = set(EmailAttachment.objects.values_list("s3_object_key", flat=True))
+        storage = importer._get_storage()
+        versions = storage.client.list_object_versions(Bucket=storage.bucket, Prefix=key)["Versions"]
+        self.assertEqual(len(versions), 1)
+
+    def test_rerun_replans_chunks_whose_items_changed(self, bulk):
+        message = (
+            "From alice@example.com Wed Jan  3 00:00:00 2024\n"
+            "Message-ID: <{0}@example.com>\nFrom: alice@example.com\nTo: bob@example.com\n"
+            "Date: Wed, 03 Jan 2024 00:00:00 +0000\nSubject: {0}\n\nbody\n"
+        )
+        self.path.write_text(message.format("first"))
+        self.run_command("--chunk-size", "1")
+        # The mbox grew and the re-run uses a larger chunk: chunk 0 now also holds the
+        # second message, so the DONE row written for chunk 0 must not skip it.
+        self.path.write_text(message.format("first") + message.format("second"))
+        output = self.run_command("--chunk-size", "2")
+
+        self.assertIn("1 chunks, 0 already done, 1 replanned", output)
+        self.assertEqual(MessageKey.objects.filter(mailbox=self.mailbox).count(), 2)
+        row = ImportChunk.objects.get(mailbox=self.mailbox, chunk_index=0)
+        self.assertEqual((row.status, row.chunk_size, row.message_count), ("DONE", 2, 2))
+        self.assertIn("1 chunks, 1 already done, 0 replanned", self.run_command("--chunk-size", "2"))
+
+    def run_command(self, *args) -> str:
+        out = io.StringIO()
+        pool = mock.patch(
+            "archive.management.commands.import_mailstore.ProcessPoolExecutor", lambda max_workers: InlineExecutor()
+        )
+        with pool:
+            call_command(
+                "import_mailstore", str(self.path), "--mailbox", self.mailbox.address, "--actor",
+                self.user.username, *args, stdout=out,
+            )
+        return out.getvalue()
+
+    def test_reconciliation_reports_lost_segments(self, bulk):
+        with override_settings(SEGMENT_STORAGE={**settings.SEGMENT_STORAGE, "ENABLED": True}):
+            self.import_into(self.mailbox)
+        email = ArchivedEmail.objects.get()
+        self.assertTrue(email.s3_object_key.startswith("segments/"))
+        reconciler = StoreReconciler()
+        reconciler._check_objects(JANUARY.date(), ReconcileBucket(day=JANUARY.date()))
+        self.assertEqual(reconciler.report["missing_objects"], 0)
+
+        storage = reconciler.storage
+        storage.client.delete_object(Bucket=storage.bucket, Key=email.s3_object_key)
+        reconciler._check_objects(JANUARY.date(), ReconcileBucket(day=JANUARY.date()))
+        self.assertEqual(reconciler.report["missing_objects"], 1)
+        check = IntegrityCheck.objects.get(kind=IntegrityCheck.KIND_EMAIL, object_id=email.id)
+        self.assertEqual((check.ok, check.error), (False, "missing_object"))
+
+    def test_reconciliation_reports_lost_email_objects(self, bulk):
+        email = self.ingest("<lost@example.com>", JANUARY)
+        self.ingest("<next-day@example.com>", JANUARY + dt.timedelta(days=1))
+        self.assertTrue(email.s3_object_key.startswith(f"eml/{JANUARY.date()}/"))
+        reconciler = StoreReconciler()
+        storage = reconciler.storage
+        storage.client.delete_object(Bucket=storage.bucket, Key=email.s3_object_key)
+
+        bucket = ReconcileBucket(day=JANUARY.date())
+        with CaptureQueriesContext(connection) as queries:
+            reconciler._check_objects(JANUARY.date(), bucket)
+        self.assertEqual((reconciler.report["missing_objects"], reconciler.report["orphaned_objects"]), (1, 0))
+        self.assertEqual(bucket.s3_count, 0)
+        check = IntegrityCheck.objects.get(kind=IntegrityCheck.KIND_EMAIL, object_id=email.id)
+        self.assertEqual((check.ok, check.error), (False, "missing_object"))
+        # The prefix lookup is bounded by received_at, so MySQL prunes partitions.
+        (lookup,) = [q["sql"] for q in queries.captured_queries if "LIKE" in q["sql"] and "s3_object_key" in q["sql"]]
+        self.assertIn("received_at", lookup)
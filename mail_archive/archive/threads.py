@@ -0,0 +1,181 @@
+"""Conversation threads from the Message-ID, In-Reply-To and References headers.
+
+Every message id seen in one of these headers is a `ThreadNode`, whether or
+not that message is archived, and every node belongs to one `Thread`. Linking
+a message unites its own node with the nodes of the ids it references, as in
+union-find: new nodes join the thread of the nodes already known, and when a
+message connects several threads the smaller ones are relabelled into the
+largest (union by size), so a node changes threads O(log n) times overall.
+
+Relabelling updates the ThreadNode and MessageKey rows in the transaction that
+stores the message. A late parent or reply therefore merges into its thread as
+it arrives, without any batch recomputation. The `thread_id` of the search
+documents of merged threads follows in `archive.tasks.merge_thread_documents`.
+"""
+from __future__ import annotations
+
+import logging
+import random
+import time
+from collections import defaultdict
+from functools import partial
+
+from django.db import OperationalError, transaction
+from .models import MessageKey, Thread, ThreadNode
+
+logger = logging.getLogger(__name__)
+
+# MySQL's ER_LOCK_DEADLOCK and ER_LOCK_WAIT_TIMEOUT: the whole transaction was rolled back or may be retried.
+RETRIED_ERRORS = (1213, 1205)
+
+
+def normalize(message_id: str) -> str:
+    """The node key of a message id: angle-bracketed like References entries and at most 255 characters."""
+    message_id = message_id.strip()
+    if not message_id.startswith("<"):
+        message_id = f"<{message_id}>"
+    return message_id[:255]
+
+
+def _dispatch_merge(thread_id: int, merged_ids: list[int]) -> None:
+    from .tasks import merge_thread_documents
+
+    merge_thread_documents.delay(thread_id, merged_ids)
+
+
+def _components(messages) -> list[list[str]]:
+    """Node keys of `messages` grouped by the conversations the batch itself connects."""
+    parent: dict[str, str] = {}
+
+    def find(key: str) -> str:
+        parent.setdefault(key, key)
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    for message_id, references in messages:
+        root = find(normalize(message_id))
+        for reference in references:
+            other = find(normalize(reference))
+            if other != root:
+                parent[other] = root
+    groups = defaultdict(list)
+    for key in sorted(parent):
+        groups[find(key)].append(key)
+    return list(groups.values())
+
+
+def _follow(merged_into: dict[int, int], thread_id: int) -> int:
+    while thread_id in merged_into:
+        thread_id = merged_into[thread_id]
+    return thread_id
+
+
+def _plan(groups, nodes: dict[str, int | None], sizes: dict[int, int]) -> list[tuple]:
+    """(group, thread id or None for a new thread, merged thread ids, new keys) per group, merging as `link` does."""
+    sizes = dict(sizes)
+    # Threads merged earlier in this batch -> the thread they were merged into.
+    merged_into: dict[int, int] = {}
+    plan = []
+    for group in groups:
+        known = sorted(
+            {_follow(merged_into, nodes[key]) for key in group if nodes[key] is not None},
+            key=lambda tid: (-sizes[tid], tid),
+        )
+        new = [key for key in group if nodes[key] is None]
+        winner = known[0] if known else None
+        for tid in known[1:]:
+            sizes[winner] += sizes.pop(tid)
+            merged_into[tid] = winner
+        if winner is not None:
+            sizes[winner] += len(new)
+        plan.append((group, winner, known[1:], new))
+    return plan
+
+
+def _merged(plan) -> set[int]:
+    return {tid for _, _, merged, _ in plan for tid in merged}
+
+
+def _lock(groups, keys: list[str]) -> tuple[dict[str, int | None], dict[int, Thread], list[tuple]]:
+    """Locks the nodes of `keys` and of the threads they merge, then those threads; returns nodes, threads, plan.
+
+    Every link locks all the node rows it will change in one statement in
+    message_id order, and only then Thread rows in id order. A concurrent link
+    of a message into a merged thread holds one of those nodes before it asks
+    for the thread, so the two wait for each other instead of deadlocking.
+    """
+    nodes = dict(ThreadNode.objects.filter(message_id__in=keys).values_list("message_id", "thread_id"))
+    thread_ids = {tid for tid in nodes.values() if tid}
+    # A thread merged away since the nodes were read counts as empty; the locked pass sees the truth.
+    sizes = {tid: 0 for tid in thread_ids} | dict(Thread.objects.filter(id__in=thread_ids).values_list("id", "size"))
+    expected = _merged(_plan(groups, nodes, sizes))
+    while True:
+        others = ThreadNode.objects.filter(thread_id__in=expected).values_list("message_id", flat=True)
+        locked = dict(
+            ThreadNode.objects.select_for_update()
+            .filter(message_id__in=sorted(set(keys).union(others)))
+            .order_by("message_id")
+            .values_list("message_id", "thread_id")
+        )
+        nodes = {key: locked[key] for key in keys}
+        threads = Thread.objects.select_for_update().filter(id__in={tid for tid in nodes.values() if tid})
+        threads = {thread.id: thread for thread in threads.order_by("id")}
+        plan = _plan(groups, nodes, {tid: thread.size for tid, thread in threads.items()})
+        if _merged(plan) <= expected:
+            return nodes, threads, plan
+        # A concurrent link changed the threads between the read and the locks; lock the new ones too.
+        expected |= _merged(plan)
+
+
+def link(messages) -> dict[str, int]:
+    """Links (message id, referenced ids) pairs into threads; returns the thread id of each message id.
+
+    Call it in the transaction that stores the messages, and store their
+    MessageKey rows with the returned thread ids. Run that transaction with
+    `retry_on_deadlock`: lock order rules out deadlocks between links, but not
+    with every other statement of the transaction.
+    """
+    messages = list(messages)
+    groups = _components(messages)
+    keys = sorted(key for group in groups for key in group)
+    # Creating missing nodes first makes a concurrent link of the same ids wait here instead of deadlocking.
+    ThreadNode.objects.bulk_create([ThreadNode(message_id=key) for key in keys], ignore_conflicts=True, batch_size=500)
+    nodes, threads, plan = _lock(groups, keys)
+    thread_of: dict[str, int] = {}
+    for group, winner, merged, new in plan:
+        if winner is None:
+            thread = Thread.objects.create()
+            threads[thread.id] = thread
+        else:
+            thread = threads[winner]
+        if merged:
+            ThreadNode.objects.filter(thread_id__in=merged).update(thread=thread)
+            MessageKey.objects.filter(thread_id__in=merged).update(thread=thread)
+            Thread.objects.filter(id__in=merged).delete()
+            for tid in merged:
+                thread.size += threads.pop(tid).size
+            transaction.on_commit(partial(_dispatch_merge, thread.id, merged))
+        if new:
+            ThreadNode.objects.filter(message_id__in=new).update(thread=thread)
+            thread.size += len(new)
+        if merged or new:
+            thread.save(update_fields=["size"])
+        for key in group:
+            thread_of[key] = thread.id
+    # A group whose thread a later group merged ends up in that group's thread.
+    final = {tid: winner for _, winner, merged, _ in plan for tid in merged}
+    return {message_id: _follow(final, thread_of[normalize(message_id)]) for message_id, _ in messages}
+
+
+def retry_on_deadlock(function, attempts: int = 3):
+    """Runs `function`, which opens its own transaction, again when MySQL aborted it as a deadlock victim."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return function()
+        except OperationalError as exc:
+            if attempt == attempts or not exc.args or exc.args[0] not in RETRIED_ERRORS:
+                raise
+            logger.warning("transaction aborted by a lock conflict, retrying (%s/%s): %s", attempt, attempts, exc)
+            time.sleep(random.uniform(0.01, 0.05) * attempt)
@@ -0,0 +1,441 @@
+"""Cold tier for email metadata.
+
+Once a month is older than `COLD_TIER["AGE_DAYS"]`, the ArchivedEmail,
+EmailParticipant and EmailAttachment rows of each mailbox in it are written to
+one zstd-compressed Parquet file in S3, and the email and participant rows are
+deleted from MySQL. `ColdPartition` indexes the files, and MessageKey, which
+stays in MySQL, maps an email id or a message id to its mailbox and month and
+therefore to exactly one file. EmailAttachment rows are small and stay in
+MySQL as well, so the integrity sweep keeps verifying the attachment objects
+of cold mail.
+
+Files are sorted by id and cut into small row groups. Parquet keeps min/max
+statistics of every column per row group, and a lookup reads only the row
+groups whose id (or received_at) range can hold what it is looking for. The
+footer of each file is cached per process, so a warm lookup by id is a single
+ranged GET.
+
+Readers resolve ids through `get_emails` / `get_email` /
+`get_email_by_message_id`, which return ArchivedEmail instances from either
+tier. Instances built from a cold file are never saved.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import io
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from accounts.models import Department, Mailbox
+from core.hash_utils import sha256_bytes
+from core.partitioning import add_months, month_start
+from core.storage import S3Storage
+from .models import ArchivedEmail, ColdPartition, EmailAttachment, EmailParticipant, MessageKey, SearchQueue
+
+logger = logging.getLogger(__name__)
+
+EMAIL_COLUMNS = [field.attname for field in ArchivedEmail._meta.concrete_fields]
+PARTICIPANT_COLUMNS = ["type", "address"]
+ATTACHMENT_COLUMNS = ["filename", "mime_type", "size_bytes", "sha256", "s3_object_key"]
+
+
+def _arrow_type(field) -> pa.DataType:
+    kind = field.get_internal_type()
+    if kind in ("CharField", "TextField", "EmailField"):
+        return pa.string()
+    if kind == "DateTimeField":
+        return pa.timestamp("us", tz="UTC")
+    if kind == "BooleanField":
+        return pa.bool_()
+    # Keys and counters.
+    return pa.int64()
+
+
+SCHEMA = pa.schema(
+    [pa.field(field.attname, _arrow_type(field)) for field in ArchivedEmail._meta.concrete_fields]
+    + [
+        pa.field("participants", pa.list_(pa.struct([(name, pa.string()) for name in PARTICIPANT_COLUMNS]))),
+        pa.field(
+            "attachments",
+            pa.list_(
+                pa.struct(
+                    [(name, pa.int64() if name == "size_bytes" else pa.string()) for name in ATTACHMENT_COLUMNS]
+                )
+            ),
+        ),
+    ]
+)
+
+
+def _month_of(value: dt.datetime) -> dt.date:
+    return month_start(value.astimezone(dt.timezone.utc).date())
+
+
+def _month_bounds(month: dt.date) -> tuple[dt.datetime, dt.datetime]:
+    start = dt.datetime.combine(month, dt.time.min, tzinfo=dt.timezone.utc)
+    return start, dt.datetime.combine(add_months(month, 1), dt.time.min, tzinfo=dt.timezone.utc)
+
+
+def _order(email: ArchivedEmail) -> tuple[dt.datetime, int]:
+    return email.received_at, email.id
+
+
+class _RangeReader(io.RawIOBase):
+    """Seekable, read-only view of an S3 object of known size; every read is one ranged GET."""
+
+    def __init__(self, storage: S3Storage, key: str, size: int):
+        self.storage = storage
+        self.key = key
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = base + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        data = b"".join(self.storage.iter_object(self.key, byte_range=(self.position, length)))
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class _FooterCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, pq.FileMetaData] = OrderedDict()
+
+    def get(self, key: str) -> pq.FileMetaData | None:
+        with self._lock:
+            metadata = self._entries.get(key)
+            if metadata is not None:
+                self._entries.move_to_end(key)
+            return metadata
+
+    def put(self, key: str, metadata: pq.FileMetaData) -> None:
+        with self._lock:
+            self._entries[key] = metadata
+            while len(self._entries) > settings.COLD_TIER["FOOTER_CACHE_ENTRIES"]:
+                self._entries.popitem(last=False)
+
+
+_footers = _FooterCache()
+
+
+def _attach_relations(emails) -> None:
+    """Sets mailbox and department on cold instances with two queries instead of two per email."""
+    emails = list(emails)
+    if not emails:
+        return
+    mailboxes = Mailbox.objects.in_bulk({email.mailbox_id for email in emails})
+    departments = Department.objects.in_bulk({email.department_id for email in emails})
+    for email in emails:
+        email.mailbox = mailboxes[email.mailbox_id]
+        email.department = departments[email.department_id]
+
+
+def _day_digests(rows: list[dict]) -> dict[str, list[int]]:
+    from .reconcile import item_digest
+
+    digests: dict[str, list[int]] = {}
+    for row in rows:
+        day = row["received_at"].astimezone(dt.timezone.utc).date().isoformat()
+        count, digest = digests.get(day, (0, 0))
+        digests[day] = [count + 1, digest ^ item_digest(row["id"], row["sha256"])]
+    return digests
+
+
+class ColdStore:
+    def __init__(self, storage: S3Storage | None = None):
+        self.cfg = settings.COLD_TIER
+        self.storage = storage or S3Storage()
+
+    # Reading
+
+    def _open(self, key: str, size: int) -> pq.ParquetFile:
+        metadata = _footers.get(key)
+        # pre_buffer coalesces the column chunks of the selected row groups into as few GETs as possible.
+        parquet = pq.ParquetFile(_RangeReader(self.storage, key, size), metadata=metadata, pre_buffer=True)
+        if metadata is None:
+            _footers.put(key, parquet.metadata)
+        return parquet
+
+    @staticmethod
+    def _row_groups(metadata: pq.FileMetaData, column: str, low, high) -> list[int]:
+        """Row groups whose min/max statistics for `column` overlap [low, high]."""
+        position = {metadata.schema.column(i).path: i for i in range(metadata.num_columns)}[column]
+        groups = []
+        for i in range(metadata.num_row_groups):
+            stats = metadata.row_group(i).column(position).statistics
+            if stats is None or not stats.has_min_max or (stats.max >= low and stats.min <= high):
+                groups.append(i)
+        return groups
+
+    def _read(self, partition: ColdPartition, column: str, low, high, columns=None) -> pa.Table:
+        """Rows of the partition's file with low <= column <= high, reading only the row groups that may match."""
+        parquet = self._open(partition.s3_object_key, partition.size_bytes)
+        present = parquet.schema_arrow.names
+        # Files written before a column was added simply lack it; the model default fills in.
+        columns = [name for name in (columns or present) if name in present]
+        groups = self._row_groups(parquet.metadata, column, low, high)
+        if not groups:
+            return parquet.schema_arrow.empty_table().select(columns)
+        table = parquet.read_row_groups(groups, columns=columns)
+        kind = table.schema.field(column).type
+        return table.filter(
+            pc.and_(
+                pc.greater_equal(table[column], pa.scalar(low, type=kind)),
+                pc.less_equal(table[column], pa.scalar(high, type=kind)),
+            )
+        )
+
+    @staticmethod
+    def _emails(table: pa.Table) -> list[ArchivedEmail]:
+        emails = []
+        for row in table.to_pylist():
+            participants = row.pop("participants", None)
+            row.pop("attachments", None)
+            email = ArchivedEmail(**row)
+            email._state.adding = False
+            if participants is not None:
+                email.tiered_participants = participants
+            emails.append(email)
+        return emails
+
+    def get_many(self, keys, *, participants: bool = False) -> dict[int, ArchivedEmail]:
+        """Cold emails for (email_id, mailbox_id, received_at) keys; ids that are not tiered are left out.
+
+        With `participants` the list of {"type", "address"} is set as `tiered_participants`.
+        """
+        wanted: dict[tuple[int, dt.date], set[int]] = defaultdict(set)
+        for email_id, mailbox_id, received_at in keys:
+            wanted[(mailbox_id, _month_of(received_at))].add(email_id)
+        if not wanted:
+            return {}
+        partitions = ColdPartition.objects.filter(
+            mailbox_id__in={mailbox_id for mailbox_id, _ in wanted}, month__in={month for _, month in wanted}
+        )
+        found = {}
+        for partition in partitions:
+            ids = wanted.get((partition.mailbox_id, partition.month))
+            if not ids:
+                continue
+            columns = EMAIL_COLUMNS + ["participants"] if participants else EMAIL_COLUMNS
+            table = self._read(partition, "id", min(ids), max(ids), columns=columns)
+            table = table.filter(pc.is_in(table["id"], value_set=pa.array(sorted(ids), pa.int64())))
+            found.update((email.id, email) for email in self._emails(table))
+        _attach_relations(found.values())
+        return found
+
+    def emails(self, mailbox_id: int, start, end, *, after=None, limit: int | None = None) -> list[ArchivedEmail]:
+        """Cold emails of a mailbox in [start, end] after the (received_at, id) cursor, in that order."""
+        low = start if after is None else max(start, after[0])
+        partitions = ColdPartition.objects.filter(
+            mailbox_id=mailbox_id, max_received_at__gte=low, min_received_at__lte=end
+        ).order_by("month")
+        found: list[ArchivedEmail] = []
+        for partition in partitions:
+            # Files cover disjoint months, so a later file cannot hold rows that sort before these.
+            if limit is not None and len(found) >= limit:
+                break
+            table = self._read(partition, "received_at", low, end, columns=EMAIL_COLUMNS)
+            emails = sorted(self._emails(table), key=_order)
+            found.extend(email for email in emails if after is None or _order(email) > tuple(after))
+        found = found if limit is None else found[:limit]
+        _attach_relations(found)
+        return found
+
+    def day_emails(self, day: dt.date, address: str | None = None) -> list[ArchivedEmail]:
+        """Cold emails received on `day` (UTC), optionally of one mailbox; used by reconciliation."""
+        partitions = ColdPartition.objects.filter(month=month_start(day))
+        if address is not None:
+            partitions = partitions.filter(mailbox__address=address)
+        start = dt.datetime.combine(day, dt.time.min, tzinfo=dt.timezone.utc)
+        end = start + dt.timedelta(days=1) - dt.timedelta(microseconds=1)
+        emails = []
+        for partition in partitions:
+            if day.isoformat() in partition.day_digests:
+                emails.extend(self._emails(self._read(partition, "received_at", start, end, columns=EMAIL_COLUMNS)))
+        return emails
+
+    def rows(self, partition: ColdPartition, columns: list[str]) -> list[dict]:
+        """All rows of a partition's file, limited to `columns`."""
+        return self._open(partition.s3_object_key, partition.size_bytes).read(columns=columns).to_pylist()
+
+    # Tiering
+
+    def candidates(self, limit: int) -> list[tuple[int, dt.date]]:
+        """(mailbox id, month) of hot rows in months that ended more than AGE_DAYS ago, oldest first.
+
+        Rows still waiting to be indexed are left out as in `_hot_rows`, so a month
+        `tier` would skip does not take a slot of the run.
+        """
+        cutoff, _ = _month_bounds(_month_of(timezone.now() - dt.timedelta(days=self.cfg["AGE_DAYS"])))
+        rows = (
+            ArchivedEmail.objects.filter(received_at__lt=cutoff)
+            .exclude(id__in=SearchQueue.objects.filter(status="PENDING").values("email_id"))
+            .annotate(month=TruncMonth("received_at", tzinfo=dt.timezone.utc))
+            .values_list("mailbox_id", "month")
+            .distinct()
+            .order_by("month", "mailbox_id")[:limit]
+        )
+        return [(mailbox_id, month.date() if isinstance(month, dt.datetime) else month) for mailbox_id, month in rows]
+
+    def _hot_rows(self, mailbox_id: int, start, end) -> list[dict]:
+        rows = list(
+            ArchivedEmail.objects.filter(mailbox_id=mailbox_id, received_at__gte=start, received_at__lt=end)
+            # Rows still waiting to be indexed stay hot until the search queue has caught up.
+            .exclude(id__in=SearchQueue.objects.filter(status="PENDING").values("email_id"))
+            .order_by("id")
+            .values(*EMAIL_COLUMNS)
+        )
+        participants, attachments = defaultdict(list), defaultdict(list)
+        batch = self.cfg["BATCH_SIZE"]
+        for i in range(0, len(rows), batch):
+            ids = [row["id"] for row in rows[i : i + batch]]
+            for row in EmailParticipant.objects.filter(email_id__in=ids).values("email_id", *PARTICIPANT_COLUMNS):
+                participants[row.pop("email_id")].append(row)
+            for row in EmailAttachment.objects.filter(email_id__in=ids).values("email_id", *ATTACHMENT_COLUMNS):
+                attachments[row.pop("email_id")].append(row)
+        for row in rows:
+            row["participants"] = participants.get(row["id"], [])
+            row["attachments"] = attachments.get(row["id"], [])
+        return rows
+
+    def tier(self, mailbox_id: int, month: dt.date) -> int:
+        """Moves the mailbox's hot rows of `month` into its cold file; returns the number of emails moved.
+
+        Late rows for a month that is already cold are merged into a new generation of its file.
+        The file is written and indexed before any row is deleted, so every email stays readable.
+        """
+        start, end = _month_bounds(month)
+        rows = self._hot_rows(mailbox_id, start, end)
+        if not rows:
+            return 0
+        partition = ColdPartition.objects.filter(mailbox_id=mailbox_id, month=month).first()
+        merged = list(rows)
+        if partition is not None:
+            moved = {row["id"] for row in rows}
+            previous = self._open(partition.s3_object_key, partition.size_bytes).read()
+            merged.extend(row for row in previous.to_pylist() if row["id"] not in moved)
+            merged.sort(key=lambda row: row["id"])
+        sink = io.BytesIO()
+        pq.write_table(
+            pa.Table.from_pylist(merged, schema=SCHEMA),
+            sink,
+            row_group_size=self.cfg["ROW_GROUP_ROWS"],
+            compression="zstd",
+            compression_level=self.cfg["COMPRESSION_LEVEL"],
+            write_statistics=True,
+        )
+        data = sink.getvalue()
+        generation = partition.generation + 1 if partition is not None else 1
+        key = f"{self.cfg['PREFIX']}{mailbox_id}/{month:%Y-%m}/{generation:04d}.parquet"
+        self.storage.put_object(key, data)
+        written = self._open(key, len(data)).metadata.num_rows
+        if written != len(merged):
+            raise RuntimeError(f"{key} holds {written} rows, expected {len(merged)}")
+        received = [row["received_at"] for row in merged]
+        ColdPartition.objects.update_or_create(
+            mailbox_id=mailbox_id,
+            month=month,
+            defaults={
+                "generation": generation,
+                "s3_object_key": key,
+                "size_bytes": len(data),
+                "sha256": sha256_bytes(data),
+                "row_count": len(merged),
+                "min_received_at": min(received),
+                "max_received_at": max(received),
+                "day_digests": _day_digests(merged),
+            },
+        )
+        self._delete([row["id"] for row in rows], start, end)
+        return len(rows)
+
+    def _delete(self, ids: list[int], start, end) -> None:
+        batch = self.cfg["BATCH_SIZE"]
+        for i in range(0, len(ids), batch):
+            chunk = ids[i : i + batch]
+            with transaction.atomic():
+                EmailParticipant.objects.filter(email_id__in=chunk).delete()
+                # MessageKey rows stay: they are the index into the cold tier. EmailAttachment rows stay
+                # for the integrity sweep (their foreign key does not cascade).
+                ArchivedEmail.objects.filter(id__in=chunk, received_at__gte=start, received_at__lt=end).delete()
+
+    def run(self) -> dict:
+        report = {"files": 0, "emails": 0, "failed": 0}
+        for mailbox_id, month in self.candidates(self.cfg["MAX_FILES_PER_RUN"]):
+            try:
+                moved = self.tier(mailbox_id, month)
+            except Exception:
+                logger.exception("tiering mailbox %s month %s failed", mailbox_id, month)
+                report["failed"] += 1
+                continue
+            report["files"] += 1
+            report["emails"] += moved
+        logger.info("cold tiering finished: %s", report)
+        return report
+
+
+def resolve_keys(keys: list[tuple], queryset=None) -> dict[int, ArchivedEmail]:
+    """Emails for (email_id, mailbox_id, received_at) keys, as read from MessageKey, from either tier."""
+    if not keys:
+        return {}
+    queryset = ArchivedEmail.objects.all() if queryset is None else queryset
+    received = [received_at for _, _, received_at in keys]
+    # The received_at bounds let MySQL read only the partitions the rows are in.
+    found = {
+        email.id: email
+        for email in queryset.filter(
+            id__in=[email_id for email_id, _, _ in keys], received_at__range=(min(received), max(received))
+        )
+    }
+    missing = [key for key in keys if key[0] not in found]
+    if missing:
+        found.update(ColdStore().get_many(missing))
+    return found
+
+
+def get_emails(email_ids, queryset=None) -> dict[int, ArchivedEmail]:
+    """Emails by id from either tier; `queryset` (e.g. with select_related) is used for hot rows."""
+    keys = list(
+        MessageKey.objects.filter(email_id__in=list(email_ids)).values_list("email_id", "mailbox_id", "received_at")
+    )
+    return resolve_keys(keys, queryset)
+
+
+def get_email(email_id: int, queryset=None) -> ArchivedEmail | None:
+    return get_emails([email_id], queryset).get(email_id)
+
+
+def get_email_by_message_id(mailbox_id: int, message_id: str, queryset=None) -> ArchivedEmail | None:
+    key = (
+        MessageKey.objects.filter(mailbox_id=mailbox_id, message_id=message_id)
+        .values_list("email_id", "mailbox_id", "received_at")
+        .first()
+    )
+    if key is None:
+        return None
+    return resolve_keys([key], queryset).get(key[0])
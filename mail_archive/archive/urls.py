@@ -1,9 +1,30 @@
 from django.urls import path
-from .views import ArchiveIngestView, EmailDetailView, EmailVerifyView, ExportJobView
+from .views import (
+    ArchiveIngestView,
+    EmailDetailView,
+    EmailDownloadView,
+    EmailPreviewView,
+    EmailProofView,
+    EmailVerifyView,
+    ExportJobView,
+    IngestStatsView,
+    IngestStatusView,
+    QueueStatsView,
+    StorageStatsView,
+    ThreadView,
+)
 
 urlpatterns = [
     path("ingest/", ArchiveIngestView.as_view(), name="archive-ingest"),
+    path("ingest/stats/", IngestStatsView.as_view(), name="archive-ingest-stats"),
+    path("ingest/<str:tracking_id>/", IngestStatusView.as_view(), name="archive-ingest-status"),
     path("emails/<int:email_id>/", EmailDetailView.as_view(), name="email-detail"),
+    path("emails/<int:email_id>/download/", EmailDownloadView.as_view(), name="email-download"),
+    path("emails/<int:email_id>/preview/", EmailPreviewView.as_view(), name="email-preview"),
     path("emails/<int:email_id>/verify/", EmailVerifyView.as_view(), name="email-verify"),
+    path("emails/<int:email_id>/proof/", EmailProofView.as_view(), name="email-proof"),
+    path("threads/<int:thread_id>/", ThreadView.as_view(), name="thread-detail"),
     path("exports/", ExportJobView.as_view(), name="export-job"),
+    path("queues/stats/", QueueStatsView.as_view(), name="archive-queue-stats"),
+    path("storage/stats/", StorageStatsView.as_view(), name="archive-storage-stats"),
 ]
@@ -1,15 +1,45 @@
+import logging
+
+from redis.exceptions import RedisError
 from rest_framework import status
+from rest_framework.exceptions import NotFound, Throttled, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.shortcuts import get_object_or_404
-from django.utils import timezone
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import reverse
+from mail_archive.celery import QUEUE_CONCURRENCY
+from core.compression import CODEC_IDENTITY
 from core.permissions import RBACPermission
+from core.queues import queue_stats
+from core.ratelimit import export_slots
+from core.replicas import replica_reads
+from core.storage import BlobCache
+from core.streaming import RangeNotSatisfiable, iterate_in_threads, none_match, parse_range, range_applies
 from accounts.access import AccessService
 from audit.services import AuditService
-from .models import ArchivedEmail, ExportJob
+from .models import ArchivedEmail, ExportJob, MessageKey, Thread
+from .dedup import DuplicateGuard
+from .merkle import inclusion_proof
+from .preview import body_page, cache_stats, email_preview
 from .serializers import ArchiveRequestSerializer, ArchivedEmailSerializer, ExportJobRequestSerializer
 from .services import ArchiveIngestService, EmailAccessService
-from .tasks import build_export_archive
+from .staging import IngestStage
+from .scheduling import ExportScheduler
+from .tasks import dispatch_exports
+from .tiering import get_email, resolve_keys
+
+logger = logging.getLogger(__name__)
+
+
+def _email_or_404(email_id: int, queryset=None) -> ArchivedEmail:
+    """The email from MySQL or, once its month has been tiered, from its cold file."""
+    email = get_email(email_id, queryset)
+    if email is None:
+        raise Http404
+    return email
 
 
 class ArchiveIngestView(APIView):
@@ -19,9 +49,54 @@ class ArchiveIngestView(APIView):
     def post(self, request):
         serializer = ArchiveRequestSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        if settings.INGEST_SETTINGS["MODE"] == "queued":
+            existing = DuplicateGuard().existing(data["mailbox"].id, data["message_id"])
+            if existing is not None:
+                return Response({"id": existing.id, "sha256": existing.sha256, "duplicate": True})
+            tracking_id = IngestStage().enqueue(user=request.user, data=request.data)
+            return Response({"tracking_id": tracking_id}, status=status.HTTP_202_ACCEPTED)
         service = ArchiveIngestService()
-        email = service.ingest(user=request.user, payload=serializer.validated_data)
-        return Response({"id": email.id, "sha256": email.sha256}, status=status.HTTP_201_CREATED)
+        email = service.ingest(user=request.user, payload=data)
+        headers = {"Server-Timing": service.timer.server_timing()}
+        if email.is_duplicate:
+            return Response({"id": email.id, "sha256": email.sha256, "duplicate": True}, headers=headers)
+        return Response({"id": email.id, "sha256": email.sha256}, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class IngestStatusView(APIView):
+    permission_classes = [RBACPermission]
+    required_permission = "ARCHIVE_STORE"
+
+    def get(self, request, tracking_id: str):
+        record = IngestStage().status(tracking_id, user=request.user)
+        if record is None:
+            raise Http404
+        return Response({"tracking_id": tracking_id, **record})
+
+
+class IngestStatsView(APIView):
+    permission_classes = [RBACPermission]
+    required_permission = "OPS_METRICS"
+
+    def get(self, request):
+        return Response({**IngestStage().stats(), "dedup": DuplicateGuard().stats()})
+
+
+class StorageStatsView(APIView):
+    permission_classes = [RBACPermission]
+    required_permission = "OPS_METRICS"
+
+    def get(self, request):
+        return Response({"blob_cache": BlobCache().stats(), "preview_cache": cache_stats()})
+
+
+class QueueStatsView(APIView):
+    permission_classes = [RBACPermission]
+    required_permission = "OPS_METRICS"
+
+    def get(self, request):
+        return Response({"queues": queue_stats(list(QUEUE_CONCURRENCY)), "exports": ExportScheduler().stats()})
 
 
 class EmailDetailView(APIView):
@@ -29,13 +104,132 @@ class EmailDetailView(APIView):
     required_permission = "EMAIL_VIEW"
 
     def get(self, request, email_id: int):
-        email = get_object_or_404(ArchivedEmail, id=email_id)
+        with replica_reads():
+            email = _email_or_404(email_id, ArchivedEmail.objects.select_related("mailbox", "department"))
+            AccessService.ensure_email_access(request.user, email)
+            AccessService.ensure_time_scope(request.user, email.received_at)
+            data = ArchivedEmailSerializer(email).data
+            data["thread_id"] = MessageKey.objects.filter(email_id=email.id).values_list("thread_id", flat=True).first()
+        proxy_url = request.build_absolute_uri(reverse("email-download", args=[email.id]))
+        if email.codec == CODEC_IDENTITY and email.segment_id is None:
+            download_url = EmailAccessService().presign(email)
+        else:
+            # Compressed or packed objects are only meaningful through the download endpoint.
+            download_url = proxy_url
+        AuditService.append(request.user, "EMAIL_VIEW", {"email_id": email_id})
+        return Response({"email": data, "download_url": download_url, "proxy_url": proxy_url})
+
+
+class ThreadView(APIView):
+    """The messages of a thread the caller may read, oldest first (see archive.threads)."""
+
+    permission_classes = [RBACPermission]
+    required_permission = "EMAIL_VIEW"
+
+    def get(self, request, thread_id: int):
+        limit = settings.THREADING["MAX_MESSAGES"]
+        with replica_reads():
+            if not Thread.objects.filter(id=thread_id).exists():
+                raise Http404
+            # One query over the (thread, received_at) index yields the ordered, access-filtered thread.
+            keys = list(
+                MessageKey.objects.filter(
+                    AccessService.mailbox_filter(request.user),
+                    AccessService.time_filter(request.user, "received_at"),
+                    thread_id=thread_id,
+                )
+                .order_by("received_at", "email_id")
+                .values_list("email_id", "mailbox_id", "received_at")[: limit + 1]
+            )
+            emails = resolve_keys(keys[:limit], ArchivedEmail.objects.select_related("mailbox", "department"))
+            data = ArchivedEmailSerializer([emails[key[0]] for key in keys[:limit] if key[0] in emails], many=True).data
+        AuditService.append(
+            request.user, "THREAD_VIEW", {"thread_id": thread_id}, result_count=len(data), target_id=str(thread_id)
+        )
+        return Response({"thread_id": thread_id, "emails": data, "truncated": len(keys) > limit})
+
+
+class EmailDownloadView(APIView):
+    """Streams the original message; supports single byte ranges and the sha256 ETag.
+
+    Under ASGI the body is an async iterator, so a slow client holds no worker thread.
+    """
+
+    permission_classes = [RBACPermission]
+    required_permission = "EMAIL_VIEW"
+
+    def get(self, request, email_id: int):
+        email = _email_or_404(email_id)
         AccessService.ensure_email_access(request.user, email)
         AccessService.ensure_time_scope(request.user, email.received_at)
-        serializer = ArchivedEmailSerializer(email)
-        presign = EmailAccessService().presign(email)
-        AuditService.append(request.user, "EMAIL_VIEW", {"email_id": email_id})
-        return Response({"email": serializer.data, "download_url": presign})
+        etag = f'"{email.sha256}"'
+        headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private, max-age=86400, immutable"}
+        if none_match(request.headers.get("If-None-Match"), etag):
+            return HttpResponseNotModified(headers=headers)
+        byte_range = None
+        if range_applies(request.headers.get("If-Range"), etag):
+            try:
+                byte_range = parse_range(request.headers.get("Range"), email.size_bytes)
+            except RangeNotSatisfiable:
+                return HttpResponse(
+                    status=416, headers={**headers, "Content-Range": f"bytes */{email.size_bytes}"}
+                )
+        access = EmailAccessService()
+        if byte_range is None:
+            chunks, length, status_code = access.iter_content(email), email.size_bytes, 200
+        else:
+            start, length = byte_range
+            chunks, status_code = access.iter_range(email, start, length), 206
+            headers["Content-Range"] = f"bytes {start}-{start + length - 1}/{email.size_bytes}"
+        AuditService.append(
+            request.user,
+            "EMAIL_DOWNLOAD",
+            {"email_id": email_id, "range": request.headers.get("Range") if byte_range else None},
+        )
+        if isinstance(request._request, ASGIRequest):
+            chunks = iterate_in_threads(chunks)
+        response = StreamingHttpResponse(chunks, status=status_code, content_type="message/rfc822", headers=headers)
+        response["Content-Length"] = str(length)
+        # GZipMiddleware leaves encoded responses alone; compressing would drop the length and weaken the ETag.
+        response["Content-Encoding"] = "identity"
+        response["Content-Disposition"] = f'attachment; filename="{email.id}.eml"'
+        return response
+
+
+class EmailPreviewView(APIView):
+    """Headers, plain-text body and attachment list; the body is paged with `offset`/`limit`."""
+
+    permission_classes = [RBACPermission]
+    required_permission = "EMAIL_VIEW"
+
+    @staticmethod
+    def _int_param(request, name: str, default: int, maximum: int) -> int:
+        try:
+            value = int(request.query_params.get(name, default))
+        except ValueError:
+            raise ValidationError({name: "must be an integer"})
+        if value < 0:
+            raise ValidationError({name: "must not be negative"})
+        return min(value, maximum)
+
+    def get(self, request, email_id: int):
+        email = _email_or_404(email_id)
+        AccessService.ensure_email_access(request.user, email)
+        AccessService.ensure_time_scope(request.user, email.received_at)
+        cfg = settings.PREVIEW
+        offset = self._int_param(request, "offset", 0, cfg["MAX_BODY_CHARS"])
+        limit = self._int_param(request, "limit", cfg["PAGE_CHARS"], cfg["PAGE_CHARS"])
+        preview = email_preview(email)
+        AuditService.append(request.user, "EMAIL_PREVIEW", {"email_id": email_id, "offset": offset})
+        return Response(
+            {
+                "email_id": email.id,
+                "sha256": email.sha256,
+                "headers": preview["headers"],
+                "body": body_page(preview, offset, limit),
+                "attachments": preview["attachments"],
+            }
+        )
 
 
 class EmailVerifyView(APIView):
@@ -43,7 +237,7 @@ class EmailVerifyView(APIView):
     required_permission = "EMAIL_VERIFY"
 
     def post(self, request, email_id: int):
-        email = get_object_or_404(ArchivedEmail, id=email_id)
+        email = _email_or_404(email_id)
         AccessService.ensure_email_access(request.user, email)
         AccessService.ensure_time_scope(request.user, email.received_at)
         verified = EmailAccessService().verify(email)
@@ -51,6 +245,21 @@ class EmailVerifyView(APIView):
         return Response({"verified": verified})
 
 
+class EmailProofView(APIView):
+    permission_classes = [RBACPermission]
+    required_permission = "EMAIL_VERIFY"
+
+    def get(self, request, email_id: int):
+        email = _email_or_404(email_id)
+        AccessService.ensure_email_access(request.user, email)
+        AccessService.ensure_time_scope(request.user, email.received_at)
+        proof = inclusion_proof(email)
+        if proof is None:
+            raise NotFound("merkle_tree_not_built")
+        AuditService.append(request.user, "EMAIL_PROOF", {"email_id": email_id, "day_root": proof["day_root"]})
+        return Response(proof)
+
+
 class ExportJobView(APIView):
     permission_classes = [RBACPermission]
     required_permission = "EXPORT_EMAIL"
@@ -62,12 +271,21 @@ class ExportJobView(APIView):
         data = serializer.validated_data
         AccessService.ensure_mailbox_access(request.user, data["mailbox"])
         AccessService.ensure_time_scope(request.user, data["time_start"])
-        job = ExportJob.objects.create(
-            owner=request.user,
-            mailbox=data["mailbox"],
-            time_start=data["time_start"],
-            time_end=data["time_end"],
-        )
-        build_export_archive.delay(job.id)
+        with transaction.atomic():
+            job = ExportJob.objects.create(
+                owner=request.user,
+                mailbox=data["mailbox"],
+                time_start=data["time_start"],
+                time_end=data["time_end"],
+            )
+            try:
+                acquired = export_slots().acquire(request.user.id, job.id)
+            except RedisError:
+                # Fail open like the rate limits: the export scheduler still bounds running exports.
+                logger.warning("export slots unavailable; allowing export %s", job.id, exc_info=True)
+                acquired = True
+            if not acquired:
+                raise Throttled(detail="export_concurrency_limit")
+        dispatch_exports.delay()
         AuditService.append(request.user, "EXPORT_REQUEST", {"job_id": job.id})
         return Response({"job_id": job.id}, status=status.HTTP_202_ACCEPTED)
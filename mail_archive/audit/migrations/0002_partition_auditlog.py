@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from core.partitioning import partition_table, unpartition_table
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        partition_table(schema_editor.connection, "audit_auditlog", settings.PARTITIONING["MONTHS_AHEAD"])
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor == "mysql":
+        unpartition_table(schema_editor.connection, "audit_auditlog")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('audit', '0001_initial'),
+        # Drops the merkle tree foreign key to this table.
+        ('archive', '0009_partition_archivedemail'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='auditlog',
+            name='actor',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(partition, unpartition),
+    ]
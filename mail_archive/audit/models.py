@@ -3,7 +3,8 @@ from django.conf import settings
 
 
 class AuditLog(models.Model):
-    actor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT)
+    # Partitioned by month of occurred_at (core.partitioning), so no foreign keys to or from this table.
+    actor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, db_constraint=False)
     actor_role = models.CharField(max_length=128)
     action = models.CharField(max_length=64)
     parameters = models.JSONField()
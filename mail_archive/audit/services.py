@@ -1,8 +1,9 @@
 import hashlib
 import json
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from django.db import transaction
 from django.utils import timezone
+from core import metrics
 from .models import AuditLog
 
 
@@ -30,20 +31,25 @@ class AuditService:
             "ts": timezone.now().isoformat(),
         }
         serialized = json.dumps(payload, separators=(",", ":"), sort_keys=True)
-        prev = AuditLog.objects.select_for_update().order_by("-id").first()
+        with metrics.stage("audit_append", "lock"):
+            # The tail is almost always from the last day; bounding occurred_at keeps the locking read in the
+            # newest partition, and only an idle day falls back to the whole table.
+            tail = AuditLog.objects.select_for_update().order_by("-id")
+            prev = tail.filter(occurred_at__gte=timezone.now() - timedelta(days=1)).first() or tail.first()
         prev_hash = prev.sha256 if prev else None
         sha = hashlib.sha256()
         sha.update(serialized.encode())
         if prev_hash:
             sha.update(prev_hash.encode())
-        entry = AuditLog.objects.create(
-            actor=actor,
-            actor_role=",".join(actor.role_codes),
-            action=action,
-            parameters=clean_params,
-            result_count=result_count,
-            target_id=target_id,
-            prev_hash=prev_hash,
-            sha256=sha.hexdigest(),
-        )
+        with metrics.stage("audit_append", "insert"):
+            entry = AuditLog.objects.create(
+                actor=actor,
+                actor_role=",".join(actor.role_codes),
+                action=action,
+                parameters=clean_params,
+                result_count=result_count,
+                target_id=target_id,
+                prev_hash=prev_hash,
+                sha256=sha.hexdigest(),
+            )
         return entry
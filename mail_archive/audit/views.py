@@ -1,6 +1,9 @@
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView
 from rest_framework.pagination import LimitOffsetPagination
 from core.permissions import RBACPermission
+from core.replicas import replica_reads
 from .models import AuditLog
 from .serializers import AuditLogSerializer
 
@@ -13,6 +16,10 @@ class AuditLogView(ListAPIView):
     required_permission = "AUDIT_READ"
     require_mfa = True
 
+    def list(self, request, *args, **kwargs):
+        with replica_reads():
+            return super().list(request, *args, **kwargs)
+
     def get_queryset(self):
         qs = super().get_queryset()
         actor = self.request.query_params.get("actor")
@@ -21,4 +28,11 @@ class AuditLogView(ListAPIView):
             qs = qs.filter(actor_id=actor)
         if action:
             qs = qs.filter(action=action)
+        # The table is partitioned by month of occurred_at; a time range reads only the matching partitions.
+        for name, lookup in (("since", "occurred_at__gte"), ("until", "occurred_at__lt")):
+            if value := self.request.query_params.get(name):
+                moment = parse_datetime(value)
+                if moment is None:
+                    raise ValidationError({name: "must be an ISO 8601 datetime"})
+                qs = qs.filter(**{lookup: moment})
         return qs
@@ -0,0 +1,6 @@
+"""Load and throughput benchmarks for ingest, search, audit appends and exports.
+
+Runs on a single box against in-process stand-ins (moto for S3, an in-memory
+Elasticsearch, fakeredis or a local Redis) and SQLite or a local MySQL. See
+`python -m benchmarks --help`.
+"""
@@ -0,0 +1,137 @@
+"""`python -m benchmarks`: run from the directory holding manage.py.
+
+Each scenario runs in its own process with a fresh database and fresh
+stand-ins, so peak RSS and caches do not leak from one scenario to the next.
+Results are printed next to the baseline values and the exit status is 1 when
+a metric regressed by more than `--tolerance`.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from dataclasses import asdict
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default="ingest,search,audit,export", help="comma separated, in run order")
+    parser.add_argument("--operations", type=int, default=200, help="measured operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="threads issuing operations")
+    parser.add_argument("--seed-messages", type=int, default=1000, help="messages seeded for search and export")
+    parser.add_argument("--mailboxes", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42, help="corpus seed")
+    parser.add_argument("--redis-url", help="use this Redis instead of fakeredis")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression as a fraction")
+    parser.add_argument("--output", help="also write the results as JSON to this path")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    return parser
+
+
+def _environment(args) -> dict:
+    """What a baseline is only comparable under: the box, the backends and the load."""
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "database": os.getenv("BENCHMARK_DB", "sqlite"),
+        "redis": "local" if args.redis_url else "fakeredis",
+        "operations": args.operations,
+        "concurrency": args.concurrency,
+        "seed_messages": args.seed_messages,
+        "mailboxes": args.mailboxes,
+        "seed": args.seed,
+    }
+
+
+def _worker(args) -> None:
+    """Runs one scenario in this process and prints its result as the last line of output."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    from . import backends
+
+    aws = backends.install(args.redis_url)
+    import django
+
+    django.setup()
+    from django.conf import settings
+    from django.core.management import call_command
+
+    database = settings.DATABASES["default"]
+    if database["ENGINE"] == "benchmarks.sqlite":
+        os.makedirs(os.path.dirname(database["NAME"]), exist_ok=True)
+        if os.path.exists(database["NAME"]):
+            os.remove(database["NAME"])
+    call_command("migrate", verbosity=0)
+    call_command("flush", interactive=False, verbosity=0)
+    if args.redis_url:
+        from core.redis import get_redis
+
+        get_redis().flushdb()
+    backends.create_bucket()
+
+    from .runner import run
+    from .scenarios import SCENARIOS, Bench
+
+    bench = Bench(args.seed, args.mailboxes)
+    operation = SCENARIOS[args.worker](bench, args.operations, args.seed_messages)
+    result = run(args.worker, operation, args.operations, args.concurrency)
+    aws.stop()
+    print(json.dumps(asdict(result)))
+
+
+def main(argv=None) -> int:
+    args = _parser().parse_args(argv)
+    if args.worker:
+        _worker(args)
+        return 0
+    from .runner import Result, compare, load_baseline, render, save_baseline
+
+    baseline = load_baseline(args.baseline)
+    environment = _environment(args)
+    if baseline and baseline.get("environment") != environment:
+        print(f"note: baseline was recorded with {baseline.get('environment')}", file=sys.stderr)
+    forwarded = [
+        f"--operations={args.operations}",
+        f"--concurrency={args.concurrency}",
+        f"--seed-messages={args.seed_messages}",
+        f"--mailboxes={args.mailboxes}",
+        f"--seed={args.seed}",
+    ] + ([f"--redis-url={args.redis_url}"] if args.redis_url else [])
+    results = []
+    for scenario in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        print(f"running {scenario} ...", file=sys.stderr)
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks", f"--worker={scenario}", *forwarded],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if completed.returncode != 0:
+            print(f"{scenario} failed with exit status {completed.returncode}", file=sys.stderr)
+            return completed.returncode
+        results.append(Result(**json.loads(completed.stdout.strip().splitlines()[-1])))
+
+    scenarios = baseline.get("scenarios", {})
+    print(render(results, scenarios))
+    regressions = [line for r in results for line in compare(r, scenarios.get(r.scenario), args.tolerance)]
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump({"environment": environment, "results": [asdict(r) for r in results]}, handle, indent=2)
+    if args.save_baseline:
+        save_baseline(args.baseline, results, environment)
+        print(f"baseline written to {args.baseline}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""In-process stand-ins for S3, Elasticsearch and Redis.
+
+`install()` must run before `django.setup()`: modules bind `core.search.get_client`
+and `core.redis.get_redis` when they are imported. S3 is moto, so requests still
+go through botocore; Elasticsearch is an in-memory index that evaluates the
+queries the search view builds by scanning every document, so its time says
+nothing about a real cluster and is reported separately as the `es` stage.
+"""
+from __future__ import annotations
+
+import re
+import threading
+
+_TOKEN = re.compile(r"\w+")
+
+
+def _tokens(value) -> set[str]:
+    if isinstance(value, list):
+        return set().union(*(_tokens(item) for item in value)) if value else set()
+    if isinstance(value, dict):
+        return _tokens(list(value.values()))
+    return {token.lower() for token in _TOKEN.findall(str(value or ""))}
+
+
+def _field(document: dict, path: str):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, list):
+            value = [item.get(part) for item in value if isinstance(item, dict)]
+        else:
+            value = (value or {}).get(part)
+    return value
+
+
+class FakeElasticsearch:
+    """Supports `index`, `search` (bool/terms/range/match/multi_match/match_all) and no-op updates."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents: dict[str, dict] = {}
+
+    def index(self, index, id, document, refresh=False, **kwargs):
+        with self._lock:
+            self.documents[str(id)] = document
+        return {"result": "created", "_id": str(id)}
+
+    def update(self, **kwargs):
+        return {"result": "noop"}
+
+    def update_by_query(self, **kwargs):
+        return {"updated": 0}
+
+    def _matches(self, document: dict, clause: dict) -> bool:
+        (kind, spec), = clause.items()
+        if kind == "match_all":
+            return True
+        if kind == "bool":
+            return all(self._matches(document, c) for c in spec.get("filter", []) + spec.get("must", []))
+        if kind == "terms":
+            (path, wanted), = spec.items()
+            value = _field(document, path)
+            values = set(value) if isinstance(value, list) else {value}
+            return bool(values & set(wanted))
+        if kind == "range":
+            (path, bounds), = spec.items()
+            value = _field(document, path)
+            return value is not None and bounds.get("gte", value) <= value <= bounds.get("lte", value)
+        if kind == "match":
+            (path, query), = spec.items()
+            return bool(_tokens(query["query"]) & _tokens(_field(document, path)))
+        if kind == "multi_match":
+            wanted = _tokens(spec["query"])
+            return any(wanted & _tokens(_field(document, path)) for path in spec["fields"])
+        raise ValueError(f"unsupported query clause {kind}")
+
+    def search(self, index, query, from_=0, size=10, **kwargs):
+        with self._lock:
+            documents = list(self.documents.items())
+        hits = [
+            {"_id": doc_id, "_source": document}
+            for doc_id, document in reversed(documents)
+            if self._matches(document, query)
+        ]
+        return {"hits": {"total": {"value": len(hits)}, "hits": hits[from_ : from_ + size]}}
+
+
+def install(redis_url: str | None = None):
+    """Starts the stand-ins; returns the running moto mock. Without `redis_url` Redis is fakeredis."""
+    from moto import mock_aws
+    import core.redis
+    import core.search
+
+    aws = mock_aws()
+    aws.start()
+    if not redis_url:
+        import fakeredis
+
+        client = core.redis.TracedRedis(connection_pool=fakeredis.FakeRedis(server=fakeredis.FakeServer()).connection_pool)
+        core.redis.get_redis = lambda: client
+    es = FakeElasticsearch()
+    core.search.get_client = lambda: es
+    return aws
+
+
+def create_bucket() -> None:
+    from core.storage import S3Storage
+
+    storage = S3Storage()
+    storage.client.create_bucket(Bucket=storage.bucket, ObjectLockEnabledForBucket=True)
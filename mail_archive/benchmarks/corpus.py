@@ -0,0 +1,159 @@
+"""Reproducible synthetic mail corpus.
+
+Message `n` of a corpus depends only on the seed and `n`, so every run and
+every scenario sees the same messages. Body and attachment sizes are
+log-normal, which matches the long tail of real journals: most messages are a
+few KiB of text, a quarter carry attachments, and a few attachments are
+several MiB. Attachment bytes are random (already compressed formats); bodies
+are word salad and compress like prose.
+"""
+from __future__ import annotations
+
+import base64
+import datetime as dt
+import math
+import random
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+BODY_MEDIAN_BYTES = 3 * 1024
+BODY_SIGMA = 1.1
+BODY_MAX_BYTES = 512 * 1024
+ATTACHMENT_PROBABILITY = 0.25
+ATTACHMENT_MEDIAN_BYTES = 96 * 1024
+ATTACHMENT_SIGMA = 1.4
+ATTACHMENT_MAX_BYTES = 8 * 1024 * 1024
+ATTACHMENT_TYPES = (
+    ("pdf", "application/pdf"),
+    ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ("jpg", "image/jpeg"),
+    ("zip", "application/zip"),
+)
+WORDS = (
+    "quarterly report budget forecast invoice contract renewal meeting agenda minutes review approval "
+    "compliance audit policy retention legal hold discovery custodian vendor supplier payment schedule "
+    "shipment delivery warehouse inventory pricing discount proposal tender merger acquisition board "
+    "committee hiring onboarding payroll benefits travel expense reimbursement incident outage release "
+    "deployment roadmap milestone deadline escalation customer complaint refund warranty settlement "
+    "project alpha beta gamma delta northwind contoso fabrikam tailspin litware adventure works"
+).split()
+
+
+@dataclass
+class Message:
+    message_id: str
+    mailbox: str
+    subject: str
+    sent_at: dt.datetime
+    received_at: dt.datetime
+    participants: list[dict]
+    body_text: str
+    attachments: list[tuple[str, str, bytes]] = field(default_factory=list)
+    raw_eml: bytes = b""
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.raw_eml)
+
+
+def _lognormal(rng: random.Random, median: int, sigma: float, maximum: int) -> int:
+    return max(16, min(maximum, int(rng.lognormvariate(math.log(median), sigma))))
+
+
+class Corpus:
+    def __init__(self, seed: int, mailboxes: list[str], start: dt.datetime, span_days: int = 365):
+        self.seed = seed
+        self.mailboxes = mailboxes
+        self.start = start
+        self.span = dt.timedelta(days=span_days)
+        self.people = [f"user{i}@corp.example" for i in range(200)] + [f"contact{i}@partner.example" for i in range(100)]
+
+    def _text(self, rng: random.Random, size: int) -> str:
+        words, length = [], 0
+        while length < size:
+            word = rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)
+
+    def message(self, n: int) -> Message:
+        rng = random.Random(f"{self.seed}:{n}")
+        mailbox = rng.choice(self.mailboxes)
+        sent_at = self.start + self.span * rng.random()
+        sender = rng.choice(self.people)
+        recipients = rng.sample(self.people, rng.randint(1, 6))
+        participants = [{"type": "FROM", "address": sender}, {"type": "TO", "address": mailbox}]
+        participants += [{"type": rng.choice(("TO", "CC")), "address": r} for r in recipients if r != sender]
+        attachments = []
+        if rng.random() < ATTACHMENT_PROBABILITY:
+            for index in range(rng.choice((1, 1, 1, 2, 3))):
+                extension, mime_type = rng.choice(ATTACHMENT_TYPES)
+                size = _lognormal(rng, ATTACHMENT_MEDIAN_BYTES, ATTACHMENT_SIGMA, ATTACHMENT_MAX_BYTES)
+                attachments.append((f"{rng.choice(WORDS)}-{n}-{index}.{extension}", mime_type, rng.randbytes(size)))
+        message = Message(
+            message_id=f"<bench-{self.seed}-{n}@corp.example>",
+            mailbox=mailbox,
+            subject=self._text(rng, rng.randint(12, 70)).capitalize(),
+            sent_at=sent_at,
+            received_at=sent_at + dt.timedelta(seconds=rng.randint(1, 120)),
+            participants=participants,
+            body_text=self._text(rng, _lognormal(rng, BODY_MEDIAN_BYTES, BODY_SIGMA, BODY_MAX_BYTES)),
+            attachments=attachments,
+        )
+        message.raw_eml = self._render(message)
+        return message
+
+    @staticmethod
+    def _render(message: Message) -> bytes:
+        eml = EmailMessage()
+        eml["Message-ID"] = message.message_id
+        eml["Date"] = format_datetime(message.sent_at)
+        eml["Subject"] = message.subject
+        eml["From"] = message.participants[0]["address"]
+        for kind in ("To", "Cc"):
+            addresses = [p["address"] for p in message.participants if p["type"] == kind.upper()]
+            if addresses:
+                eml[kind] = ", ".join(addresses)
+        eml.set_content(message.body_text)
+        for filename, mime_type, content in message.attachments:
+            maintype, subtype = mime_type.split("/", 1)
+            eml.add_attachment(content, maintype=maintype, subtype=subtype, filename=filename)
+        return eml.as_bytes()
+
+    @staticmethod
+    def request_body(message: Message) -> dict:
+        """The JSON body `POST /api/v1/archive/ingest/` expects."""
+        return {
+            "mailbox": message.mailbox,
+            "message_id": message.message_id,
+            "subject": message.subject,
+            "sent_at": message.sent_at.isoformat(),
+            "received_at": message.received_at.isoformat(),
+            "raw_eml": base64.b64encode(message.raw_eml).decode(),
+            "body_text": message.body_text,
+            "participants": message.participants,
+            "attachments": [
+                {"filename": name, "mime_type": mime_type, "content": base64.b64encode(content).decode()}
+                for name, mime_type, content in message.attachments
+            ],
+        }
+
+    @staticmethod
+    def service_payload(message: Message, mailbox) -> dict:
+        """The validated payload `ArchiveIngestService.ingest` takes, for seeding without HTTP."""
+        return {
+            "mailbox": mailbox,
+            "message_id": message.message_id,
+            "subject": message.subject,
+            "sent_at": message.sent_at,
+            "received_at": message.received_at,
+            "raw_bytes": message.raw_eml,
+            "body_text": message.body_text,
+            "participants": message.participants,
+            "attachments": [
+                {"filename": name, "mime_type": mime_type, "content_bytes": content}
+                for name, mime_type, content in message.attachments
+            ],
+        }
@@ -0,0 +1,179 @@
+"""Runs an operation at a given concurrency and compares results with a baseline."""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass
+
+from django.db import connections
+from core.metrics import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+# Metric -> True when a larger value is better.
+COMPARED = {
+    "ops_per_sec": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_rss_mb": False,
+    "queries_per_op": False,
+}
+
+
+@dataclass
+class Result:
+    scenario: str
+    concurrency: int
+    operations: int
+    errors: int
+    seconds: float
+    ops_per_sec: float
+    p50_ms: float
+    p99_ms: float
+    max_ms: float
+    queries_per_op: float
+    peak_rss_mb: float
+
+
+def _percentile(ordered: list[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+class RssSampler:
+    """Tracks the peak resident set size of this process while active (Linux, via /proc)."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self._page = os.sysconf("SC_PAGE_SIZE")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def sample(self) -> None:
+        with open("/proc/self/statm") as statm:
+            self.peak = max(self.peak, int(statm.read().split()[1]) * self._page)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def run(scenario: str, operation, operations: int, concurrency: int) -> Result:
+    """Calls `operation(i)` for i in range(operations) from `concurrency` threads."""
+    latencies: list[float] = []
+    queries: list[int] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i: int) -> None:
+        nonlocal errors
+        counter = QueryCounter()
+        failed = False
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            start = time.perf_counter()
+            try:
+                operation(i)
+            except Exception:
+                logger.exception("%s operation %s failed", scenario, i)
+                failed = True
+            elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            queries.append(counter.count)
+            errors += failed
+
+    with RssSampler() as rss, ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as pool:
+        started = time.perf_counter()
+        list(pool.map(one, range(operations)))
+        seconds = time.perf_counter() - started
+    latencies.sort()
+    return Result(
+        scenario=scenario,
+        concurrency=concurrency,
+        operations=operations,
+        errors=errors,
+        seconds=round(seconds, 3),
+        ops_per_sec=round(operations / seconds, 2) if seconds else 0.0,
+        p50_ms=round(_percentile(latencies, 0.50) * 1000, 2),
+        p99_ms=round(_percentile(latencies, 0.99) * 1000, 2),
+        max_ms=round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        queries_per_op=round(sum(queries) / len(queries), 2) if queries else 0.0,
+        peak_rss_mb=round(rss.peak / 1024**2, 1),
+    )
+
+
+def compare(result: Result, baseline: dict | None, tolerance: float) -> list[str]:
+    """Describes every metric worse than the baseline by more than `tolerance` (a fraction)."""
+    if not baseline:
+        return []
+    regressions = []
+    for metric, higher_is_better in COMPARED.items():
+        before, after = baseline.get(metric), getattr(result, metric)
+        if not before:
+            continue
+        change = (after - before) / before
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{result.scenario}.{metric}: {before} -> {after} ({change:+.0%})")
+    if result.errors:
+        regressions.append(f"{result.scenario}: {result.errors} failed operations")
+    return regressions
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def save_baseline(path: str, results: list[Result], environment: dict) -> None:
+    document = {"environment": environment, "scenarios": {r.scenario: asdict(r) for r in results}}
+    with open(path, "w") as handle:
+        json.dump(document, handle, indent=2, sort_keys=True)
+        handle.write("\n")
+
+
+def render(results: list[Result], baseline: dict) -> str:
+    columns = ("scenario", "ops", "err", "ops/s", "p50 ms", "p99 ms", "max ms", "queries/op", "peak RSS MB")
+    rows = [columns]
+    for r in results:
+        before = baseline.get(r.scenario, {})
+
+        def cell(metric):
+            value = getattr(r, metric)
+            return f"{value} ({before[metric]})" if before.get(metric) is not None else str(value)
+
+        rows.append(
+            (
+                f"{r.scenario} x{r.concurrency}",
+                str(r.operations),
+                str(r.errors),
+                cell("ops_per_sec"),
+                cell("p50_ms"),
+                cell("p99_ms"),
+                str(r.max_ms),
+                cell("queries_per_op"),
+                cell("peak_rss_mb"),
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
@@ -0,0 +1,131 @@
+"""Fixtures and the operations each scenario measures.
+
+Every scenario gets a `Bench` with a department, mailboxes, a user holding the
+permissions and mailbox grants a real operator would have, and a corpus.
+Scenarios that read data seed it first, outside the measured phase.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import threading
+
+from django.test import Client
+from django.utils import timezone
+from accounts.models import Department, Mailbox, MailboxAccess, Permission, Role, User, UserRole
+from archive.models import ExportJob
+from archive.services import ArchiveIngestService
+from archive.tasks import build_export_archive
+from audit.services import AuditService
+from core.authentication import generate_jwt
+from .corpus import WORDS, Corpus
+
+PERMISSIONS = ("ARCHIVE_STORE", "EMAIL_SEARCH", "EMAIL_VIEW", "EXPORT_EMAIL")
+CORPUS_START = dt.datetime(2024, 1, 1, tzinfo=dt.timezone.utc)
+
+
+class Bench:
+    def __init__(self, seed: int, mailboxes: int):
+        department = Department.objects.create(name="Benchmark", path="/benchmark")
+        addresses = [f"box{i}@corp.example" for i in range(mailboxes)]
+        self.mailboxes = {
+            address: Mailbox.objects.create(address=address, department=department) for address in addresses
+        }
+        self.user = User.objects.create(username="bench", email="bench@corp.example", department=department)
+        role = Role.objects.create(name="BENCH_OPERATOR", description="benchmark operator")
+        for code in PERMISSIONS:
+            permission, _ = Permission.objects.get_or_create(code=code, defaults={"description": code})
+            role.permissions.add(permission)
+        UserRole.objects.create(user=self.user, role=role)
+        for mailbox in self.mailboxes.values():
+            MailboxAccess.objects.create(
+                user=self.user, mailbox=mailbox, time_start=CORPUS_START - dt.timedelta(days=1), scope="EXPORT"
+            )
+        self.token = generate_jwt(self.user, mfa_verified_until=timezone.now() + dt.timedelta(hours=12))
+        self.corpus = Corpus(seed, addresses, CORPUS_START)
+        self._local = threading.local()
+
+    def client(self) -> Client:
+        """One test client per thread; requests pass through the full middleware stack."""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = Client(HTTP_AUTHORIZATION=f"Bearer {self.token}")
+        return client
+
+    def seed(self, count: int, offset: int) -> None:
+        service = ArchiveIngestService()
+        for n in range(offset, offset + count):
+            message = self.corpus.message(n)
+            service.ingest(user=self.user, payload=Corpus.service_payload(message, self.mailboxes[message.mailbox]))
+
+
+def _expect(response, *statuses: int):
+    if response.status_code not in statuses:
+        raise RuntimeError(f"{response.status_code}: {response.content[:300]!r}")
+    return response
+
+
+def ingest(bench: Bench, operations: int, seed_messages: int):
+    """`POST /api/v1/archive/ingest/`, one new message per operation."""
+
+    def operation(i: int):
+        body = Corpus.request_body(bench.corpus.message(i))
+        _expect(bench.client().post("/api/v1/archive/ingest/", body, content_type="application/json"), 201)
+
+    return operation
+
+
+def search(bench: Bench, operations: int, seed_messages: int):
+    """`POST /api/v1/search/emails/` over the seeded corpus with mixed filters."""
+    bench.seed(seed_messages, offset=operations)
+    mailboxes = list(bench.mailboxes)
+
+    def operation(i: int):
+        start = CORPUS_START + dt.timedelta(days=(i * 37) % 300)
+        body = {
+            "time_start": start.isoformat(),
+            "time_end": (start + dt.timedelta(days=30 + i % 60)).isoformat(),
+            "size": 50,
+        }
+        if i % 3 == 0:
+            body["keywords"] = WORDS[i % len(WORDS)]
+        if i % 4 == 1:
+            body["subject"] = WORDS[(i * 7) % len(WORDS)]
+        if i % 5 == 2:
+            body["participants"] = [mailboxes[i % len(mailboxes)]]
+        _expect(bench.client().post("/api/v1/search/emails/", body, content_type="application/json"), 200)
+
+    return operation
+
+
+def audit(bench: Bench, operations: int, seed_messages: int):
+    """`AuditService.append`; every append serializes on the tail of the hash chain."""
+
+    def operation(i: int):
+        AuditService.append(bench.user, "BENCHMARK", {"operation": i, "query": WORDS[i % len(WORDS)]}, result_count=i)
+
+    return operation
+
+
+def export(bench: Bench, operations: int, seed_messages: int):
+    """`build_export_archive` for a month of one mailbox, part after part until complete."""
+    bench.seed(seed_messages, offset=operations)
+    mailboxes = list(bench.mailboxes.values())
+
+    def operation(i: int):
+        start = CORPUS_START + dt.timedelta(days=(i * 29) % 330)
+        job = ExportJob.objects.create(
+            owner=bench.user,
+            mailbox=mailboxes[i % len(mailboxes)],
+            time_start=start,
+            time_end=start + dt.timedelta(days=30),
+            status=ExportJob.STATUS_RUNNING,
+            dispatched_at=timezone.now(),
+        )
+        # Runs the task body in this thread; the scheduler's follow-up message goes to the in-memory broker.
+        while not build_export_archive(job.id)["complete"]:
+            ExportJob.objects.filter(id=job.id).update(status=ExportJob.STATUS_RUNNING, dispatched_at=timezone.now())
+
+    return operation
+
+
+SCENARIOS = {"ingest": ingest, "search": search, "audit": audit, "export": export}
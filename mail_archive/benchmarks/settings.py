@@ -0,0 +1,43 @@
+"""Project settings pointed at the benchmark stand-ins (`benchmarks.backends`)."""
+import os
+import tempfile
+
+from mail_archive.settings import *  # noqa: F401,F403
+from mail_archive.settings import (
+    DATABASES,
+    DEDUP_SETTINGS,
+    LOGGING,
+    METRICS,
+    PROFILING,
+    RATE_LIMITS,
+    REPLICA_ROUTING,
+    S3_STORAGE,
+)
+
+WORK_DIR = os.getenv("BENCHMARK_WORK_DIR", os.path.join(tempfile.gettempdir(), "mail_archive_bench"))
+
+if os.getenv("BENCHMARK_DB", "sqlite") == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "benchmarks.sqlite",
+            "NAME": os.path.join(WORK_DIR, "bench.sqlite3"),
+            # Concurrent writers wait up to this long for the database lock.
+            "OPTIONS": {"timeout": 60},
+        }
+    }
+else:
+    # A local MySQL; the benchmark database is flushed on every run, never point it at real data.
+    DATABASES = {"default": {**DATABASES["default"], "NAME": os.getenv("BENCHMARK_DB_NAME", "mail_archive_bench")}}
+
+REPLICA_ROUTING = {**REPLICA_ROUTING, "ALIASES": [], "EXPORT_ALIAS": ""}
+ALLOWED_HOSTS = ["*"]
+# Follow-up task messages (e.g. `dispatch_exports`) are published here and never consumed.
+CELERY_BROKER_URL = "memory://localhost/"
+CELERY_RESULT_BACKEND = "cache+memory://"
+S3_STORAGE = {**S3_STORAGE, "ENDPOINT": None, "BUCKET": "bench-archive", "REGION": "us-east-1"}
+# A bitmap sized for production would dominate fakeredis memory and time.
+DEDUP_SETTINGS = {**DEDUP_SETTINGS, "BLOOM_CAPACITY": 1_000_000}
+RATE_LIMITS = {**RATE_LIMITS, "ENABLED": False}
+PROFILING = {**PROFILING, "ENABLED": False, "SAMPLE_RATE": 0.0}
+METRICS = {**METRICS, "WORKER_PORT": 0}
+LOGGING = {**LOGGING, "root": {**LOGGING["root"], "level": os.getenv("BENCHMARK_LOG_LEVEL", "WARNING")}}
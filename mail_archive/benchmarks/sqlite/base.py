@@ -0,0 +1,18 @@
+"""SQLite backend for concurrent benchmark writers.
+
+Django 4.2 opens transactions with a deferred `BEGIN`; two threads that both
+read and then write deadlock on the lock upgrade and one fails at once with
+"database is locked". `BEGIN IMMEDIATE` takes the write lock up front so the
+busy timeout applies, and WAL lets readers proceed while a writer commits.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
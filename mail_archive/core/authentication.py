@@ -2,13 +2,15 @@
 from __future__ import annotations
 
 import datetime as dt
+import uuid
+
 import jwt
 from django.conf import settings
-from django.contrib.auth import get_user_model
 from django.utils import timezone
+from redis.exceptions import RedisError
 from rest_framework import authentication, exceptions
-
-User = get_user_model()
+from accounts.principal import authenticated_user
+from .revocation import is_revoked
 
 
 class JWTAuthentication(authentication.BaseAuthentication):
@@ -21,9 +23,14 @@ class JWTAuthentication(authentication.BaseAuthentication):
         token = header[len(self.keyword) :].strip()
         payload = decode_jwt(token)
         try:
-            user = User.objects.get(id=payload["sub"], is_active=True)
-        except User.DoesNotExist as exc:
-            raise exceptions.AuthenticationFailed("invalid_user") from exc
+            revoked = is_revoked(payload)
+        except RedisError as exc:
+            raise exceptions.AuthenticationFailed("revocation_unavailable") from exc
+        if revoked:
+            raise exceptions.AuthenticationFailed("token_revoked")
+        user = authenticated_user(payload["sub"], payload.get("iat", 0))
+        if user is None:
+            raise exceptions.AuthenticationFailed("invalid_user")
         request.auth = payload
         return user, payload
 
@@ -41,6 +48,7 @@ def generate_jwt(user, *, mfa_verified_until: dt.datetime | None = None) -> str:
         "iss": settings.JWT_SETTINGS["ISSUER"],
         "aud": settings.JWT_SETTINGS["AUDIENCE"],
         "sub": str(user.id),
+        "jti": uuid.uuid4().hex,
         "iat": int(now.timestamp()),
         "exp": int(exp.timestamp()),
         "username": user.username,
@@ -0,0 +1,69 @@
+"""Bloom filters: a negative answer is definitive, a positive one must be confirmed."""
+from __future__ import annotations
+
+import hashlib
+import math
+
+
+def bloom_parameters(capacity: int, error_rate: float) -> tuple[int, int]:
+    """Returns (bit count, hash count) for the expected capacity and false-positive rate."""
+    size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    hashes = max(1, round(size / capacity * math.log(2)))
+    return size, hashes
+
+
+def bloom_positions(item: str, size: int, hashes: int) -> list[int]:
+    digest = hashlib.sha256(item.encode()).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:16], "big") | 1
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+class RedisBloomFilter:
+    """Bloom filter stored as a Redis bitmap (plain SETBIT/GETBIT, no modules required)."""
+
+    MAX_BITS = 2**32  # Redis string limit
+
+    def __init__(self, client, key: str, *, capacity: int, error_rate: float):
+        self.client = client
+        self.key = key
+        self.size, self.hashes = bloom_parameters(capacity, error_rate)
+        if self.size > self.MAX_BITS:
+            raise ValueError("bloom filter exceeds the Redis bitmap limit; lower capacity or raise error_rate")
+
+    def add(self, item: str, pipe=None) -> None:
+        target = pipe if pipe is not None else self.client.pipeline(transaction=False)
+        for position in bloom_positions(item, self.size, self.hashes):
+            target.setbit(self.key, position, 1)
+        if pipe is None:
+            target.execute()
+
+    def add_many(self, items) -> None:
+        pipe = self.client.pipeline(transaction=False)
+        for item in items:
+            self.add(item, pipe)
+        pipe.execute()
+
+    def might_contain(self, item: str) -> bool:
+        pipe = self.client.pipeline(transaction=False)
+        for position in bloom_positions(item, self.size, self.hashes):
+            pipe.getbit(self.key, position)
+        return all(pipe.execute())
+
+
+class BloomFilter:
+    """In-process Bloom filter over a bytearray."""
+
+    def __init__(self, *, capacity: int, error_rate: float):
+        self.size, self.hashes = bloom_parameters(capacity, error_rate)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, item: str) -> None:
+        for position in bloom_positions(item, self.size, self.hashes):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in bloom_positions(item, self.size, self.hashes)
+        )
@@ -0,0 +1,31 @@
+"""zstd framing for stored objects, optionally against a trained dictionary."""
+from __future__ import annotations
+
+import zstandard
+
+CODEC_IDENTITY = "identity"
+CODEC_ZSTD = "zstd"
+
+
+def load_dictionary(data: bytes) -> zstandard.ZstdCompressionDict:
+    return zstandard.ZstdCompressionDict(data)
+
+
+def compress(data: bytes, *, level: int, dictionary: zstandard.ZstdCompressionDict | None = None) -> bytes:
+    # Compressor contexts are not thread-safe; they are cheap next to the S3 PUT, so one per call.
+    return zstandard.ZstdCompressor(level=level, dict_data=dictionary).compress(data)
+
+
+def decompress_stream(chunks, dictionary: zstandard.ZstdCompressionDict | None = None):
+    """Decompresses an iterable of zstd frame chunks without buffering the whole object."""
+    decompressor = zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if not decompressor.eof:
+        raise zstandard.ZstdError("truncated zstd frame")
+
+
+def train_dictionary(samples: list[bytes], size: int) -> zstandard.ZstdCompressionDict:
+    return zstandard.train_dictionary(size, samples)
@@ -0,0 +1,96 @@
+"""Binary Merkle trees stored as packed levels of 32-byte digests.
+
+Leaves and interior nodes use distinct prefixes (RFC 6962 style) so a leaf can
+never be passed off as a node. An odd node at the end of a level is promoted
+unchanged, which keeps level sizes a pure function of the leaf count.
+"""
+from __future__ import annotations
+
+import hashlib
+import struct
+
+DIGEST_SIZE = 32
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+
+def leaf_hash(identifier: int, digest_hex: str) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + struct.pack(">Q", identifier) + bytes.fromhex(digest_hex)).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def level_sizes(leaf_count: int) -> list[int]:
+    sizes = [leaf_count]
+    while sizes[-1] > 1:
+        sizes.append((sizes[-1] + 1) // 2)
+    return sizes
+
+
+def build(leaves: list[bytes]) -> tuple[bytes, bytes]:
+    """Returns (root, packed nodes of every level, leaves first)."""
+    if not leaves:
+        raise ValueError("cannot build a Merkle tree without leaves")
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append(
+            [node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+        )
+    return levels[-1][0], b"".join(b"".join(level) for level in levels)
+
+
+def _node(packed: bytes, offset: int) -> bytes:
+    return bytes(packed[offset * DIGEST_SIZE : (offset + 1) * DIGEST_SIZE])
+
+
+def proof_offsets(leaf_count: int, index: int) -> list[tuple[int, str]]:
+    """(node offset in the packed tree, side) of each sibling from leaf `index` up to the root."""
+    offsets = []
+    base = 0
+    for size in level_sizes(leaf_count)[:-1]:
+        sibling = index ^ 1
+        if sibling < size:
+            offsets.append((base + sibling, "left" if sibling < index else "right"))
+        base += size
+        index //= 2
+    return offsets
+
+
+def inclusion_proof(packed: bytes, leaf_count: int, index: int) -> list[dict]:
+    return [
+        {"position": side, "hash": _node(packed, offset).hex()} for offset, side in proof_offsets(leaf_count, index)
+    ]
+
+
+def verify_proof(leaf: bytes, proof: list[dict], root: bytes) -> bool:
+    current = leaf
+    for step in proof:
+        sibling = bytes.fromhex(step["hash"])
+        current = node_hash(sibling, current) if step["position"] == "left" else node_hash(current, sibling)
+    return current == root
+
+
+def pack_ids(ids: list[int]) -> bytes:
+    return struct.pack(f">{len(ids)}Q", *ids)
+
+
+def unpack_ids(packed_ids: bytes) -> tuple[int, ...]:
+    return struct.unpack(f">{len(packed_ids) // 8}Q", packed_ids)
+
+
+def find_id(packed_ids: bytes, identifier: int) -> int | None:
+    """Binary search over ascending ids packed by `pack_ids`."""
+    lo, hi = 0, len(packed_ids) // 8
+    while lo < hi:
+        mid = (lo + hi) // 2
+        (value,) = struct.unpack_from(">Q", packed_ids, mid * 8)
+        if value < identifier:
+            lo = mid + 1
+        elif value > identifier:
+            hi = mid
+        else:
+            return mid
+    return None
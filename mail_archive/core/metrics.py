@@ -0,0 +1,125 @@
+"""Prometheus metrics for the request path, ingest stages and background work.
+
+Under gunicorn and Celery prefork every process writes its samples to
+`PROMETHEUS_MULTIPROC_DIR` (set and emptied by the entrypoint before the
+server starts) and `/metrics` aggregates them. Request IDs are far too many
+distinct values to be labels; they are attached to histogram samples as
+OpenMetrics exemplars (single-process mode only, prometheus_client drops them
+in multiprocess mode) and written to the per-request log line.
+"""
+from __future__ import annotations
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess
+from prometheus_client.exposition import choose_encoder
+from .context import get_request_id
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = tuple(4**i * 256 for i in range(12))  # 256 B .. 1 GiB
+
+REQUEST_SECONDS = Histogram(
+    "mail_archive_http_request_duration_seconds",
+    "Time spent handling an HTTP request.",
+    ["view", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    "mail_archive_http_request_db_queries",
+    "Database queries executed per HTTP request.",
+    ["view"],
+    buckets=COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "mail_archive_http_request_db_seconds",
+    "Time spent in database queries per HTTP request.",
+    ["view"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_BYTES = Histogram(
+    "mail_archive_http_request_bytes",
+    "Request and response body sizes.",
+    ["view", "direction"],
+    buckets=SIZE_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "mail_archive_stage_duration_seconds",
+    "Time spent per stage of an operation (ingest, search, audit_append, export).",
+    ["operation", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+TASK_SECONDS = Histogram(
+    "mail_archive_task_duration_seconds",
+    "Celery task run time.",
+    ["task", "state"],
+    buckets=LATENCY_BUCKETS,
+)
+STORAGE_BYTES = Counter(
+    "mail_archive_storage_bytes",
+    "Bytes moved to and from object storage.",
+    ["direction"],
+)
+
+
+def _exemplar() -> dict | None:
+    request_id = get_request_id()
+    return {"request_id": request_id[:64]} if request_id else None
+
+
+def observe(histogram, value: float, **labels) -> None:
+    histogram.labels(**labels).observe(value, exemplar=_exemplar())
+
+
+def observe_stages(operation: str, timer) -> None:
+    """Publishes every stage of a `core.timing.StageTimer`."""
+    exemplar = _exemplar()
+    for stage, seconds in timer.stages.items():
+        STAGE_SECONDS.labels(operation=operation, stage=stage).observe(seconds, exemplar=exemplar)
+
+
+@contextmanager
+def stage(operation: str, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(STAGE_SECONDS, time.perf_counter() - start, operation=operation, stage=name)
+
+
+class QueryCounter:
+    """`connection.execute_wrapper` that counts queries and their total time."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def registry():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    from prometheus_client import REGISTRY
+
+    return REGISTRY
+
+
+def render(accept_header: str | None) -> tuple[bytes, str]:
+    encoder, content_type = choose_encoder(accept_header or "")
+    return encoder(registry()), content_type
+
+
+def mark_process_dead(pid: int) -> None:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
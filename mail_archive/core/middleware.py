@@ -1,8 +1,23 @@
-"""Custom middleware for request metadata and immutability enforcement."""
+"""Custom middleware for request metadata, metrics, profiling, replica routing, immutability enforcement and rate limits."""
+import datetime as dt
+import logging
+import random
+import time
 import uuid
+from contextlib import ExitStack
+from django.db import connections
 from django.http import JsonResponse
 from django.conf import settings
+from django.utils import timezone
+from redis.exceptions import RedisError
+from rest_framework.exceptions import AuthenticationFailed
+from .authentication import JWTAuthentication, decode_jwt
+from . import metrics, profiling, replicas
 from .context import set_request_id
+from .models import RequestProfile
+from .ratelimit import limiter
+
+logger = logging.getLogger(__name__)
 
 
 class RequestIdMiddleware:
@@ -21,6 +36,147 @@ class RequestIdMiddleware:
         return response
 
 
+class MetricsMiddleware:
+    """Records latency, DB queries and body sizes per view; runs inside RequestIdMiddleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS["ENABLED"]:
+            return self.get_response(request)
+        counter = metrics.QueryCounter()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else "unmatched"
+        metrics.observe(
+            metrics.REQUEST_SECONDS, elapsed, view=view, method=request.method, status=str(response.status_code)
+        )
+        metrics.observe(metrics.REQUEST_QUERIES, counter.count, view=view)
+        metrics.observe(metrics.REQUEST_DB_SECONDS, counter.seconds, view=view)
+        received = int(request.META.get("CONTENT_LENGTH") or 0)
+        metrics.observe(metrics.REQUEST_BYTES, received, view=view, direction="in")
+        sent = response.get("Content-Length") or (None if response.streaming else len(response.content))
+        if sent is not None:
+            metrics.observe(metrics.REQUEST_BYTES, int(sent), view=view, direction="out")
+        logger.info(
+            "%s %s view=%s status=%s ms=%.1f queries=%s db_ms=%.1f in=%s out=%s",
+            request.method,
+            request.path,
+            view,
+            response.status_code,
+            elapsed * 1000,
+            counter.count,
+            counter.seconds * 1000,
+            received,
+            sent if sent is not None else "-",
+        )
+        return response
+
+
+class ProfilingMiddleware:
+    """Profiles a request when an `OPS_PROFILE` holder asks for it or at `PROFILING["SAMPLE_RATE"]`.
+
+    The profile covers the view and the middleware inside this one; a streamed
+    body is produced after it ends. It is stored under the request's
+    `X-Request-ID` and the response carries `X-Profiled`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        trigger, user = self._trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+        with ExitStack() as stack:
+            current = stack.enter_context(profiling.profile())
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(current.trace_sql))
+            response = self.get_response(request)
+        try:
+            self._store(request, response, current, trigger, user)
+        except Exception:  # a lost profile must never fail the request
+            logger.exception("could not store profile for request %s", request.request_id)
+            return response
+        response["X-Profiled"] = "true"
+        return response
+
+    @staticmethod
+    def _trigger(request):
+        cfg = settings.PROFILING
+        if not cfg["ENABLED"]:
+            return None, None
+        if request.META.get(cfg["HEADER"]):
+            try:
+                authenticated = JWTAuthentication().authenticate(request)
+            except AuthenticationFailed:
+                authenticated = None
+            if authenticated and authenticated[0].has_permission("OPS_PROFILE"):
+                return RequestProfile.TRIGGER_HEADER, authenticated[0]
+        if cfg["SAMPLE_RATE"] and random.random() < cfg["SAMPLE_RATE"]:
+            return RequestProfile.TRIGGER_SAMPLED, None
+        return None, None
+
+    @staticmethod
+    def _store(request, response, current: profiling.Profile, trigger: str, user) -> None:
+        match = getattr(request, "resolver_match", None)
+        RequestProfile.objects.update_or_create(
+            request_id=request.request_id[:64],
+            defaults={
+                "trigger": trigger,
+                "user": user,
+                "method": request.method,
+                "path": request.path[:512],
+                "view_name": match.view_name if match else "unmatched",
+                "status_code": response.status_code,
+                "duration_ms": round(current.duration * 1000, 3),
+                "sample_interval_ms": current.interval_ms,
+                "samples": current.sampler.samples,
+                "collapsed_stacks": current.sampler.collapsed(),
+                "spans": current.spans,
+                "span_summary": current.summary,
+                "dropped_spans": current.dropped_spans,
+            },
+        )
+        cutoff = timezone.now() - dt.timedelta(days=settings.PROFILING["RETENTION_DAYS"])
+        RequestProfile.objects.filter(created_at__lt=cutoff).delete()
+
+
+class ReplicaRoutingMiddleware:
+    """Tracks writes for `core.replicas` and keeps a user who wrote on the primary for a while."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REPLICA_ROUTING["ALIASES"]:
+            return self.get_response(request)
+        with replicas.track_request(lambda: self._user_id(request)) as state:
+            response = self.get_response(request)
+        if state.wrote and state.user_id is not None:
+            try:
+                replicas.mark_sticky(state.user_id)
+            except RedisError:
+                logger.warning("could not keep user %s on the primary", state.user_id, exc_info=True)
+        return response
+
+    @staticmethod
+    def _user_id(request):
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        if header.startswith("Bearer "):
+            try:
+                return decode_jwt(header[len("Bearer "):].strip())["sub"]
+            except AuthenticationFailed:
+                return None
+        return None
+
+
 class ImmutableRequestMiddleware:
     """Rejects unsafe verbs targeting immutable resources."""
 
@@ -34,3 +190,51 @@ class ImmutableRequestMiddleware:
             if any(request.path.startswith(prefix) for prefix in self.IMMUTABLE_PREFIXES):
                 return JsonResponse({"detail": "immutable_resource"}, status=405)
         return self.get_response(request)
+
+
+class RateLimitMiddleware:
+    """Applies `RATE_LIMITS["RULES"]` to views by `rate_limit_scope`, else by `required_permission`.
+
+    Authenticated callers are limited per token subject, anonymous ones per
+    client address. Limited responses carry RateLimit-* headers.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        decision = getattr(request, "rate_limit", None)
+        if decision is not None:
+            for name, value in decision.headers().items():
+                response[name] = value
+        return response
+
+    @staticmethod
+    def _identity(request) -> str:
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        if header.startswith("Bearer "):
+            try:
+                return f"user:{decode_jwt(header[len('Bearer '):].strip())['sub']}"
+            except AuthenticationFailed:
+                pass  # authentication rejects the request anyway; count it against the address
+        return f"ip:{request.META.get('REMOTE_ADDR', 'unknown')}"
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        cfg = settings.RATE_LIMITS
+        if not cfg["ENABLED"]:
+            return None
+        view_class = getattr(view_func, "cls", None)
+        scope = getattr(view_class, "rate_limit_scope", None) or getattr(view_class, "required_permission", None)
+        rate = cfg["RULES"].get(scope)
+        if not rate:
+            return None
+        try:
+            decision = limiter().hit(scope, self._identity(request), rate)
+        except RedisError:
+            logger.warning("rate limiter unavailable; allowing %s", request.path, exc_info=True)
+            return None
+        request.rate_limit = decision
+        if not decision.allowed:
+            return JsonResponse({"detail": "rate_limited"}, status=429)
+        return None
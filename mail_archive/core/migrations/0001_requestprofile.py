@@ -0,0 +1,41 @@
+# Generated by Django 4.2.11 on 2026-10-19 12:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('request_id', models.CharField(max_length=64, unique=True)),
+                ('trigger', models.CharField(choices=[('HEADER', 'HEADER'), ('SAMPLED', 'SAMPLED')], max_length=16)),
+                ('method', models.CharField(max_length=8)),
+                ('path', models.CharField(max_length=512)),
+                ('view_name', models.CharField(max_length=128)),
+                ('status_code', models.PositiveSmallIntegerField()),
+                ('duration_ms', models.FloatField()),
+                ('sample_interval_ms', models.FloatField()),
+                ('samples', models.PositiveIntegerField()),
+                ('collapsed_stacks', models.TextField()),
+                ('spans', models.JSONField(default=list)),
+                ('span_summary', models.JSONField(default=dict)),
+                ('dropped_spans', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='core_reques_created_11e53f_idx'), models.Index(fields=['view_name', 'created_at'], name='core_reques_view_na_b057ac_idx')],
+            },
+        ),
+    ]
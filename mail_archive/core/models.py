@@ -1,3 +1,32 @@
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class RequestProfile(models.Model):
+    """Sampled stacks and SQL/S3/ES/Redis spans of one profiled request (see `core.profiling`)."""
+
+    TRIGGER_HEADER = "HEADER"
+    TRIGGER_SAMPLED = "SAMPLED"
+
+    request_id = models.CharField(max_length=64, unique=True)
+    trigger = models.CharField(max_length=16, choices=((TRIGGER_HEADER, TRIGGER_HEADER), (TRIGGER_SAMPLED, TRIGGER_SAMPLED)))
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    method = models.CharField(max_length=8)
+    path = models.CharField(max_length=512)
+    view_name = models.CharField(max_length=128)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    sample_interval_ms = models.FloatField()
+    samples = models.PositiveIntegerField()
+    # Collapsed stacks, one "frame;frame;frame count" line per distinct stack.
+    collapsed_stacks = models.TextField()
+    spans = models.JSONField(default=list)
+    span_summary = models.JSONField(default=dict)
+    dropped_spans = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at"]),
+            models.Index(fields=["view_name", "created_at"]),
+        ]
@@ -0,0 +1,141 @@
+"""Monthly RANGE partitioning of the two append-only tables (MySQL only).
+
+Partition `pYYYYMM` holds the rows whose partitioning column falls in that UTC
+month, and a trailing `pmax` catches anything later. `ensure_future_partitions`
+splits new months off `pmax` ahead of time, so `pmax` normally stays empty and
+the split is a metadata change.
+
+MySQL requires every unique key of a partitioned table, the primary key
+included, to contain the partitioning column, and partitioned InnoDB tables
+can neither have nor be the target of foreign keys. The primary key therefore
+becomes (id, column), and uniqueness that does not involve the column lives in
+a separate table (see `archive.models.MessageKey`).
+"""
+from __future__ import annotations
+
+import datetime as dt
+from dataclasses import dataclass
+
+from django.utils import timezone
+
+# Table -> partitioning column.
+PARTITIONED_TABLES = {
+    "archive_archivedemail": "received_at",
+    "audit_auditlog": "occurred_at",
+}
+
+
+@dataclass
+class PartitionInfo:
+    table: str
+    name: str
+    # First day after the partition's range; None for pmax.
+    less_than: dt.date | None
+    rows: int
+    data_bytes: int
+    index_bytes: int
+
+
+def month_start(value: dt.date) -> dt.date:
+    return dt.date(value.year, value.month, 1)
+
+
+def add_months(month: dt.date, count: int) -> dt.date:
+    index = month.year * 12 + month.month - 1 + count
+    return dt.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: dt.date) -> str:
+    return f"p{month:%Y%m}"
+
+
+def _definition(month: dt.date) -> str:
+    return f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{add_months(month, 1).isoformat()}'))"
+
+
+def _months(first: dt.date, last: dt.date) -> list[dt.date]:
+    months = []
+    while first <= last:
+        months.append(first)
+        first = add_months(first, 1)
+    return months
+
+
+def _current_month() -> dt.date:
+    return month_start(timezone.now().astimezone(dt.timezone.utc).date())
+
+
+def partition_table(connection, table: str, months_ahead: int) -> None:
+    """Partitions an unpartitioned table by month, from its oldest row to `months_ahead` months from now.
+
+    This rebuilds the table; on a large live table run the equivalent change with an online schema change tool.
+    """
+    column = PARTITIONED_TABLES[table]
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT MIN({column}) FROM {table}")
+        oldest = cursor.fetchone()[0]
+        last = add_months(_current_month(), months_ahead)
+        first = min(month_start(oldest.date()), last) if oldest else _current_month()
+        definitions = ", ".join([_definition(month) for month in _months(first, last)])
+        cursor.execute(
+            f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, {column}) "
+            f"PARTITION BY RANGE (TO_DAYS({column})) ({definitions}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        )
+
+
+def unpartition_table(connection, table: str) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {table} REMOVE PARTITIONING")
+        cursor.execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id)")
+
+
+def partitions(connection, tables=None) -> list[PartitionInfo]:
+    """Partitions of `tables` (default: all partitioned tables) with InnoDB's row and size estimates."""
+    tables = list(tables or PARTITIONED_TABLES)
+    placeholders = ", ".join(["%s"] * len(tables))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT TABLE_NAME, PARTITION_NAME, PARTITION_DESCRIPTION, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH "
+            "FROM information_schema.PARTITIONS "
+            f"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders}) AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY TABLE_NAME, PARTITION_ORDINAL_POSITION",
+            tables,
+        )
+        rows = cursor.fetchall()
+        # PARTITION_DESCRIPTION is the TO_DAYS() value of the bound.
+        days = sorted({int(row[2]) for row in rows if row[2] != "MAXVALUE"})
+        dates = {}
+        if days:
+            cursor.execute("SELECT " + ", ".join(["FROM_DAYS(%s)"] * len(days)), days)
+            dates = dict(zip(days, cursor.fetchone()))
+    return [
+        PartitionInfo(
+            table=table,
+            name=name,
+            less_than=None if description == "MAXVALUE" else dates[int(description)],
+            rows=int(table_rows or 0),
+            data_bytes=int(data_length or 0),
+            index_bytes=int(index_length or 0),
+        )
+        for table, name, description, table_rows, data_length, index_length in rows
+    ]
+
+
+def ensure_future_partitions(connection, table: str, months_ahead: int) -> list[str]:
+    """Splits the months up to `months_ahead` months from now off `pmax`; returns the created partition names."""
+    existing = partitions(connection, [table])
+    if not existing:
+        raise ValueError(f"{table} is not partitioned")
+    bounded = [p.less_than for p in existing if p.less_than is not None]
+    # The month after the last bounded partition is the first one still inside pmax.
+    first = bounded[-1] if bounded else _current_month()
+    months = _months(first, add_months(_current_month(), months_ahead))
+    if not months:
+        return []
+    definitions = ", ".join([_definition(month) for month in months])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO "
+            f"({definitions}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        )
+    return [partition_name(month) for month in months]
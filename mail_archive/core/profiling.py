@@ -0,0 +1,176 @@
+"""On-demand request profiling with sampled flame graphs.
+
+A profiled request runs alongside a sampling profiler: a helper thread reads
+the request thread's stack every `INTERVAL_MS` and folds the samples into
+collapsed stacks (`root;caller;callee count` per line, the input of
+flamegraph.pl, speedscope and most flame graph viewers). Costs are one stack
+walk per interval, with no tracing hooks on every call, so production requests
+can be profiled as they are. SQL queries and calls to S3, Elasticsearch and
+Redis made from the request's context are recorded as spans with their offset
+and duration. Work handed to other threads is not sampled and its calls are
+not recorded.
+
+`core.middleware.ProfilingMiddleware` decides which requests are profiled and
+stores the result as a `core.models.RequestProfile` keyed by the request id.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+_active: ContextVar[Profile | None] = ContextVar("profile", default=None)
+
+_ROOTS = sorted({path for path in sys.path if path}, key=len, reverse=True)
+
+
+def _short_path(filename: str) -> str:
+    for root in _ROOTS:
+        if filename.startswith(root + os.sep):
+            return filename[len(root) + 1 :]
+    return filename
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled from a background thread."""
+
+    def __init__(self, thread_id: int, interval: float, max_depth: int):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.counts: Counter[str] = Counter()
+        self._labels: dict = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            # ';' separates frames in the collapsed format.
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+            self._labels[code] = label
+        return label
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if frame is not None:
+                stack.append("[truncated]")
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    @property
+    def samples(self) -> int:
+        return sum(self.counts.values())
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.counts.most_common())
+
+
+class Profile:
+    def __init__(self):
+        cfg = settings.PROFILING
+        self.interval_ms = cfg["INTERVAL_MS"]
+        self.max_spans = cfg["MAX_SPANS"]
+        self.spans: list[dict] = []
+        self.summary: dict[str, dict] = {}
+        self.dropped_spans = 0
+        self.duration = 0.0
+        self.sampler = StackSampler(threading.get_ident(), self.interval_ms / 1000, cfg["MAX_DEPTH"])
+        self.started = time.perf_counter()
+
+    def add_span(self, kind: str, name: str, started: float, seconds: float, error: bool = False) -> None:
+        totals = self.summary.setdefault(kind, {"count": 0, "ms": 0.0})
+        totals["count"] += 1
+        totals["ms"] = round(totals["ms"] + seconds * 1000, 3)
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return
+        entry = {
+            "kind": kind,
+            "name": name[:300],
+            "start_ms": round((started - self.started) * 1000, 3),
+            "ms": round(seconds * 1000, 3),
+        }
+        if error:
+            entry["error"] = True
+        self.spans.append(entry)
+
+    def trace_sql(self, execute, sql, params, many, context):
+        """`connection.execute_wrapper`; records the statement without its parameters."""
+        with span("sql", sql):
+            return execute(sql, params, many, context)
+
+
+def active() -> Profile | None:
+    return _active.get()
+
+
+@contextmanager
+def profile():
+    """Profiles the calling thread for the duration of the block."""
+    current = Profile()
+    token = _active.set(current)
+    current.sampler.start()
+    try:
+        yield current
+    finally:
+        current.sampler.stop()
+        current.duration = time.perf_counter() - current.started
+        _active.reset(token)
+
+
+@contextmanager
+def span(kind: str, name: str):
+    current = _active.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        current.add_span(kind, name, started, time.perf_counter() - started, error)
+
+
+def _boto_before_call(model, context, **kwargs):
+    if _active.get() is not None:
+        context["profile_span"] = (model.name, time.perf_counter())
+
+
+def _boto_after_call(context, exception=None, **kwargs):
+    pending = context.pop("profile_span", None)
+    current = _active.get()
+    if pending is None or current is None:
+        return
+    name, started = pending
+    current.add_span("s3", name, started, time.perf_counter() - started, exception is not None)
+
+
+def trace_boto_client(client) -> None:
+    """Records the client's API calls as spans. Streamed bodies are read after the span ends."""
+    events = client.meta.events
+    events.register("before-call.*", _boto_before_call)
+    events.register("after-call.*", _boto_after_call)
+    events.register("after-call-error.*", _boto_after_call)
@@ -0,0 +1,53 @@
+"""Celery queue depth and wait-time metrics.
+
+Publishers stamp each message with `enqueued_at` (see `mail_archive/celery.py`);
+workers record how long it waited before starting. Depth is the length of the
+queue's list in the Redis broker.
+"""
+from __future__ import annotations
+
+import time
+
+from .redis import get_redis
+
+WAIT_SAMPLES = 256
+
+
+def _wait_key(queue: str) -> str:
+    return f"celery_queue_wait:{queue}"
+
+
+def record_wait(queue: str, enqueued_at: float) -> None:
+    waited = max(0.0, time.time() - float(enqueued_at))
+    key = _wait_key(queue)
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hincrby(key, "count", 1)
+    pipe.hincrbyfloat(key, "total_seconds", waited)
+    pipe.hset(key, "last_seconds", round(waited, 3))
+    pipe.lpush(f"{key}:samples", round(waited, 3))
+    pipe.ltrim(f"{key}:samples", 0, WAIT_SAMPLES - 1)
+    pipe.execute()
+
+
+def queue_stats(queues) -> dict:
+    redis = get_redis()
+    pipe = redis.pipeline(transaction=False)
+    for queue in queues:
+        pipe.llen(queue)
+        pipe.hgetall(_wait_key(queue))
+        pipe.lrange(f"{_wait_key(queue)}:samples", 0, -1)
+    results = pipe.execute()
+    stats = {}
+    for index, queue in enumerate(queues):
+        depth, counters, samples = results[index * 3 : index * 3 + 3]
+        counters = {k.decode(): float(v) for k, v in counters.items()}
+        samples = sorted(float(v) for v in samples)
+        count = int(counters.get("count", 0))
+        stats[queue] = {
+            "depth": depth,
+            "started": count,
+            "mean_wait_seconds": round(counters["total_seconds"] / count, 3) if count else None,
+            "last_wait_seconds": counters.get("last_seconds"),
+            "p95_wait_seconds": samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else None,
+        }
+    return stats
@@ -0,0 +1,173 @@
+"""Distributed token-bucket rate limits and concurrency slots backed by Redis Lua scripts.
+
+Buckets live in Redis so every process shares one budget per (scope, principal).
+To keep the hot path cheap a process leases a small batch of tokens per call
+(`LEASE_FRACTION` of the bucket) and spends them locally for at most
+`LEASE_SECONDS`; tokens are deducted in Redis when leased, so leasing can
+delay a request by one lease but never lets a principal exceed its budget.
+Tokens left in an expired lease are returned to the bucket with the next
+lease, so a principal with sparse requests is not charged a lease per request.
+"""
+from __future__ import annotations
+
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from .lru import SizedLRU
+from .redis import get_redis
+
+# KEYS[1] bucket; ARGV capacity, refill tokens per second, tokens wanted, unspent tokens returned.
+# Returns {granted, tokens left (string), milliseconds until one token is available}.
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local wanted = tonumber(ARGV[3])
+local returned = tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + returned + math.max(0, now - ts) * rate / 1000)
+local granted = math.min(wanted, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+local wait = 0
+if tokens < 1 then
+  wait = math.ceil((1 - tokens) / rate * 1000)
+end
+return {granted, tostring(tokens), wait}
+"""
+
+# KEYS[1] slot set; ARGV member, limit, now, lease seconds. Returns 1 if a slot was taken.
+ACQUIRE_SLOT_LUA = """
+local now = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[4]))
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  return 1
+end
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+return 1
+"""
+
+_PERIODS = {"s": 1, "sec": 1, "second": 1, "m": 60, "min": 60, "minute": 60, "h": 3600, "hour": 3600, "d": 86400, "day": 86400}
+
+
+def parse_rate(rate: str) -> tuple[int, float]:
+    """Parses "<count>/<period>" (e.g. "60/min") into (capacity, tokens per second)."""
+    count, _, period = rate.partition("/")
+    capacity = int(count)
+    return capacity, capacity / _PERIODS[period.strip().lower()]
+
+
+@dataclass
+class Decision:
+    allowed: bool
+    limit: int
+    remaining: int
+    reset_seconds: int
+    retry_after: int = 0
+
+    def headers(self) -> dict:
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(self.reset_seconds),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+class _Lease:
+    __slots__ = ("tokens", "expires", "bucket_tokens")
+
+    def __init__(self, tokens: int, expires: float, bucket_tokens: float):
+        self.tokens = tokens
+        self.expires = expires
+        self.bucket_tokens = bucket_tokens
+
+
+class RateLimiter:
+    def __init__(self):
+        self.cfg = settings.RATE_LIMITS
+        self._leases = SizedLRU(self.cfg["MAX_LOCAL_LEASES"], lambda lease: 1)
+        self._lock = threading.Lock()
+        self._script = None
+
+    def _bucket(self, key: str, capacity: int, rate: float, wanted: int, returned: int = 0) -> tuple[int, float, int]:
+        if self._script is None:
+            self._script = get_redis().register_script(TOKEN_BUCKET_LUA)
+        granted, tokens, wait_ms = self._script(keys=[key], args=[capacity, rate, wanted, returned])
+        return int(granted), float(tokens), int(wait_ms)
+
+    def hit(self, scope: str, identity: str, rate: str) -> Decision:
+        capacity, per_second = parse_rate(rate)
+        key = f"ratelimit:{scope}:{identity}"
+        now = time.monotonic()
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and lease.tokens > 0 and lease.expires > now:
+                lease.tokens -= 1
+                remaining = int(lease.bucket_tokens) + lease.tokens
+                return Decision(True, capacity, remaining, math.ceil((capacity - remaining) / per_second))
+            # The expired lease's tokens go back with this call; no other thread may return them as well.
+            returned = lease.tokens if lease is not None else 0
+            if lease is not None:
+                lease.tokens = 0
+        lease_size = max(1, int(capacity * self.cfg["LEASE_FRACTION"]))
+        granted, bucket_tokens, wait_ms = self._bucket(key, capacity, per_second, lease_size, returned)
+        reset = math.ceil((capacity - bucket_tokens) / per_second)
+        if not granted:
+            return Decision(False, capacity, 0, reset, retry_after=max(1, math.ceil(wait_ms / 1000)))
+        with self._lock:
+            self._leases.set(key, _Lease(granted - 1, now + self.cfg["LEASE_SECONDS"], bucket_tokens))
+        return Decision(True, capacity, int(bucket_tokens) + granted - 1, reset)
+
+
+class ConcurrencySlots:
+    """At most `limit` concurrent holders per owner; slots left by crashed holders lapse after `lease_seconds`."""
+
+    def __init__(self, name: str, limit: int, lease_seconds: int):
+        self.name = name
+        self.limit = limit
+        self.lease_seconds = lease_seconds
+        self.redis = get_redis()
+
+    def _key(self, owner) -> str:
+        return f"slots:{self.name}:{owner}"
+
+    def acquire(self, owner, member) -> bool:
+        acquired = self.redis.eval(
+            ACQUIRE_SLOT_LUA, 1, self._key(owner), str(member), self.limit, int(time.time()), self.lease_seconds
+        )
+        return bool(acquired)
+
+    def release(self, owner, member) -> None:
+        self.redis.zrem(self._key(owner), str(member))
+
+    def in_use(self, owner) -> int:
+        return self.redis.zcount(self._key(owner), int(time.time()) - self.lease_seconds, "+inf")
+
+
+_limiter: RateLimiter | None = None
+
+
+def limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
+
+
+def export_slots() -> ConcurrencySlots:
+    cfg = settings.RATE_LIMITS
+    return ConcurrencySlots("export", cfg["EXPORT_MAX_CONCURRENT"], cfg["EXPORT_SLOT_SECONDS"])
@@ -0,0 +1,31 @@
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+from . import profiling
+
+
+class _TracedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        if profiling.active() is None:
+            return super().execute(raise_on_error)
+        with profiling.span("redis", f"pipeline ({len(self.command_stack)} commands)"):
+            return super().execute(raise_on_error)
+
+
+class TracedRedis(redis.Redis):
+    """Redis client whose commands show up as spans in request profiles."""
+
+    def execute_command(self, *args, **options):
+        if profiling.active() is None:
+            return super().execute_command(*args, **options)
+        with profiling.span("redis", str(args[0])):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return _TracedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+@lru_cache(maxsize=1)
+def get_redis() -> redis.Redis:
+    return TracedRedis.from_url(settings.REDIS_URL)
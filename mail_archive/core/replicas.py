@@ -0,0 +1,185 @@
+"""Routing of read-only work to MySQL replicas.
+
+Reads go to a replica only inside `replica_reads()` (search hydration, audit
+listing, email detail and their access checks) or through `export_database()`
+for export scans; everything else, including every read inside a transaction,
+stays on the primary. A replica is picked at random, weighted by
+1 / (1 + replication lag). Lag is measured with `SHOW REPLICA STATUS` every
+`LAG_CHECK_SECONDS` per process, and replicas that are behind by more than
+`MAX_LAG_SECONDS` or not replicating get no reads.
+
+Read-your-writes: a request that writes (other than `STICKY_EXEMPT_MODELS`)
+reads from the primary for the rest of the request. `ReplicaRoutingMiddleware`
+then marks its token subject sticky in Redis for `STICKY_SECONDS`, and that
+user's later requests skip the replicas until the mark expires.
+"""
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from redis.exceptions import RedisError
+from .redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "default"
+
+_read_alias: ContextVar[str | None] = ContextVar("replica_read_alias", default=None)
+_request_state: ContextVar[RequestState | None] = ContextVar("replica_request_state", default=None)
+
+
+def _sticky_key(user_id) -> str:
+    return f"db_sticky:{user_id}"
+
+
+class RequestState:
+    """Per-request routing state; the user is resolved only when stickiness matters."""
+
+    def __init__(self, resolve_user):
+        self._resolve_user = resolve_user
+        self._user_id = None
+        self._resolved = False
+        self.wrote = False
+        self.sticky: bool | None = None
+
+    @property
+    def user_id(self):
+        if not self._resolved:
+            self._user_id, self._resolved = self._resolve_user(), True
+        return self._user_id
+
+    def is_sticky(self) -> bool:
+        if self.wrote:
+            return True
+        if self.sticky is None:
+            user_id = self.user_id
+            try:
+                self.sticky = user_id is not None and bool(get_redis().exists(_sticky_key(user_id)))
+            except RedisError:
+                logger.warning("replica stickiness unavailable; reading from the primary", exc_info=True)
+                self.sticky = True
+        return self.sticky
+
+
+class ReplicaPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lags: dict[str, float | None] = {}
+        self._checked = float("-inf")
+
+    @staticmethod
+    def _measure(alias: str) -> float | None:
+        connection = connections[alias]
+        if connection.vendor != "mysql":
+            return 0.0
+        try:
+            with connection.cursor() as cursor:
+                try:
+                    cursor.execute("SHOW REPLICA STATUS")
+                except DatabaseError:  # MySQL before 8.0.22
+                    cursor.execute("SHOW SLAVE STATUS")
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                status = dict(zip([column[0] for column in cursor.description], row))
+        except DatabaseError:
+            logger.warning("replication status of %s unavailable", alias, exc_info=True)
+            return None
+        lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+        return None if lag is None else float(lag)
+
+    def lags(self) -> dict[str, float | None]:
+        cfg = settings.REPLICA_ROUTING
+        # One thread refreshes; the others keep using the previous measurements.
+        if time.monotonic() - self._checked >= cfg["LAG_CHECK_SECONDS"] and self._lock.acquire(blocking=False):
+            try:
+                self._lags = {alias: self._measure(alias) for alias in cfg["ALIASES"]}
+                self._checked = time.monotonic()
+            finally:
+                self._lock.release()
+        return dict(self._lags)
+
+    def choose(self, aliases: list[str]) -> str:
+        lags = self.lags()
+        max_lag = settings.REPLICA_ROUTING["MAX_LAG_SECONDS"]
+        healthy = [alias for alias in aliases if lags.get(alias) is not None and lags[alias] <= max_lag]
+        if not healthy:
+            return PRIMARY
+        return random.choices(healthy, weights=[1 / (1 + lags[alias]) for alias in healthy])[0]
+
+
+pool = ReplicaPool()
+
+
+def _interactive_aliases() -> list[str]:
+    cfg = settings.REPLICA_ROUTING
+    aliases = [alias for alias in cfg["ALIASES"] if alias != cfg["EXPORT_ALIAS"]]
+    return aliases or list(cfg["ALIASES"])
+
+
+@contextmanager
+def replica_reads():
+    """Sends the block's reads to a replica unless the caller must read its own writes."""
+    state = _request_state.get()
+    if not settings.REPLICA_ROUTING["ALIASES"] or (state is not None and state.is_sticky()):
+        yield PRIMARY
+        return
+    alias = pool.choose(_interactive_aliases())
+    token = _read_alias.set(alias)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+def export_database() -> str:
+    """The alias export scans read from: the export replica while it is current enough, else the primary."""
+    alias = settings.REPLICA_ROUTING["EXPORT_ALIAS"]
+    if not alias:
+        return PRIMARY
+    return pool.choose([alias])
+
+
+@contextmanager
+def track_request(resolve_user):
+    """Routing state for one request; yields it so the caller can persist stickiness afterwards."""
+    state = RequestState(resolve_user)
+    token = _request_state.set(state)
+    try:
+        yield state
+    finally:
+        _request_state.reset(token)
+
+
+def mark_sticky(user_id) -> None:
+    get_redis().set(_sticky_key(user_id), 1, ex=settings.REPLICA_ROUTING["STICKY_SECONDS"])
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        if alias is None or alias == PRIMARY:
+            return None
+        state = _request_state.get()
+        if (state is not None and state.wrote) or connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        return alias
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None and model._meta.label_lower not in settings.REPLICA_ROUTING["STICKY_EXEMPT_MODELS"]:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
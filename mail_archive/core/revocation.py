@@ -0,0 +1,153 @@
+"""JWT revocation list in Redis, mirrored per process into a Bloom filter.
+
+Revoked token IDs live in the sorted set `jwt:revoked` (score = token expiry)
+and "revoke everything issued before" cutoffs in the hash `jwt:cutoffs`
+(sub -> timestamp). Every change is also published on `jwt:revocations`. Each
+process keeps a Bloom filter of revoked IDs plus the cutoffs, maintained by a
+subscriber thread that reloads the full list on (re)connect and every
+`REFRESH_SECONDS`, which also drops expired entries. A token whose ID is not in
+the filter is accepted without a network round trip; possible hits are
+confirmed against Redis. Until the mirror has loaded, or when its last reload
+is older than `MAX_STALENESS_SECONDS`, every check goes to Redis.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+from .bloom import BloomFilter
+from .redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+REVOKED_KEY = "jwt:revoked"
+CUTOFFS_KEY = "jwt:cutoffs"
+CHANNEL = "jwt:revocations"
+
+
+def _token_lifetime() -> int:
+    return settings.JWT_SETTINGS["EXP_MINUTES"] * 60
+
+
+def revoke_token(jti: str, expires_at: int) -> None:
+    """Revokes one token until its own expiry."""
+    now = int(time.time())
+    pipe = get_redis().pipeline()
+    pipe.zadd(REVOKED_KEY, {jti: expires_at})
+    pipe.zremrangebyscore(REVOKED_KEY, "-inf", now)
+    pipe.publish(CHANNEL, f"jti:{jti}")
+    pipe.execute()
+
+
+def revoke_user_tokens(user_id) -> int:
+    """Revokes every token issued to the user up to now; returns the cutoff."""
+    cutoff = int(time.time())
+    pipe = get_redis().pipeline()
+    pipe.hset(CUTOFFS_KEY, str(user_id), cutoff)
+    pipe.publish(CHANNEL, f"sub:{user_id}:{cutoff}")
+    pipe.execute()
+    return cutoff
+
+
+class RevocationMirror:
+    def __init__(self):
+        self.cfg = settings.JWT_REVOCATION
+        self.bloom = self._empty_filter()
+        self.cutoffs: dict[str, int] = {}
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _empty_filter(self) -> BloomFilter:
+        return BloomFilter(capacity=self.cfg["BLOOM_CAPACITY"], error_rate=self.cfg["BLOOM_ERROR_RATE"])
+
+    def reload(self, client) -> None:
+        now = int(time.time())
+        revoked = client.zrangebyscore(REVOKED_KEY, now, "+inf")
+        cutoffs = {k.decode(): int(v) for k, v in client.hgetall(CUTOFFS_KEY).items()}
+        stale = [sub for sub, cutoff in cutoffs.items() if cutoff < now - _token_lifetime()]
+        if stale:
+            # Every token issued before these cutoffs has expired by now.
+            client.hdel(CUTOFFS_KEY, *stale)
+        bloom = self._empty_filter()
+        for jti in revoked:
+            bloom.add(jti.decode())
+        with self._lock:
+            self.bloom = bloom
+            self.cutoffs = {sub: cutoff for sub, cutoff in cutoffs.items() if sub not in stale}
+            self.loaded_at = time.monotonic()
+
+    @property
+    def fresh(self) -> bool:
+        return bool(self.loaded_at) and time.monotonic() - self.loaded_at < self.cfg["MAX_STALENESS_SECONDS"]
+
+    def apply(self, message: str) -> None:
+        kind, _, value = message.partition(":")
+        with self._lock:
+            if kind == "jti":
+                self.bloom.add(value)
+            elif kind == "sub":
+                sub, _, cutoff = value.rpartition(":")
+                self.cutoffs[sub] = max(self.cutoffs.get(sub, 0), int(cutoff))
+
+    def run(self) -> None:
+        client = get_redis()
+        while True:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                # Subscribe before loading the snapshot so no revocation falls in between.
+                pubsub.subscribe(CHANNEL)
+                self.reload(client)
+                while time.monotonic() - self.loaded_at < self.cfg["REFRESH_SECONDS"]:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self.apply(message["data"].decode())
+            except RedisError:
+                logger.warning("revocation mirror lost its Redis connection; reconnecting", exc_info=True)
+                time.sleep(self.cfg["RECONNECT_SECONDS"])
+            finally:
+                pubsub.close()
+
+    def is_revoked(self, payload: dict) -> bool:
+        sub, issued_at, jti = str(payload.get("sub")), payload.get("iat", 0), payload.get("jti")
+        if not self.fresh:
+            return _revoked_in_redis(sub, issued_at, jti)
+        if issued_at <= self.cutoffs.get(sub, -1):
+            return True
+        if jti is None or not self.bloom.might_contain(jti):
+            return False
+        return get_redis().zscore(REVOKED_KEY, jti) is not None
+
+
+def _revoked_in_redis(sub: str, issued_at: int, jti: str | None) -> bool:
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.hget(CUTOFFS_KEY, sub)
+    pipe.zscore(REVOKED_KEY, jti or "")
+    cutoff, score = pipe.execute()
+    return (cutoff is not None and issued_at <= int(cutoff)) or (jti is not None and score is not None)
+
+
+_mirror: RevocationMirror | None = None
+_mirror_pid: int | None = None
+_start_lock = threading.Lock()
+
+
+def mirror() -> RevocationMirror:
+    """The process's mirror; the subscriber thread starts on first use, after any fork."""
+    global _mirror, _mirror_pid
+    if _mirror is None or _mirror_pid != os.getpid():
+        with _start_lock:
+            if _mirror is None or _mirror_pid != os.getpid():
+                _mirror = RevocationMirror()
+                _mirror_pid = os.getpid()
+                threading.Thread(target=_mirror.run, name="jwt-revocation-mirror", daemon=True).start()
+    return _mirror
+
+
+def is_revoked(payload: dict) -> bool:
+    if not settings.JWT_REVOCATION["ENABLED"]:
+        return False
+    return mirror().is_revoked(payload)
@@ -1,6 +1,17 @@
 from elasticsearch import Elasticsearch
 from django.conf import settings
+from . import profiling
+
+
+class TracedElasticsearch(Elasticsearch):
+    """Elasticsearch client whose API calls show up as spans in request profiles."""
+
+    def perform_request(self, method, path, **kwargs):
+        if profiling.active() is None:
+            return super().perform_request(method, path, **kwargs)
+        with profiling.span("es", kwargs.get("endpoint_id") or f"{method} {path}"):
+            return super().perform_request(method, path, **kwargs)
 
 
 def get_client() -> Elasticsearch:
-    return Elasticsearch(settings.ELASTICSEARCH["HOSTS"], timeout=5)
+    return TracedElasticsearch(settings.ELASTICSEARCH["HOSTS"], timeout=5)
@@ -0,0 +1,29 @@
+from rest_framework import serializers
+from .models import RequestProfile
+
+
+class RequestProfileSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RequestProfile
+        fields = [
+            "request_id",
+            "trigger",
+            "user",
+            "method",
+            "path",
+            "view_name",
+            "status_code",
+            "duration_ms",
+            "sample_interval_ms",
+            "samples",
+            "span_summary",
+            "dropped_spans",
+            "created_at",
+        ]
+        read_only_fields = fields
+
+
+class RequestProfileDetailSerializer(RequestProfileSerializer):
+    class Meta(RequestProfileSerializer.Meta):
+        fields = RequestProfileSerializer.Meta.fields + ["spans"]
+        read_only_fields = fields
@@ -0,0 +1,57 @@
+"""Crash-safe local spool: a message is acknowledged only after it is fsynced here."""
+from __future__ import annotations
+
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+
+
+class Spool:
+    def __init__(self, directory: str | Path):
+        self.root = Path(directory)
+        self.incoming = self.root / "incoming"
+        self.ready = self.root / "ready"
+        self.rejected = self.root / "rejected"
+        for path in (self.incoming, self.ready, self.rejected):
+            path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _fsync_dir(path: Path) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write(self, data: bytes, meta: dict) -> Path:
+        """Writes `meta` as a JSON header line followed by `data`; returns the ready path."""
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.msg"
+        tmp = self.incoming / name
+        with tmp.open("wb") as f:
+            f.write(json.dumps(meta, separators=(",", ":")).encode() + b"\n")
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        target = self.ready / name
+        os.replace(tmp, target)
+        self._fsync_dir(self.ready)
+        return target
+
+    @staticmethod
+    def read(path: Path) -> tuple[dict, bytes]:
+        with path.open("rb") as f:
+            meta = json.loads(f.readline())
+            return meta, f.read()
+
+    def pending(self, limit: int | None = None) -> list[Path]:
+        # Names start with a nanosecond timestamp, so replay keeps arrival order.
+        paths = sorted(self.ready.glob("*.msg"))
+        return paths[:limit] if limit else paths
+
+    def remove(self, path: Path) -> None:
+        path.unlink(missing_ok=True)
+
+    def reject(self, path: Path) -> None:
+        os.replace(path, self.rejected / path.name)
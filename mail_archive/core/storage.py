@@ -1,8 +1,23 @@
 from __future__ import annotations
 
 import datetime as dt
+import fcntl
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+from pathlib import Path
+
 import boto3
+from botocore.exceptions import ClientError
 from django.conf import settings
+from core import metrics, profiling
+from core.hash_utils import sha256_file
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
 
 
 class S3Storage:
@@ -16,6 +31,7 @@ class S3Storage:
             aws_secret_access_key=cfg["SECRET_KEY"],
             region_name=cfg["REGION"],
         )
+        profiling.trace_boto_client(self.client)
 
     def put_object(self, key: str, data: bytes, retain_days: int | None = None) -> str:
         retain_until = dt.datetime.now(dt.timezone.utc) + dt.timedelta(days=retain_days or settings.S3_STORAGE["LOCK_RETENTION_DAYS"])
@@ -27,11 +43,243 @@ class S3Storage:
             ObjectLockRetainUntilDate=retain_until,
             ServerSideEncryption="AES256",
         )
+        metrics.STORAGE_BYTES.labels(direction="out").inc(len(data))
         return key
 
+    def iter_object(self, key: str, chunk_size: int = 1024 * 1024, byte_range: tuple[int, int] | None = None):
+        """Yields the object, or its (offset, length) slice, in chunks so large blobs never sit in memory whole."""
+        extra = {}
+        if byte_range is not None:
+            offset, length = byte_range
+            extra["Range"] = f"bytes={offset}-{offset + length - 1}"
+        body = self.client.get_object(Bucket=self.bucket, Key=key, **extra)["Body"]
+        received = 0
+        try:
+            for chunk in body.iter_chunks(chunk_size=chunk_size):
+                received += len(chunk)
+                yield chunk
+        finally:
+            body.close()
+            metrics.STORAGE_BYTES.labels(direction="in").inc(received)
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
     def presign(self, key: str, expires: int = 300) -> str:
         return self.client.generate_presigned_url(
             "get_object",
             Params={"Bucket": self.bucket, "Key": key},
             ExpiresIn=expires,
         )
+
+
+class BlobCache:
+    """Node-local read-through LRU cache of immutable S3 objects.
+
+    Object Lock guarantees stored objects never change, so an entry is valid
+    for as long as its content still hashes to the expected SHA-256. Entries
+    are named after the hash of their object key, filled through a temp file
+    and `os.replace` so readers never see a partial blob, and their mtime
+    doubles as the LRU clock. A byte counter and eviction share one `flock`,
+    so every process on the node can use the same directory.
+    """
+
+    def __init__(self, storage: S3Storage | None = None):
+        self.cfg = settings.BLOB_CACHE
+        self.storage = storage or S3Storage()
+        self.root = Path(self.cfg["DIR"]) if self.cfg["DIR"] else None
+        if self.root is not None:
+            (self.root / "tmp").mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+
+    def _path(self, key: str, byte_range: tuple[int, int] | None = None) -> Path:
+        if byte_range is not None:
+            key = f"{key}@{byte_range[0]}+{byte_range[1]}"
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return self.root / name[:2] / name
+
+    def _record(self, **counters: int) -> None:
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for field, amount in counters.items():
+                pipe.hincrby(f"blob_cache:{socket.gethostname()}", field, amount)
+            pipe.execute()
+        except Exception:  # statistics must never fail a read
+            logger.debug("blob cache stats unavailable", exc_info=True)
+
+    def _valid(self, path: Path, sha256: str) -> bool:
+        if not self.cfg["VERIFY_ON_READ"]:
+            return True
+        if sha256_file(path) == sha256:
+            return True
+        logger.error("blob cache entry %s failed validation; discarding", path.name)
+        self._discard(path)
+        return False
+
+    def iter_object(
+        self,
+        key: str,
+        sha256: str,
+        chunk_size: int = 1024 * 1024,
+        refresh: bool = False,
+        decoder=None,
+        byte_range: tuple[int, int] | None = None,
+    ):
+        """Yields the object from the cache, or from S3 while filling the cache.
+
+        `refresh` always reads S3 (e.g. to verify the stored object) and replaces the entry.
+        `decoder` transforms the S3 chunk stream (decompression); entries hold decoded bytes,
+        which is what `sha256` describes. `byte_range` addresses a record inside a segment.
+        """
+        if not self.enabled:
+            chunks = self.storage.iter_object(key, chunk_size=chunk_size, byte_range=byte_range)
+            yield from decoder(chunks) if decoder else chunks
+            return
+        path = self._path(key, byte_range)
+        handle = None if refresh else self._open_entry(path, sha256)
+        if handle is None:
+            yield from self._fill(key, sha256, path, chunk_size, decoder, byte_range)
+            return
+        yield from self._serve(handle, chunk_size)
+
+    def iter_cached_slice(
+        self,
+        key: str,
+        sha256: str,
+        start: int,
+        length: int,
+        chunk_size: int = 1024 * 1024,
+        byte_range: tuple[int, int] | None = None,
+    ):
+        """Serves `length` bytes from `start` of a cached entry; None on a miss (partial reads never fill)."""
+        if not self.enabled:
+            return None
+        handle = self._open_entry(self._path(key, byte_range), sha256)
+        if handle is None:
+            return None
+        return self._serve(handle, chunk_size, start, length)
+
+    def _open_entry(self, path: Path, sha256: str):
+        try:
+            if not (path.is_file() and self._valid(path, sha256)):
+                return None
+            handle = path.open("rb")
+        except FileNotFoundError:  # evicted concurrently
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return handle
+
+    def _serve(self, handle, chunk_size: int, start: int = 0, length: int | None = None):
+        # An open handle keeps reading even if the entry is evicted meanwhile.
+        served = 0
+        with handle:
+            handle.seek(start)
+            while length is None or served < length:
+                chunk = handle.read(chunk_size if length is None else min(chunk_size, length - served))
+                if not chunk:
+                    break
+                served += len(chunk)
+                yield chunk
+        self._record(hits=1, bytes_served=served)
+
+    def _fill(self, key: str, sha256: str, path: Path, chunk_size: int, decoder=None, byte_range=None):
+        tmp = self.root / "tmp" / f"{uuid.uuid4().hex}.part"
+        digest = hashlib.sha256()
+        size = 0
+        chunks = self.storage.iter_object(key, chunk_size=chunk_size, byte_range=byte_range)
+        try:
+            with tmp.open("wb") as handle:
+                for chunk in decoder(chunks) if decoder else chunks:
+                    handle.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+            if digest.hexdigest() != sha256:
+                logger.error("S3 object %s does not match its recorded sha256; not caching", key)
+                return
+            path.parent.mkdir(exist_ok=True)
+            replaced = self._size(path)
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        self._record(misses=1, bytes_fetched=size)
+        # A refresh replaces an entry the counter already includes.
+        self._account(size - replaced)
+
+    @staticmethod
+    def _size(path: Path) -> int:
+        try:
+            return path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _discard(self, path: Path) -> None:
+        size = self._size(path)
+        path.unlink(missing_ok=True)
+        self._account(-size)
+
+    def read(self, key: str, sha256: str, decoder=None) -> bytes:
+        return b"".join(self.iter_object(key, sha256, decoder=decoder))
+
+    def _account(self, added: int) -> None:
+        limit = self.cfg["MAX_BYTES"]
+        with open(self.root / ".usage", "a+") as usage:
+            fcntl.flock(usage, fcntl.LOCK_EX)
+            usage.seek(0)
+            used = int(usage.read() or 0) + added
+            if used > limit * self.cfg["HIGH_WATER"]:
+                used = self._evict(int(limit * self.cfg["LOW_WATER"]))
+            usage.seek(0)
+            usage.truncate()
+            usage.write(str(used))
+
+    def _evict(self, target: int) -> int:
+        """Deletes least recently used entries down to `target` bytes; returns the bytes kept."""
+        entries = []
+        stale_before = time.time() - 3600
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                stat = entry.stat()
+                if shard.name == "tmp":
+                    if stat.st_mtime < stale_before:  # left behind by a killed fill
+                        os.unlink(entry.path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        used = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, entry_path in sorted(entries):
+            if used <= target:
+                break
+            try:
+                os.unlink(entry_path)
+            except FileNotFoundError:
+                pass
+            used -= size
+            evicted += 1
+        self._record(evictions=evicted)
+        return used
+
+    def stats(self) -> dict:
+        raw = get_redis().hgetall(f"blob_cache:{socket.gethostname()}")
+        counters = {k.decode(): int(v) for k, v in raw.items()}
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        return {
+            "enabled": self.enabled,
+            "hit_ratio": round(counters.get("hits", 0) / lookups, 4) if lookups else None,
+            "max_bytes": self.cfg["MAX_BYTES"],
+            **counters,
+        }
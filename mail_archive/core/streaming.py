@@ -0,0 +1,81 @@
+"""Helpers for streaming responses: byte ranges and async iteration under ASGI."""
+from __future__ import annotations
+
+import re
+
+from asgiref.sync import sync_to_async
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """Returns (start, length) for a single `bytes=` range, or None to serve the whole body.
+
+    Multiple ranges and malformed headers are ignored, which RFC 9110 allows.
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        suffix = int(last)
+        if suffix == 0:
+            raise RangeNotSatisfiable()
+        start = max(0, size - suffix)
+        return start, size - start
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, end - start + 1
+
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def none_match(header: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header matches `etag`; uses the weak comparison RFC 9110 prescribes."""
+    if not header:
+        return False
+    return header.strip() == "*" or _opaque(etag) in {_opaque(tag) for tag in header.split(",")}
+
+
+def range_applies(header: str | None, etag: str) -> bool:
+    """Whether a Range request may be honoured under its If-Range header (strong comparison only).
+
+    A weak validator or a date never matches, so the whole body is sent.
+    """
+    if header is None:
+        return True
+    header = header.strip()
+    return not header.startswith("W/") and not etag.startswith("W/") and header == etag
+
+
+async def iterate_in_threads(iterator):
+    """Async view of a blocking iterator; each chunk is produced in a worker thread.
+
+    Django consumes (and buffers) synchronous iterators entirely when serving
+    them over ASGI, so streamed bodies must be async there. Between chunks no
+    thread is held while the client is slow to read.
+    """
+    iterator = iter(iterator)
+    done = object()
+    fetch = sync_to_async(lambda: next(iterator, done), thread_sensitive=False)
+    try:
+        while True:
+            chunk = await fetch()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=False)()
@@ -0,0 +1,48 @@
+"""Stand-ins for S3, Elasticsearch and Redis in tests.
+
+`BackendsMixin` gives every test its own moto S3 (with the archive bucket
+created), the in-memory Elasticsearch of `benchmarks.backends` (`self.es`)
+and a fresh fakeredis server (`self.redis`), so `python manage.py test` needs
+nothing but the database. The stand-ins are in `benchmarks/requirements.txt`.
+"""
+from __future__ import annotations
+
+from unittest import mock
+
+import fakeredis
+from django.conf import settings
+from django.test import override_settings
+from moto import mock_aws
+from benchmarks.backends import FakeElasticsearch, create_bucket
+from core import redis as core_redis
+from core.lru import SizedLRU
+
+
+class BackendsMixin:
+    def setUp(self):
+        super().setUp()
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        # moto only intercepts AWS endpoints.
+        storage = override_settings(S3_STORAGE={**settings.S3_STORAGE, "ENDPOINT": None, "REGION": "us-east-1"})
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.es = FakeElasticsearch()
+        self.redis = core_redis.TracedRedis(
+            connection_pool=fakeredis.FakeRedis(server=fakeredis.FakeServer()).connection_pool
+        )
+        # Cached principals are stamped with generations from Redis; a fresh server restarts
+        # them at zero, so entries left by an earlier test would look current.
+        local_principals = SizedLRU(settings.PRINCIPAL_CACHE["LOCAL_MAX_ENTRIES"], lambda entry: 1)
+        for target, stand_in in (
+            ("core.search.TracedElasticsearch", lambda *args, **kwargs: self.es),
+            ("core.redis.TracedRedis.from_url", lambda *args, **kwargs: self.redis),
+            ("accounts.principal._local", local_principals),
+        ):
+            patcher = mock.patch(target, stand_in)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        core_redis.get_redis.cache_clear()
+        self.addCleanup(core_redis.get_redis.cache_clear)
+        create_bucket()
@@ -1,3 +1,401 @@
-from django.test import TestCase
+import datetime as dt
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from redis.exceptions import ConnectionError as RedisConnectionError
+from accounts.models import Department, Permission, Role, RolePermission, User, UserRole
+from archive.models import ArchivedEmail
+from audit.models import AuditLog
+from . import partitioning, profiling, replicas, revocation
+from .authentication import generate_jwt
+from .hash_utils import sha256_bytes
+from .middleware import ReplicaRoutingMiddleware
+from .models import RequestProfile
+from .ratelimit import ConcurrencySlots, RateLimiter
+from .storage import BlobCache
+from .streaming import RangeNotSatisfiable, none_match, parse_range, range_applies
+from .testing import BackendsMixin
+
+
+@override_settings(RATE_LIMITS={**settings.RATE_LIMITS, "LEASE_FRACTION": 0.1, "LEASE_SECONDS": 1})
+class RateLimiterTests(BackendsMixin, TestCase):
+    def bucket_tokens(self, scope: str, identity: str) -> float:
+        return float(self.redis.hget(f"ratelimit:{scope}:{identity}", "tokens"))
+
+    def test_budget_is_shared_and_never_exceeded(self):
+        limiters = [RateLimiter(), RateLimiter()]
+        allowed = sum(limiters[i % 2].hit("EMAIL_SEARCH", "user:1", "20/day").allowed for i in range(60))
+        self.assertEqual(allowed, 20)
+        denied = limiters[0].hit("EMAIL_SEARCH", "user:1", "20/day")
+        self.assertFalse(denied.allowed)
+        self.assertGreater(denied.retry_after, 0)
+
+    def test_expired_lease_returns_unspent_tokens(self):
+        limiter = RateLimiter()
+        with mock.patch("core.ratelimit.time.monotonic", return_value=1000.0):
+            self.assertEqual(limiter.hit("EMAIL_VIEW", "user:1", "100/day").remaining, 99)
+        self.assertAlmostEqual(self.bucket_tokens("EMAIL_VIEW", "user:1"), 90, places=0)
+        with mock.patch("core.ratelimit.time.monotonic", return_value=1002.0):
+            decision = limiter.hit("EMAIL_VIEW", "user:1", "100/day")
+        # Two requests cost two tokens, not two leases.
+        self.assertEqual(decision.remaining, 98)
+        self.assertAlmostEqual(self.bucket_tokens("EMAIL_VIEW", "user:1"), 89, places=0)
+
+    def test_sparse_requests_are_not_limited(self):
+        limiter = RateLimiter()
+        for second in range(40):
+            with mock.patch("core.ratelimit.time.monotonic", return_value=1000.0 + 2 * second):
+                self.assertTrue(limiter.hit("LOGIN", "ip:10.0.0.1", "50/day").allowed)
+
+
+class ConcurrencySlotsTests(BackendsMixin, TestCase):
+    def test_limit_per_owner(self):
+        slots = ConcurrencySlots("export", limit=2, lease_seconds=60)
+        self.assertTrue(slots.acquire(1, "a"))
+        self.assertTrue(slots.acquire(1, "b"))
+        self.assertTrue(slots.acquire(1, "a"))
+        self.assertFalse(slots.acquire(1, "c"))
+        self.assertTrue(slots.acquire(2, "c"))
+        slots.release(1, "a")
+        self.assertTrue(slots.acquire(1, "c"))
+        self.assertEqual(slots.in_use(1), 2)
+
+
+class BlobCacheTests(BackendsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = override_settings(BLOB_CACHE={**settings.BLOB_CACHE, "DIR": directory.name})
+        cache.enable()
+        self.addCleanup(cache.disable)
+        self.cache = BlobCache()
+        self.data = b"locked object" * 100
+        self.cache.storage.put_object("emails/one.eml", self.data)
+
+    def used(self) -> int:
+        return int((Path(settings.BLOB_CACHE["DIR"]) / ".usage").read_text())
+
+    def test_refresh_does_not_count_the_entry_twice(self):
+        sha = sha256_bytes(self.data)
+        self.assertEqual(self.cache.read("emails/one.eml", sha), self.data)
+        self.assertEqual(b"".join(self.cache.iter_object("emails/one.eml", sha, refresh=True)), self.data)
+        self.assertEqual(self.used(), len(self.data))
+
+    def test_hits_are_not_rehashed_by_default(self):
+        sha = sha256_bytes(self.data)
+        self.cache.read("emails/one.eml", sha)
+        with mock.patch("core.storage.sha256_file") as rehash:
+            self.assertEqual(self.cache.read("emails/one.eml", sha), self.data)
+        rehash.assert_not_called()
+
+    def test_discarded_entry_leaves_the_usage(self):
+        sha = sha256_bytes(self.data)
+        self.cache.read("emails/one.eml", sha)
+        self.cache._path("emails/one.eml").write_bytes(b"x" * len(self.data))
+        with override_settings(BLOB_CACHE={**settings.BLOB_CACHE, "VERIFY_ON_READ": True}):
+            cache = BlobCache()
+            self.assertEqual(cache.read("emails/one.eml", sha), self.data)
+        self.assertEqual(self.used(), len(self.data))
+
+
+class MetricsViewTests(TestCase):
+    def scrape(self, **headers):
+        return self.client.get("/metrics", **headers).status_code
+
+    def test_requires_the_token(self):
+        with override_settings(METRICS={**settings.METRICS, "TOKEN": "scraper"}):
+            self.assertEqual(self.scrape(), 403)
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION="Bearer wrong"), 403)
+            self.assertEqual(self.scrape(HTTP_AUTHORIZATION="Bearer scraper"), 200)
+
+    def test_refused_without_a_token_outside_debug(self):
+        with override_settings(METRICS={**settings.METRICS, "TOKEN": ""}):
+            self.assertEqual(self.scrape(), 403)
+            with override_settings(DEBUG=True):
+                self.assertEqual(self.scrape(), 200)
+
+
+class PartitioningTests(TestCase):
+    def test_month_arithmetic(self):
+        self.assertEqual(partitioning.add_months(dt.date(2024, 12, 1), 1), dt.date(2025, 1, 1))
+        self.assertEqual(partitioning.add_months(dt.date(2024, 1, 1), -1), dt.date(2023, 12, 1))
+        self.assertEqual(partitioning.month_start(dt.date(2024, 2, 29)), dt.date(2024, 2, 1))
+        self.assertEqual(
+            partitioning._definition(dt.date(2024, 12, 1)),
+            "PARTITION p202412 VALUES LESS THAN (TO_DAYS('2025-01-01'))",
+        )
+
+
+@skipUnless(connection.vendor == "mysql", "partitioning is MySQL only")
+class MySQLPartitioningTests(TransactionTestCase):
+    def test_migrated_tables_are_partitioned_ahead(self):
+        ahead = partitioning.add_months(partitioning._current_month(), settings.PARTITIONING["MONTHS_AHEAD"])
+        for table in partitioning.PARTITIONED_TABLES:
+            names = [p.name for p in partitioning.partitions(connection, [table])]
+            self.assertEqual(names[-1], "pmax")
+            self.assertIn(partitioning.partition_name(ahead), names)
+
+    def test_future_partitions_are_created_once(self):
+        months_ahead = settings.PARTITIONING["MONTHS_AHEAD"] + 1
+        month = partitioning.add_months(partitioning._current_month(), months_ahead)
+        for table in partitioning.PARTITIONED_TABLES:
+            self.assertEqual(
+                partitioning.ensure_future_partitions(connection, table, months_ahead),
+                [partitioning.partition_name(month)],
+            )
+            self.assertEqual(partitioning.ensure_future_partitions(connection, table, months_ahead), [])
+
+    def test_time_ranges_prune_to_their_month(self):
+        month = partitioning.add_months(partitioning._current_month(), 1)
+        start = dt.datetime.combine(month, dt.time.min, tzinfo=dt.timezone.utc)
+        end = dt.datetime.combine(partitioning.add_months(month, 1), dt.time.min, tzinfo=dt.timezone.utc)
+        for queryset in (
+            ArchivedEmail.objects.filter(received_at__gte=start, received_at__lt=end),
+            AuditLog.objects.filter(occurred_at__gte=start, occurred_at__lt=end),
+        ):
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN {sql}", params)
+                columns = [column[0] for column in cursor.description]
+                plan = dict(zip(columns, cursor.fetchone()))
+            self.assertEqual(plan["partitions"], partitioning.partition_name(month))
+
+
+class RevocationMirrorTests(BackendsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.mirror = revocation.RevocationMirror()
+        self.expires = int(time.time()) + 600
+
+    def token(self, jti: str, sub: str = "7", issued_at: int | None = None) -> dict:
+        return {"sub": sub, "jti": jti, "iat": int(time.time()) if issued_at is None else issued_at}
+
+    def test_unloaded_mirror_asks_redis(self):
+        revocation.revoke_token("revoked", self.expires)
+        self.assertFalse(self.mirror.fresh)
+        self.assertTrue(self.mirror.is_revoked(self.token("revoked")))
+        self.assertFalse(self.mirror.is_revoked(self.token("valid")))
+
+    def test_loaded_mirror_skips_redis_for_valid_tokens(self):
+        revocation.revoke_token("revoked", self.expires)
+        self.mirror.reload(self.redis)
+        with mock.patch("core.revocation.get_redis", side_effect=AssertionError("Redis was asked")):
+            self.assertFalse(self.mirror.is_revoked(self.token("valid")))
+        self.assertTrue(self.mirror.is_revoked(self.token("revoked")))
+
+    def test_published_revocations_apply_without_reload(self):
+        self.mirror.reload(self.redis)
+        revocation.revoke_token("later", self.expires)
+        self.mirror.apply("jti:later")
+        self.mirror.apply("sub:7:1000")
+        self.assertTrue(self.mirror.is_revoked(self.token("later")))
+        self.assertTrue(self.mirror.is_revoked(self.token("old", issued_at=1000)))
+        self.assertFalse(self.mirror.is_revoked(self.token("new", issued_at=1001)))
+        self.assertFalse(self.mirror.is_revoked(self.token("other", sub="8", issued_at=1000)))
+
+    def test_reload_forgets_expired_revocations(self):
+        now = int(time.time())
+        self.redis.zadd(revocation.REVOKED_KEY, {"expired": now - 1})
+        self.redis.hset(revocation.CUTOFFS_KEY, "7", now - revocation._token_lifetime() - 1)
+        self.mirror.reload(self.redis)
+        self.assertFalse(self.mirror.bloom.might_contain("expired"))
+        self.assertEqual(self.mirror.cutoffs, {})
+        self.assertIsNone(self.redis.hget(revocation.CUTOFFS_KEY, "7"))
+
+
+class StreamingTests(TestCase):
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-9", 100), (0, 10))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 10))
+        self.assertEqual(parse_range("bytes=-30", 100), (70, 30))
+        self.assertEqual(parse_range("bytes=-300", 100), (0, 100))
+        self.assertEqual(parse_range("bytes=95-200", 100), (95, 5))
+        for ignored in (None, "", "bytes=-", "bytes=0-1,5-6", "items=0-1", "bytes=a-b"):
+            self.assertIsNone(parse_range(ignored, 100))
+        for unsatisfiable in ("bytes=100-", "bytes=-0", "bytes=9-5"):
+            with self.assertRaises(RangeNotSatisfiable):
+                parse_range(unsatisfiable, 100)
+
+    def test_validators(self):
+        self.assertTrue(none_match('W/"abc"', '"abc"'))
+        self.assertTrue(none_match("*", '"abc"'))
+        self.assertFalse(none_match(None, '"abc"'))
+        self.assertTrue(range_applies(None, '"abc"'))
+        self.assertTrue(range_applies('"abc"', '"abc"'))
+        self.assertFalse(range_applies('W/"abc"', '"abc"'))
+        self.assertFalse(range_applies("Wed, 03 Jan 2024 00:00:00 GMT", '"abc"'))
+
+
+@override_settings(
+    REPLICA_ROUTING={**settings.REPLICA_ROUTING, "ALIASES": ["replica1", "replica2"], "EXPORT_ALIAS": "replica2"}
+)
+class ReplicaRoutingTests(BackendsMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.lags = {"replica1": 0.0, "replica2": 0.0}
+        patcher = mock.patch.object(replicas.pool, "lags", lambda: dict(self.lags))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = replicas.ReplicaRouter()
+
+    def request(self, user_id: int, view):
+        """Runs `view(state)` as one request of `user_id` through the routing middleware."""
+        token = generate_jwt(SimpleNamespace(id=user_id, username=f"user{user_id}", role_codes=[]))
+        request = RequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {token}")
+        result = {}
+
+        def get_response(request):
+            result["value"] = view(replicas._request_state.get())
+            return HttpResponse()
+
+        ReplicaRoutingMiddleware(get_response)(request)
+        return result["value"]
+
+    def read_alias(self, state=None):
+        # Django falls back to the primary when the router has no opinion.
+        with replicas.replica_reads():
+            return self.router.db_for_read(ArchivedEmail) or replicas.PRIMARY
+
+    def test_writer_reads_from_the_primary_for_the_rest_of_the_request_and_after(self):
+        def write_then_read(state):
+            before = self.read_alias()
+            self.router.db_for_write(ArchivedEmail)
+            return before, self.read_alias()
+
+        self.assertEqual(self.request(7, write_then_read), ("replica1", "default"))
+        self.assertEqual(self.request(7, self.read_alias), "default")
+        self.assertEqual(self.request(8, self.read_alias), "replica1")
+        self.redis.delete("db_sticky:7")
+        self.assertEqual(self.request(7, self.read_alias), "replica1")
+
+    def test_bookkeeping_writes_do_not_make_the_writer_sticky(self):
+        def audit_then_read(state):
+            self.router.db_for_write(AuditLog)
+            return self.read_alias()
+
+        self.assertEqual(self.request(7, audit_then_read), "replica1")
+        self.assertFalse(self.redis.exists("db_sticky:7"))
+
+    def test_reads_inside_a_transaction_stay_on_the_primary(self):
+        with mock.patch.object(connections["default"], "in_atomic_block", True):
+            self.assertEqual(self.request(7, self.read_alias), "default")
+        self.assertEqual(self.request(7, self.read_alias), "replica1")
+
+    def test_lagging_replicas_fall_back_to_the_primary(self):
+        self.lags.update(replica1=settings.REPLICA_ROUTING["MAX_LAG_SECONDS"] + 1)
+        self.assertEqual(self.read_alias(), "default")
+        self.lags.update(replica1=None)
+        self.assertEqual(self.read_alias(), "default")
+        # The export replica serves interactive reads only when it is the sole replica.
+        self.assertEqual(replicas.export_database(), "replica2")
+        self.lags.update(replica1=0.0, replica2=60.0)
+        self.assertEqual(self.read_alias(), "replica1")
+        self.assertEqual(replicas.export_database(), "default")
+
+    def test_stickiness_unknown_without_redis_reads_from_the_primary(self):
+        with mock.patch.object(self.redis, "exists", side_effect=RedisConnectionError("down")), \
+                self.assertLogs("core.replicas", "WARNING"):
+            self.assertEqual(self.request(7, self.read_alias), "default")
+
+
+@override_settings(PROFILING={**settings.PROFILING, "ENABLED": True, "SAMPLE_RATE": 0.0, "INTERVAL_MS": 1})
+class ProfilingMiddlewareTests(BackendsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        department = Department.objects.create(name="Ops", path="/ops")
+        self.operator = User.objects.create(username="operator", email="operator@example.com", department=department)
+        role = Role.objects.create(name="operator", description="")
+        permission = Permission.objects.create(code="OPS_PROFILE", description="")
+        RolePermission.objects.create(role=role, permission=permission)
+        UserRole.objects.create(user=self.operator, role=role)
+        self.viewer = User.objects.create(username="viewer", email="viewer@example.com", department=department)
+
+    def get(self, path: str, user=None, **headers):
+        if user is not None:
+            token = generate_jwt(user, mfa_verified_until=timezone.now() + dt.timedelta(minutes=5))
+            headers["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+        return self.client.get(path, **headers)
+
+    def test_header_profiles_requests_of_ops_profile_holders(self):
+        response = self.get("/api/v1/ops/profiles/", self.operator, HTTP_X_PROFILE="1", HTTP_X_REQUEST_ID="req-1")
+        self.assertEqual((response.status_code, response["X-Profiled"]), (200, "true"))
+
+        profile = RequestProfile.objects.get(request_id="req-1")
+        self.assertEqual((profile.trigger, profile.user, profile.method), ("HEADER", self.operator, "GET"))
+        self.assertEqual((profile.view_name, profile.status_code), ("ops-profiles", 200))
+        self.assertGreater(profile.span_summary["sql"]["count"], 0)
+        self.assertLessEqual({"sql", "redis"}, {span["kind"] for span in profile.spans})
+        self.assertTrue(all(span["start_ms"] >= 0 and span["ms"] >= 0 for span in profile.spans))
+
+        detail = self.get("/api/v1/ops/profiles/req-1/", self.operator).json()
+        self.assertEqual((detail["request_id"], len(detail["spans"])), ("req-1", len(profile.spans)))
+
+    def test_header_is_ignored_without_ops_profile(self):
+        for user in (self.viewer, None):
+            response = self.get("/api/v1/ops/profiles/", user, HTTP_X_PROFILE="1")
+            self.assertFalse(response.has_header("X-Profiled"))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_sampled_requests_are_profiled_without_a_user(self):
+        with override_settings(PROFILING={**settings.PROFILING, "ENABLED": True, "SAMPLE_RATE": 1.0}):
+            response = self.get("/api/v1/ops/profiles/", HTTP_X_REQUEST_ID="req-2")
+        self.assertEqual(response["X-Profiled"], "true")
+        profile = RequestProfile.objects.get(request_id="req-2")
+        self.assertEqual((profile.trigger, profile.user, profile.status_code), ("SAMPLED", None, 403))
+
+    def test_disabled_profiling_ignores_the_header(self):
+        with override_settings(PROFILING={**settings.PROFILING, "ENABLED": False, "SAMPLE_RATE": 1.0}):
+            response = self.get("/api/v1/ops/profiles/", self.operator, HTTP_X_PROFILE="1")
+        self.assertFalse(response.has_header("X-Profiled"))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_failing_to_store_a_profile_keeps_the_response(self):
+        with mock.patch.object(RequestProfile.objects, "update_or_create", side_effect=RuntimeError("full")), \
+                self.assertLogs("core.middleware", "ERROR"):
+            response = self.get("/api/v1/ops/profiles/", self.operator, HTTP_X_PROFILE="1")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("X-Profiled"))
+
+    def test_old_profiles_expire_when_a_new_one_is_stored(self):
+        self.get("/api/v1/ops/profiles/", self.operator, HTTP_X_PROFILE="1", HTTP_X_REQUEST_ID="old")
+        RequestProfile.objects.filter(request_id="old").update(created_at=timezone.now() - dt.timedelta(days=30))
+        self.get("/api/v1/ops/profiles/", self.operator, HTTP_X_PROFILE="1", HTTP_X_REQUEST_ID="new")
+        self.assertEqual(list(RequestProfile.objects.values_list("request_id", flat=True)), ["new"])
+
+
+@override_settings(PROFILING={**settings.PROFILING, "INTERVAL_MS": 1, "MAX_SPANS": 2})
+class ProfileTests(SimpleTestCase):
+    def test_samples_the_calling_thread(self):
+        def busy_profiled_work():
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+
+        with profiling.profile() as current:
+            busy_profiled_work()
+        self.assertGreater(current.sampler.samples, 0)
+        self.assertIn("busy_profiled_work", current.sampler.collapsed())
+        self.assertIsNone(profiling.active())
+
+    def test_spans_beyond_the_limit_are_counted_but_not_kept(self):
+        with profiling.profile() as current:
+            for i in range(3):
+                with profiling.span("redis", f"GET {i}"):
+                    pass
+            with self.assertRaises(KeyError), profiling.span("es", "search"):
+                raise KeyError
+        self.assertEqual([span["name"] for span in current.spans], ["GET 0", "GET 1"])
+        self.assertEqual((current.dropped_spans, current.summary["redis"]["count"]), (2, 3))
+        self.assertEqual(current.summary["es"]["count"], 1)
+        # Outside a profile, spans cost nothing and record nothing.
+        with profiling.span("redis", "GET"):
+            pass
@@ -0,0 +1,28 @@
+"""Token-bucket throttle for background jobs that must stay within a byte budget."""
+from __future__ import annotations
+
+import threading
+import time
+
+
+class ByteBudget:
+    """Blocks callers so that consumption averages at most `rate` bytes/second across threads."""
+
+    def __init__(self, rate: int, burst: int | None = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            deficit = -self.tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
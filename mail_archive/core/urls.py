@@ -0,0 +1,8 @@
+from django.urls import path
+from .views import RequestProfileDetailView, RequestProfileListView, RequestProfileStacksView
+
+urlpatterns = [
+    path("profiles/", RequestProfileListView.as_view(), name="ops-profiles"),
+    path("profiles/<str:request_id>/", RequestProfileDetailView.as_view(), name="ops-profile-detail"),
+    path("profiles/<str:request_id>/stacks/", RequestProfileStacksView.as_view(), name="ops-profile-stacks"),
+]
@@ -1,3 +1,65 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
+from rest_framework.generics import ListAPIView, RetrieveAPIView
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.views import APIView
+from . import metrics
+from .models import RequestProfile
+from .permissions import RBACPermission
+from .serializers import RequestProfileDetailSerializer, RequestProfileSerializer
 
-# Create your views here.
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; requires `METRICS_TOKEN`, which only DEBUG may leave unset."""
+    token = settings.METRICS["TOKEN"]
+    if not token:
+        if not settings.DEBUG:
+            return HttpResponseForbidden("METRICS_TOKEN is not configured")
+    elif not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    body, content_type = metrics.render(request.headers.get("Accept"))
+    return HttpResponse(body, content_type=content_type)
+
+
+class RequestProfileListView(ListAPIView):
+    serializer_class = RequestProfileSerializer
+    queryset = RequestProfile.objects.order_by("-created_at")
+    pagination_class = LimitOffsetPagination
+    permission_classes = [RBACPermission]
+    required_permission = "OPS_PROFILE"
+    require_mfa = True
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        view_name = self.request.query_params.get("view")
+        trigger = self.request.query_params.get("trigger")
+        if view_name:
+            qs = qs.filter(view_name=view_name)
+        if trigger:
+            qs = qs.filter(trigger=trigger)
+        return qs.defer("collapsed_stacks", "spans")
+
+
+class RequestProfileDetailView(RetrieveAPIView):
+    serializer_class = RequestProfileDetailSerializer
+    queryset = RequestProfile.objects.defer("collapsed_stacks")
+    lookup_field = "request_id"
+    permission_classes = [RBACPermission]
+    required_permission = "OPS_PROFILE"
+    require_mfa = True
+
+
+class RequestProfileStacksView(APIView):
+    """The collapsed stacks as a file for flamegraph.pl or speedscope."""
+
+    permission_classes = [RBACPermission]
+    required_permission = "OPS_PROFILE"
+    require_mfa = True
+
+    def get(self, request, request_id: str):
+        profile = get_object_or_404(RequestProfile.objects.only("collapsed_stacks"), request_id=request_id)
+        response = HttpResponse(profile.collapsed_stacks + "\n", content_type="text/plain; charset=utf-8")
+        response["Content-Disposition"] = f'attachment; filename="{request_id}.collapsed"'
+        return response
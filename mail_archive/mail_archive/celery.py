@@ -1,8 +1,88 @@
 import os
+import time
+
 from celery import Celery
+from celery.signals import (
+    before_task_publish,
+    celeryd_init,
+    task_postrun,
+    task_prerun,
+    worker_process_shutdown,
+    worker_ready,
+)
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mail_archive.settings")
 
+# Worker processes per queue (routes: CELERY_TASK_ROUTES). A worker started with
+# `-Q` and without `-c` runs the sum of the concurrencies of its queues, so each
+# queue can get its own deployment sized for its work.
+QUEUE_CONCURRENCY = {
+    "ingest": int(os.getenv("CELERY_INGEST_CONCURRENCY", "4")),
+    "indexing": int(os.getenv("CELERY_INDEXING_CONCURRENCY", "2")),
+    "export": int(os.getenv("CELERY_EXPORT_CONCURRENCY", "2")),
+    "integrity": int(os.getenv("CELERY_INTEGRITY_CONCURRENCY", "1")),
+    "default": int(os.getenv("CELERY_DEFAULT_CONCURRENCY", "2")),
+}
+
 app = Celery("mail_archive")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+
+
+@celeryd_init.connect
+def _queue_concurrency(sender=None, conf=None, options=None, **kwargs):
+    options = options or {}
+    queues = options.get("queues")
+    if not queues or options.get("concurrency"):
+        return
+    if isinstance(queues, str):
+        queues = queues.split(",")
+    conf.worker_concurrency = sum(QUEUE_CONCURRENCY.get(queue.strip(), 1) for queue in queues)
+
+
+@before_task_publish.connect
+def _stamp_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("enqueued_at", time.time())
+
+
+@task_prerun.connect
+def _task_started(task=None, **kwargs):
+    task.request.started_at = time.perf_counter()
+    enqueued_at = getattr(task.request, "enqueued_at", None)
+    queue = (task.request.delivery_info or {}).get("routing_key")
+    if enqueued_at is None or not queue:
+        return
+    from core.queues import record_wait
+
+    try:
+        record_wait(queue, enqueued_at)
+    except Exception:  # metrics must never fail a task
+        pass
+
+
+@task_postrun.connect
+def _record_task_duration(task=None, state=None, **kwargs):
+    started_at = getattr(task.request, "started_at", None)
+    if started_at is None:
+        return
+    from core import metrics
+
+    metrics.observe(metrics.TASK_SECONDS, time.perf_counter() - started_at, task=task.name, state=state or "UNKNOWN")
+
+
+@worker_ready.connect
+def _serve_worker_metrics(**kwargs):
+    from django.conf import settings
+    from prometheus_client import start_http_server
+    from core import metrics
+
+    if settings.METRICS["ENABLED"] and settings.METRICS["WORKER_PORT"]:
+        start_http_server(settings.METRICS["WORKER_PORT"], registry=metrics.registry())
+
+
+@worker_process_shutdown.connect
+def _forget_worker_process(pid=None, **kwargs):
+    from core import metrics
+
+    metrics.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,7 @@
+"""Gunicorn hooks (`--config python:mail_archive.gunicorn_conf`)."""
+
+
+def child_exit(server, worker):
+    from core import metrics
+
+    metrics.mark_process_dead(worker.pid)
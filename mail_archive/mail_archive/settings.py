@@ -5,10 +5,12 @@ object storage, and search integration.
 
 from __future__ import annotations
 
+import json
 import os
-from datetime import timedelta
 from pathlib import Path
 
+from celery.schedules import crontab
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 DEBUG = os.getenv("DJANGO_DEBUG", "false").lower() == "true"
@@ -36,6 +38,9 @@ MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.middleware.gzip.GZipMiddleware",
     "core.middleware.RequestIdMiddleware",
+    "core.middleware.MetricsMiddleware",
+    "core.middleware.ProfilingMiddleware",
+    "core.middleware.ReplicaRoutingMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -43,6 +48,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "core.middleware.ImmutableRequestMiddleware",
+    "core.middleware.RateLimitMiddleware",
 ]
 
 ROOT_URLCONF = "mail_archive.urls"
@@ -83,6 +89,38 @@ DATABASES = {
     }
 }
 
+# Read replicas as host[:port] pairs; they become aliases replica1, replica2, ...
+for _index, _host in enumerate(filter(None, os.getenv("DB_REPLICA_HOSTS", "").split(",")), start=1):
+    _hostname, _, _port = _host.strip().partition(":")
+    DATABASES[f"replica{_index}"] = {
+        **DATABASES["default"],
+        "HOST": _hostname,
+        "PORT": _port or DATABASES["default"]["PORT"],
+        "USER": os.getenv("DB_REPLICA_USER", DATABASES["default"]["USER"]),
+        "PASSWORD": os.getenv("DB_REPLICA_PASSWORD", DATABASES["default"]["PASSWORD"]),
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["core.replicas.ReplicaRouter"]
+
+REPLICA_ROUTING = {
+    "ALIASES": [alias for alias in DATABASES if alias != "default"],
+    # Replica reserved for export scans (e.g. "replica2"); interactive reads use the others.
+    "EXPORT_ALIAS": os.getenv("DB_EXPORT_REPLICA", ""),
+    # Replicas further behind than this get no reads; with none left, reads go to the primary.
+    "MAX_LAG_SECONDS": float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5")),
+    "LAG_CHECK_SECONDS": float(os.getenv("DB_REPLICA_LAG_CHECK_SECONDS", "5")),
+    # After a write a user reads from the primary for this long; keep it above MAX_LAG_SECONDS.
+    "STICKY_SECONDS": int(os.getenv("DB_REPLICA_STICKY_SECONDS", "15")),
+    # Bookkeeping writes that do not make the writer sticky.
+    "STICKY_EXEMPT_MODELS": ["audit.auditlog", "core.requestprofile"],
+}
+
+PARTITIONING = {
+    # Monthly partitions of archive_archivedemail and audit_auditlog kept ready ahead of the current month.
+    "MONTHS_AHEAD": int(os.getenv("PARTITION_MONTHS_AHEAD", "3")),
+}
+
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.redis.RedisCache",
@@ -159,7 +197,60 @@ CELERY_BROKER_URL = REDIS_URL
 CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_TASK_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
-CELERY_BEAT_SCHEDULE = {}
+# Queues and per-queue worker concurrency: mail_archive/celery.py (QUEUE_CONCURRENCY).
+CELERY_TASK_DEFAULT_QUEUE = "default"
+CELERY_TASK_ROUTES = {
+    "archive.tasks.drain_ingest_stage": {"queue": "ingest"},
+    "archive.tasks.retry_search_queue": {"queue": "indexing"},
+    "archive.tasks.repair_search_index": {"queue": "indexing"},
+    "archive.tasks.merge_thread_documents": {"queue": "indexing"},
+    "archive.tasks.build_export_archive": {"queue": "export"},
+    "archive.tasks.sweep_integrity": {"queue": "integrity"},
+    "archive.tasks.build_merkle_trees": {"queue": "integrity"},
+    "archive.tasks.reconcile_stores": {"queue": "integrity"},
+    "archive.tasks.maintain_partitions": {"queue": "integrity"},
+    "archive.tasks.tier_cold_metadata": {"queue": "integrity"},
+}
+# Long tasks must not sit prefetched behind another long task on the same worker process.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_BEAT_SCHEDULE = {
+    "drain-ingest-stage": {
+        "task": "archive.tasks.drain_ingest_stage",
+        "schedule": float(os.getenv("INGEST_DRAIN_INTERVAL", "2")),
+    },
+    "retry-search-queue": {
+        "task": "archive.tasks.retry_search_queue",
+        "schedule": 60.0,
+    },
+    "sweep-integrity": {
+        "task": "archive.tasks.sweep_integrity",
+        "schedule": float(os.getenv("INTEGRITY_SWEEP_INTERVAL", "3600")),
+    },
+    "build-merkle-trees": {
+        "task": "archive.tasks.build_merkle_trees",
+        "schedule": crontab(hour=0, minute=30),
+    },
+    "dispatch-exports": {
+        "task": "archive.tasks.dispatch_exports",
+        "schedule": float(os.getenv("EXPORT_DISPATCH_INTERVAL", "10")),
+    },
+    "reconcile-stores": {
+        "task": "archive.tasks.reconcile_stores",
+        "schedule": crontab(hour=2, minute=0),
+    },
+    "maintain-partitions": {
+        "task": "archive.tasks.maintain_partitions",
+        "schedule": crontab(hour=3, minute=15),
+    },
+    "tier-cold-metadata": {
+        "task": "archive.tasks.tier_cold_metadata",
+        "schedule": crontab(hour=4, minute=0),
+    },
+    "rebuild-dedup-filter": {
+        "task": "archive.tasks.rebuild_dedup_filter",
+        "schedule": crontab(day_of_week="sun", hour=5, minute=0),
+    },
+}
 
 S3_STORAGE = {
     "ENDPOINT": os.getenv("S3_ENDPOINT", "http://127.0.0.1:9000"),
@@ -170,6 +261,148 @@ S3_STORAGE = {
     "LOCK_RETENTION_DAYS": int(os.getenv("S3_LOCK_DAYS", "365")),
 }
 
+BLOB_CACHE = {
+    # Node-local directory shared by web and worker processes; empty disables the cache.
+    "DIR": os.getenv("BLOB_CACHE_DIR", ""),
+    "MAX_BYTES": int(os.getenv("BLOB_CACHE_MAX_BYTES", str(10 * 1024**3))),
+    # Eviction starts above HIGH_WATER * MAX_BYTES and removes LRU entries down to LOW_WATER.
+    "HIGH_WATER": float(os.getenv("BLOB_CACHE_HIGH_WATER", "0.9")),
+    "LOW_WATER": float(os.getenv("BLOB_CACHE_LOW_WATER", "0.75")),
+    # Fills are always checked against the recorded SHA-256; re-hashing every hit costs a full read of the entry.
+    "VERIFY_ON_READ": os.getenv("BLOB_CACHE_VERIFY_ON_READ", "false").lower() == "true",
+}
+
+COMPRESSION = {
+    # zstd-compress stored EML objects, with the department's trained dictionary when there is one.
+    "ENABLED": os.getenv("COMPRESSION_ENABLED", "false").lower() == "true",
+    "LEVEL": int(os.getenv("COMPRESSION_LEVEL", "6")),
+    "MIN_BYTES": int(os.getenv("COMPRESSION_MIN_BYTES", "256")),
+    "DICTIONARY_SIZE": int(os.getenv("COMPRESSION_DICTIONARY_SIZE", str(112 * 1024))),
+    "DICTIONARY_REFRESH_SECONDS": int(os.getenv("COMPRESSION_DICTIONARY_REFRESH_SECONDS", "300")),
+}
+
+SEGMENT_STORAGE = {
+    # Pack small EML objects of queued-ingest batches and bulk-import chunks into shared segment objects.
+    "ENABLED": os.getenv("SEGMENT_STORAGE_ENABLED", "false").lower() == "true",
+    "MAX_OBJECT_BYTES": int(os.getenv("SEGMENT_MAX_OBJECT_BYTES", str(64 * 1024))),
+    "TARGET_SEGMENT_BYTES": int(os.getenv("SEGMENT_TARGET_BYTES", str(64 * 1024 * 1024))),
+    # OPEN segments older than this belonged to a crashed writer and are settled by reconciliation.
+    "OPEN_GRACE_SECONDS": int(os.getenv("SEGMENT_OPEN_GRACE_SECONDS", "3600")),
+    "EXPORT_MAX_RANGE_BYTES": int(os.getenv("SEGMENT_EXPORT_MAX_RANGE_BYTES", str(16 * 1024 * 1024))),
+}
+
+PREVIEW = {
+    # Parsed previews are cached per process by sha256; the archive is immutable, so entries never go stale.
+    "CACHE_MAX_BYTES": int(os.getenv("PREVIEW_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    "MAX_BODY_CHARS": int(os.getenv("PREVIEW_MAX_BODY_CHARS", str(1024 * 1024))),
+    "PAGE_CHARS": int(os.getenv("PREVIEW_PAGE_CHARS", str(64 * 1024))),
+}
+
+EXPORT_SCHEDULER = {
+    # Exports run in parts of this many messages and requeue between parts (preemption points).
+    "PART_MESSAGES": int(os.getenv("EXPORT_PART_MESSAGES", "50000")),
+    # Export parts running at once across all export workers.
+    "MAX_RUNNING": int(os.getenv("EXPORT_MAX_RUNNING", "4")),
+    "MAX_CANDIDATES": int(os.getenv("EXPORT_MAX_CANDIDATES", "500")),
+    # Running parts refresh their heartbeat this often; a part silent for PART_TIMEOUT_SECONDS
+    # lost its worker and is requeued.
+    "HEARTBEAT_SECONDS": int(os.getenv("EXPORT_HEARTBEAT_SECONDS", "30")),
+    "PART_TIMEOUT_SECONDS": int(os.getenv("EXPORT_PART_TIMEOUT_SECONDS", "300")),
+    "USAGE_HALF_LIFE_SECONDS": int(os.getenv("EXPORT_USAGE_HALF_LIFE_SECONDS", "3600")),
+    # Fair-share weight per department path, e.g. {"Legal": 4}; others weigh 1.
+    "DEPARTMENT_WEIGHTS": json.loads(os.getenv("EXPORT_DEPARTMENT_WEIGHTS", "{}")),
+}
+
+INGEST_SETTINGS = {
+    # "sync" stores inside the request; "queued" stages to Redis and returns 202.
+    "MODE": os.getenv("INGEST_MODE", "sync"),
+    "STREAM": os.getenv("INGEST_STREAM", "archive:ingest"),
+    "CONSUMER_GROUP": os.getenv("INGEST_CONSUMER_GROUP", "ingest-workers"),
+    "MAX_PENDING": int(os.getenv("INGEST_MAX_PENDING", "100000")),
+    "BATCH_SIZE": int(os.getenv("INGEST_BATCH_SIZE", "50")),
+    "DRAIN_SECONDS": int(os.getenv("INGEST_DRAIN_SECONDS", "25")),
+    "CLAIM_IDLE_SECONDS": int(os.getenv("INGEST_CLAIM_IDLE_SECONDS", "300")),
+    "MAX_DELIVERIES": int(os.getenv("INGEST_MAX_DELIVERIES", "5")),
+    "STATUS_TTL_SECONDS": int(os.getenv("INGEST_STATUS_TTL_SECONDS", "259200")),
+    # Parallel attachment decode/hash/upload threads per ingested message.
+    "ATTACHMENT_CONCURRENCY": int(os.getenv("INGEST_ATTACHMENT_CONCURRENCY", "8")),
+}
+
+DEDUP_SETTINGS = {
+    "ENABLED": os.getenv("DEDUP_ENABLED", "true").lower() == "true",
+    "KEY_PREFIX": os.getenv("DEDUP_KEY_PREFIX", "archive:dedup"),
+    "BLOOM_CAPACITY": int(os.getenv("DEDUP_BLOOM_CAPACITY", "200000000")),
+    "BLOOM_ERROR_RATE": float(os.getenv("DEDUP_BLOOM_ERROR_RATE", "0.01")),
+    "CLAIM_TTL_SECONDS": int(os.getenv("DEDUP_CLAIM_TTL_SECONDS", "300")),
+    # Longer than the rebuild-dedup-filter beat interval, so the filter only goes cold
+    # when rebuilds stop.
+    "WARM_TTL_SECONDS": int(os.getenv("DEDUP_WARM_TTL_SECONDS", str(8 * 24 * 3600))),
+}
+
+INTEGRITY_SETTINGS = {
+    "BATCH_SIZE": int(os.getenv("INTEGRITY_BATCH_SIZE", "200")),
+    "CONCURRENCY": int(os.getenv("INTEGRITY_CONCURRENCY", "8")),
+    "BYTES_PER_SECOND": int(os.getenv("INTEGRITY_BYTES_PER_SECOND", str(50 * 1024 * 1024))),
+    "CHUNK_BYTES": int(os.getenv("INTEGRITY_CHUNK_BYTES", str(1024 * 1024))),
+    # Each run stops after this long; the next beat run resumes from the stored cursor.
+    "TIME_BUDGET_SECONDS": int(os.getenv("INTEGRITY_TIME_BUDGET_SECONDS", "3300")),
+}
+
+MERKLE_SETTINGS = {
+    # Username that appends each day root to the audit chain; empty disables anchoring.
+    "AUDIT_ACTOR": os.getenv("MERKLE_AUDIT_ACTOR", ""),
+    "LOOKBACK_DAYS": int(os.getenv("MERKLE_LOOKBACK_DAYS", "7")),
+}
+
+RECONCILE_SETTINGS = {
+    # Days compared on every run (plus days with new rows); 0 compares every day in the index each run.
+    "LOOKBACK_DAYS": int(os.getenv("RECONCILE_LOOKBACK_DAYS", "30")),
+    # Older days compared per run, least recently checked first, so the whole archive is covered in turn.
+    "HISTORY_DAYS_PER_RUN": int(os.getenv("RECONCILE_HISTORY_DAYS_PER_RUN", "30")),
+    "WATERMARK_SKEW_SECONDS": int(os.getenv("RECONCILE_WATERMARK_SKEW_SECONDS", "3600")),
+    "MAX_MAILBOXES_PER_DAY": int(os.getenv("RECONCILE_MAX_MAILBOXES_PER_DAY", "10000")),
+    "SCAN_PAGE_SIZE": int(os.getenv("RECONCILE_SCAN_PAGE_SIZE", "1000")),
+    "REPAIR_BATCH_SIZE": int(os.getenv("RECONCILE_REPAIR_BATCH_SIZE", "200")),
+}
+
+COLD_TIER = {
+    # Moves email metadata of whole months older than AGE_DAYS from MySQL to Parquet files in S3.
+    "ENABLED": os.getenv("COLD_TIER_ENABLED", "false").lower() == "true",
+    "AGE_DAYS": int(os.getenv("COLD_TIER_AGE_DAYS", "365")),
+    "PREFIX": os.getenv("COLD_TIER_PREFIX", "cold/"),
+    # Rows per Parquet row group; a lookup by id reads one row group.
+    "ROW_GROUP_ROWS": int(os.getenv("COLD_TIER_ROW_GROUP_ROWS", "2048")),
+    "COMPRESSION_LEVEL": int(os.getenv("COLD_TIER_COMPRESSION_LEVEL", "9")),
+    "MAX_FILES_PER_RUN": int(os.getenv("COLD_TIER_MAX_FILES_PER_RUN", "500")),
+    # Emails per participant/attachment read and per delete transaction.
+    "BATCH_SIZE": int(os.getenv("COLD_TIER_BATCH_SIZE", "1000")),
+    # Parquet footers kept in memory per process, so a warm lookup costs a single range request.
+    "FOOTER_CACHE_ENTRIES": int(os.getenv("COLD_TIER_FOOTER_CACHE_ENTRIES", "2048")),
+}
+
+THREADING = {
+    # Referenced ids linked per message; a long References chain keeps its root and the closest ancestors.
+    "MAX_REFERENCES": int(os.getenv("THREADING_MAX_REFERENCES", "50")),
+    # Messages returned by GET /api/v1/archive/threads/<id>/.
+    "MAX_MESSAGES": int(os.getenv("THREADING_MAX_MESSAGES", "1000")),
+}
+
+SMTP_JOURNAL = {
+    "HOST": os.getenv("SMTP_JOURNAL_HOST", "0.0.0.0"),
+    "PORT": int(os.getenv("SMTP_JOURNAL_PORT", "2525")),
+    "HOSTNAME": os.getenv("SMTP_JOURNAL_HOSTNAME", "mail-archive"),
+    "SPOOL_DIR": os.getenv("SMTP_JOURNAL_SPOOL_DIR", str(BASE_DIR / "var" / "smtp-spool")),
+    "SERVICE_USERNAME": os.getenv("SMTP_JOURNAL_SERVICE_USER", "journal-relay"),
+    "MAX_MESSAGE_BYTES": int(os.getenv("SMTP_JOURNAL_MAX_BYTES", str(150 * 1024 * 1024))),
+    "BATCH_SIZE": int(os.getenv("SMTP_JOURNAL_BATCH_SIZE", "25")),
+    "PERSIST_WORKERS": int(os.getenv("SMTP_JOURNAL_PERSIST_WORKERS", "4")),
+    "FLUSH_INTERVAL_SECONDS": float(os.getenv("SMTP_JOURNAL_FLUSH_INTERVAL", "1")),
+    # Messages that fail to store are retried with exponential backoff, and rejected after MAX_ATTEMPTS.
+    "RETRY_BASE_SECONDS": float(os.getenv("SMTP_JOURNAL_RETRY_BASE_SECONDS", "5")),
+    "RETRY_MAX_SECONDS": float(os.getenv("SMTP_JOURNAL_RETRY_MAX_SECONDS", "600")),
+    "MAX_ATTEMPTS": int(os.getenv("SMTP_JOURNAL_MAX_ATTEMPTS", "100")),
+}
+
 ELASTICSEARCH = {
     "HOSTS": os.getenv("ES_HOSTS", "http://127.0.0.1:9200").split(","),
     "INDEX": os.getenv("ES_INDEX", "emails_archive"),
@@ -183,6 +416,61 @@ JWT_SETTINGS = {
     "VERIFYING_KEY": os.getenv("JWT_VERIFYING_KEY"),
 }
 
+JWT_REVOCATION = {
+    "ENABLED": os.getenv("JWT_REVOCATION_ENABLED", "true").lower() == "true",
+    # Sizing of the per-process Bloom filter mirroring revoked token IDs; false positives cost one Redis lookup.
+    "BLOOM_CAPACITY": int(os.getenv("JWT_REVOCATION_BLOOM_CAPACITY", "100000")),
+    "BLOOM_ERROR_RATE": float(os.getenv("JWT_REVOCATION_BLOOM_ERROR_RATE", "0.001")),
+    "REFRESH_SECONDS": int(os.getenv("JWT_REVOCATION_REFRESH_SECONDS", "300")),
+    "MAX_STALENESS_SECONDS": int(os.getenv("JWT_REVOCATION_MAX_STALENESS_SECONDS", "900")),
+    "RECONNECT_SECONDS": int(os.getenv("JWT_REVOCATION_RECONNECT_SECONDS", "5")),
+}
+
+METRICS = {
+    "ENABLED": os.getenv("METRICS_ENABLED", "true").lower() == "true",
+    # Bearer token required by /metrics; without one /metrics is only served with DEBUG on.
+    "TOKEN": os.getenv("METRICS_TOKEN", ""),
+    # Celery workers serve their own /metrics on this port (0 disables).
+    "WORKER_PORT": int(os.getenv("METRICS_WORKER_PORT", "9808")),
+}
+
+PROFILING = {
+    "ENABLED": os.getenv("PROFILING_ENABLED", "true").lower() == "true",
+    # Requests carrying this header are profiled when the bearer token holds OPS_PROFILE.
+    "HEADER": "HTTP_X_PROFILE",
+    # Fraction of all requests profiled at random (0 disables sampling).
+    "SAMPLE_RATE": float(os.getenv("PROFILING_SAMPLE_RATE", "0")),
+    "INTERVAL_MS": float(os.getenv("PROFILING_INTERVAL_MS", "5")),
+    "MAX_DEPTH": int(os.getenv("PROFILING_MAX_DEPTH", "128")),
+    "MAX_SPANS": int(os.getenv("PROFILING_MAX_SPANS", "2000")),
+    "RETENTION_DAYS": int(os.getenv("PROFILING_RETENTION_DAYS", "7")),
+}
+
+RATE_LIMITS = {
+    "ENABLED": os.getenv("RATE_LIMITS_ENABLED", "true").lower() == "true",
+    # "<count>/<s|min|hour|day>" per principal, keyed by a view's rate_limit_scope or required_permission.
+    "RULES": {
+        "LOGIN": os.getenv("RATE_LIMIT_LOGIN", "10/min"),
+        "EMAIL_SEARCH": os.getenv("RATE_LIMIT_EMAIL_SEARCH", "60/min"),
+        "EXPORT_EMAIL": os.getenv("RATE_LIMIT_EXPORT_EMAIL", "20/hour"),
+        "EMAIL_VIEW": os.getenv("RATE_LIMIT_EMAIL_VIEW", "600/min"),
+    },
+    # Share of a bucket a process leases per Redis call, and how long it may spend the lease locally.
+    "LEASE_FRACTION": float(os.getenv("RATE_LIMIT_LEASE_FRACTION", "0.05")),
+    "LEASE_SECONDS": float(os.getenv("RATE_LIMIT_LEASE_SECONDS", "1")),
+    "MAX_LOCAL_LEASES": int(os.getenv("RATE_LIMIT_MAX_LOCAL_LEASES", "10000")),
+    "EXPORT_MAX_CONCURRENT": int(os.getenv("EXPORT_MAX_CONCURRENT", "2")),
+    # A slot whose export never finished (crashed worker) is reclaimed after this long.
+    "EXPORT_SLOT_SECONDS": int(os.getenv("EXPORT_SLOT_SECONDS", str(6 * 3600))),
+}
+
+PRINCIPAL_CACHE = {
+    # Caches the JWT principal (user row, roles, permission codes) per process and in Redis.
+    "ENABLED": os.getenv("PRINCIPAL_CACHE_ENABLED", "true").lower() == "true",
+    "LOCAL_MAX_ENTRIES": int(os.getenv("PRINCIPAL_CACHE_LOCAL_MAX_ENTRIES", "10000")),
+    "STATS_FLUSH_SECONDS": int(os.getenv("PRINCIPAL_CACHE_STATS_FLUSH_SECONDS", "10")),
+}
+
 MFA_SETTINGS = {
     "STEP_UP_ROLES": ["system_admin", "compliance_admin", "legal_user"],
     "REQUIRED_ACTIONS": {"EMAIL_SEARCH", "AUDIT_READ", "EXPORT_EMAIL"},
@@ -1,9 +1,11 @@
 from django.contrib import admin
 from django.urls import include, path
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
+from core.views import metrics_view
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
     path("api/schema/", SpectacularAPIView.as_view(), name="schema"),
     path(
         "api/docs/",
@@ -14,4 +16,5 @@ urlpatterns = [
     path("api/v1/archive/", include("archive.urls")),
     path("api/v1/search/", include("searchapp.urls")),
     path("api/v1/audit/", include("audit.urls")),
+    path("api/v1/ops/", include("core.urls")),
 ]
@@ -3,23 +3,32 @@ set -euo pipefail
 cmd=${1:-web}
 shift || true
 
+# Per-process metric files; stale files from a previous run would be summed in.
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus-multiproc}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 python manage.py migrate --noinput
 python manage.py check --deploy
 
 case "$cmd" in
   web)
     exec gunicorn mail_archive.wsgi:application \
+      --config python:mail_archive.gunicorn_conf \
       --bind 0.0.0.0:8000 \
       --workers ${GUNICORN_WORKERS:-4} \
       --threads ${GUNICORN_THREADS:-2} \
       --timeout ${GUNICORN_TIMEOUT:-120}
     ;;
   celery-worker)
-    exec celery -A mail_archive worker -l info
+    # Concurrency follows QUEUE_CONCURRENCY in mail_archive/celery.py for the queues served.
+    exec celery -A mail_archive worker -l info -Q "${CELERY_QUEUES:-default,ingest,indexing,export,integrity}"
     ;;
   celery-beat)
     exec celery -A mail_archive beat -l info
     ;;
+  smtp-journal)
+    exec python manage.py smtp_journal
+    ;;
   *)
     exec "$cmd" "$@"
     ;;
@@ -16,3 +16,17 @@ class SearchRequestSerializer(serializers.Serializer):
         if data["time_end"] < data["time_start"]:
             raise serializers.ValidationError("invalid_time_range")
         return data
+
+
+class CorrespondentRequestSerializer(serializers.Serializer):
+    address = serializers.EmailField()
+    # Restricts the result to one pair.
+    counterpart = serializers.EmailField(required=False)
+    time_start = serializers.DateTimeField()
+    time_end = serializers.DateTimeField()
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=200, default=20)
+
+    def validate(self, data):
+        if data["time_end"] < data["time_start"]:
+            raise serializers.ValidationError("invalid_time_range")
+        return data
@@ -1,6 +1,7 @@
 from django.urls import path
-from .views import EmailSearchView
+from .views import CorrespondentsView, EmailSearchView
 
 urlpatterns = [
     path("emails/", EmailSearchView.as_view(), name="email-search"),
+    path("correspondents/", CorrespondentsView.as_view(), name="correspondents"),
 ]
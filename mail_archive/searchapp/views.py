@@ -1,12 +1,22 @@
+import datetime as dt
+
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.conf import settings
-from archive.models import ArchivedEmail
+from django.db.models import F, Sum
+from django.utils import timezone
+from archive.correspondence import normalize
+from archive.models import Address, ArchivedEmail, CorrespondenceCount, MessageKey
+from archive.tiering import ColdStore
 from accounts.access import AccessService
 from audit.services import AuditService
+from core import metrics
+from core.partitioning import add_months, month_start
 from core.permissions import RBACPermission
+from core.replicas import replica_reads
 from core.search import get_client
-from .serializers import SearchRequestSerializer
+from core.timing import StageTimer
+from .serializers import CorrespondentRequestSerializer, SearchRequestSerializer
 
 
 class EmailSearchView(APIView):
@@ -19,7 +29,9 @@ class EmailSearchView(APIView):
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
         client = get_client()
-        tags = AccessService.resolve_tags(request.user, data)
+        timer = StageTimer()
+        with timer.stage("access"), replica_reads():
+            tags = AccessService.resolve_tags(request.user, data)
         must = []
         filters = [
             {"terms": {"access_tags": tags}},
@@ -42,15 +54,33 @@ class EmailSearchView(APIView):
                 }
             )
         query = {"bool": {"filter": filters, "must": must or [{"match_all": {}}]}}
-        resp = client.search(
-            index=settings.ELASTICSEARCH["INDEX"],
-            query=query,
-            from_=(data["page"] - 1) * data["size"],
-            size=data["size"],
-        )
+        with timer.stage("es"):
+            resp = client.search(
+                index=settings.ELASTICSEARCH["INDEX"],
+                query=query,
+                from_=(data["page"] - 1) * data["size"],
+                size=data["size"],
+            )
         ids = [int(hit["_id"]) for hit in resp["hits"]["hits"]]
-        emails = ArchivedEmail.objects.filter(id__in=ids)
-        email_map = {email.id: email for email in emails}
+        with timer.stage("db"), replica_reads():
+            # Thread ids come from MessageKey: a merge relabels the rows at once, the documents only later.
+            keys = {
+                key[0]: key
+                for key in MessageKey.objects.filter(email_id__in=ids).values_list(
+                    "email_id", "mailbox_id", "received_at", "thread_id"
+                )
+            }
+            # The time range lets MySQL read only the month partitions the hits can be in; the slack
+            # covers Elasticsearch's millisecond precision.
+            emails = ArchivedEmail.objects.filter(
+                id__in=ids,
+                received_at__gte=data["time_start"] - dt.timedelta(seconds=1),
+                received_at__lte=data["time_end"] + dt.timedelta(seconds=1),
+            ).select_related("mailbox")
+            email_map = {email.id: email for email in emails}
+            if missing := [keys[eid][:3] for eid in ids if eid not in email_map and eid in keys]:
+                # Hits whose month has moved to the cold tier.
+                email_map.update(ColdStore().get_many(missing))
         ordered = [email_map.get(eid) for eid in ids if email_map.get(eid)]
         results = [
             {
@@ -59,8 +89,92 @@ class EmailSearchView(APIView):
                 "mailbox": email.mailbox.address,
                 "received_at": email.received_at,
                 "sha256": email.sha256,
+                "thread_id": keys[email.id][3] if email.id in keys else None,
             }
             for email in ordered
         ]
-        AuditService.append(request.user, "EMAIL_SEARCH", data, result_count=resp["hits"]["total"]["value"])
-        return Response({"results": results, "total": resp["hits"]["total"]["value"]})
+        with timer.stage("audit"):
+            AuditService.append(request.user, "EMAIL_SEARCH", data, result_count=resp["hits"]["total"]["value"])
+        metrics.observe_stages("search", timer)
+        return Response(
+            {"results": results, "total": resp["hits"]["total"]["value"]},
+            headers={"Server-Timing": timer.server_timing()},
+        )
+
+
+class CorrespondentsView(APIView):
+    """Top counterparts of an address with their monthly timelines, from `CorrespondenceCount`.
+
+    Counts cover whole UTC months and the archived copies in the mailboxes the
+    caller may read; a message archived in two of them counts twice.
+    """
+
+    permission_classes = [RBACPermission]
+    required_permission = "EMAIL_SEARCH"
+    require_mfa = True
+
+    def get(self, request):
+        serializer = CorrespondentRequestSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        first = month_start(data["time_start"].astimezone(dt.timezone.utc).date())
+        last = month_start(data["time_end"].astimezone(dt.timezone.utc).date())
+        timer = StageTimer()
+        with timer.stage("access"), replica_reads():
+            # The counts cannot be split within a month, so the time scope must cover the whole months.
+            AccessService.ensure_time_scope(
+                request.user, dt.datetime.combine(first, dt.time.min, tzinfo=dt.timezone.utc)
+            )
+            AccessService.ensure_time_scope(
+                request.user,
+                min(
+                    dt.datetime.combine(add_months(last, 1), dt.time.min, tzinfo=dt.timezone.utc)
+                    - dt.timedelta(microseconds=1),
+                    timezone.now(),
+                ),
+            )
+            scope = AccessService.mailbox_filter(request.user)
+        address = normalize(data["address"])
+        counterpart = normalize(data["counterpart"]) if data.get("counterpart") else None
+        results = []
+        with timer.stage("db"), replica_reads():
+            ids = dict(Address.objects.filter(address__in=[address, counterpart]).values_list("address", "id"))
+            if address in ids and (counterpart is None or counterpart in ids):
+                rows = CorrespondenceCount.objects.filter(scope, address_id=ids[address], month__range=(first, last))
+                if counterpart is not None:
+                    rows = rows.filter(counterpart_id=ids[counterpart])
+                top = list(
+                    rows.values("counterpart_id")
+                    .annotate(sent_total=Sum("sent"), received_total=Sum("received"))
+                    .annotate(total=F("sent_total") + F("received_total"))
+                    .order_by("-total", "counterpart_id")[: data["limit"]]
+                )
+                top_ids = [row["counterpart_id"] for row in top]
+                timelines = {counterpart_id: [] for counterpart_id in top_ids}
+                for row in (
+                    rows.filter(counterpart_id__in=top_ids)
+                    .values("counterpart_id", "month")
+                    .annotate(sent_total=Sum("sent"), received_total=Sum("received"))
+                    .order_by("counterpart_id", "month")
+                ):
+                    timelines[row["counterpart_id"]].append(
+                        {"month": f"{row['month']:%Y-%m}", "sent": row["sent_total"], "received": row["received_total"]}
+                    )
+                names = dict(Address.objects.filter(id__in=top_ids).values_list("id", "address"))
+                results = [
+                    {
+                        "address": names[row["counterpart_id"]],
+                        "sent": row["sent_total"],
+                        "received": row["received_total"],
+                        "total": row["total"],
+                        "timeline": timelines[row["counterpart_id"]],
+                    }
+                    for row in top
+                ]
+        with timer.stage("audit"):
+            AuditService.append(request.user, "CORRESPONDENT_SEARCH", data, result_count=len(results))
+        metrics.observe_stages("correspondents", timer)
+        return Response(
+            {"address": address, "counterparts": results},
+            headers={"Server-Timing": timer.server_timing()},
+        )